@@ -3,7 +3,8 @@ from backend.data_class.wmata.wmata_avl import WMATA_AVL
 from data_class import GTFS, MBTA_GTFS, WMATA_GTFS, AVL, MBTA_AVL
 from backend.shapes.base_shape import BaseShape
 from logger.backend_logger import getLogger
-from backend.metrics import Metric_Calculation, Metric_Aggregation, WMATA_Metric_Calculation, WMATA_Metric_Aggregation
+from backend.metrics import Metric_Calculation, Metric_Aggregation, Partitioned_Metric_Execution, WMATA_Metric_Calculation, WMATA_Metric_Aggregation
+from backend.metrics.execution_backend import get_execution_backend
 from data_class.rove_parameters import ROVE_params
 from helper_functions import read_shapes, write_to_frontend_config, string_is_date, string_is_month
 import argparse
@@ -21,6 +22,12 @@ DATA_OPTION = 'GTFS-AVL' # GTFS, GTFS-AVL
 
 SHAPE_GENERATION = True # True/False: whether to generate shapes
 METRIC_CAL_AGG = True # True/False: whether to run metric calculation and aggregation
+ROUTE_PARTITIONS = 0 # number of route partitions to calculate and aggregate metrics in, 0 to process all routes at once
+PARTITION_WORKERS = 1 # number of worker processes that calculate the metrics of route partitions in parallel
+LEAN = False # True/False: whether to release raw and intermediate data tables as soon as they are no longer needed
+EXECUTION_BACKEND = 'pandas' # pandas, polars: engine of the groupwise reductions of metric calculation and aggregation
+VERIFY_EXECUTION_BACKEND = False # True/False: whether to verify the results of the polars execution backend against pandas
+LEAN_DTYPES = False # True/False: whether to store the records and metrics tables in memory-lean dtypes
 
 # --------------------------------END PARAMETERS--------------------------------------
 
@@ -48,8 +55,21 @@ def __main__(args):
     "-no-sg" or "--no_shape_gen": don't perform shape generation. 
     "-ma" or "--metric_agg": perform metrics aggregation (default).
     "-no-ma" or "--no_metric_agg": don't perform metrics aggregation.
-    "-sig" or "--check_signal": check each shape segment and see if it intersects with a traffic signal. This operation may take some time.
+    "-sig" or "--check_signal": check each shape segment and see if it intersects with a traffic signal, and optionally overlay the 
+        background layers of the frontend config on the segments, see "overlay" in the backend config.
     "-no-sig" or "--no_check_signal": don't check whether shape segments intersect with traffic signals (default).
+    "-rp" or "--route_partitions": number of route partitions that metrics are calculated and aggregated in, one partition at a time, 
+        to bound memory usage for long analysis periods. Defaults to 0, i.e. all routes are processed at once.
+    "-pw" or "--partition_workers": number of worker processes that calculate the metrics of route partitions in parallel, when 
+        "--route_partitions" is given. Defaults to 1, i.e. one partition at a time.
+    "-lean" or "--lean": release the raw and validated GTFS and AVL data tables, and the AVL records once metrics are calculated, as soon 
+        as they are no longer needed, to reduce peak memory usage. Outputs are the same.
+    "-eb" or "--execution_backend": engine of the groupwise reductions of metric calculation and aggregation. Must be one of "pandas" (default) 
+        or "polars", which requires the polars package to be installed.
+    "-veb" or "--verify_execution_backend": execute every reduction of the "polars" execution backend with "pandas" as well, and raise an error 
+        if the results differ.
+    "-ldt" or "--lean_dtypes": store the records and metrics tables in memory-lean dtypes, i.e. categorical IDs, int32 times, small integer 
+        counts and float32 metrics, to reduce memory usage. Outputs are the same.
     :type args: _type_
     """
     if len(args) > 0:
@@ -70,6 +90,12 @@ def __main__(args):
         parser.add_argument("-sig", "--check_signal", action='store_true', required=False)
         parser.add_argument("-no-sig", "--no_check_signal", dest='check_signal', action='store_false', required=False)
         parser.set_defaults(check_signal=False)
+        parser.add_argument("-rp", "--route_partitions", type=int, default=0, required=False)
+        parser.add_argument("-pw", "--partition_workers", type=int, default=1, required=False)
+        parser.add_argument("-lean", "--lean", action='store_true', required=False)
+        parser.add_argument("-eb", "--execution_backend", type=str, default='pandas', required=False)
+        parser.add_argument("-veb", "--verify_execution_backend", action='store_true', required=False)
+        parser.add_argument("-ldt", "--lean_dtypes", action='store_true', required=False)
         args = parser.parse_args(args)
 
         agency = args.agency
@@ -83,6 +109,12 @@ def __main__(args):
         shape_gen = args.shape_gen
         metric_calc_agg = args.metric_agg
         check_signal = args.check_signal
+        route_partitions = args.route_partitions
+        partition_workers = args.partition_workers
+        lean = args.lean
+        execution_backend = args.execution_backend
+        verify_execution_backend = args.verify_execution_backend
+        lean_dtypes = args.lean_dtypes
 
         if not string_is_month(month) and (not string_is_date(start_date) or not string_is_date(end_date)):
             parser.error(f'-sd (--start_date) and -ed (--end_date) must be valid string dates (YYYY-MM-DD) '\
@@ -100,6 +132,12 @@ def __main__(args):
         shape_gen = SHAPE_GENERATION
         metric_calc_agg = METRIC_CAL_AGG
         check_signal = False
+        route_partitions = ROUTE_PARTITIONS
+        partition_workers = PARTITION_WORKERS
+        lean = LEAN
+        execution_backend = EXECUTION_BACKEND
+        verify_execution_backend = VERIFY_EXECUTION_BACKEND
+        lean_dtypes = LEAN_DTYPES
 
         if not string_is_month(month) and (not string_is_date(start_date) or not string_is_date(end_date)):
             logger.fatal(f'START_DATE and END_DATE must be valid string dates (YYYY-MM-DD) '\
@@ -119,6 +157,7 @@ def __main__(args):
             'backend_config': f'data/{agency}/config.json',
             'frontend_config': f'frontend/static/inputs/{agency}/config.json',
             'shapes': f'frontend/static/inputs/{agency}/shapes/bus-shapes{suffix}.json',
+            'osm': f'data/{agency}/osm/{agency}.osm',
             'signals': f'frontend/static/inputs/{agency}/backgroundlayers/{agency.lower()}_traffic_signals.geojson',
             'timepoint': f'data/{agency}/agency-specific/timepoints{suffix}.csv', 
             'fsn':  f'data/{agency}/agency-specific/dim_fsn_routes.csv',
@@ -131,19 +170,26 @@ def __main__(args):
             'timepoints': f'frontend/static/inputs/{agency}/timepoints/timepoints{suffix}.json',
             'stop_name_lookup': f'frontend/static/inputs/{agency}/lookup/lookup{suffix}.json',
             'metric_calculation_aggre': f'data/{agency}/metrics/METRICS{suffix}.p',
-            'metric_calculation_aggre_10min': f'data/{agency}/metrics/METRICS_10MIN{suffix}.p'
+            'metric_calculation_aggre_10min': f'data/{agency}/metrics/METRICS_10MIN{suffix}.p',
+            'partitions': f'data/{agency}/partitions/PARTITIONS{suffix}',
+            'shape_cache': f'data/{agency}/shapes/SEGMENT_CACHE_{agency}.sqlite',
+            'avl_quality_report': f'data/{agency}/avl/quality/AVL_QUALITY_REPORT{suffix}.csv',
+            'avl_quarantine': f'data/{agency}/avl/quality/AVL_QUARANTINE{suffix}.csv'
         }
 
     # -----store parameters-----
-    params = ROVE_params(agency, month, year, date_type, data_option, input_paths, output_paths, start_date, end_date)
+    params = ROVE_params(agency, month, year, date_type, data_option, input_paths, output_paths, start_date, end_date, 
+                            execution_backend, verify_execution_backend, lean_dtypes)
+    # fail before any data is processed if the execution backend is not available, e.g. polars is not installed
+    get_execution_backend(params)
 
     # ------GTFS data generation------
     if agency == 'MBTA':
-        bus_gtfs = MBTA_GTFS(params, mode='bus', shape_gen=shape_gen)
+        bus_gtfs = MBTA_GTFS(params, mode='bus', shape_gen=shape_gen, lean=lean)
     elif agency == 'WMATA':
-        bus_gtfs = WMATA_GTFS(params, mode='bus', shape_gen=shape_gen)
+        bus_gtfs = WMATA_GTFS(params, mode='bus', shape_gen=shape_gen, lean=lean)
     else:
-        bus_gtfs = GTFS(params, mode='bus', shape_gen=shape_gen)
+        bus_gtfs = GTFS(params, mode='bus', shape_gen=shape_gen, lean=lean)
     gtfs_records = bus_gtfs.records
 
 
@@ -159,21 +205,37 @@ def __main__(args):
         # ------AVL data generation------
         if 'AVL' in data_option:
             if agency == 'MBTA':
-                avl = MBTA_AVL(params, bus_gtfs)
+                avl = MBTA_AVL(params, bus_gtfs, lean=lean)
             elif agency == 'WMATA':
-                avl = WMATA_AVL(params, bus_gtfs)
+                avl = WMATA_AVL(params, bus_gtfs, lean=lean)
             else:
-                avl = AVL(params, bus_gtfs) 
-            avl_records = avl.records
+                avl = AVL(params, bus_gtfs, lean=lean)
         else:
-            avl_records = None
+            avl = None
 
-        if agency == 'WMATA':
-            metrics = WMATA_Metric_Calculation(shapes, gtfs_records, avl_records, params, bus_gtfs.raw_data['stops'])
-            agg = WMATA_Metric_Aggregation(metrics, params)
+        if route_partitions > 0:
+            if agency == 'WMATA':
+                agg = Partitioned_Metric_Execution(shapes, gtfs_records, avl, params, route_partitions, 
+                                                    WMATA_Metric_Calculation, WMATA_Metric_Aggregation, (bus_gtfs.stop_coords,), 
+                                                    workers=partition_workers)
+            else:
+                agg = Partitioned_Metric_Execution(shapes, gtfs_records, avl, params, route_partitions, workers=partition_workers)
         else:
-            metrics = Metric_Calculation(shapes, gtfs_records, avl_records, params)
-            agg = Metric_Aggregation(metrics, params)
+            avl_records = avl.records if avl is not None else None
+            if agency == 'WMATA':
+                metrics = WMATA_Metric_Calculation(shapes, gtfs_records, avl_records, params, bus_gtfs.stop_coords)
+            else:
+                metrics = Metric_Calculation(shapes, gtfs_records, avl_records, params)
+
+            if lean and avl is not None:
+                # metric calculation works on its own copy of the AVL records
+                avl.records = None
+                del avl_records
+
+            if agency == 'WMATA':
+                agg = WMATA_Metric_Aggregation(metrics, params)
+            else:
+                agg = Metric_Aggregation(metrics, params)
 
         write_to_frontend_config(agg.metrics_names, params.frontend_config, input_paths['frontend_config'])
 
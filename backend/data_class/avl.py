@@ -8,10 +8,11 @@ import time
 from tqdm import tqdm
 
 from backend.data_class.gtfs import GTFS
+from backend.data_class.gps_pings import GPS_Ping_Inference
 from backend.data_class.rove_parameters import ROVE_params
-from copy import deepcopy
 import json
-from backend.helper_functions import load_csv_to_dataframe, series_to_datetime, check_is_file, convert_stop_ids
+from backend.helper_functions import load_csv_to_dataframe, series_to_datetime, check_is_file, check_parent_dir, convert_stop_ids, \
+    to_lean_dtypes
 
 
 logger = logging.getLogger("backendLogger")
@@ -22,6 +23,11 @@ class AVL():
 
     :param rove_params: a rove_params object that stores information needed throughout the backend
     :type rove_params: ROVE_params
+    :param bus_gtfs: GTFS data object of the analyzed dates
+    :type bus_gtfs: GTFS
+    :param lean: whether to convert the raw and validated data tables in place instead of copying them, and release them once the 
+        records table is built, defaults to False
+    :type lean: bool, optional
     """
     
     #: Required columns and the data types that each column will be converted to in AVL data
@@ -43,7 +49,14 @@ class AVL():
 
     }
 
-    def __init__(self, rove_params:ROVE_params, bus_gtfs:GTFS):
+    #: Strategies for balancing passenger_on, passenger_off and passenger_load, see :py:meth:`.AVL.correct_passenger_load`.
+    LOAD_BALANCING_STRATEGIES = ['alightings', 'boardings', 'proportional']
+
+    #: Quality rules applied to AVL records in the order of their bits in the quality flags, see :py:meth:`.AVL.check_data_quality`.
+    QUALITY_RULES = ['duplicate', 'out_of_order', 'negative_dwell_time', 'negative_running_time', 'repeated_stop', 'over_capacity',
+                     'negative_passenger_count', 'missing_trip_key']
+
+    def __init__(self, rove_params:ROVE_params, bus_gtfs:GTFS, lean:bool=False):
         """Instantiate an AVL data class.
         """
 
@@ -55,6 +68,10 @@ class AVL():
 
         #: GTFS records table
         self.gtfs:GTFS = bus_gtfs
+
+        #: Whether the raw and validated data tables are converted in place and released once they are no longer needed, see parameter 
+        #: definition.
+        self.lean:bool = lean
         
                                                         
         logger.info(f'loading {alias} data')
@@ -82,31 +99,48 @@ class AVL():
                     continue
                 raw_avl = pd.concat([raw_avl, self.load_data(fpath)]) 
 
-        # Raw data read from the given path, see :py:meth:`.AVL.load_data` for details.
+        #: Raw data read from the given path, see :py:meth:`.AVL.load_data` for details. In lean mode, it is converted in place by 
+        #: validation and released once the validated data is available.
         self.raw_data:pd.DataFrame = raw_avl
 
         logger.info(f'validating {alias} data')
         #: Validated data, see :py:meth:`.AVL.validate_data` for details.
         self.validated_data:pd.DataFrame = self.validate_data()
+        if self.lean:
+            self.raw_data = None
+            logger.debug(f'released raw {alias} data')
 
         self.check_avl_gtfs_ids_match()
+        self.check_data_quality()
         #: AVL records table, see :py:meth:`.AVL.get_avl_records` for details.
         self.records:pd.DataFrame = self.get_avl_records()
 
         self.correct_passenger_load()
 
+        if self.lean:
+            self.validated_data = None
+            logger.debug(f'released validated {alias} data')
+
     def load_data(self, path: str) -> pd.DataFrame:
-        """Load in AVL data from the given path.
+        """Load in AVL data from the given path. If "avl_format" in backend_config is "gps_pings", the file contains raw vehicle 
+        GPS pings instead of stop-level records, and stop events are inferred from the pings, see :py:class:`.GPS_Ping_Inference`.
 
         :param path: file path to raw AVL data
         :type path: str
         :raises ValueError: raw AVL data file is empty
+        :raises ValueError: invalid avl_format in backend_config
         :return: dataframe of AVL data with all required columns
         :rtype: pd.DataFrame
         """
 
-        id_cols = [col for col, dtype in self.REQUIRED_COL_SPEC.items() if dtype == 'string']
-        raw_avl = load_csv_to_dataframe(path, id_cols=id_cols)
+        avl_format = self.rove_params.backend_config.get('avl_format', 'stop_events')
+        if avl_format == 'gps_pings':
+            raw_avl = GPS_Ping_Inference(self.rove_params, self.gtfs).load_stop_events(path)
+        elif avl_format == 'stop_events':
+            id_cols = [col for col, dtype in self.REQUIRED_COL_SPEC.items() if dtype == 'string']
+            raw_avl = load_csv_to_dataframe(path, id_cols=id_cols)
+        else:
+            raise ValueError(f"Invalid avl_format {avl_format}, must be one of: 'stop_events', 'gps_pings'.")
 
         if raw_avl.empty:
             logger.error(f'AVL data from {path} is empty.')
@@ -127,19 +161,22 @@ class AVL():
 
     def validate_data(self) -> pd.DataFrame:
         """Clean up raw data by converting column types to those listed in the spec. Convert dwell_time and stop_time columns 
-        to integer seconds if necessary. Filter to keep only AVL records of dates in the date_list in ROVE_params.
+        to integer seconds if necessary. Filter to keep only AVL records of dates in the date_list in ROVE_params. In lean mode, the 
+        raw data table is converted in place instead of being copied.
 
         :return: a dataframe of validated AVL data
         :rtype: pd.DataFrame
         """
 
-        data:pd.DataFrame = deepcopy(self.raw_data)
+        data:pd.DataFrame = self.raw_data if self.lean else self.raw_data.copy()
 
         data['dwell_time'] = self.convert_dwell_time(data['dwell_time'])
 
         data['stop_time'], data['svc_date'] = self.convert_stop_time(data['stop_time'])
 
-        data = deepcopy(data[data['svc_date'].isin(self.rove_params.date_list)])
+        in_date_list = data['svc_date'].isin(self.rove_params.date_list)
+        if not in_date_list.all():
+            data = data.loc[in_date_list].reset_index(drop=True)
 
         if data.empty:
             raise ValueError(f'AVL table is empty after filtering for dates in the date_list.')
@@ -148,19 +185,26 @@ class AVL():
             logger.info(f'loaded AVL data for {len(num_dates)} days')
 
         data_specs = {**self.REQUIRED_COL_SPEC, **self.OPTIONAL_COL_SPEC}
-        cols = list(data_specs.keys())
-        data[cols] = data[cols].astype(dtype=data_specs)
+        for col, dtype in data_specs.items():
+            if data[col].dtype != dtype:
+                data[col] = data[col].astype(dtype)
 
-        data = data.rename(columns={'route': 'route_id'})
+        data.rename(columns={'route': 'route_id'}, inplace=True)
 
         logger.info(f"AVL service date range: {data['svc_date'].min()} to {data['svc_date'].max()}, {data['svc_date'].nunique()} days in total")
                
         return data
     
     def check_avl_gtfs_ids_match(self):
+        """Check that stop_ids and trip_ids in the AVL data are consistent with those in the GTFS data. If the share of AVL trip_ids 
+        found in GTFS is lower than the "min_matched_share" in the "trip_matching" object of backend_config (by default, only when none 
+        of the trip_ids match), AVL trips are matched to GTFS trips instead, see :py:meth:`.AVL.match_trips_to_gtfs` for details.
+
+        :raises ValueError: none of the AVL stop_ids or trip_ids match with GTFS
+        """
         logger.debug(f'checking consistency of AVL and GTFS IDs')
-        gtfs_stop_ids_set = set(self.gtfs.validated_data['stops']['stop_id'])
-        gtfs_trip_ids_set = set(self.gtfs.validated_data['trips']['trip_id'])
+        gtfs_stop_ids_set = self.gtfs.stop_ids
+        gtfs_trip_ids_set = self.gtfs.trip_ids
 
         avl_stop_ids_set = set(self.validated_data['stop_id'])
         avl_trip_ids_set = set(self.validated_data['trip_id'])
@@ -174,10 +218,108 @@ class AVL():
         if len(matching_stop_ids) == 0:
             raise ValueError(f'None of stop_ids in the AVL data match with stop_ids in the GTFS data. Please '+\
                              'make sure stop_ids from both data sources match.')
+
+        matching_config = self.rove_params.backend_config.get('trip_matching', {})
+        min_matched_share = matching_config.get('min_matched_share', 0)
+        matched_share = len(matching_trip_ids) / max(len(avl_trip_ids_set), 1)
+        if matched_share <= min_matched_share and matching_config.get('enabled', True):
+            logger.warning(f'{round(matched_share * 100, 1)}% of AVL trip_ids match with GTFS trip_ids, '\
+                            f'matching AVL trips to GTFS trips by route, stops and start time instead.')
+            self.validated_data = self.match_trips_to_gtfs()
+            matching_trip_ids = gtfs_trip_ids_set & set(self.validated_data['trip_id'])
+
         if len(matching_trip_ids) == 0:
             raise ValueError(f'None of trip_ids in the AVL data match with trip_ids in the GTFS data. Please '+\
                              'make sure trip_ids from both data sources match.')
 
+    def match_trips_to_gtfs(self) -> pd.DataFrame:
+        """Assign each AVL trip (i.e. each trip_id on each svc_date) to the best matching GTFS trip and replace the AVL trip_id with the 
+        GTFS trip_id. Each AVL trip is first matched to the GTFS pattern of the same route with the most similar set of stops (Jaccard 
+        similarity), which also determines the direction. Then, among the GTFS trips of that pattern operating on the service date, 
+        the trip whose scheduled arrival at the first observed stop is nearest to the observed arrival is selected with a sorted 
+        as-of merge. If multiple AVL trips are assigned to the same GTFS trip on the same day, the one closest in time is kept.
+        Ties are resolved deterministically: patterns of the same similarity by pattern name, GTFS trips at the same time difference 
+        by the earlier scheduled arrival, and AVL trips at the same time difference by svc_date, route_id and trip_id.
+
+        Parameters are read from the "trip_matching" object of backend_config: "min_stop_similarity" (default 0.5) and 
+        "max_start_time_diff" in seconds (default 900). AVL records of unmatched trips are dropped. The matches are stored in 
+        :py:attr:`.AVL.trip_matches`.
+
+        :raises ValueError: max_start_time_diff is negative
+        :return: validated AVL data with trip_id replaced by the matched GTFS trip_id
+        :rtype: pd.DataFrame
+        """
+
+        start_time = time.time()
+        matching_config = self.rove_params.backend_config.get('trip_matching', {})
+        min_stop_similarity = matching_config.get('min_stop_similarity', 0.5)
+        # stop times are integer seconds, and the as-of merge requires a tolerance of the same type, e.g. not a float read from json
+        max_start_time_diff = int(matching_config.get('max_start_time_diff', 900))
+        if max_start_time_diff < 0:
+            raise ValueError(f'Invalid max_start_time_diff {max_start_time_diff}, must be non-negative.')
+
+        data = self.validated_data
+        trip_cols = ['svc_date', 'route_id', 'trip_id']
+        gtfs_records = self.gtfs.records
+
+        # similarity between the stops of each AVL trip and each GTFS pattern of the same route: Jaccard similarity of the sets of stops, 
+        # weighted by the share of consecutive shared stops that are visited in the same order as in the pattern
+        avl_stops = data[trip_cols + ['stop_id', 'stop_sequence', 'stop_time']].sort_values('stop_sequence')\
+                        .drop_duplicates(subset=trip_cols + ['stop_id'])
+        avl_stops['avl_stop_count'] = avl_stops.groupby(trip_cols)['stop_id'].transform('size')
+        pattern_stops = gtfs_records.groupby(['route_id', 'pattern', 'stop_id'], observed=True)['stop_sequence'].min()\
+                            .reset_index(name='pattern_stop_sequence')
+        pattern_stops['pattern_stop_count'] = pattern_stops.groupby('pattern')['stop_id'].transform('size')
+
+        shared_stops = avl_stops.merge(pattern_stops, on=['route_id', 'stop_id'], how='inner')\
+                            .sort_values(trip_cols + ['pattern', 'stop_sequence'])
+        shared_stops['in_order'] = shared_stops.groupby(trip_cols + ['pattern'], observed=True)['pattern_stop_sequence'].diff() > 0
+        similarity = shared_stops.groupby(trip_cols + ['pattern'], sort=False, observed=True)\
+                        .agg(shared=('stop_id', 'size'), in_order=('in_order', 'sum'), avl_stop_count=('avl_stop_count', 'first'), 
+                             pattern_stop_count=('pattern_stop_count', 'first')).reset_index()
+        order_agreement = (similarity['in_order'] / (similarity['shared'] - 1)).where(similarity['shared'] > 1, 1)
+        similarity['similarity'] = order_agreement * similarity['shared'] / \
+                        (similarity['avl_stop_count'] + similarity['pattern_stop_count'] - similarity['shared'])
+        # stable sort, so that of patterns with the same similarity, the first one by name is kept
+        best_patterns = similarity.sort_values('similarity', ascending=False, kind='mergesort').drop_duplicates(subset=trip_cols)
+        best_patterns = best_patterns.loc[best_patterns['similarity'] >= min_stop_similarity, trip_cols + ['pattern', 'similarity']]
+
+        # first observed stop of each AVL trip that belongs to the matched pattern, used as the anchor for the time lookup
+        anchors = shared_stops.merge(best_patterns, on=trip_cols + ['pattern'], how='inner')\
+                        .drop_duplicates(subset=trip_cols)[trip_cols + ['pattern', 'similarity', 'stop_id', 'stop_time']]
+
+        # scheduled arrivals of GTFS trips at the anchor stops on each service date
+        service_dates = pd.DataFrame([(svc_date, service_id) for svc_date, service_ids in self.gtfs.service_ids_by_date.items() \
+                                        for service_id in service_ids], columns=['svc_date', 'service_id'])
+        candidates = gtfs_records[['pattern', 'stop_id', 'trip_id', 'service_id', 'arrival_time']]\
+                        .merge(anchors[['pattern', 'stop_id']].drop_duplicates(), on=['pattern', 'stop_id'], how='inner')\
+                        .merge(service_dates, on='service_id', how='inner')\
+                        .rename(columns={'trip_id': 'gtfs_trip_id'})
+        candidates['svc_date'] = candidates['svc_date'].astype(anchors['svc_date'].dtype)
+        candidates['arrival_time'] = candidates['arrival_time'].astype(anchors['stop_time'].dtype)
+
+        matches = pd.merge_asof(anchors.sort_values('stop_time'), 
+                                candidates[['svc_date', 'pattern', 'stop_id', 'arrival_time', 'gtfs_trip_id']].sort_values('arrival_time'),
+                                left_on='stop_time', right_on='arrival_time', by=['svc_date', 'pattern', 'stop_id'], 
+                                direction='nearest', tolerance=max_start_time_diff)
+        matches = matches.dropna(subset=['gtfs_trip_id'])
+        matches['start_time_diff'] = (matches['stop_time'] - matches['arrival_time']).abs()
+        conflicts = matches.duplicated(subset=['svc_date', 'gtfs_trip_id']).sum()
+        matches = matches.sort_values(['start_time_diff'] + trip_cols).drop_duplicates(subset=['svc_date', 'gtfs_trip_id'])
+
+        #: Table of AVL trips matched to GTFS trips, see :py:meth:`.AVL.match_trips_to_gtfs` for details.
+        self.trip_matches:pd.DataFrame = matches[trip_cols + ['gtfs_trip_id', 'pattern', 'similarity', 'start_time_diff']]\
+                                            .sort_values(trip_cols).reset_index(drop=True)
+
+        total_trips = data[trip_cols].drop_duplicates().shape[0]
+        logger.debug(f'matched {self.trip_matches.shape[0]} out of {total_trips} AVL trips to GTFS trips ({conflicts} duplicate '\
+                        f'assignments resolved) in {round((time.time() - start_time), 2)} seconds')
+
+        data = data.merge(self.trip_matches[trip_cols + ['gtfs_trip_id']], on=trip_cols, how='inner')
+        data['trip_id'] = data['gtfs_trip_id'].astype('string')
+
+        return data.drop(columns=['gtfs_trip_id'])
+
     def convert_dwell_time(self, data:pd.Series) -> pd.Series:
         """Convert dwell times to integer seconds.
 
@@ -223,68 +365,269 @@ class AVL():
         return stop_time_total_seconds_converted, stop_time_date_converted
 
 
+    def check_data_quality(self):
+        """Apply all quality rules (see :py:attr:`.AVL.QUALITY_RULES`) to the validated data in a single vectorized pass. The validated
+        data is sorted by ['svc_date', 'route_id', 'trip_id', 'stop_sequence'] in place, so that the stop events of each trip are
+        contiguous, and each record is checked against its neighbors in the same trip:
+
+            - duplicate: same svc_date, route_id, trip_id and stop_sequence as an earlier record, only the first one is kept;
+            - out_of_order: stop_time earlier than that of a previous stop of the trip;
+            - negative_dwell_time: dwell_time below zero;
+            - negative_running_time: the next stop of the trip is reached before the bus departs from this stop;
+            - repeated_stop: same stop_id as the previous stop of the trip, i.e. a jump of zero distance;
+            - over_capacity: passenger_load over "max_load_factor" (default 3) times the seat_capacity;
+            - negative_passenger_count: passenger_on, passenger_off or passenger_load below zero;
+            - missing_trip_key: missing svc_date, route_id or trip_id, i.e. the record can't be assigned to a trip.
+
+        Duplicates and records with a missing trip key are checked first, and the other rules are applied to the remaining records 
+        only. Duplicates, records with a missing trip key and records that break a rule listed in "quarantine" of the "avl_quality" 
+        object of backend_config are removed from the validated data and stored in :py:attr:`.AVL.quarantine`, records that break 
+        other rules are only flagged. A per-trip summary of the trips with at least one flagged record is stored in 
+        :py:attr:`.AVL.quality_report`. If "avl_quality_report" or "avl_quarantine" are given in the output paths, the tables are 
+        also written to csv.
+
+        :raises ValueError: invalid quality rule in backend_config
+        """
+
+        logger.info(f'checking AVL data quality')
+        start_time = time.time()
+
+        quality_config = self.rove_params.backend_config.get('avl_quality', {})
+        always_quarantined = ['duplicate', 'missing_trip_key']
+        quarantine_rules = always_quarantined + [rule for rule in quality_config.get('quarantine', []) if rule not in always_quarantined]
+        max_load_factor = quality_config.get('max_load_factor', 3)
+        invalid_rules = set(quarantine_rules) - set(self.QUALITY_RULES)
+        if invalid_rules:
+            raise ValueError(f'Invalid AVL quality rules: {invalid_rules}, must be among: {self.QUALITY_RULES}.')
+
+        data = self.validated_data
+        trip_cols = ['svc_date', 'route_id', 'trip_id']
+        key_cols = trip_cols + ['stop_sequence']
+        data.sort_values(key_cols, kind='mergesort', inplace=True, ignore_index=True)
+
+        # trips are numbered by the changes of the sorted keys, each record with a missing key is a trip of its own
+        trip_codes = np.column_stack([pd.factorize(data[col])[0] for col in trip_cols])
+        missing_trip_key = (trip_codes < 0).any(axis=1)
+        same_trip = (trip_codes[1:] == trip_codes[:-1]).all(axis=1) & ~missing_trip_key[1:]
+        trip_group = np.cumsum(np.r_[0, ~same_trip])
+        stop_sequence = data['stop_sequence'].to_numpy()
+        flags = np.zeros(data.shape[0], dtype='int64')
+        duplicate = np.r_[False, same_trip & (stop_sequence[1:] == stop_sequence[:-1])]
+        flags[duplicate] = 1
+        flags[missing_trip_key] |= 1 << self.QUALITY_RULES.index('missing_trip_key')
+
+        # the other rules compare each record with its neighbors among the records that are not duplicates and have all trip keys
+        kept = np.flatnonzero(~duplicate & ~missing_trip_key)
+        kept_group = trip_group[kept]
+        has_previous = np.r_[False, kept_group[1:] == kept_group[:-1]]
+        has_next = np.r_[kept_group[1:] == kept_group[:-1], False]
+
+        stop_time = data['stop_time'].to_numpy(dtype='float64')[kept]
+        dwell_time = data['dwell_time'].to_numpy(dtype='float64')[kept]
+        stop_id = pd.factorize(data['stop_id'])[0][kept]
+        load = data['passenger_load'].to_numpy()[kept]
+        seat_capacity = data['seat_capacity'].to_numpy()[kept]
+
+        previous_max_time = np.r_[-np.inf, pd.Series(stop_time).groupby(kept_group).cummax().to_numpy()[:-1]]
+        next_stop_time = np.r_[stop_time[1:], np.inf]
+        rule_results = {
+            'out_of_order': has_previous & (stop_time < previous_max_time),
+            'negative_dwell_time': dwell_time < 0,
+            'negative_running_time': has_next & (next_stop_time - stop_time - np.nan_to_num(dwell_time) < 0),
+            'repeated_stop': has_previous & np.r_[False, stop_id[1:] == stop_id[:-1]],
+            'over_capacity': (seat_capacity > 0) & (load > seat_capacity * max_load_factor),
+            'negative_passenger_count': (load < 0) | (data['passenger_on'].to_numpy()[kept] < 0) | \
+                                            (data['passenger_off'].to_numpy()[kept] < 0)
+        }
+        for rule, broken in rule_results.items():
+            flags[kept[broken]] |= 1 << self.QUALITY_RULES.index(rule)
+
+        quarantine_mask = sum(1 << self.QUALITY_RULES.index(rule) for rule in quarantine_rules)
+        quarantined = (flags & quarantine_mask) != 0
+
+        # compact per-trip summary of the trips with flagged records
+        flagged = flags != 0
+        trip_records = np.bincount(trip_group)
+        report = pd.DataFrame({rule: (flags[flagged] >> bit) & 1 for bit, rule in enumerate(self.QUALITY_RULES)})
+        report['quarantined'] = quarantined[flagged]
+        report['trip_group'] = trip_group[flagged]
+        report = report.groupby('trip_group').sum()
+        report.insert(0, 'records', trip_records[report.index])
+        trip_keys = data.loc[np.r_[True, ~same_trip], trip_cols].reset_index(drop=True)
+        #: Per-trip summary of AVL quality rules, with the number of records of the trip that break each rule, 
+        #: see :py:meth:`.AVL.check_data_quality` for details.
+        self.quality_report:pd.DataFrame = pd.concat([trip_keys.loc[report.index].reset_index(drop=True), 
+                                                        report.reset_index(drop=True)], axis=1)
+
+        flag_names = {flag: ','.join(rule for bit, rule in enumerate(self.QUALITY_RULES) if flag >> bit & 1) \
+                        for flag in np.unique(flags[quarantined])}
+        #: AVL records removed by quality rules, with the rules that each record breaks in the quality_issues column,
+        #: see :py:meth:`.AVL.check_data_quality` for details.
+        self.quarantine:pd.DataFrame = data.loc[quarantined].reset_index(drop=True)
+        self.quarantine['quality_issues'] = pd.Series(flags[quarantined]).map(flag_names)
+
+        if quarantined.any():
+            data.drop(index=np.flatnonzero(quarantined), inplace=True)
+            data.reset_index(drop=True, inplace=True)
+
+        output_paths = self.rove_params.output_paths
+        if output_paths.get('avl_quality_report'):
+            self.quality_report.to_csv(check_parent_dir(output_paths['avl_quality_report']), index=False)
+        if output_paths.get('avl_quarantine'):
+            self.quarantine.to_csv(check_parent_dir(output_paths['avl_quarantine']), index=False)
+
+        rule_counts = {rule: int(count) for rule, count in self.quality_report[self.QUALITY_RULES].sum().items() if count > 0}
+        logger.debug(f'flagged AVL records by rule: {rule_counts}; quarantined {quarantined.sum()} out of {len(flags)} records '\
+                        f'(rules: {quarantine_rules})')
+        logger.debug(f'finished checking AVL data quality in {round((time.time() - start_time), 2)} seconds')
+
     def get_avl_records(self) -> pd.DataFrame:
-        """Return a dataframe that is the validated AVL table. Values are sorted by ['svc_date', 'route_id', 'trip_id', 'stop_sequence'], 
-        and only unique rows of each combination of ['svc_date', 'route_id', 'trip_id', 'stop_sequence'] columns are kept.
+        """Return a dataframe that is the validated AVL table, with the start and end time of each trip added. Values are sorted by 
+        ['svc_date', 'route_id', 'trip_id', 'stop_sequence'], and only unique rows of each combination of 
+        ['svc_date', 'route_id', 'trip_id', 'stop_sequence'] columns are kept, see :py:meth:`.AVL.check_data_quality`. The columns 
+        are added to a copy of the validated table, or to the validated table in place in lean mode. If lean_dtypes is set in 
+        ROVE_params, the table is stored in memory-lean dtypes, see :py:func:`.to_lean_dtypes`. Trip and stop IDs stay strings, as in 
+        the GTFS records table.
 
         :return: dataframe containing validated and sorted AVL data
         :rtype: pd.DataFrame
         """
 
-        avl_df:pd.DataFrame = deepcopy(self.validated_data)
+        avl_df:pd.DataFrame = self.validated_data if self.lean else self.validated_data.copy()
 
-        avl_df = avl_df.sort_values(['svc_date', 'route_id', 'trip_id', 'stop_sequence'])\
-                        .drop_duplicates(['svc_date', 'route_id', 'trip_id', 'stop_sequence'])\
-                        .reset_index(drop=True)
+        trip_stop_times = avl_df.groupby(by=['svc_date', 'trip_id'])['stop_time']
+        avl_df['trip_start_time'] = trip_stop_times.transform('min')
+        avl_df['trip_end_time'] = trip_stop_times.transform('max')
 
-        avl_df['trip_start_time'] = avl_df.groupby(by=['svc_date', 'trip_id'])['stop_time'].transform('min')
-        avl_df['trip_end_time'] = avl_df.groupby(by=['svc_date', 'trip_id'])['stop_time'].transform('max')
+        if self.rove_params.lean_dtypes:
+            to_lean_dtypes(avl_df, exclude=['trip_id', 'stop_id'])
 
         return avl_df
     
+
     def correct_passenger_load(self):
         """Enforce that no one alights at the first stop or boards at the last stop, and make sure the passenger_on, passenger_off and
-        passenger_load values of each trip add up.
+        passenger_load values of each trip add up, i.e. passenger_load at a stop equals the load at the previous stop plus passenger_on
+        minus passenger_off, the load never drops below zero, and everyone alights at the last stop. All trips are corrected at once
+        using grouped cumulative operations. Where the cumulative load would turn negative, the balancing strategy specified in the
+        "passenger_load_correction" object of backend_config (see :py:attr:`.LOAD_BALANCING_STRATEGIES`) decides how boardings and
+        alightings are adjusted:
+
+            - alightings (default): reduce alightings at the stops where the load would become negative;
+            - boardings: add boardings at the stops where the load would become negative;
+            - proportional: scale down all alightings of the trip by the largest factor that keeps the load non-negative, repeated 
+              for at most "max_iterations" rounds to absorb rounding, and any remaining negative load is resolved as in "alightings".
+
+        A per-trip summary of the corrections is stored in :py:attr:`.AVL.load_correction_report`.
+
+        :raises ValueError: invalid balancing strategy in backend_config
         """
+
         logger.info(f'correcting passenger load')
+        start_time = time.time()
+
+        correction_config = self.rove_params.backend_config.get('passenger_load_correction', {})
+        strategy = correction_config.get('strategy', 'alightings')
+        max_iterations = correction_config.get('max_iterations', 10)
+        if strategy not in self.LOAD_BALANCING_STRATEGIES:
+            raise ValueError(f'Invalid passenger load correction strategy: {strategy}, must be one of: {self.LOAD_BALANCING_STRATEGIES}.')
+
         records = self.records
+        trip_cols = ['svc_date', 'route_id', 'trip_id']
 
-        p = deepcopy(records)
+        # records are sorted by trip and stop_sequence (see get_avl_records), so the stop events of each trip are contiguous
+        trip_group = records.groupby(trip_cols, sort=False, observed=True).ngroup().to_numpy()
+        is_head = np.r_[True, trip_group[1:] != trip_group[:-1]]
+        is_tail = np.r_[trip_group[1:] != trip_group[:-1], True]
 
+        raw_on = records['passenger_on'].to_numpy(dtype='float64')
+        raw_off = records['passenger_off'].to_numpy(dtype='float64')
+        on = raw_on.copy()
+        off = raw_off.copy()
 
-        start_time = time.time()
-        
         # enforce that no one alights at the first stop or boards at the last stop
-        head_indices = p.groupby(['svc_date', 'route_id', 'trip_id']).head(1).index
-        tail_indices = p.groupby(['svc_date', 'route_id', 'trip_id']).tail(1).index
-
-        p.loc[head_indices, 'passenger_off'] = 0
-        p.loc[tail_indices, 'passenger_on'] = 0
-        # p['passenger_delta'] = p['passenger_on'] - p['passenger_off']
+        off[is_head] = 0
+        on[is_tail] = 0
+        # passengers still on board before the last stop are not known yet, exclude the last alighting from balancing
+        off[is_tail] = 0
+
+        raw_negative_load = self.__grouped_cumsum(raw_on - raw_off, trip_group) < 0
+
+        if strategy == 'proportional':
+            for _ in range(max_iterations):
+                if not (self.__grouped_cumsum(on - off, trip_group) < 0).any():
+                    break
+                # largest factor f per trip such that f * cumulative alightings <= cumulative boardings at every stop
+                cum_on = self.__grouped_cumsum(on, trip_group)
+                cum_off = self.__grouped_cumsum(off, trip_group)
+                ratio = np.divide(cum_on, cum_off, out=np.ones_like(cum_on), where=cum_off > 0)
+                factor = pd.Series(ratio).groupby(trip_group).transform('min').clip(upper=1).to_numpy()
+                off = np.floor(off * factor)
+
+        # closed form of load_i = max(0, load_i-1 + on_i - off_i): the shortfall at each stop is the drop of the running minimum 
+        # of the unconstrained cumulative load (floored at 0)
+        unconstrained_load = self.__grouped_cumsum(on - off, trip_group)
+        running_min = pd.Series(np.minimum(unconstrained_load, 0)).groupby(trip_group).cummin().to_numpy()
+        previous_running_min = np.where(is_head, 0, np.r_[0, running_min[:-1]])
+        shortfall = previous_running_min - running_min
+
+        if strategy == 'boardings':
+            on = on + shortfall
+        else:
+            off = off - shortfall
+
+        load = self.__grouped_cumsum(on - off, trip_group)
+        # everyone alights at the last stop
+        off[is_tail] = np.where(is_head, 0, np.r_[0, load[:-1]])[is_tail]
+        load[is_tail] = 0
+
+        report = pd.DataFrame({
+            'trip_group': trip_group,
+            'stops': 1,
+            'raw_boardings': raw_on,
+            'raw_alightings': raw_off,
+            'boardings': on,
+            'alightings': off,
+            'boardings_added': np.clip(on - raw_on, 0, None),
+            'boardings_removed': np.clip(raw_on - on, 0, None),
+            'alightings_added': np.clip(off - raw_off, 0, None),
+            'alightings_removed': np.clip(raw_off - off, 0, None),
+            'stops_corrected': (on != raw_on) | (off != raw_off),
+            'raw_negative_load_stops': raw_negative_load,
+            'raw_max_load': records['passenger_load'].to_numpy(),
+            'max_load': load
+        }).groupby('trip_group').agg({
+            'stops': 'sum', 'raw_boardings': 'sum', 'raw_alightings': 'sum', 'boardings': 'sum', 'alightings': 'sum',
+            'boardings_added': 'sum', 'boardings_removed': 'sum', 'alightings_added': 'sum', 'alightings_removed': 'sum',
+            'stops_corrected': 'sum', 'raw_negative_load_stops': 'sum', 'raw_max_load': 'max', 'max_load': 'max'
+        })
+        trip_keys = records.loc[is_head, trip_cols].reset_index(drop=True)
+        #: Per-trip summary of the passenger load correction, see :py:meth:`.AVL.correct_passenger_load` for details.
+        self.load_correction_report:pd.DataFrame = pd.concat([trip_keys, report.reset_index(drop=True)], axis=1)
+
+        records['passenger_on'] = on.round().astype('int64')
+        records['passenger_off'] = off.round().astype('int64')
+        records['passenger_load'] = load.round().astype('int64')
+        if self.rove_params.lean_dtypes:
+            to_lean_dtypes(records, columns=['passenger_on', 'passenger_off', 'passenger_load'])
+
+        corrected_trips = (self.load_correction_report['stops_corrected'] > 0).sum()
+        logger.debug(f'passenger load corrected with the {strategy} strategy for {corrected_trips} out of '\
+                        f'{self.load_correction_report.shape[0]} trips')
+        logger.debug(f'finished correcting passenger load in {round((time.time() - start_time), 2)} seconds')
 
-        # p['passenger_load'] = p.groupby(['svc_date', 'route_id', 'trip_id'])['passenger_delta'].cumsum()
-        # p.loc[tail_indices, 'passenger_off'] = p.loc[tail_indices, 'passenger_load']
-        # p['passenger_delta'] = p['passenger_on'] - p['passenger_off']
+    def __grouped_cumsum(self, values:np.ndarray, trip_group:np.ndarray) -> np.ndarray:
+        """Cumulative sum of values within each trip, where the records of each trip are contiguous.
 
-        # p['reset'] = (p['passenger_load']<0).astype(int)
-        
-        # logger.info(f'correcting passenger load')
-        # while 1 in p['reset'].unique():
-            
-        #     reset_row_index = p[p['reset']==1].first_valid_index()
-        #     if reset_row_index in tail_indices:
-        #         p.loc[reset_row_index, 'passenger_off'] = p.loc[reset_row_index, 'passenger_load']
-        #         p.loc[reset_row_index, 'passenger_delta'] = -p.loc[reset_row_index, 'passenger_off']
-        #     else:
-        #         p.loc[reset_row_index, 'passenger_off'] = p.loc[reset_row_index-1, 'passenger_load'] \
-        #                                                     + p.loc[reset_row_index, 'passenger_on']
-        #         p.loc[reset_row_index, 'passenger_delta'] = -p.loc[reset_row_index-1, 'passenger_load']
-        #     p['passenger_load'] = p.groupby(['svc_date', 'route_id', 'trip_id'])['passenger_delta'].cumsum()
-
-        #     p['reset'] = (p['passenger_load']<0).astype(int)
-
-        # p.loc[tail_indices, 'passenger_off'] = p.loc[tail_indices, 'passenger_load']
-        # p.loc[tail_indices, 'passenger_delta'] = -p.loc[tail_indices, 'passenger_off']
+        :param values: array of values of each stop event
+        :type values: np.ndarray
+        :param trip_group: array of trip group numbers of each stop event
+        :type trip_group: np.ndarray
+        :return: array of cumulative sums that restart at the first stop event of each trip
+        :rtype: np.ndarray
+        """
 
-        logger.debug(f'finished correcting passenger load in {round((time.time() - start_time), 2)} seconds')
-        records[['passenger_off', 'passenger_load']] = p[['passenger_off', 'passenger_load']]
+        cumsum = np.cumsum(values)
+        head_positions = np.flatnonzero(np.r_[True, trip_group[1:] != trip_group[:-1]])
+        offsets = cumsum[head_positions] - values[head_positions]
+        return cumsum - np.repeat(offsets, np.diff(np.r_[head_positions, len(values)]))
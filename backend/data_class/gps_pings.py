@@ -0,0 +1,340 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Dict, List, Tuple
+import logging
+import os
+import time
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from backend.data_class.gtfs import GTFS
+from backend.data_class.rove_parameters import ROVE_params
+from backend.helper_functions import check_is_file
+
+logger = logging.getLogger("backendLogger")
+
+EARTH_RADIUS_M = 6371008.8
+#: Offset in meters between the along-pattern positions of consecutive trip runs, larger than the length of any pattern, so that
+#: the positions of all runs can be searched as one sorted array.
+RUN_POSITION_OFFSET = 1e8
+
+
+class GPS_Ping_Inference():
+    """Infer stop-level AVL records from raw vehicle GPS pings. Each ping is projected onto the geometry of the GTFS pattern of its trip,
+    then the arrival and departure times at each stop of the pattern are detected from the projected positions, all with vectorized
+    operations. Chunks of trips are processed in parallel. The output has the columns of :py:attr:`.AVL.REQUIRED_COL_SPEC`, so that it
+    can be validated and processed like stop-level AVL data.
+
+    Parameters are read from the "gps_pings" object of backend_config:
+
+        - arrival_radius: distance in meters within which a vehicle is considered to be at a stop, defaults to 30
+        - max_offset: pings further away from the pattern than this distance in meters are discarded, defaults to 50
+        - densify_spacing: spacing in meters of the points along the pattern geometry that pings are snapped to, defaults to 5
+        - max_trip_gap: time in seconds between two pings of the same trip_id after which they are treated as separate runs
+          of the trip (e.g. on different days), defaults to 10800
+        - seat_capacity: seat capacity of the vehicles, defaults to 0 since pings carry no passenger counts
+        - workers: number of worker processes, defaults to the number of CPUs
+        - chunk_size: approximate number of pings processed by a worker at a time, defaults to 1000000
+
+    :param rove_params: a rove_params object that stores information needed throughout the backend
+    :type rove_params: ROVE_params
+    :param bus_gtfs: GTFS data object, whose records table and patterns_dict provide the trip patterns and their geometry
+    :type bus_gtfs: GTFS
+    """
+
+    #: Required columns and the data types that each column will be converted to in GPS ping data. Timestamps are either
+    #: date-time strings in local time or numeric epoch seconds.
+    REQUIRED_COL_SPEC = {
+        'route': 'string',
+        'trip_id': 'string',
+        'timestamp': 'object',
+        'lat': 'float64',
+        'lon': 'float64'
+    }
+
+    def __init__(self, rove_params:ROVE_params, bus_gtfs:GTFS):
+
+        self.rove_params:ROVE_params = rove_params
+        self.gtfs:GTFS = bus_gtfs
+
+        ping_config = rove_params.backend_config.get('gps_pings', {})
+        self.arrival_radius:float = ping_config.get('arrival_radius', 30)
+        self.max_offset:float = ping_config.get('max_offset', 50)
+        self.densify_spacing:float = ping_config.get('densify_spacing', 5)
+        self.max_trip_gap:int = ping_config.get('max_trip_gap', 10800)
+        self.seat_capacity:int = ping_config.get('seat_capacity', 0)
+        self.workers:int = ping_config.get('workers', os.cpu_count() or 1)
+        self.chunk_size:int = ping_config.get('chunk_size', 1000000)
+
+    def load_stop_events(self, path:str) -> pd.DataFrame:
+        """Load GPS pings from the given path and infer stop events.
+
+        :param path: file path to raw GPS ping data
+        :type path: str
+        :return: dataframe of stop events with all required columns of AVL data
+        :rtype: pd.DataFrame
+        """
+
+        pings = self.load_pings(path)
+        return self.infer_stop_events(pings)
+
+    def load_pings(self, path:str) -> pd.DataFrame:
+        """Load GPS pings from the given csv path, converting timestamps to integer seconds.
+
+        :param path: file path to raw GPS ping data
+        :type path: str
+        :return: dataframe of GPS pings with columns route, trip_id, timestamp (integer seconds), lat and lon
+        :rtype: pd.DataFrame
+        """
+
+        in_path = check_is_file(path, '.csv')
+        dtypes = {col: ('str' if dtype == 'string' else dtype) for col, dtype in self.REQUIRED_COL_SPEC.items()}
+        pings = pd.read_csv(in_path, usecols=lambda col: col.lower() in dtypes)
+        pings.columns = pings.columns.str.lower()
+
+        if not set(self.REQUIRED_COL_SPEC.keys()).issubset(pings.columns):
+            missing_columns = set(self.REQUIRED_COL_SPEC.keys()) - set(pings.columns)
+            logger.fatal(f'GPS ping data is missing required columns: {missing_columns}.', exc_info=True)
+            quit()
+
+        pings = pings.dropna(subset=list(self.REQUIRED_COL_SPEC.keys())).astype(dtypes)
+        pings['timestamp'] = self.convert_timestamp(pings['timestamp'])
+        logger.info(f'loaded {pings.shape[0]} GPS pings from {path}')
+
+        return pings
+
+    def convert_timestamp(self, data:pd.Series) -> pd.Series:
+        """Convert ping timestamps to integer seconds of local time since the epoch. Numeric timestamps are taken as epoch seconds
+        and converted to local time with the "timezone" of the "gps_pings" object in backend_config, if given.
+
+        :param data: the column of ping timestamps
+        :type data: pd.Series
+        :return: column of timestamps in integer seconds
+        :rtype: pd.Series
+        """
+
+        numeric_timestamps = pd.to_numeric(data, errors='coerce')
+        if numeric_timestamps.notna().all():
+            timezone = self.rove_params.backend_config.get('gps_pings', {}).get('timezone')
+            if timezone is None:
+                return numeric_timestamps.astype('int64')
+            timestamps = pd.to_datetime(numeric_timestamps, unit='s', utc=True).dt.tz_convert(timezone).dt.tz_localize(None)
+        else:
+            timestamps = pd.to_datetime(data, infer_datetime_format=True, cache=True)
+
+        return (timestamps - pd.Timestamp(0)) // pd.Timedelta(seconds=1)
+
+    def infer_stop_events(self, pings:pd.DataFrame) -> pd.DataFrame:
+        """Infer stop events from GPS pings. Pings are grouped into runs of each trip_id (consecutive pings of a trip_id no more than
+        max_trip_gap apart). Pings of trips that are not found in the GTFS data are dropped.
+
+        :param pings: dataframe of GPS pings, see :py:meth:`load_pings`
+        :type pings: pd.DataFrame
+        :raises ValueError: none of the ping trip_ids match with GTFS trip_ids
+        :return: dataframe of stop events with all required columns of AVL data
+        :rtype: pd.DataFrame
+        """
+
+        logger.info(f'inferring stop events from GPS pings')
+        start_time = time.time()
+
+        # look up patterns on the unique trip_ids, and work with integer codes of trips and patterns instead of strings
+        trip_codes, trip_ids = pd.factorize(pings['trip_id'])
+        trip_patterns = self.gtfs.records[['trip_id', 'pattern']].drop_duplicates(subset=['trip_id']).set_index('trip_id')['pattern']
+        pattern_codes, patterns = pd.factorize(trip_patterns.reindex(trip_ids))
+        ping_pattern_codes = pattern_codes[trip_codes]
+
+        unmatched_pings = ping_pattern_codes == -1
+        if unmatched_pings.all():
+            raise ValueError(f'None of trip_ids in the GPS ping data match with trip_ids in the GTFS data.')
+        if unmatched_pings.any():
+            logger.warning(f'dropped {unmatched_pings.sum()} GPS pings of {(pattern_codes == -1).sum()} trips not found in GTFS')
+
+        # runs of each trip, sorted by pattern so that each chunk needs the geometry of few patterns
+        timestamps = pings['timestamp'].to_numpy()
+        order = np.lexsort((timestamps, trip_codes, ping_pattern_codes))
+        order = order[~unmatched_pings[order]]
+        pings = pings.take(order).reset_index(drop=True)
+        pings['pattern'] = patterns[ping_pattern_codes[order]]
+        trip_codes = trip_codes[order]
+        timestamps = timestamps[order]
+        new_run = np.r_[True, (trip_codes[1:] != trip_codes[:-1]) | (np.diff(timestamps) > self.max_trip_gap)]
+        pings['run'] = np.cumsum(new_run)
+
+        geometries = {pattern: pattern_geometry(self.gtfs.patterns_dict[pattern], self.densify_spacing) \
+                        for pattern in pings['pattern'].unique()}
+
+        chunks = self.__split_into_chunks(pings, np.flatnonzero(new_run))
+        chunk_geometries = [{pattern: geometries[pattern] for pattern in chunk['pattern'].unique()} for chunk in chunks]
+        settings = (self.arrival_radius, self.max_offset)
+
+        if self.workers > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(max_workers=min(self.workers, len(chunks))) as executor:
+                stop_events = list(executor.map(infer_chunk_stop_events, chunks, chunk_geometries, repeat(settings)))
+        else:
+            stop_events = [infer_chunk_stop_events(chunk, geometry, settings) for chunk, geometry in zip(chunks, chunk_geometries)]
+
+        stop_events = pd.concat(stop_events, ignore_index=True)
+        stop_events['stop_time'] = pd.to_datetime(stop_events['stop_time'].round(), unit='s')
+        stop_events['passenger_load'] = 0
+        stop_events['passenger_on'] = 0
+        stop_events['passenger_off'] = 0
+        stop_events['seat_capacity'] = self.seat_capacity
+
+        logger.debug(f'inferred {stop_events.shape[0]} stop events from {pings.shape[0]} GPS pings of {pings["run"].iloc[-1]} trip runs '\
+                        f'in {round((time.time() - start_time), 2)} seconds')
+
+        return stop_events
+
+    def __split_into_chunks(self, pings:pd.DataFrame, run_starts:np.ndarray) -> List[pd.DataFrame]:
+        """Split pings into chunks of about chunk_size pings without splitting any run.
+        """
+
+        # the first run starting at or after each multiple of chunk_size, if any
+        first_runs = np.searchsorted(run_starts, np.arange(0, pings.shape[0], self.chunk_size), side='left')
+        chunk_starts = np.unique(run_starts[first_runs[first_runs < len(run_starts)]])
+        chunk_ends = np.r_[chunk_starts[1:], pings.shape[0]]
+
+        return [pings.iloc[start:end] for start, end in zip(chunk_starts, chunk_ends)]
+
+
+def project_coordinates(lat:np.ndarray, lon:np.ndarray, ref_lat:float) -> np.ndarray:
+    """Project coordinates to planar x, y coordinates in meters with an equirectangular projection centered at ref_lat.
+
+    :return: array of shape (n, 2)
+    :rtype: np.ndarray
+    """
+
+    return np.column_stack([EARTH_RADIUS_M * np.radians(lon) * np.cos(np.radians(ref_lat)), EARTH_RADIUS_M * np.radians(lat)])
+
+
+def pattern_geometry(segments:Dict[Tuple, List], spacing:float) -> Dict:
+    """Build the geometry of a pattern used to snap GPS pings: points along the pattern every spacing meters (at most), their
+    distance along the pattern, and the distance along the pattern of each stop.
+
+    :param segments: segment dict of a pattern from :py:attr:`.GTFS.patterns_dict`, whose keys are stop pairs in order and values
+        are lists of (lat, lon) coordinates
+    :type segments: Dict[Tuple, List]
+    :param spacing: maximum spacing in meters between points along the pattern
+    :type spacing: float
+    :return: dict with keys ref_lat, points, positions, stop_ids and stop_positions
+    :rtype: Dict
+    """
+
+    stop_ids = [stop_pair[0] for stop_pair in segments.keys()] + [list(segments.keys())[-1][1]]
+    coords = [np.asarray(coord_list, dtype='float64') for coord_list in segments.values()]
+    ref_lat = float(np.mean(np.concatenate(coords)[:, 0]))
+
+    # vertices of all segments in order, the first vertex of each segment being the stop shared with the previous segment
+    vertices = project_coordinates(coords[0][:1, 0], coords[0][:1, 1], ref_lat)
+    stop_vertex_index = [0]
+    for coord_list in coords:
+        vertices = np.vstack([vertices, project_coordinates(coord_list[1:, 0], coord_list[1:, 1], ref_lat)])
+        stop_vertex_index.append(vertices.shape[0] - 1)
+
+    edge_lengths = np.hypot(*np.diff(vertices, axis=0).T)
+    vertex_positions = np.r_[0, np.cumsum(edge_lengths)]
+
+    # densify each edge into ceil(length / spacing) sub-edges
+    subdivisions = np.maximum(np.ceil(edge_lengths / spacing).astype(int), 1)
+    edge_index = np.repeat(np.arange(len(edge_lengths)), subdivisions)
+    fraction = (np.arange(subdivisions.sum()) - np.repeat(np.cumsum(subdivisions) - subdivisions, subdivisions)) / subdivisions[edge_index]
+    points = np.vstack([vertices[edge_index] + (vertices[edge_index + 1] - vertices[edge_index]) * fraction[:, None], vertices[-1:]])
+    positions = np.r_[vertex_positions[edge_index] + edge_lengths[edge_index] * fraction, vertex_positions[-1]]
+
+    return {
+        'ref_lat': ref_lat,
+        'points': points,
+        'positions': positions,
+        'stop_ids': np.asarray(stop_ids, dtype=object),
+        'stop_positions': vertex_positions[stop_vertex_index]
+    }
+
+
+def infer_chunk_stop_events(pings:pd.DataFrame, geometries:Dict[str, Dict], settings:Tuple[float, float]) -> pd.DataFrame:
+    """Infer stop events from a chunk of GPS pings sorted by run and timestamp. Runs in a worker process.
+
+        1. Each ping is snapped to the nearest point of its pattern geometry; pings further than max_offset from the pattern are
+           discarded. The distance along the pattern is made non-decreasing within each run to absorb GPS noise.
+        2. A stop is observed if any ping of the run lies within arrival_radius (along the pattern) of the stop, in which case the
+           first and last of those pings give the arrival and departure times.
+        3. Otherwise, if the run has pings before and after the stop, arrival and departure times are interpolated linearly between
+           the two pings around the stop, with zero dwell time.
+
+    :param pings: chunk of GPS pings with columns route, trip_id, timestamp, lat, lon, pattern and run
+    :type pings: pd.DataFrame
+    :param geometries: pattern geometries from :py:func:`pattern_geometry`, keyed by pattern
+    :type geometries: Dict[str, Dict]
+    :param settings: arrival_radius and max_offset in meters
+    :type settings: Tuple[float, float]
+    :return: dataframe of stop events with columns route, trip_id, stop_id, stop_sequence, stop_time (in seconds) and dwell_time
+    :rtype: pd.DataFrame
+    """
+
+    arrival_radius, max_offset = settings
+
+    positions = np.empty(pings.shape[0])
+    offsets = np.empty(pings.shape[0])
+    lat = pings['lat'].to_numpy()
+    lon = pings['lon'].to_numpy()
+    for pattern, ping_index in pings.groupby('pattern', sort=False, observed=True).indices.items():
+        geometry = geometries[pattern]
+        offsets[ping_index], nearest = cKDTree(geometry['points']).query(project_coordinates(lat[ping_index], lon[ping_index], geometry['ref_lat']))
+        positions[ping_index] = geometry['positions'][nearest]
+
+    on_pattern = offsets <= max_offset
+    pings = pings[on_pattern]
+    positions = positions[on_pattern]
+
+    runs = pings['run'].to_numpy()
+    timestamps = pings['timestamp'].to_numpy(dtype='float64')
+    new_run = np.r_[True, runs[1:] != runs[:-1]]
+    run_rank = np.cumsum(new_run) - 1
+    run_starts = np.flatnonzero(new_run)
+    run_ends = np.r_[run_starts[1:], len(runs)]
+    positions = pd.Series(positions).groupby(run_rank).cummax().to_numpy()
+    # positions of all runs as one non-decreasing array
+    run_positions = run_rank * RUN_POSITION_OFFSET + positions
+
+    # one candidate stop event per stop of the pattern of each run
+    run_info = pings.iloc[run_starts]
+    run_geometries = [geometries[pattern] for pattern in run_info['pattern']]
+    stops_per_run = np.array([len(geometry['stop_ids']) for geometry in run_geometries], dtype=int)
+    if stops_per_run.sum() == 0:
+        return pd.DataFrame(columns=['route', 'trip_id', 'stop_id', 'stop_sequence', 'stop_time', 'dwell_time'])
+    stop_run = np.repeat(np.arange(len(run_starts)), stops_per_run)
+    stop_ids = np.concatenate([geometry['stop_ids'] for geometry in run_geometries])
+    stop_positions = np.concatenate([geometry['stop_positions'] for geometry in run_geometries])
+    stop_sequence = np.arange(len(stop_run)) - np.repeat(np.cumsum(stops_per_run) - stops_per_run, stops_per_run) + 1
+    stop_run_positions = stop_run * RUN_POSITION_OFFSET + stop_positions
+
+    # observed stops: first and last ping within arrival_radius of the stop
+    first_in_radius = np.searchsorted(run_positions, stop_run_positions - arrival_radius, side='left')
+    last_in_radius = np.searchsorted(run_positions, stop_run_positions + arrival_radius, side='right') - 1
+    observed = last_in_radius >= first_in_radius
+
+    # passed stops: interpolate between the last ping before the stop and the first ping at or after the stop
+    after = np.searchsorted(run_positions, stop_run_positions, side='left')
+    passed = (after > run_starts[stop_run]) & (after < run_ends[stop_run])
+    before = np.clip(after - 1, 0, len(runs) - 1)
+    after = np.clip(after, 0, len(runs) - 1)
+    position_gap = run_positions[after] - run_positions[before]
+    fraction = np.divide(stop_run_positions - run_positions[before], position_gap, out=np.zeros_like(position_gap), where=position_gap > 0)
+    interpolated_time = timestamps[before] + fraction * (timestamps[after] - timestamps[before])
+
+    first_in_radius = np.clip(first_in_radius, 0, len(runs) - 1)
+    last_in_radius = np.clip(last_in_radius, 0, len(runs) - 1)
+    arrival_time = np.where(observed, timestamps[first_in_radius], interpolated_time)
+    departure_time = np.where(observed, timestamps[last_in_radius], interpolated_time)
+
+    detected = observed | passed
+    stop_run = stop_run[detected]
+    return pd.DataFrame({
+        'route': run_info['route'].to_numpy()[stop_run],
+        'trip_id': run_info['trip_id'].to_numpy()[stop_run],
+        'stop_id': stop_ids[detected],
+        'stop_sequence': stop_sequence[detected],
+        'stop_time': arrival_time[detected],
+        'dwell_time': departure_time[detected] - arrival_time[detected]
+    })
@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, Set
 import partridge as ptg
 import pandas as pd
 import numpy as np
@@ -7,7 +7,7 @@ import json
 from .rove_parameters import ROVE_params
 from copy import deepcopy
 from backend.helper_functions import get_hash_of_stop_list, check_dataframe_column, check_parent_dir, \
-    check_is_file
+    check_is_file, to_lean_dtypes
 from scipy.spatial import distance
 
 
@@ -23,6 +23,11 @@ class GTFS():
         For example, if mode is 'bus', then the list of route type values for 'bus' as specified in backend_config will be used to query the corresponding GTFS trips. 
         The current implementation (metrics, shapes, etc.) is developed around bus (or bus-like) mode only. Support for other transit modes may be added in the future.
     :type mode: str, optional
+    :param shape_gen: whether patterns are improved with the GTFS shapes table for shape generation, defaults to True
+    :type shape_gen: bool, optional
+    :param lean: whether to release the raw and validated data tables once the records table and patterns are built, keeping only
+        the stops tables and the stop and trip ID sets needed downstream, defaults to False. See :py:meth:`.GTFS.release_data`.
+    :type lean: bool, optional
     """
 
     #: Required tables and columns in GTFS static data. Note that "direction_id" is not a required field in GTFS specification, but is required by ROVE.
@@ -63,7 +68,7 @@ class GTFS():
                             }
                         }
 
-    def __init__(self, rove_params:ROVE_params, mode:str='bus', shape_gen=True):
+    def __init__(self, rove_params:ROVE_params, mode:str='bus', shape_gen=True, lean=False):
         """Instantiate a GTFS data class.
         """
         logger.info(f'Processing GTFS data...')
@@ -77,6 +82,9 @@ class GTFS():
 
         #: ROVE_params for the backend, see parameter definition.
         self.rove_params:ROVE_params = rove_params
+
+        #: Whether the raw and validated data tables are released once they are no longer needed, see parameter definition.
+        self.lean:bool = lean
         
         logger.info(f'loading {self.alias} data')
         path = check_is_file(rove_params.input_paths[self.alias])
@@ -87,7 +95,17 @@ class GTFS():
         #: Validated data, see  :py:meth:`.GTFS.validate_data` for details.
         self.validated_data:Dict[str, pd.DataFrame] = self.validate_data()
 
+        #: Set of stop IDs in the validated stops table, used to check that other data sources match with GTFS.
+        self.stop_ids:Set[str] = set(self.validated_data['stops']['stop_id'])
+        #: Set of trip IDs in the validated trips table, used to check that other data sources match with GTFS.
+        self.trip_ids:Set[str] = set(self.validated_data['trips']['trip_id'])
+        #: Validated stops table, used to convert stop IDs of other data sources to GTFS stop IDs.
+        self.stops:pd.DataFrame = self.validated_data['stops']
+        #: Raw stops table with stop coordinates, e.g. to flag stops inside areas of interest in metric calculation.
+        self.stop_coords:pd.DataFrame = self.raw_data['stops']
+
         #: GTFS records table that contains all stop events info and trips info, see  :py:meth:`.GTFS.get_gtfs_records` for details.
+        #: Stored in memory-lean dtypes once complete if lean_dtypes is set in ROVE_params, see :py:func:`.to_lean_dtypes`.
         self.records:pd.DataFrame = self.get_gtfs_records()
 
         # make sure the 'timepoint' column is valid in the stop_times table
@@ -116,6 +134,13 @@ class GTFS():
         self.generate_timepoints_output()
         self.generate_stop_name_output()
 
+        if self.rove_params.lean_dtypes:
+            # trip and stop IDs stay strings, since other data sources are matched with GTFS by them
+            to_lean_dtypes(self.records, exclude=['trip_id', 'stop_id'])
+
+        if self.lean:
+            self.release_data()
+
 
     def load_data(self, path:str)->Dict[str, pd.DataFrame]:
         """Load in GTFS data from a zip file, and retrieve data of the dates in date_list (as stored in rove_params) and 
@@ -139,6 +164,8 @@ class GTFS():
             not_available_dates = set(rove_params.date_list) - set(service_ids_by_date)
             available_dates = set(rove_params.date_list) - not_available_dates
             service_id_list = list(set([service_ids_by_date[day] for day in available_dates]))
+            #: Dict of service IDs active on each analyzed date that is available in GTFS, used to match AVL trips to GTFS trips.
+            self.service_ids_by_date:Dict = {day: service_ids_by_date[day] for day in available_dates}
 
             logger.info(f'loaded GTFS data for {len(available_dates)} days')
             # logger.debug(f'service IDs retrieved: {set(frozenset().union(*service_id_list))}')
@@ -203,8 +230,8 @@ class GTFS():
         :rtype: Dict[str, pd.DataFrame]
         """
 
-        # avoid changing the raw data object
-        data:Dict = deepcopy(self.raw_data)
+        # avoid changing the raw data object, tables are replaced rather than modified in place so that lean mode can skip the copy
+        data:Dict = dict(self.raw_data) if self.lean else deepcopy(self.raw_data)
         data_specs = {**self.REQUIRED_DATA_SPEC, **self.OPTIONAL_DATA_SPEC}
 
         # convert column types according to the spec
@@ -217,6 +244,18 @@ class GTFS():
 
         return data
 
+    def release_data(self):
+        """Release the raw and validated data tables, which are only needed until the records table and patterns are built. The stop 
+        and trip ID sets, the validated stops table and the stop coordinates are kept, see :py:attr:`.GTFS.stop_ids`, 
+        :py:attr:`.GTFS.trip_ids`, :py:attr:`.GTFS.stops` and :py:attr:`.GTFS.stop_coords`.
+        """
+
+        coord_cols = [col for col in ['stop_id', 'stop_code', 'stop_lat', 'stop_lon'] if col in self.stop_coords.columns]
+        self.stop_coords = self.stop_coords[coord_cols].copy()
+        self.raw_data = None
+        self.validated_data = None
+        logger.debug(f'released raw and validated {self.alias} data')
+
     def get_gtfs_records(self) -> pd.DataFrame:
         """Return a dataframe that is the validated GTFS stop_times table left joined by the validated GTFS trips table. 
         Values are sorted by [route_id, trip_id, stop_sequence]. Additional columns are added for the convenience of downstream
@@ -6,8 +6,8 @@ import pandas as pd
 
 class MBTA_AVL(AVL):
 
-    def __init__(self, rove_params: ROVE_params, bus_gtfs: GTFS):
-        super().__init__(rove_params, bus_gtfs)
+    def __init__(self, rove_params: ROVE_params, bus_gtfs: GTFS, lean: bool=False):
+        super().__init__(rove_params, bus_gtfs, lean)
 
     def convert_dwell_time(self, data:pd.Series):
         
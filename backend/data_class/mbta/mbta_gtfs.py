@@ -3,8 +3,8 @@ import pandas as pd
 
 class MBTA_GTFS(GTFS):
 
-    def __init__(self, rove_params, mode='bus', shape_gen=True):
-        super().__init__(rove_params, mode, shape_gen)
+    def __init__(self, rove_params, mode='bus', shape_gen=True, lean=False):
+        super().__init__(rove_params, mode, shape_gen, lean)
 
     def add_timepoints(self):
         records = self.records
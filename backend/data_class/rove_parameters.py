@@ -25,6 +25,15 @@ class ROVE_params(object, metaclass=ABCMeta):
     :type date_type: str
     :param data_option: list of input data options. One of 'GTFS', 'GTFS-AVL'
     :type data_option: list
+    :param execution_backend: engine of the groupwise reductions of metric calculation and aggregation. One of 'pandas' (default) or 'polars', 
+        which requires the optional polars package, see :py:class:`.Execution_Backend`
+    :type execution_backend: str, optional
+    :param verify_execution_backend: whether the results of the 'polars' execution backend are verified against the 'pandas' execution backend, 
+        defaults to False
+    :type verify_execution_backend: bool, optional
+    :param lean_dtypes: whether the records and metrics tables are stored in memory-lean dtypes, i.e. categorical IDs, int32 times, small integer 
+        counts and float32 metrics, which leaves the aggregated metrics unchanged, see :py:func:`.to_lean_dtypes`. Defaults to False.
+    :type lean_dtypes: bool, optional
     """
 
     def __init__(self,
@@ -36,7 +45,10 @@ class ROVE_params(object, metaclass=ABCMeta):
                 input_paths:Dict,
                 output_paths:Dict,
                 start_date:str='',
-                end_date:str=''):
+                end_date:str='',
+                execution_backend:str='pandas',
+                verify_execution_backend:bool=False,
+                lean_dtypes:bool=False):
                                  
                                    
         """Instantiate rove parameters.
@@ -74,6 +86,16 @@ class ROVE_params(object, metaclass=ABCMeta):
         #: Analyzed data option, see parameter definition.
         self.data_option:str = data_option
 
+        SUPPORTED_EXECUTION_BACKENDS = ['pandas', 'polars']
+        if execution_backend not in SUPPORTED_EXECUTION_BACKENDS:
+            raise ValueError(f"Invalid execution_backend: {execution_backend}, must be one of: {SUPPORTED_EXECUTION_BACKENDS}.")
+        #: Execution backend of metric calculation and aggregation, see parameter definition.
+        self.execution_backend:str = execution_backend
+        #: Whether the execution backend is verified against the pandas execution backend, see parameter definition.
+        self.verify_execution_backend:bool = verify_execution_backend
+        #: Whether the records and metrics tables are stored in memory-lean dtypes, see parameter definition.
+        self.lean_dtypes:bool = lean_dtypes
+
         #: Suffix used in input and output file names, string concatenation in the form of "<agency>_<month>_<year>", e.g. "MBTA_02_2021".
         self.suffix:str = f'_{self.agency}_{self.month}_{self.year}'
 
@@ -10,11 +10,11 @@ logger = logging.getLogger("backendLogger")
 
 class WMATA_AVL(AVL):
 
-    def __init__(self, rove_params: ROVE_params, bus_gtfs: GTFS):
-        super().__init__(rove_params, bus_gtfs)
+    def __init__(self, rove_params: ROVE_params, bus_gtfs: GTFS, lean: bool=False):
+        super().__init__(rove_params, bus_gtfs, lean)
 
     def validate_data(self) -> pd.DataFrame:
         data = super().validate_data()
-        data = convert_stop_ids('avl', data, 'stop_id', self.gtfs.validated_data['stops'])
+        data = convert_stop_ids('avl', data, 'stop_id', self.gtfs.stops)
 
         return data
@@ -8,8 +8,8 @@ import logging
 logger = logging.getLogger("backendLogger")
 class WMATA_GTFS(GTFS):
 
-    def __init__(self, rove_params, mode='bus', shape_gen=True):
-        super().__init__(rove_params, mode, shape_gen)
+    def __init__(self, rove_params, mode='bus', shape_gen=True, lean=False):
+        super().__init__(rove_params, mode, shape_gen, lean)
 
         self.generate_route_types_by_fsn()
         self.add_route_types_by_efbl()
@@ -57,7 +57,7 @@ class WMATA_GTFS(GTFS):
         timepoint_df = load_csv_to_dataframe(timepont_inpath, id_cols=id_cols)
         timepoint_df[id_cols] = timepoint_df[id_cols].astype(tp_df_col_types)
         
-        timepoint_df = convert_stop_ids('wmata timepoint data', timepoint_df, 'reg_id', self.validated_data['stops'])
+        timepoint_df = convert_stop_ids('wmata timepoint data', timepoint_df, 'reg_id', self.stops)
         
         timepoint_stop_lookup = timepoint_df[['route', 'reg_id', 'assoc_tpid']].drop_duplicates(subset=['route', 'reg_id'])
         self.records = self.records.merge(timepoint_stop_lookup, left_on=['route_id', 'stop_id'], right_on=['route','reg_id'], how='left')
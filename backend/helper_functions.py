@@ -169,21 +169,42 @@ def get_stop_value(stop:str) -> int:
         num = sum([ord(x) for x in stop])
     return num
 
-def read_shapes(path:str):
-        
+def read_shapes(path:str, bbox:Tuple[float, float, float, float]=None, route_ids:List[str]=None):
+    """Read the shapes JSON file. If the shape store written alongside it (see write_shape_store) is at least as recent, 
+    shapes are read from the store instead, and only segments that intersect bbox and belong to route_ids are read.
+
+    Args:
+        path (str): path to the shapes JSON file
+        bbox (Tuple[float, float, float, float], optional): (min lon, min lat, max lon, max lat) that segments must intersect. Defaults to None.
+        route_ids (List[str], optional): route IDs of the segments to read. Defaults to None.
+
+    Returns:
+        pd.DataFrame: shapes dataframe, or None if the file is not found
+    """
+    # imported here because the shape store module depends on this module
+    from backend.shapes.shape_store import shape_store_path, read_shape_store, intersects_bbox
+
     try:
         in_path = check_is_file(path)
-        with open(in_path) as shapes_file:
-            shapes_json = json.load(shapes_file)
+        store_path = shape_store_path(in_path)
+        if os.path.isfile(store_path) and os.path.getmtime(store_path) >= os.path.getmtime(in_path):
+            shapes = read_shape_store(store_path, bbox=bbox, route_ids=route_ids)
+        else:
+            with open(in_path) as shapes_file:
+                shapes_json = json.load(shapes_file)
             shapes = pd.json_normalize(shapes_json)
-            shapes['stop_pair'] = shapes.apply(lambda x: tuple(x.stop_pair), axis=1)
-            specs = {
-                'pattern':'string',
-                'distance':'float64'
-            }
-            cols = list(specs.keys())
-            shapes[cols] = shapes[cols].astype(dtype=specs)
-            return shapes
+            shapes['stop_pair'] = [tuple(stop_pair) for stop_pair in shapes['stop_pair']]
+            if route_ids is not None:
+                shapes = shapes[shapes['route_id'].isin(route_ids)].reset_index(drop=True)
+            if bbox is not None:
+                shapes = shapes[intersects_bbox(shapes['geometry'], bbox)].reset_index(drop=True)
+        specs = {
+            'pattern':'string',
+            'distance':'float64'
+        }
+        cols = list(specs.keys())
+        shapes[cols] = shapes[cols].astype(dtype=specs)
+        return shapes
     except FileNotFoundError:
         logger.exception(f'No shapes file found.')
         return None
@@ -246,6 +267,121 @@ def check_dataframe_column(df:pd.DataFrame, column_name, criteria='0or1'):
     else:
         raise ValueError(f'Invalid criteria. Select from: {valid_criteria}.')
 
+#: Memory-lean dtypes of the columns of the records and metrics tables, see to_lean_dtypes(). IDs are categoricals, times are int32
+#: seconds, and counts and flags are small integers.
+LEAN_DTYPES:Dict[str, str] = {
+    'svc_date': 'category',
+    'route_id': 'category',
+    'service_id': 'category',
+    'pattern': 'category',
+    'trip_id': 'category',
+    'stop_id': 'category',
+    'next_stop': 'category',
+    'direction_id': 'int8',
+    'timepoint': 'int8',
+    'branchpoint': 'int8',
+    'tp_bp': 'int8',
+    'is_on_time': 'int8',
+    'passenger_on': 'int16',
+    'passenger_off': 'int16',
+    'passenger_load': 'int16',
+    'seat_capacity': 'int16',
+    'boardings': 'int16',
+    'stop_sequence': 'int32',
+    'arrival_time': 'int32',
+    'departure_time': 'int32',
+    'stop_time': 'int32',
+    'dwell_time': 'int32',
+    'trip_start_time': 'int32',
+    'trip_end_time': 'int32',
+    'next_stop_arrival_time': 'int32'
+}
+
+#: Number of decimals that the calculated metrics are rounded to at most, and that float32 values of memory-lean tables are rounded to
+#: when they are converted back to float64, see restore_float32().
+LEAN_FLOAT_DECIMALS:int = 2
+
+def is_restored_from_float32(values:pd.Series) -> bool:
+    """Whether all values of a float column are restored by restore_float32() when stored as float32, i.e. they are rounded to at 
+    most LEAN_FLOAT_DECIMALS decimals and small enough for float32 to tell those decimals apart.
+    """
+
+    values = values.to_numpy(dtype='float64')
+    return np.array_equal(restore_float32(values.astype('float32')), values, equal_nan=True)
+
+def to_lean_dtypes(df:pd.DataFrame, columns:List[str]=None, exclude:List[str]=[], floats:bool=False) -> pd.DataFrame:
+    """Convert the columns of a records or metrics table to the memory-lean dtypes of LEAN_DTYPES in place. Integer columns are only
+    downcast if all of their values fit, and float columns of integer values (e.g. times of a lookup) are stored as float32, which
+    holds integers below 2^24 exactly, if they have missing values. Float columns are only stored as float32 if all of their values 
+    are restored by restore_float32(), see is_restored_from_float32(), so that e.g. sums with float errors keep their dtype.
+
+    Args:
+        df (DataFrame): records or metrics table
+        columns (List[str], optional): columns to convert. Defaults to None, i.e. all columns.
+        exclude (List[str], optional): columns of LEAN_DTYPES that keep their dtype, e.g. IDs that are matched with other data sources.
+                                        Defaults to [].
+        floats (bool, optional): whether all other float64 columns, i.e. the calculated metrics, which are rounded to at most 
+                                    LEAN_FLOAT_DECIMALS decimals, are stored as float32. Defaults to False.
+
+    Returns:
+        DataFrame: the table with the converted columns
+    """
+
+    for column in (df.columns if columns is None else columns):
+        values = df[column]
+        dtype = LEAN_DTYPES.get(column) if column not in exclude else None
+        if dtype == 'category':
+            if not isinstance(values.dtype, pd.CategoricalDtype):
+                df[column] = values.astype('category')
+        elif dtype is not None and values.dtype.kind in 'iuf' and values.dtype != dtype:
+            if values.dtype.kind == 'f' and (values.isna().any() or not np.array_equal(values, np.round(values))):
+                if is_restored_from_float32(values):
+                    df[column] = values.astype('float32')
+            elif values.empty or (np.iinfo(dtype).min <= values.min() and values.max() <= np.iinfo(dtype).max):
+                df[column] = values.astype(dtype)
+        elif dtype is None and floats and values.dtype == 'float64' and is_restored_from_float32(values):
+            df[column] = values.astype('float32')
+    return df
+
+def to_standard_dtypes(df:pd.DataFrame) -> pd.DataFrame:
+    """Convert the columns of a table in memory-lean dtypes (see to_lean_dtypes()) back to the standard dtypes in place, i.e.
+    categoricals to the dtype of their categories, integers to int64 and floats to float64 values rounded as by restore_float32(), 
+    e.g. for output.
+
+    Args:
+        df (DataFrame): table in memory-lean dtypes
+
+    Returns:
+        DataFrame: the table with the converted columns
+    """
+
+    for column in df.columns:
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            df[column] = values.astype(values.cat.categories.dtype)
+        elif values.dtype.kind == 'i' and values.dtype.itemsize < 8:
+            df[column] = values.astype('int64')
+        elif values.dtype == 'float32':
+            df[column] = restore_float32(values)
+    return df
+
+def restore_float32(values):
+    """Float32 values of a column of a table in memory-lean dtypes (see to_lean_dtypes()) as the float64 values that they were stored 
+    from, i.e. rounded to LEAN_FLOAT_DECIMALS decimals (e.g. 3.55 rather than 3.5499999523), so that metrics reduced from them are the 
+    same as without memory-lean dtypes. Values of other dtypes are returned as they are.
+
+    Args:
+        values (Series or ndarray): values of a column
+
+    Returns:
+        Series or ndarray: the float64 values of float32 values, otherwise values
+    """
+
+    if values.dtype != np.dtype('float32'):
+        return values
+    restored = np.asarray(values, dtype='float64').round(LEAN_FLOAT_DECIMALS)
+    return pd.Series(restored, index=values.index, name=values.name) if isinstance(values, pd.Series) else restored
+
 def series_to_datetime(date_pd_series:pd.Series, format:str=None):
     """
     This is an extremely fast approach to datetime parsing.
@@ -1,8 +1,9 @@
 from .metric_calculation import Metric_Calculation
 from .metric_aggregation import Metric_Aggregation
+from .partitioned_execution import Partitioned_Metric_Execution
 from metrics.wmata.wmata_metric_calculation import WMATA_Metric_Calculation
 from metrics.wmata.wmata_metric_aggregation import WMATA_Metric_Aggregation
 
 __all__ = [
-    "Metric_Calculation", "Metric_Aggregation", "WMATA_Metric_Calculation", "WMATA_Metric_Aggregation"
+    "Metric_Calculation", "Metric_Aggregation", "Partitioned_Metric_Execution", "WMATA_Metric_Calculation", "WMATA_Metric_Aggregation"
 ]
\ No newline at end of file
@@ -0,0 +1,332 @@
+import logging
+from typing import Callable, Dict, List, Tuple, Union
+import numpy as np
+import pandas as pd
+from backend.data_class.rove_parameters import ROVE_params
+from backend.helper_functions import restore_float32
+from backend.metrics.group_index import Group_Index
+
+try:
+    import polars as pl
+except ImportError:
+    # polars is an optional dependency, only required by the polars execution backend
+    pl = None
+
+logger = logging.getLogger("backendLogger")
+
+
+class Execution_Backend():
+    """Engine that executes the groupwise reductions of metric calculation and aggregation, i.e. the sums and maxima over the stop
+    events of each trip and timepoint pair, the free flow speed quantiles of stop pairs, and the reductions of each metrics table
+    at each aggregation level (see :py:meth:`.Metric_Aggregation.aggregate_metrics`). The metric definitions do not depend on the
+    backend. This is the default pandas backend, which reduces the groups of a :py:class:`.Group_Index` with numpy and aggregates
+    metrics tables with pandas groupbys.
+    """
+
+    #: Name of the backend, as the execution_backend parameter of :py:class:`.ROVE_params`.
+    name = 'pandas'
+
+    def group_reduce(self, group_index:Group_Index, values, reducer:Union[str, Tuple[str, float]]) -> np.ndarray:
+        """Reduce the values of the rows of each group of a group index.
+
+        :param group_index: index of the table of values
+        :type group_index: Group_Index
+        :param values: value of each row of the table
+        :param reducer: 'sum', 'max' or ('quantile', q)
+        :type reducer: Union[str, Tuple[str, float]]
+        :raises ValueError: the reducer is not supported
+        :return: the reduced value of each group, in the order of the groups of group_index
+        :rtype: np.ndarray
+        """
+
+        values = restore_float32(values)
+        if reducer == 'sum':
+            return group_index.sum(values)
+        if reducer == 'max':
+            return group_index.max(values)
+        if isinstance(reducer, tuple) and reducer[0] == 'quantile':
+            return group_index.quantile(values, reducer[1])
+        raise ValueError(f"Invalid group reducer {reducer}, must be one of: 'sum', 'max', ('quantile', q).")
+
+    @staticmethod
+    def reduced_dtype(dtype):
+        """Dtype that values of a dtype are reduced in, i.e. int64 for small integers and float64 for float32 values (see 
+        :py:func:`.to_lean_dtypes`), so that reductions neither overflow nor lose precision, otherwise the dtype itself. Float32 values 
+        are converted by :py:func:`.restore_float32`.
+        """
+
+        if isinstance(dtype, np.dtype) and dtype.kind in 'iu' and dtype.itemsize < 8:
+            return np.dtype('int64')
+        if dtype == np.dtype('float32'):
+            return np.dtype('float64')
+        return dtype
+
+    def reduce(self, records:pd.DataFrame, keys:List[str], reductions:Dict[Union[str, Tuple[str, float]], List[str]]) -> Dict[Tuple, pd.Series]:
+        """Reduce columns of a metrics table by key columns, with all reductions executed on a single groupby.
+
+        :param records: metrics table
+        :type records: pd.DataFrame
+        :param keys: key columns
+        :type keys: List[str]
+        :param reductions: columns of each reducer, which is a groupby aggregation such as 'mean', 'sum', 'min', 'max', 'var' or 'nunique',
+            or ('quantile', q)
+        :type reductions: Dict[Union[str, Tuple[str, float]], List[str]]
+        :return: the reduced series indexed by the keys, by (reducer, column)
+        :rtype: Dict[Tuple, pd.Series]
+        """
+
+        reduced = {}
+        # group only the reduced columns, every selection of columns of a groupby copies all columns but the keys
+        grouped_columns = list(dict.fromkeys(column for columns in reductions.values() for column in columns))
+        if not grouped_columns:
+            return reduced
+        # keys may be categoricals (see to_lean_dtypes), whose unobserved combinations are no groups, and small integers and float32 
+        # values are reduced as int64 and float64 values
+        reduced_dtypes = {column: self.reduced_dtype(records[column].dtype) for column in grouped_columns}
+        reduced_columns = {column: restore_float32(records[column]) if records[column].dtype == np.dtype('float32') else records[column].astype(dtype)
+                            for column, dtype in reduced_dtypes.items() if dtype != records[column].dtype}
+        grouped = records[keys + grouped_columns].assign(**reduced_columns).groupby(keys, observed=True)
+        for reducer, columns in reductions.items():
+            columns = list(columns)
+            if not columns:
+                continue
+            if isinstance(reducer, tuple):
+                reducer_reduced = grouped[columns].quantile(reducer[1])
+            elif reducer == 'nunique':
+                # unique counts of several columns of pandas < 1.4 include the unobserved groups of categorical keys, each column is counted alone
+                reducer_reduced = {column: grouped[column].nunique() for column in columns}
+            else:
+                reducer_reduced = grouped[columns].agg(reducer)
+            for column in columns:
+                reduced[(reducer, column)] = reducer_reduced[column]
+        return reduced
+
+
+class Polars_Execution_Backend(Execution_Backend):
+    """Execution backend that runs the reductions as lazy queries on polars, a multithreaded columnar DataFrame engine. Metrics tables
+    stay pandas DataFrames: their keys are passed to polars as integer group codes, the reduced values are returned as pandas series
+    and numpy arrays, and all queries of a metrics table are collected together, so that polars executes them in parallel.
+
+    The results are the same as those of the pandas backend, bit for bit. Minima, maxima, unique counts and sums of integers are
+    reduced by polars, and quantiles are interpolated with the arithmetic of the pandas backend from the values sorted by polars
+    within each group. Sums, means and variances of floats, whose summation order polars does not reproduce, and reducers that are
+    not supported here (e.g. custom reducers of an agency) are executed by the pandas backend.
+
+    :param verify: whether every reduction is also executed by the pandas backend and compared with the polars result, defaults to False
+    :type verify: bool, optional
+    :raises ImportError: polars is not installed
+    """
+
+    name = 'polars'
+
+    def __init__(self, verify:bool=False):
+
+        if pl is None:
+            raise ImportError(f'The polars execution backend requires the polars package, which is not installed. '\
+                                f"Install polars (e.g. pip install polars) or use the default 'pandas' execution backend.")
+        #: Whether the results are verified against the pandas backend.
+        self.verify:bool = verify
+
+    def group_reduce(self, group_index:Group_Index, values, reducer:Union[str, Tuple[str, float]]) -> np.ndarray:
+
+        sorted_values = np.asarray(restore_float32(values))[group_index.order]
+        sorted_values = sorted_values.astype(self.reduced_dtype(sorted_values.dtype), copy=False)
+        groups = pl.Series('group', group_index.group_ids)
+        if isinstance(reducer, tuple) and reducer[0] == 'quantile':
+            sorted_values = pl.DataFrame([groups, self.__to_polars('value', sorted_values.astype('float64'))]).lazy()\
+                                .sort(['group', 'value'], nulls_last=True).collect()['value']
+            group_values = group_index.sorted_quantile(self.__to_numpy(sorted_values), reducer[1])
+        elif reducer in ['sum', 'max'] and self.__is_exact(reducer, sorted_values):
+            group_values = pl.DataFrame([groups, self.__to_polars('value', sorted_values)]).lazy()\
+                                .group_by('group').agg(self.__expression(reducer, 'value')).sort('group').collect()['value']
+            group_values = self.__to_numpy(group_values)
+        else:
+            return super().group_reduce(group_index, values, reducer)
+
+        if self.verify:
+            self.__verify(f'{reducer} of {group_index.starts.shape[0]} groups', group_values, super().group_reduce(group_index, values, reducer))
+        return group_values
+
+    def reduce(self, records:pd.DataFrame, keys:List[str], reductions:Dict[Union[str, Tuple[str, float]], List[str]]) -> Dict[Tuple, pd.Series]:
+
+        values = {}
+        polars_reductions = {}
+        pandas_reductions = {}
+        for reducer, columns in reductions.items():
+            for column in columns:
+                if column not in values:
+                    values[column] = self.__numeric_values(records[column])
+                is_exact = self.__is_exact(reducer, values[column])
+                (polars_reductions if is_exact else pandas_reductions).setdefault(reducer, []).append(column)
+
+        reduced = super().reduce(records, keys, pandas_reductions)
+        if polars_reductions:
+            polars_reduced = self.__reduce(records, keys, polars_reductions, values)
+            if self.verify:
+                pandas_reduced = super().reduce(records, keys, polars_reductions)
+                for reduction, reduction_values in polars_reduced.items():
+                    reference = pandas_reduced[reduction]
+                    if not reduction_values.index.isin(reference.index).all():
+                        raise ValueError(f'Groups of the polars execution backend differ from the pandas groups for {reduction} by {keys}.')
+                    self.__verify(f'{reduction} by {keys}', reduction_values.reindex(reference.index).to_numpy(), reference.to_numpy())
+            reduced.update(polars_reduced)
+        return reduced
+
+    def __reduce(self, records:pd.DataFrame, keys:List[str], reductions:Dict[Union[str, Tuple[str, float]], List[str]],
+                    values:Dict[str, np.ndarray]) -> Dict[Tuple, pd.Series]:
+        """Execute reductions on polars, given the numeric values of their columns (or None for other columns).
+        """
+
+        key_codes, key_uniques = zip(*[pd.factorize(records[key]) for key in keys])
+        dims = [max(uniques.shape[0], 1) for uniques in key_uniques]
+        if np.prod(dims, dtype=object) >= 2**63:
+            # too many combinations of keys for int64 group codes
+            return super().reduce(records, keys, reductions)
+        # as in pandas groupbys, records with a missing key belong to no group
+        is_valid = np.logical_and.reduce([codes >= 0 for codes in key_codes])
+        groups = np.where(is_valid, np.ravel_multi_index([np.where(is_valid, codes, 0) for codes in key_codes], dims), -1)
+        # all reduced series share the index of the groups
+        all_groups = np.unique(groups[is_valid])
+        group_key_codes = np.unravel_index(all_groups, dims)
+        if len(keys) == 1:
+            index = pd.Index(key_uniques[0].take(group_key_codes[0]), name=keys[0])
+        else:
+            index = pd.MultiIndex.from_arrays([uniques.take(codes) for uniques, codes in zip(key_uniques, group_key_codes)], names=keys)
+
+        columns = list(dict.fromkeys(column for columns in reductions.values() for column in columns))
+        frame = [pl.Series('group', groups)]
+        for column in columns:
+            column_values = values[column]
+            if column_values is None:
+                # e.g. trip IDs, whose unique counts are the unique counts of their codes
+                codes = pd.factorize(records[column])[0]
+                column_values = np.where(codes >= 0, codes, np.nan)
+            frame.append(self.__to_polars(column, column_values))
+        frame = pl.DataFrame(frame).lazy().filter(pl.col('group') >= 0)
+
+        quantiles = []
+        aggregations = []
+        queries = []
+        for reducer, reducer_columns in reductions.items():
+            for column in reducer_columns:
+                if isinstance(reducer, tuple):
+                    quantiles.append((reducer, column))
+                    queries.append(frame.select(['group', column]).drop_nulls(column).sort(['group', column]))
+                else:
+                    aggregations.append((reducer, column))
+        if aggregations:
+            queries.append(frame.group_by('group').agg([self.__expression(reducer, column).alias(f'reduced_{i}')
+                                                            for i, (reducer, column) in enumerate(aggregations)]))
+        results = pl.collect_all(queries)
+
+        reduced = {}
+        for (reducer, column), result in zip(quantiles, results):
+            result_groups, quantile_values = self.__sorted_quantile(result['group'].to_numpy(), self.__to_numpy(result[column]).astype('float64'), reducer[1])
+            # groups without values have no quantile
+            values = np.full(all_groups.shape[0], np.nan)
+            values[np.searchsorted(all_groups, result_groups)] = quantile_values
+            reduced[(reducer, column)] = pd.Series(values, index=index, name=column)
+        if aggregations:
+            result = results[-1]
+            positions = np.argsort(np.searchsorted(all_groups, result['group'].to_numpy()))
+            for i, (reducer, column) in enumerate(aggregations):
+                reduced[(reducer, column)] = pd.Series(self.__to_numpy(result[f'reduced_{i}'])[positions], index=index, name=column)
+        return reduced
+
+    @staticmethod
+    def __sorted_quantile(groups:np.ndarray, sorted_values:np.ndarray, q:float) -> Tuple[np.ndarray, np.ndarray]:
+        """Quantile of the values of each group with the arithmetic of pandas groupby quantiles, given the non-missing values sorted
+        by group and value. Returns the groups and their quantiles.
+        """
+
+        starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]]) if groups.shape[0] else np.empty(0, dtype='int64')
+        counts = np.diff(np.r_[starts, groups.shape[0]])
+        quantile_indexes = q * (counts - 1).astype('float64')
+        # the index is truncated, and the value interpolated with the next value if the quantile falls between them
+        indexes = starts + quantile_indexes.astype('int64')
+        fractions = quantile_indexes % 1
+        values = sorted_values[indexes]
+        next_values = sorted_values[np.minimum(indexes + 1, starts + counts - 1)]
+        return groups[starts], np.where(fractions == 0, values, values + (next_values - values) * fractions)
+
+    @staticmethod
+    def __is_exact(reducer:Union[str, Tuple[str, float], Callable], values:np.ndarray) -> bool:
+        """Whether polars reduces the values with the same result as pandas. Values are None if they are not numeric.
+        """
+
+        if reducer == 'nunique':
+            return True
+        if values is None:
+            return False
+        if isinstance(reducer, tuple):
+            return reducer[0] == 'quantile' and values.dtype.kind in 'iuf'
+        if reducer in ['min', 'max']:
+            return values.dtype.kind in 'iuf'
+        # sums of floats depend on the order of summation
+        return reducer == 'sum' and values.dtype.kind in 'iu'
+
+    @staticmethod
+    def __expression(reducer:str, column:str) -> 'pl.Expr':
+
+        value = pl.col(column)
+        if reducer == 'nunique':
+            return value.drop_nulls().n_unique()
+        return getattr(value, reducer)()
+
+    def __numeric_values(self, values:pd.Series) -> np.ndarray:
+        """Numeric values of a column in the dtype they are reduced in, with missing values as NaN, or None if the column is not numeric.
+        """
+
+        if pd.api.types.is_bool_dtype(values.dtype) or not pd.api.types.is_numeric_dtype(values.dtype):
+            return None
+        if pd.api.types.is_extension_array_dtype(values.dtype):
+            return values.to_numpy(dtype='float64', na_value=np.nan)
+        return np.asarray(restore_float32(values)).astype(self.reduced_dtype(values.dtype), copy=False)
+
+    @staticmethod
+    def __to_polars(name:str, values:np.ndarray) -> 'pl.Series':
+
+        # missing values are nulls in polars, which are skipped by the reductions
+        return pl.Series(name, values, nan_to_null=values.dtype.kind == 'f')
+
+    @staticmethod
+    def __to_numpy(values:'pl.Series') -> np.ndarray:
+
+        values = values.to_numpy()
+        # counts are unsigned in polars
+        return values.astype('int64') if values.dtype.kind == 'u' else values
+
+    def __verify(self, description:str, values:np.ndarray, reference:np.ndarray):
+        """Compare the result of a reduction with the result of the pandas backend.
+
+        :raises ValueError: the results differ
+        """
+
+        values = np.asarray(values)
+        reference = np.asarray(reference)
+        if values.shape != reference.shape:
+            raise ValueError(f'Result of the polars execution backend has {values.shape[0]} groups instead of the {reference.shape[0]} groups '\
+                                f'of the pandas result for {description}.')
+        different = np.flatnonzero(~((values == reference) | (pd.isna(values) & pd.isna(reference))))
+        if different.shape[0]:
+            raise ValueError(f'Result of the polars execution backend differs from the pandas result for {description} in {different.shape[0]} '\
+                                f'of {reference.shape[0]} groups, e.g. {values[different[0]]} instead of {reference[different[0]]}.')
+        logger.debug(f'{description} verified against the pandas execution backend')
+
+
+def get_execution_backend(params:ROVE_params) -> Execution_Backend:
+    """Execution backend of a run, selected by the execution_backend and verify_execution_backend parameters.
+
+    :param params: a rove_params object that stores information needed throughout the backend
+    :type params: ROVE_params
+    :raises ValueError: the execution backend is not 'pandas' or 'polars'
+    :raises ImportError: polars is selected but not installed
+    :return: the execution backend
+    :rtype: Execution_Backend
+    """
+
+    if params.execution_backend == 'pandas':
+        return Execution_Backend()
+    if params.execution_backend == 'polars':
+        return Polars_Execution_Backend(verify=params.verify_execution_backend)
+    raise ValueError(f"Invalid execution_backend: {params.execution_backend}, must be one of: ['pandas', 'polars'].")
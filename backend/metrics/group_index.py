@@ -0,0 +1,369 @@
+import weakref
+from typing import Dict, Hashable, List, Tuple
+import numpy as np
+import pandas as pd
+
+
+class Group_Index():
+    """Sort order and group boundaries of a metrics table by a set of key columns, computed once and reused by the groupwise operations
+    of :py:class:`.Metric_Calculation`. The rows of each group are stored contiguously in :py:attr:`order`, in the order of the sort column
+    within the group if one is given, otherwise in the order of the table, and shifts, diffs, cumulative sums, sums and quantiles are
+    computed on arrays in this order using the group boundary offsets, without sorting or hashing the keys again.
+
+    The results of the operations are the same as those of the pandas groupby operations on the key columns (after sorting the table
+    by the keys and the sort column), including the Kahan summation of float sums, except for the exact decimal sums of
+    :py:meth:`exact_sums`. As in pandas, rows with a missing key belong to no
+    group, and their results are missing. Results are numpy (or extension) arrays aligned with the rows of the table.
+
+    :param records: metrics table
+    :type records: pd.DataFrame
+    :param keys: key columns of the groups
+    :type keys: List[str]
+    :param sort_column: column that orders the rows within each group, missing values last. Defaults to None, the order of the table.
+    :type sort_column: str, optional
+    """
+
+    def __init__(self, records:pd.DataFrame, keys:List[str], sort_column:str=None):
+
+        codes = [pd.factorize(records[key])[0] for key in keys]
+        is_valid = np.logical_and.reduce([key_codes >= 0 for key_codes in codes]) if codes else np.ones(records.shape[0], dtype=bool)
+        rows = np.flatnonzero(is_valid)
+        codes = [key_codes[rows] for key_codes in codes]
+
+        sort_keys = codes[::-1]
+        if sort_column is not None:
+            sort_keys = [self.__sort_values(records[sort_column].to_numpy()[rows])] + sort_keys
+        permutation = np.lexsort(sort_keys) if sort_keys else np.arange(rows.shape[0])
+
+        is_start = np.zeros(rows.shape[0], dtype=bool)
+        is_start[:1] = True
+        for key_codes in codes:
+            sorted_codes = key_codes[permutation]
+            is_start[1:] |= sorted_codes[1:] != sorted_codes[:-1]
+
+        self.__set_groups(records, rows[permutation], np.cumsum(is_start) - 1)
+
+    def __set_groups(self, records:pd.DataFrame, order:np.ndarray, group_ids:np.ndarray):
+
+        self.__records = weakref.ref(records)
+        #: Number of rows of the table.
+        self.size:int = records.shape[0]
+        # positions are stored as int32 where possible, to halve the memory of the cached indexes
+        position_dtype = 'int32' if self.size < 2**31 else 'int64'
+        #: Positions of the rows that belong to a group, sorted by group.
+        self.order:np.ndarray = order.astype(position_dtype, copy=False)
+        #: Group of each row of order.
+        self.group_ids:np.ndarray = group_ids.astype(position_dtype, copy=False)
+        #: Offset in order of the first row of each group.
+        self.starts:np.ndarray = np.flatnonzero(np.r_[True, group_ids[1:] != group_ids[:-1]]) if group_ids.shape[0] else np.empty(0, dtype='int64')
+        #: Number of rows of each group.
+        self.sizes:np.ndarray = np.diff(np.r_[self.starts, order.shape[0]])
+
+    @staticmethod
+    def __sort_values(values:np.ndarray) -> np.ndarray:
+
+        if values.dtype.kind in 'biuf':
+            return values
+        # e.g. strings, sorted by their sort codes with missing values last
+        sort_codes = pd.factorize(values, sort=True)[0]
+        return np.where(sort_codes < 0, sort_codes.max() + 1, sort_codes)
+
+    def records(self) -> pd.DataFrame:
+        """The table of the index, or None if it no longer exists.
+        """
+
+        return self.__records()
+
+    def is_index_of(self, records:pd.DataFrame) -> bool:
+        """Whether this is the index of the table object, i.e. the table has not been replaced since the index was computed.
+        """
+
+        return self.__records() is records and records.shape[0] == self.size
+
+    def subset(self, records:pd.DataFrame, mask:np.ndarray) -> 'Group_Index':
+        """Index of a subset of the rows, without regrouping.
+
+        :param records: the subset of the rows of the table, i.e. table[mask]
+        :type records: pd.DataFrame
+        :param mask: boolean mask of the rows of the table
+        :type mask: np.ndarray
+        :return: index of records by the same keys
+        :rtype: Group_Index
+        """
+
+        mask = np.asarray(mask, dtype=bool)
+        positions = np.cumsum(mask) - 1
+        is_kept = mask[self.order]
+        return self.__derive(records, positions[self.order[is_kept]], self.group_ids[is_kept])
+
+    def split(self, values) -> 'Group_Index':
+        """Index of the same table by the keys and an additional key that is constant over consecutive rows of a group, e.g. a
+        cumulative count within each group. Rows with a missing value of the additional key belong to no group.
+
+        :param values: additional key of each row
+        :return: index with a group for each run of equal values in each group
+        :rtype: Group_Index
+        """
+
+        sorted_values = np.asarray(values)[self.order]
+        # as for the keys, rows with a missing value belong to no group
+        is_kept = ~pd.isna(sorted_values)
+        order, group_ids, sorted_values = self.order[is_kept], self.group_ids[is_kept], sorted_values[is_kept]
+        is_change = np.zeros(order.shape[0], dtype=bool)
+        is_change[1:] = sorted_values[1:] != sorted_values[:-1]
+        return self.__derive(self.__records(), order, group_ids + np.cumsum(is_change))
+
+    def __derive(self, records:pd.DataFrame, order:np.ndarray, group_ids:np.ndarray) -> 'Group_Index':
+
+        is_start = np.ones(group_ids.shape[0], dtype=bool)
+        is_start[1:] = group_ids[1:] != group_ids[:-1]
+        group_index = Group_Index.__new__(Group_Index)
+        group_index.__set_groups(records, order, np.cumsum(is_start) - 1)
+        return group_index
+
+    def first_rows(self) -> np.ndarray:
+        """Positions of the first row of each group, e.g. to get the keys of the groups.
+        """
+
+        return self.order[self.starts]
+
+    def last_rows(self) -> np.ndarray:
+        """Positions of the last row of each group.
+        """
+
+        return self.order[self.starts + self.sizes - 1]
+
+    def __ranks(self) -> np.ndarray:
+
+        return np.arange(self.order.shape[0]) - self.starts[self.group_ids]
+
+    def __take(self, values, sources:np.ndarray):
+
+        values = values.array if pd.api.types.is_extension_array_dtype(values) else np.asarray(values)
+        return pd.api.extensions.take(values, sources, allow_fill=True)
+
+    def __to_rows(self, sorted_values:np.ndarray) -> np.ndarray:
+
+        if self.order.shape[0] == self.size:
+            values = np.empty(self.size, dtype=sorted_values.dtype)
+        else:
+            values = np.full(self.size, np.nan, dtype=np.result_type(sorted_values.dtype, np.float64))
+        values[self.order] = sorted_values
+        return values
+
+    def shift(self, values, periods:int=1):
+        """Values of the row periods rows before (or after, if negative) each row in its group, missing if there is none, as
+        groupby().shift(periods).
+        """
+
+        ranks = self.__ranks()
+        sources = np.full(self.size, -1, dtype='int64')
+        has_source = (ranks >= periods) & (ranks - periods < self.sizes[self.group_ids])
+        positions = np.flatnonzero(has_source)
+        sources[self.order[positions]] = self.order[positions - periods]
+        return self.__take(values, sources)
+
+    def diff(self, values, periods:int=1) -> np.ndarray:
+        """Difference between the value of each row and the value of the row periods rows before in its group, as groupby().diff(periods).
+        """
+
+        return np.asarray(values, dtype='float64') - np.asarray(self.shift(values, periods), dtype='float64')
+
+    def ffill(self, values):
+        """Values with missing values filled by the last non-missing value before them in their group, as groupby().ffill().
+        """
+
+        positions = np.arange(self.order.shape[0])
+        is_valid = ~np.asarray(pd.isna(self.__take(values, self.order)))
+        last_valid = np.maximum.accumulate(np.where(is_valid, positions, -1)) if positions.shape[0] else positions
+        # non-missing values of previous groups are not carried over
+        last_valid[last_valid < self.starts[self.group_ids]] = -1
+
+        sources = np.full(self.size, -1, dtype='int64')
+        has_source = last_valid >= 0
+        sources[self.order[has_source]] = self.order[last_valid[has_source]]
+        return self.__take(values, sources)
+
+    def cumsum(self, values) -> np.ndarray:
+        """Cumulative sum of the values of the rows of each group up to each row, as groupby().cumsum().
+        """
+
+        sorted_values = self.__sum_values(values)
+        if sorted_values.dtype.kind == 'f':
+            return self.__to_rows(self.__kahan_sum(sorted_values, cumulative=True))
+        cumsum = np.cumsum(sorted_values)
+        return self.__to_rows(cumsum - (cumsum - sorted_values)[self.starts][self.group_ids])
+
+    def sum(self, values) -> np.ndarray:
+        """Sum of the values of each group, as groupby().sum().
+        """
+
+        sorted_values = self.__sum_values(values)
+        if sorted_values.dtype.kind == 'f':
+            return self.__kahan_sum(sorted_values, cumulative=False)
+        return np.add.reduceat(sorted_values, self.starts) if self.starts.shape[0] else np.zeros(0, dtype=sorted_values.dtype)
+
+    def __sum_values(self, values) -> np.ndarray:
+        """Sorted values to sum, with booleans and integers upcast to int64 and floats to float64, so that sums of the memory-lean 
+        dtypes (see :py:func:`.to_lean_dtypes`) neither overflow nor lose precision.
+        """
+
+        sorted_values = np.asarray(values)[self.order]
+        if sorted_values.dtype.kind in 'biu':
+            return sorted_values.astype('int64', copy=False)
+        if sorted_values.dtype.kind == 'f':
+            return sorted_values.astype('float64', copy=False)
+        return sorted_values
+
+    def exact_sums(self, columns:List, decimals:List[int]) -> List[np.ndarray]:
+        """Sums of several columns over each group, as the differences of one cumulative sum of all columns over the rows in order at
+        the group boundaries, so that all columns are summed in one vectorized step. Float values are summed as integers in units of
+        their number of decimals (e.g. hundredths), so they must be rounded to it. The sums are then the exact decimal sums of the values,
+        independent of the summation order, i.e. the sums of :py:meth:`sum` rounded to the decimals, which may differ from them in the
+        last bit. Missing values are skipped.
+
+        :param columns: values of each column
+        :type columns: List
+        :param decimals: number of decimals of the values of each column, ignored for integer columns
+        :type decimals: List[int]
+        :return: sums of each column for each group, as int64 for integer columns, otherwise as float64
+        :rtype: List[np.ndarray]
+        """
+
+        units, scales = [], []
+        for values, column_decimals in zip(columns, decimals):
+            sorted_values = self.__sum_values(values)
+            if sorted_values.dtype.kind == 'i':
+                units.append(sorted_values)
+                scales.append(None)
+            else:
+                scale = 10**column_decimals
+                sorted_units = np.rint(sorted_values * scale)
+                units.append(np.where(np.isnan(sorted_units), 0, sorted_units).astype('int64'))
+                scales.append(scale)
+
+        cumulative_sums = np.zeros((self.order.shape[0] + 1, len(units)), dtype='int64')
+        if units:
+            np.cumsum(np.column_stack(units), axis=0, out=cumulative_sums[1:])
+        group_sums = cumulative_sums[self.starts + self.sizes] - cumulative_sums[self.starts]
+        return [group_sums[:, i] if scale is None else group_sums[:, i] / scale for i, scale in enumerate(scales)]
+
+    def max(self, values) -> np.ndarray:
+        """Maximum of the non-missing values of each group, as groupby().max().
+        """
+
+        sorted_values = np.asarray(values)[self.order]
+        if not self.starts.shape[0]:
+            return sorted_values[:0]
+        return (np.fmax if sorted_values.dtype.kind == 'f' else np.maximum).reduceat(sorted_values, self.starts)
+
+    def quantile(self, values, q:float) -> np.ndarray:
+        """Quantile of the non-missing values of each group with linear interpolation, as groupby().quantile(q), with the same
+        arithmetic as the numpy percentile that it calls.
+        """
+
+        sorted_values = np.asarray(values, dtype='float64')[self.order]
+        return self.sorted_quantile(sorted_values[np.lexsort((sorted_values, self.group_ids))], q)
+
+    def sorted_quantile(self, sorted_values:np.ndarray, q:float) -> np.ndarray:
+        """Quantile of each group as :py:meth:`quantile`, from the values of the rows in order sorted within each group with missing 
+        values last, e.g. sorted by an :py:class:`.Execution_Backend`.
+        """
+
+        counts = np.add.reduceat((~np.isnan(sorted_values)).astype('int64'), self.starts) if self.starts.shape[0] else np.zeros(0, dtype='int64')
+
+        q = np.true_divide(np.asarray(q) * 100.0, 100)
+        virtual_indexes = (counts - 1) * q
+        previous_indexes = np.floor(virtual_indexes)
+        next_indexes = previous_indexes + 1
+        is_above_bounds = virtual_indexes >= counts - 1
+        previous_indexes[is_above_bounds] = -1
+        next_indexes[is_above_bounds] = -1
+        previous_indexes = previous_indexes.astype('int64')
+        next_indexes = next_indexes.astype('int64')
+        gamma = virtual_indexes - previous_indexes
+
+        has_values = counts > 0
+        starts, counts = self.starts[has_values], counts[has_values]
+        previous = sorted_values[starts + np.where(previous_indexes[has_values] < 0, counts - 1, previous_indexes[has_values])]
+        next_values = sorted_values[starts + np.where(next_indexes[has_values] < 0, counts - 1, next_indexes[has_values])]
+        gamma = gamma[has_values]
+        # numpy's linear interpolation between the previous and next values
+        with np.errstate(invalid='ignore'):
+            diff_next_previous = next_values - previous
+            interpolation = previous + diff_next_previous * gamma
+            interpolation = np.where(gamma >= 0.5, next_values - diff_next_previous * (1 - gamma), interpolation)
+
+        quantiles = np.full(self.starts.shape[0], np.nan)
+        quantiles[has_values] = interpolation
+        return quantiles
+
+    def broadcast(self, group_values:np.ndarray) -> np.ndarray:
+        """Value of the group of each row, as the result of groupby().transform().
+        """
+
+        return self.__to_rows(np.asarray(group_values)[self.group_ids])
+
+    def __kahan_sum(self, sorted_values:np.ndarray, cumulative:bool) -> np.ndarray:
+        """Kahan summation of the non-missing values of each group in order, vectorized over the groups, which is the summation of
+        pandas groupby sums and cumulative sums of floats. It takes one step per row of the largest group.
+        """
+
+        sums = np.zeros(self.starts.shape[0])
+        compensations = np.zeros(self.starts.shape[0])
+        cumulative_sums = np.full(sorted_values.shape[0], np.nan)
+        groups = np.arange(self.starts.shape[0])
+        for rank in range(self.sizes.max() if self.sizes.shape[0] else 0):
+            groups = groups[self.sizes[groups] > rank]
+            positions = self.starts[groups] + rank
+            values = sorted_values[positions]
+            is_valid = ~np.isnan(values)
+            step_groups, positions, values = groups[is_valid], positions[is_valid], values[is_valid]
+
+            # infinite values give nan compensations, as in pandas
+            with np.errstate(invalid='ignore'):
+                y = values - compensations[step_groups]
+                t = sums[step_groups] + y
+                compensations[step_groups] = t - sums[step_groups] - y
+            sums[step_groups] = t
+            cumulative_sums[positions] = t
+        return cumulative_sums if cumulative else sums
+
+
+class Group_Index_Cache():
+    """Group indexes of metrics tables, cached per table object and key (e.g. the key columns), so that the groups of a table are
+    computed once for all of its metrics. Indexes refer to their tables by object identity, so a cache is empty when unpickled,
+    e.g. in another process, and its indexes are recomputed.
+    """
+
+    def __init__(self):
+
+        self.__indexes:Dict[Tuple[int, Hashable], Group_Index] = {}
+
+    def get(self, records:pd.DataFrame, key:Hashable) -> Group_Index:
+        """Cached index of the table object by key, or None if there is none or the table has been replaced.
+        """
+
+        group_index = self.__indexes.get((id(records), key))
+        return group_index if group_index is not None and group_index.is_index_of(records) else None
+
+    def put(self, records:pd.DataFrame, key:Hashable, group_index:Group_Index):
+        """Cache the index of the table object by key, and drop the indexes of tables that no longer exist.
+        """
+
+        self.__indexes = {cache_key: index for cache_key, index in self.__indexes.items() if index.records() is not None}
+        self.__indexes[(id(records), key)] = group_index
+
+    def clear(self):
+        """Drop all indexes, e.g. when the metrics are calculated, to release their memory.
+        """
+
+        self.__indexes = {}
+
+    def __getstate__(self) -> dict:
+
+        return {}
+
+    def __setstate__(self, state:dict):
+
+        self.__init__()
@@ -1,14 +1,15 @@
 from abc import abstractmethod
-from copy import deepcopy
 import logging
 import pandas as pd
 import numpy as np
 from typing import Tuple, Dict, Set, List, Callable
 import scipy.stats
 import pickle
+from backend.metrics.execution_backend import Execution_Backend, get_execution_backend
 from backend.metrics.metric_calculation import Metric_Calculation
+from backend.metrics.metric_registry import ALL_LEVELS, LEVELS, Metric, Metric_Registry
 from backend.data_class.rove_parameters import ROVE_params
-from backend.helper_functions import check_parent_dir
+from backend.helper_functions import check_parent_dir, restore_float32, to_standard_dtypes
 from tqdm.auto import tqdm
 
 logger = logging.getLogger("backendLogger")
@@ -17,6 +18,10 @@ FT_PER_MIN_TO_MPH = 0.0113636
 SECONDS_IN_MINUTE = 60
 SECONDS_IN_HOUR = 3600
 SECONDS_IN_TEN_MINUTES = SECONDS_IN_MINUTE * 10
+#: Names of the aggregation levels in the time period output, in the order of the five aggregated metrics tables.
+AGGREGATION_LEVELS = ('segment', 'corridor', 'route', 'segment-timepoints', 'corridor-timepoints')
+#: Source of the metrics tables of scheduled and observed metrics.
+DATA_TYPE_SOURCES = {'scheduled': 'gtfs', 'observed': 'avl'}
 
 class Metric_Aggregation():
     """Aggregated stop, stop-aggregated, route, timepoint, and timepoint-aggregated level metrics.
@@ -25,13 +30,19 @@ class Metric_Aggregation():
     :type metrics: Metric_Calculation
     :param params: a rove_params object that stores information needed throughout the backend
     :type params: ROVE_params
+    :param write_output: whether to aggregate by time periods and 10-min intervals and write the results to the output paths, defaults to True. 
+        Set to False when the aggregated tables are retrieved with :py:meth:`get_time_period_metrics` and :py:meth:`get_10min_interval_metrics` instead, 
+        e.g. by :py:class:`.Partitioned_Metric_Execution`
+    :type write_output: bool, optional
     """
-    def __init__(self, metrics:Metric_Calculation, params:ROVE_params):
+    def __init__(self, metrics:Metric_Calculation, params:ROVE_params, write_output:bool=True):
         
         logger.info(f'Aggregating metrics...')
         self.gtfs_stop_metrics = metrics.gtfs_stop_metrics
         self.gtfs_route_metrics = metrics.gtfs_route_metrics
         self.gtfs_tpbp_metrics = metrics.gtfs_tpbp_metrics
+        #: Codec of the stop_pair columns of the metrics tables, see :py:class:`.Stop_Pair_Codec`.
+        self.stop_pair_codec = metrics.stop_pair_codec
 
         self.data_option = params.data_option
         if 'AVL' in self.data_option:
@@ -68,46 +79,106 @@ class Metric_Aggregation():
         self.metrics_names:Dict[str, str] = params.frontend_config['units']
         self.metrics_names['sample_size'] = 'Sample Size'
 
-        self.aggregate_by_time_periods(params.output_paths['metric_calculation_aggre'])
-        self.aggregate_by_10min_intervals(params.output_paths['metric_calculation_aggre_10min'])
+        #: Engine of the reductions of the metrics tables, selected by the execution_backend parameter of params.
+        self.execution_backend:Execution_Backend = get_execution_backend(params)
+        #: Registry of the aggregated metrics, see :py:meth:`register_metrics`.
+        self.metric_registry:Metric_Registry = Metric_Registry()
+        self.register_metrics(self.metric_registry)
+        # reduced metrics by metrics table name along with the table they were reduced from, which are reused as long as the table is 
+        # the same, i.e. for all percentiles of a time window, and for all time windows if the table is not time filtered
+        self.__reductions:Dict[str, Tuple[pd.DataFrame, Dict]] = {}
+        # time-filtered metrics tables of the last time window
+        self.__time_filtered_metrics:Dict[Tuple[str, str], Tuple[pd.DataFrame, Tuple[int, int], pd.DataFrame]] = {}
+
+        if write_output:
+            self.aggregate_by_time_periods(params.output_paths['metric_calculation_aggre'])
+            self.aggregate_by_10min_intervals(params.output_paths['metric_calculation_aggre_10min'])
 
     def aggregate_metrics(self, percentile:int):
-        """All metrics aggregation methods. Can be overriden by child class to add more methods.
+        """Aggregate all registered metrics, see :py:meth:`register_metrics`. Observed metrics are only aggregated if AVL data is used.
+        All reductions of the same metrics table at the same aggregation key columns are executed together by the execution backend, 
+        e.g. on a single groupby with the columns of each reducer aggregated together, see :py:meth:`.Execution_Backend.reduce`. Reductions are executed once per metrics table, so only the percentiles are aggregated again 
+        for another percentile of the same time window, and metrics tables that are not time filtered are only aggregated once.
 
         :param percentile: percentile of metrics that is returned, e.g. 50 -> median, 90 -> worst decile
         :type percentile: int
         """
-        # not time-dependent (use non time-filtered data)
-        self.sample_size()
-        self.stop_spacing()
-        self.service_start_end()
-        self.revenue_hour()
 
-        # ---- GTFS metrics ----
-        # time-dependent (use time-filtered data)
-        self.headway(percentile, 'scheduled')
-        self.frequency('scheduled')
-        self.wait_time('scheduled')
-        self.running_time(percentile, 'scheduled')
-        self.speed(percentile, 'scheduled', 'without_dwell')
+        metrics = [metric for metric in self.metric_registry if metric.source == 'gtfs' or 'AVL' in self.data_option]
+
+        # plan the reductions of each metrics table and aggregation level
+        plan:Dict[Tuple[str, str], Dict] = {}
+        for metric in metrics:
+            if metric.column is None:
+                continue
+            for level in metric.levels:
+                table_reductions = plan.setdefault((metric.table_name(level), level), {})
+                for reducer in self.__reducers(metric, percentile):
+                    table_reductions.setdefault(reducer, {})[metric.column] = None
+
+        reduced = {}
+        for (table_name, level), table_reductions in plan.items():
+            reduced[(table_name, level)] = self.__reduce(table_name, level, table_reductions)
+
+        for metric in metrics:
+            for level in metric.levels:
+                level_table = getattr(self, level)
+                values = None
+                if metric.column is not None:
+                    level_reduced = reduced[(metric.table_name(level), level)]
+                    reducers = self.__reducers(metric, percentile)
+                    values = pd.DataFrame({reducer: level_reduced[(reducer, metric.column)] for reducer in reducers}) \
+                                if isinstance(metric.reducer, tuple) else level_reduced[(reducers[0], metric.column)]
+                if metric.derive is not None:
+                    values = metric.derive(level_table, values)
+                level_table[metric.name] = metric.finalize(values)
+            if metric.display_name is not None:
+                self.metrics_names[metric.name] = metric.display_name
+
+    def __reducers(self, metric:Metric, percentile:int) -> List:
+
+        if metric.percentile:
+            return [('quantile', self.__get_percentile(percentile, metric.name))]
+        if isinstance(metric.reducer, tuple):
+            return list(metric.reducer)
+        return [metric.reducer]
+
+    def __reduce(self, table_name:str, level:str, table_reductions:Dict) -> Dict[Tuple, pd.Series]:
+        """Execute the reductions of a metrics table at the key columns of an aggregation level together, and return the reduced 
+        series aligned with the aggregated metrics table of the level by (reducer, column).
+        """
 
-        # ---- AVL metrics ----
-        if 'AVL' in self.data_option:
-            self.headway(percentile, 'observed')
-            self.frequency('observed')
-            self.running_time(percentile, 'observed')
-            self.speed(percentile, 'observed', 'without_dwell')
-            self.speed(percentile, 'observed', 'with_dwell')
-            self.boardings(percentile)
-            self.on_time_performance()
-            self.crowding()
-            self.passenger_load(percentile)
-            self.wait_time('observed')
-            self.excess_wait_time()
-            self.passenger_flow()
-            self.congestion_delay()
-            self.productivity()
-            
+        records = getattr(self, table_name)
+        keys = getattr(self, LEVELS[level][1])
+        level_index = getattr(self, level).index
+
+        cached_records, cached_reduced = self.__reductions.get(table_name, (None, {}))
+        if cached_records is not records:
+            cached_reduced = {}
+            self.__reductions[table_name] = (records, cached_reduced)
+        cached_reduced = cached_reduced.setdefault(level, {})
+        table_reductions = {reducer: [column for column in columns if (reducer, column) not in cached_reduced] 
+                                for reducer, columns in table_reductions.items()}
+
+        table_reduced = {}
+        for reducer, columns in table_reductions.items():
+            if callable(reducer):
+                for column in columns:
+                    # custom reducers reduce float32 values of memory-lean tables as the float64 values they were stored from
+                    column_records = records.assign(**{column: restore_float32(records[column])}) if records[column].dtype == np.dtype('float32') else records
+                    table_reduced[(reducer, column)] = reducer(column_records, column, keys).reindex(level_index)
+
+        backend_reductions = {reducer: columns for reducer, columns in table_reductions.items() if not callable(reducer)}
+        # reduced series usually share their index, which is aligned with the level once, as Series.reindex
+        indexers = {}
+        for reduction, values in self.execution_backend.reduce(records, keys, backend_reductions).items():
+            if id(values.index) not in indexers:
+                indexers[id(values.index)] = values.index.get_indexer(level_index)
+            table_reduced[reduction] = pd.Series(pd.api.extensions.take(values.array, indexers[id(values.index)], allow_fill=True), 
+                                                    index=level_index, name=values.name)
+
+        cached_reduced.update(table_reduced)
+        return cached_reduced
 
     def aggregate_by_start_end_time(self, start_time:List, end_time:List, percentile:int):
         """Given a start_time and end_time, filter each metrics table to keep only stop arrivals within the time window, or 
@@ -156,14 +227,51 @@ class Metric_Aggregation():
         self.tpbp_segments_agg_metrics = self.__get_agg_metrics(self.tpbp_segments.reset_index(), 'segments')
         self.tpbp_corridors_agg_metrics = self.__get_agg_metrics(self.tpbp_corridors.reset_index(), 'corridors')
 
-    def aggregate_by_10min_intervals(self, output_path:str):
-        """Generate aggregation output for every 10-min interval of the day and write to a pickled file the results in a dict. 
-        Each key is a 10-min interval of the full day (defined in the frontend config file under 'PeriodRanges' -> 'full'), 
-        and each element is a dict, whose key is a percentile of aggregation (e.g. 50 or 90), and element is a 
-        tuple of five dataframes, each one containing the aggregated metrics of stop, stop-aggregated, route, timepoint, and
-        timepoint-aggregated metrics.
+    def get_10min_interval_metrics(self, interval_metrics:Callable[[Tuple], Dict[str, pd.DataFrame]]=None) -> Dict[Tuple, Dict[str, Tuple[pd.DataFrame, ...]]]:
+        """Generate aggregation output for every 10-min interval of the day. 
+
+        :param interval_metrics: function of a 10-min interval that returns metrics tables by attribute name, e.g. avl_stop_metrics, 
+            which replace the metrics tables of the aggregation for the interval. They must contain at least the records of the interval. 
+            Used by :py:class:`.Partitioned_Metric_Execution` to aggregate the stop events of each interval read from disk. Defaults to None, 
+            i.e. the same metrics tables are aggregated for all intervals.
+        :type interval_metrics: Callable[[Tuple], Dict[str, pd.DataFrame]], optional
+        :return: a dict, whose key is a 10-min interval of the full day (defined in the frontend config file under 'PeriodRanges' -> 'full'), 
+            and each element is a dict, whose key is a percentile of aggregation (e.g. 50 or 90), and element is a 
+            tuple of five dataframes, each one containing the aggregated metrics of stop, stop-aggregated, route, timepoint, and
+            timepoint-aggregated metrics.
+        :rtype: Dict[Tuple, Dict[str, Tuple[pd.DataFrame, ...]]]
         """
         logger.info(f'aggregating metrics for 10-min intervals')
+
+        agg_metrics_10_min = {}
+        for interval in tqdm(self.get_10min_intervals(), desc='aggregating metrics for 10-min intervals'):
+            interval_start, interval_end = interval
+            if interval_metrics is not None:
+                for table_name, records in interval_metrics(interval).items():
+                    setattr(self, table_name, records)
+
+            agg_metrics_10_min[interval] = {}
+
+            for agg_method, percentile in self.percentiles.items():
+                
+                self.aggregate_by_start_end_time(list(interval_start), list(interval_end), percentile)
+
+                agg_metrics_10_min[interval][agg_method] = (
+                    self.segments_agg_metrics,
+                    self.corridors_agg_metrics,
+                    self.routes_agg_metrics,
+                    self.tpbp_segments_agg_metrics,
+                    self.tpbp_corridors_agg_metrics
+                )
+
+        return agg_metrics_10_min
+
+    def get_10min_intervals(self) -> List[Tuple[Tuple[int, int], Tuple[int, int]]]:
+        """Split the full day (defined in the frontend config file under 'PeriodRanges' -> 'full') into 10-min intervals.
+
+        :return: list of 10-min intervals in order, each one a tuple of its start and end time in (hour, minute), e.g. ((7, 0), (7, 10))
+        :rtype: List[Tuple[Tuple[int, int], Tuple[int, int]]]
+        """
         interval_to_second = lambda x: x[0] * SECONDS_IN_HOUR + x[1] * SECONDS_IN_MINUTE if isinstance(x, List) else x * SECONDS_IN_HOUR
         second_to_interval = lambda x: (x // SECONDS_IN_HOUR, (x % SECONDS_IN_HOUR) // SECONDS_IN_MINUTE)
         
@@ -177,17 +285,40 @@ class Metric_Aggregation():
             interval_end_second = min(day_end_sec, interval_start_second + SECONDS_IN_TEN_MINUTES)
             all_10_min_intervals.append(((second_to_interval(interval_start_second)), (second_to_interval(interval_end_second))))
 
-        agg_metrics_10_min = {}
-        for interval in tqdm(all_10_min_intervals, desc='aggregating metrics for 10-min intervals'):
-            interval_start, interval_end = interval
+        return all_10_min_intervals
 
-            agg_metrics_10_min[interval] = {}
+    def aggregate_by_10min_intervals(self, output_path:str):
+        """Generate aggregation output for every 10-min interval of the day and write to a pickled file the results in a dict. 
+        Each key is a 10-min interval of the full day (defined in the frontend config file under 'PeriodRanges' -> 'full'), 
+        and each element is a dict, whose key is a percentile of aggregation (e.g. 50 or 90), and element is a 
+        tuple of five dataframes, each one containing the aggregated metrics of stop, stop-aggregated, route, timepoint, and
+        timepoint-aggregated metrics.
+        """
+        self.write_10min_interval_metrics(self.get_10min_interval_metrics(), output_path)
 
-            for agg_method, percentile in self.percentiles.items():
-                
-                self.aggregate_by_start_end_time(list(interval_start), list(interval_end), percentile)
+    @staticmethod
+    def write_10min_interval_metrics(agg_metrics_10_min:Dict[Tuple, Dict[str, Tuple[pd.DataFrame, ...]]], output_path:str):
+        """Write to a pickled file the 10-min interval aggregation output returned by :py:meth:`get_10min_interval_metrics`.
+        """
+        output_path = check_parent_dir(output_path)
+        pickle.dump(agg_metrics_10_min, open(output_path, "wb"))
 
-                agg_metrics_10_min[interval][agg_method] = (
+    def get_time_period_metrics(self) -> Dict[Tuple[str, str], Tuple[pd.DataFrame, ...]]:
+        """Generate aggregation output by pre-defined time periods.
+
+        :return: a dict, whose key is a tuple of (time period name, percentile name), e.g. ('am_peak', 'median'), and element is a 
+            tuple of five dataframes, each one containing the aggregated metrics of stop, stop-aggregated, route, timepoint, and
+            timepoint-aggregated metrics.
+        :rtype: Dict[Tuple[str, str], Tuple[pd.DataFrame, ...]]
+        """
+        agg_metrics = {}
+        for period_name, period in tqdm(self.time_dict.items(), desc='aggregating metrics for pre-defined time periods'):
+            start_time, end_time = period
+            for agg_percentile, percentile_value in self.percentiles.items():
+
+                self.aggregate_by_start_end_time(start_time, end_time, percentile_value)
+
+                agg_metrics[(period_name, agg_percentile)] = (
                     self.segments_agg_metrics,
                     self.corridors_agg_metrics,
                     self.routes_agg_metrics,
@@ -195,8 +326,7 @@ class Metric_Aggregation():
                     self.tpbp_corridors_agg_metrics
                 )
 
-        output_path = check_parent_dir(output_path)
-        pickle.dump(agg_metrics_10_min, open(output_path, "wb"))
+        return agg_metrics
 
     def aggregate_by_time_periods(self, output_path:str):
         """Generate aggregation output by pre-defined time periods and write to a pickled file the results in a dict. Each 
@@ -204,27 +334,30 @@ class Metric_Aggregation():
         "segment" means stop level aggregation, corridor means stop-aggregated, segment-timepoints means timepoint, and corridor-timepoints 
         means timepoint-aggregated. Each element is the corresponding aggregated metrics table normalized to the JSON format.
         """
-        agg_metrics = {}
-        for period_name, period in tqdm(self.time_dict.items(), desc='aggregating metrics for pre-defined time periods'):
-            start_time, end_time = period
-            for agg_percentile, percentile_value in self.percentiles.items():
-
-                self.aggregate_by_start_end_time(start_time, end_time, percentile_value)
+        self.write_time_period_metrics(self.get_time_period_metrics(), output_path)
 
-                agg_metrics[f'{period_name}-segment-{agg_percentile}'] = self.segments_agg_metrics.to_json(orient='records')
-                agg_metrics[f'{period_name}-corridor-{agg_percentile}'] = self.corridors_agg_metrics.to_json(orient='records')
-                agg_metrics[f'{period_name}-route-{agg_percentile}'] = self.routes_agg_metrics.to_json(orient='records')
-                agg_metrics[f'{period_name}-segment-timepoints-{agg_percentile}'] = self.tpbp_segments_agg_metrics.to_json(orient='records')
-                agg_metrics[f'{period_name}-corridor-timepoints-{agg_percentile}'] = self.tpbp_corridors_agg_metrics.to_json(orient='records')
+    @staticmethod
+    def write_time_period_metrics(agg_metrics:Dict[Tuple[str, str], Tuple[pd.DataFrame, ...]], output_path:str):
+        """Normalize to the JSON format the time period aggregation output returned by :py:meth:`get_time_period_metrics` and write the results 
+        to a pickled file, keyed by "time period name" - "aggregation level" - "percentile".
+        """
+        agg_metrics_json = {}
+        for (period_name, agg_percentile), tables in agg_metrics.items():
+            for level, table in zip(AGGREGATION_LEVELS, tables):
+                agg_metrics_json[f'{period_name}-{level}-{agg_percentile}'] = table.to_json(orient='records')
 
         output_path = check_parent_dir(output_path)
-        pickle.dump(agg_metrics, open(output_path, "wb"))
+        pickle.dump(agg_metrics_json, open(output_path, "wb"))
 
 
     def __get_agg_metrics(self, metrics_df:pd.DataFrame, data_type:str):
 
+        # keys of metrics tables in memory-lean dtypes are output in their standard dtypes
+        metrics_df = to_standard_dtypes(metrics_df)
         if 'stop_pair' in metrics_df.columns:
-            metrics_df[['first_stop', 'second_stop']] = pd.DataFrame(metrics_df['stop_pair'].tolist(), index=metrics_df.index)
+            metrics_df['first_stop'], metrics_df['second_stop'] = self.stop_pair_codec.decode(metrics_df['stop_pair'])
+            # stop pairs are output as tuples of stop IDs
+            metrics_df['stop_pair'] = self.stop_pair_codec.to_tuples(metrics_df['stop_pair'])
         
         if data_type == 'segments':
             table_rename = {
@@ -246,7 +379,12 @@ class Metric_Aggregation():
         else:
             raise ValueError(f'Invalid metric data_type {data_type}. Must be one of segments, corridors, routes.')
         
-        metrics_df['index'] = metrics_df[index_cols].astype(str).apply('-'.join, axis=1)
+        index_values = metrics_df[index_cols].astype(str)
+        if metrics_df.shape[0] > 0:
+            metrics_df['index'] = index_values[index_cols[0]].str.cat([index_values[col] for col in index_cols[1:]], sep='-')
+        else:
+            # keep the dtype of an empty table
+            metrics_df['index'] = index_values.apply('-'.join, axis=1, result_type='reduce')
         if metrics_df.columns.isin(['first_stop', 'second_stop']).any():
             metrics_df = metrics_df.drop(columns=['first_stop', 'second_stop'])
         df = metrics_df.rename(columns=table_rename)
@@ -266,42 +404,83 @@ class Metric_Aggregation():
 
     def __get_time_filtered_metrics(self, metrics:pd.DataFrame, start_time:int, end_time:int, data_type:str, stop_time_col:str='arrival_time'):
 
+        # the same window is filtered again for each percentile
+        cached_metrics, cached_window, time_filtered_metrics = self.__time_filtered_metrics.get((data_type, stop_time_col), (None, None, None))
+        if cached_metrics is metrics and cached_window == (start_time, end_time):
+            return time_filtered_metrics
+
+        # boolean indexing returns a new table, metrics are not modified by aggregation
         if data_type == 'route':
-            time_filtered_metrics = deepcopy(metrics.loc[(metrics['trip_start_time'] >= start_time) & (metrics['trip_start_time'] < end_time), :])
+            time_filtered_metrics = metrics.loc[(metrics['trip_start_time'] >= start_time) & (metrics['trip_start_time'] < end_time), :]
         else:
-            time_filtered_metrics = deepcopy(metrics.loc[(metrics[stop_time_col] >= start_time) & (metrics[stop_time_col] < end_time), :])
+            time_filtered_metrics = metrics.loc[(metrics[stop_time_col] >= start_time) & (metrics[stop_time_col] < end_time), :]
+        self.__time_filtered_metrics[(data_type, stop_time_col)] = (metrics, (start_time, end_time), time_filtered_metrics)
 
         return time_filtered_metrics
 
     def __generate_segments(self, records:pd.DataFrame):
         
         # Get data structure for segments. Multiindex: route_id, stop_pair, hour       
-        segments = records.groupby(self.SEGMENT_MULTIINDEX)['trip_id'].agg('nunique').to_frame(name = 'sample_size')
+        # groups of observed categorical keys (see to_lean_dtypes) are not always sorted, the aggregated tables are sorted by their keys
+        segments = records.groupby(self.SEGMENT_MULTIINDEX, observed=True)['trip_id'].agg('nunique').to_frame(name = 'sample_size').sort_index()
 
         return segments
     
     def __generate_corridors(self, records:pd.DataFrame):
 
-        corridors = records.groupby(self.CORRIDOR_MULTIINDEX)['trip_id'].agg('nunique').to_frame(name = 'sample_size')
+        corridors = records.groupby(self.CORRIDOR_MULTIINDEX, observed=True)['trip_id'].agg('nunique').to_frame(name = 'sample_size').sort_index()
 
         return corridors
 
     def __generate_routes(self, records:pd.DataFrame):
         
-        routes = records.groupby(self.ROUTE_MULTIINDEX)['trip_id'].agg('nunique').to_frame(name = 'sample_size')
+        routes = records.groupby(self.ROUTE_MULTIINDEX, observed=True)['trip_id'].agg('nunique').to_frame(name = 'sample_size').sort_index()
         return routes
 
-    def sample_size(self):
 
-        sig_fig = 0
+    def register_metrics(self, registry:Metric_Registry):
+        """Register all aggregated metrics in the order of aggregation. Can be overriden by child class to add, replace or remove metrics.
+
+        :param registry: the metric registry of the aggregation
+        :type registry: Metric_Registry
+        """
+        # not time-dependent (use non time-filtered data)
+        registry.add(*self.sample_size_metrics())
+        registry.add(*self.stop_spacing_metrics())
+        registry.add(*self.service_start_end_metrics())
+        registry.add(*self.revenue_hour_metrics())
+
+        # ---- GTFS metrics ----
+        # time-dependent (use time-filtered data)
+        registry.add(*self.headway_metrics('scheduled'))
+        registry.add(*self.frequency_metrics('scheduled'))
+        registry.add(*self.wait_time_metrics('scheduled'))
+        registry.add(*self.running_time_metrics('scheduled'))
+        registry.add(*self.speed_metrics('scheduled', 'without_dwell'))
+
+        # ---- AVL metrics ----
+        registry.add(*self.headway_metrics('observed'))
+        registry.add(*self.frequency_metrics('observed'))
+        registry.add(*self.running_time_metrics('observed'))
+        registry.add(*self.speed_metrics('observed', 'without_dwell'))
+        registry.add(*self.speed_metrics('observed', 'with_dwell'))
+        registry.add(*self.boardings_metrics())
+        registry.add(*self.on_time_performance_metrics())
+        registry.add(*self.crowding_metrics())
+        registry.add(*self.passenger_load_metrics())
+        registry.add(*self.wait_time_metrics('observed'))
+        registry.add(*self.excess_wait_time_metrics())
+        registry.add(*self.passenger_flow_metrics())
+        registry.add(*self.congestion_delay_metrics())
+        registry.add(*self.productivity_metrics())
+
+    def sample_size_metrics(self) -> List[Metric]:
+        """Number of trips at all aggregation levels.
+        """
 
-        self.segments['sample_size'] = self.gtfs_stop_metrics_time_filtered.groupby(self.SEGMENT_MULTIINDEX)['trip_id'].nunique().round(sig_fig)
-        self.corridors['sample_size'] = self.gtfs_stop_metrics_time_filtered.groupby(self.CORRIDOR_MULTIINDEX)['trip_id'].nunique().round(sig_fig)
-        self.tpbp_segments['sample_size'] = self.gtfs_tpbp_metrics_time_filtered.groupby(self.SEGMENT_MULTIINDEX)['trip_id'].nunique().round(sig_fig)
-        self.tpbp_corridors['sample_size'] = self.gtfs_tpbp_metrics_time_filtered.groupby(self.CORRIDOR_MULTIINDEX)['trip_id'].nunique().round(sig_fig)
-        self.routes['sample_size'] = self.gtfs_route_metrics_time_filtered.groupby(self.ROUTE_MULTIINDEX)['trip_id'].nunique().round(sig_fig)
+        return [Metric('sample_size', 'Sample Size', ALL_LEVELS, column='trip_id', reducer='nunique', sig_fig=0)]
 
-    def stop_spacing(self):
+    def stop_spacing_metrics(self) -> List[Metric]:
         """Aggregated stop spacing in ft. This metric is not time-dependent, so use non-time-filtered metrics for calculations.
             
             - stop/stop-aggregated level: stop_spacing of stop pairs averaged over all trips
@@ -309,99 +488,48 @@ class Metric_Aggregation():
             - timepoint/timepoint-aggregated level: stop_spacing of timepoint pairs averaged over all trips
         """
 
-        sig_fig = 0
+        return [Metric('stop_spacing', 'Stop Spacing (ft)', ALL_LEVELS, column='stop_spacing', reducer='mean', time_filtered=False, 
+                        sig_fig=0, fill_value=0, dtype=int)]
 
-        self.segments['stop_spacing'] = self.gtfs_stop_metrics.groupby(self.SEGMENT_MULTIINDEX)['stop_spacing'].mean().round(sig_fig).fillna(0).astype(int)
-        self.corridors['stop_spacing'] = self.gtfs_stop_metrics.groupby(self.CORRIDOR_MULTIINDEX)['stop_spacing'].mean().round(sig_fig).fillna(0).astype(int)
-        self.routes['stop_spacing'] = self.gtfs_route_metrics.groupby(self.ROUTE_MULTIINDEX)['stop_spacing'].mean().round(sig_fig).fillna(0).astype(int)
-        self.tpbp_segments['stop_spacing'] = self.gtfs_tpbp_metrics.groupby(self.SEGMENT_MULTIINDEX)['stop_spacing'].mean().round(sig_fig).fillna(0).astype(int)
-        self.tpbp_corridors['stop_spacing'] = self.gtfs_tpbp_metrics.groupby(self.CORRIDOR_MULTIINDEX)['stop_spacing'].mean().round(sig_fig).fillna(0).astype(int)
-        
-        self.metrics_names['stop_spacing'] = 'Stop Spacing (ft)'
-
-    def service_start_end(self):
+    def service_start_end_metrics(self) -> List[Metric]:
         """Aggregated service start/end in hour. 
 
             - stop/stop-aggregated/timepoint/timepoint-aggregated level: the first arrival at first stop of the pair and the last arrival at the first stop of the pair
             - routes level: the first arrival at first stop (service start) and the last arrival at last stop (service end) of all trips
         """
 
-        sig_fig = 2
-
-        self.segments['service_start'] = (self.gtfs_stop_metrics.groupby(self.SEGMENT_MULTIINDEX)['arrival_time'].agg('min')/3600).round(sig_fig)
-        self.segments['service_end'] = (self.gtfs_stop_metrics.groupby(self.SEGMENT_MULTIINDEX)['arrival_time'].agg('max')/3600).round(sig_fig)
-
-        self.corridors['service_start'] = (self.gtfs_stop_metrics.groupby(self.CORRIDOR_MULTIINDEX)['arrival_time'].agg('min')/3600).round(sig_fig)
-        self.corridors['service_end'] = (self.gtfs_stop_metrics.groupby(self.CORRIDOR_MULTIINDEX)['arrival_time'].agg('max')/3600).round(sig_fig)
+        stop_levels = ['segments', 'corridors', 'tpbp_segments', 'tpbp_corridors']
+        to_hours = lambda table, seconds: seconds / SECONDS_IN_HOUR
 
-        self.routes['service_start'] = (self.gtfs_route_metrics.groupby(self.ROUTE_MULTIINDEX)['trip_start_time'].agg('min')/3600).round(sig_fig)
-        self.routes['service_end'] = (self.gtfs_route_metrics.groupby(self.ROUTE_MULTIINDEX)['trip_end_time'].agg('max')/3600).round(sig_fig)
+        return [
+            Metric('service_start', 'Service Start (hr)', stop_levels, column='arrival_time', reducer='min', time_filtered=False, derive=to_hours, sig_fig=2),
+            Metric('service_start', 'Service Start (hr)', ['routes'], column='trip_start_time', reducer='min', time_filtered=False, derive=to_hours, sig_fig=2),
+            Metric('service_end', 'Service End (hr)', stop_levels, column='arrival_time', reducer='max', time_filtered=False, derive=to_hours, sig_fig=2),
+            Metric('service_end', 'Service End (hr)', ['routes'], column='trip_end_time', reducer='max', time_filtered=False, derive=to_hours, sig_fig=2)
+        ]
 
-        self.tpbp_segments['service_start'] = (self.gtfs_tpbp_metrics.groupby(self.SEGMENT_MULTIINDEX)['arrival_time'].agg('min')/3600).round(sig_fig)
-        self.tpbp_segments['service_end'] = (self.gtfs_tpbp_metrics.groupby(self.SEGMENT_MULTIINDEX)['arrival_time'].agg('max')/3600).round(sig_fig)
-
-        self.tpbp_corridors['service_start'] = (self.gtfs_tpbp_metrics.groupby(self.CORRIDOR_MULTIINDEX)['arrival_time'].agg('min')/3600).round(sig_fig)
-        self.tpbp_corridors['service_end'] = (self.gtfs_tpbp_metrics.groupby(self.CORRIDOR_MULTIINDEX)['arrival_time'].agg('max')/3600).round(sig_fig)
-        
-        self.metrics_names['service_start'] = 'Service Start (hr)'
-        self.metrics_names['service_end'] = 'Service End (hr)'
-
-    def revenue_hour(self):
+    def revenue_hour_metrics(self) -> List[Metric]:
         """Aggregated revenue hours in hr.
         
             - all aggregation levels: the time lapse between service_end and service_start
         """
 
-        sig_fig = 2
-
-        self.segments['revenue_hour'] = (self.segments['service_end'] - self.segments['service_start']).round(sig_fig)
-        self.corridors['revenue_hour'] = (self.corridors['service_end'] - self.corridors['service_start']).round(sig_fig)
-        self.routes['revenue_hour'] = (self.routes['service_end'] - self.routes['service_start']).round(sig_fig)
-        self.tpbp_segments['revenue_hour'] = (self.tpbp_segments['service_end'] - self.tpbp_segments['service_start']).round(sig_fig)
-        self.tpbp_corridors['revenue_hour'] = (self.tpbp_corridors['service_end'] - self.tpbp_corridors['service_start']).round(sig_fig)
+        return [Metric('revenue_hour', 'Revenue Hour (hr)', ALL_LEVELS, derive=lambda table, _: table['service_end'] - table['service_start'], sig_fig=2)]
 
-        self.metrics_names['revenue_hour'] = 'Revenue Hour (hr)'
-
-    def headway(self, percentile:int, data_type:str):
+    def headway_metrics(self, data_type:str) -> List[Metric]:
         """Aggregated scheduled or observed headway in minutes. 
         
             - all aggregation levels: the average or mode or percentile of headways of all trips
 
-        :param percentile: the percentile that metrics are aggregated at
-        :type percentile: int
         :param data_type: 'scheduled' or 'observed'
         :type data_type: str
         """
 
-        sig_fig = 0
-
         metric_name = f'{data_type}_headway'
+        return [Metric(metric_name, f'{data_type.capitalize()} Headway (min)', ALL_LEVELS, DATA_TYPE_SOURCES[data_type], column=metric_name, 
+                        percentile=True, sig_fig=0)]
 
-        percentile = self.__get_percentile(percentile, metric_name)
-
-        if data_type == 'scheduled':
-            stop_metrics = self.gtfs_stop_metrics_time_filtered
-            route_metrics = self.gtfs_route_metrics_time_filtered
-            tpbp_metrics = self.gtfs_tpbp_metrics_time_filtered
-        elif data_type == 'observed':
-            stop_metrics = self.avl_stop_metrics_time_filtered
-            route_metrics = self.avl_route_metrics_time_filtered
-            tpbp_metrics = self.avl_tpbp_metrics_time_filtered
-
-        self.segments[metric_name] = (stop_metrics.groupby(self.SEGMENT_MULTIINDEX)[metric_name]\
-                                        .quantile(percentile)).round(sig_fig)
-        self.corridors[metric_name] = (stop_metrics.groupby(self.CORRIDOR_MULTIINDEX)[metric_name]\
-                                        .quantile(percentile)).round(sig_fig)
-        self.routes[metric_name] = (route_metrics.groupby(self.ROUTE_MULTIINDEX)[metric_name]\
-                                        .quantile(percentile)).round(sig_fig)
-        self.tpbp_segments[metric_name] = (tpbp_metrics.groupby(self.SEGMENT_MULTIINDEX)[metric_name]\
-                                        .quantile(percentile)).round(sig_fig)
-        self.tpbp_corridors[metric_name] = (tpbp_metrics.groupby(self.CORRIDOR_MULTIINDEX)[metric_name]\
-                                        .quantile(percentile)).round(sig_fig)
-        
-        self.metrics_names[metric_name] = f'{data_type.capitalize()} Headway (min)'
-
-    def frequency(self, data_type:str):
+    def frequency_metrics(self, data_type:str) -> List[Metric]:
         """Aggregated scheduled frequency in trips/hr. 
         
             - all aggregation levels: the number of trips divided by service span (revenue hour)
@@ -410,102 +538,46 @@ class Metric_Aggregation():
         :type data_type: str
         """
 
-        sig_fig = 1
-
-        self.segments[f'{data_type}_frequency'] = (60 / self.segments[f'{data_type}_headway']).round(sig_fig)
-        self.corridors[f'{data_type}_frequency'] = (60 / self.corridors[f'{data_type}_headway']).round(sig_fig)
-        self.routes[f'{data_type}_frequency'] = (60 / self.routes[f'{data_type}_headway']).round(sig_fig)
-        self.tpbp_segments[f'{data_type}_frequency'] = (60 / self.tpbp_segments[f'{data_type}_headway']).round(sig_fig)
-        self.tpbp_corridors[f'{data_type}_frequency'] = (60 / self.tpbp_corridors[f'{data_type}_headway']).round(sig_fig)
+        return [Metric(f'{data_type}_frequency', f'{data_type.capitalize()} Freq. (/hr)', ALL_LEVELS, DATA_TYPE_SOURCES[data_type], 
+                        derive=lambda table, _: 60 / table[f'{data_type}_headway'], sig_fig=1)]
 
-        self.metrics_names[f'{data_type}_frequency'] = f'{data_type.capitalize()} Freq. (/hr)'
-
-    def running_time(self, percentile:int, data_type:str):
+    def running_time_metrics(self, data_type:str) -> List[Metric]:
         """Aggregated scheduled or observed running time in minutes. 
         
             - stop/stop-aggregated level: running time between each stop pair averaged over all trips
             - routes level: sum of running time between all stop pairs along a route averaged over all trips
             - timepoint/timepoint-aggregated level: running time between each timepoint pair averaged over all trips
 
-        :param percentile: the percentile that metrics are aggregated at
-        :type percentile: int
         :param data_type: 'scheduled' or 'observed'
         :type data_type: str
         """
-        
-        sig_fig = 1
-        metric_name = f'{data_type}_running_time'
-
-        percentile = self.__get_percentile(percentile, metric_name)
-
-        if data_type == 'scheduled':
-            stop_metrics = self.gtfs_stop_metrics_time_filtered
-            route_metrics = self.gtfs_route_metrics_time_filtered
-            tpbp_metrics = self.gtfs_tpbp_metrics_time_filtered
-        elif data_type == 'observed':
-            stop_metrics = self.avl_stop_metrics_time_filtered
-            route_metrics = self.avl_route_metrics_time_filtered
-            tpbp_metrics = self.avl_tpbp_metrics_time_filtered
 
-        self.segments[metric_name] = stop_metrics.groupby(self.SEGMENT_MULTIINDEX)[metric_name].quantile(percentile).round(sig_fig)
-        self.corridors[metric_name] = stop_metrics.groupby(self.CORRIDOR_MULTIINDEX)[metric_name].quantile(percentile).round(sig_fig)
-        self.routes[metric_name] = route_metrics.groupby(self.ROUTE_MULTIINDEX)[metric_name].quantile(percentile).round(sig_fig)
-        self.tpbp_segments[metric_name] = tpbp_metrics.groupby(self.SEGMENT_MULTIINDEX)[metric_name].quantile(percentile).round(sig_fig)
-        self.tpbp_corridors[metric_name] = tpbp_metrics.groupby(self.CORRIDOR_MULTIINDEX)[metric_name].quantile(percentile).round(sig_fig)
-
-        self.metrics_names[metric_name] = f'{data_type.capitalize()} Running Time (min)'
+        metric_name = f'{data_type}_running_time'
+        return [Metric(metric_name, f'{data_type.capitalize()} Running Time (min)', ALL_LEVELS, DATA_TYPE_SOURCES[data_type], column=metric_name, 
+                        percentile=True, sig_fig=1)]
 
-    def speed(self, percentile:int, data_type:str, dwell:str):
+    def speed_metrics(self, data_type:str, dwell:str) -> List[Metric]:
         """Aggregated scheduled or observed running speed with or without dwell in mph. 
         
             - stop/stop-aggregated level: running speed between each stop pair averaged over all trips
             - routes level: (sum of stop spacing of all stops) / (sum of running time of all stops) along a route averaged over all trips
             - timepoint/timepoint-aggregated level: running speed between each timepoint pair averaged over all trips
 
-        :param percentile: the percentile that metrics are aggregated at
-        :type percentile: int
         :param data_type: 'scheduled' or 'observed'
         :type data_type: str
         :param dwell: 'with_dwell' or '' (empty string means without dwell), defaults to ''
         :type dwell: str, optional
         """
-       
-        sig_fig = 0
+
         if dwell == '':
             metric_name = f'{data_type}_speed'
         else:
             metric_name = f'{data_type}_speed_{dwell}'
 
-        percentile = self.__get_percentile(percentile, metric_name)
-
-        if data_type == 'scheduled':
-            stop_metrics = self.gtfs_stop_metrics_time_filtered
-            route_metrics = self.gtfs_route_metrics_time_filtered
-            tpbp_metrics = self.gtfs_tpbp_metrics_time_filtered
-        elif data_type == 'observed':
-            stop_metrics = self.avl_stop_metrics_time_filtered
-            route_metrics = self.avl_route_metrics_time_filtered
-            tpbp_metrics = self.avl_tpbp_metrics_time_filtered
-
-        self.segments[metric_name] = stop_metrics\
-                                        .groupby(self.SEGMENT_MULTIINDEX)[metric_name].quantile(percentile)\
-                                            .clip(lower=self.speed_range['min'], upper=self.speed_range['max']).round(sig_fig)
-        self.corridors[metric_name] = stop_metrics\
-                                        .groupby(self.CORRIDOR_MULTIINDEX)[metric_name].quantile(percentile)\
-                                            .clip(lower=self.speed_range['min'], upper=self.speed_range['max']).round(sig_fig)
-        self.routes[metric_name] = route_metrics\
-                                        .groupby(self.ROUTE_MULTIINDEX)[metric_name].quantile(percentile)\
-                                            .clip(lower=self.speed_range['min'], upper=self.speed_range['max']).round(sig_fig)
-        self.tpbp_segments[metric_name] = tpbp_metrics\
-                                            .groupby(self.SEGMENT_MULTIINDEX)[metric_name].quantile(percentile)\
-                                                .clip(lower=self.speed_range['min'], upper=self.speed_range['max']).round(sig_fig)
-        self.tpbp_corridors[metric_name] = tpbp_metrics\
-                                            .groupby(self.CORRIDOR_MULTIINDEX)[metric_name].quantile(percentile)\
-                                                .clip(lower=self.speed_range['min'], upper=self.speed_range['max']).round(sig_fig)
-
-        self.metrics_names[metric_name] = f'{data_type.capitalize()} Speed {dwell.title()} (mph)'
-
-    def wait_time(self, data_type:str):
+        return [Metric(metric_name, f'{data_type.capitalize()} Speed {dwell.title()} (mph)', ALL_LEVELS, DATA_TYPE_SOURCES[data_type], column=metric_name, 
+                        percentile=True, clip=(self.speed_range['min'], self.speed_range['max']), sig_fig=0)]
+
+    def wait_time_metrics(self, data_type:str) -> List[Metric]:
         """Aggregated Poisson wait time in minuntes. Wait time values are capped at 300 min (5 hr).
 
             - stop level: headway mean / 2 + variance / (2 * mean), assuming passenger arrival follows a Poisson process.
@@ -515,143 +587,94 @@ class Metric_Aggregation():
         :type data_type: str
         """
 
-        sig_fig = 0
         wait_time_cap = 300
 
-        metric_name = f'{data_type}_wait_time'
-
-        if data_type == 'scheduled':
-            stop_metrics = self.gtfs_stop_metrics_time_filtered
-        elif data_type == 'observed':
-            stop_metrics = self.avl_stop_metrics_time_filtered
+        def poisson_wait_time(table:pd.DataFrame, headway:pd.DataFrame) -> pd.Series:
+            headway_mean = headway['mean'].fillna(0)
+            return (headway_mean / 2) + (headway['var'] / (2 * headway_mean))
 
-        segments_data = stop_metrics.groupby(self.SEGMENT_MULTIINDEX)[f'{data_type}_headway']\
-                                                    .agg('mean').to_frame(f'{data_type}_headway_mean').fillna(0)
-        segments_data[f'{data_type}_headway_variance'] = stop_metrics.groupby(self.SEGMENT_MULTIINDEX)[f'{data_type}_headway']\
-                                                        .agg('var')
-        self.segments[metric_name] = ((segments_data[f'{data_type}_headway_mean'] / 2) \
-                                        + (segments_data[f'{data_type}_headway_variance'] / (2 * segments_data[f'{data_type}_headway_mean'])))\
-                                            .clip(upper=wait_time_cap).round(sig_fig)
+        return [Metric(f'{data_type}_wait_time', f'{data_type.capitalize()} Wait (min)', ['segments'], DATA_TYPE_SOURCES[data_type], 
+                        column=f'{data_type}_headway', reducer=('mean', 'var'), derive=poisson_wait_time, clip=(None, wait_time_cap), sig_fig=0)]
 
-        self.metrics_names[metric_name] = f'{data_type.capitalize()} Wait (min)'
-
-    def excess_wait_time(self):
+    def excess_wait_time_metrics(self) -> List[Metric]:
         """Excess Poisson wait time in minutes. 
 
             - stop level: observed Poisson wait time - scheduled Poisson wait time
         """
-        self.segments['excess_wait_time'] = (self.segments['observed_wait_time'] - self.segments['scheduled_wait_time']).clip(lower=0)
 
-        self.metrics_names['excess_wait_time'] = 'Excess Wait (min)'
+        return [Metric('excess_wait_time', 'Excess Wait (min)', ['segments'], 'avl', 
+                        derive=lambda table, _: table['observed_wait_time'] - table['scheduled_wait_time'], clip=(0, None))]
 
-    def boardings(self, percentile:int):
+    def boardings_metrics(self) -> List[Metric]:
         """Aggregated boardings in pax. 
 
             - stop/stop-aggregated level: boardings at the first stop of a stop pair averaged over all trips
             - routes level: and the sum of boardings at all stops along a route averaged over all trips
             - timepoint/timepoint-aggregated level: boardings at the first stop of a timepoint pair averaged over all trips
-
-        :param percentile: the percentile that metrics are aggregated at
-        :type percentile: int
         """
 
-        sig_fig = 0
-
-        percentile = self.__get_percentile(percentile, 'boardings')
-
-        self.segments['boardings'] = self.avl_stop_metrics_time_filtered.groupby(self.SEGMENT_MULTIINDEX)['boardings'].quantile(percentile).round(sig_fig)
-        self.corridors['boardings'] = self.avl_stop_metrics_time_filtered.groupby(self.CORRIDOR_MULTIINDEX)['boardings'].quantile(percentile).round(sig_fig)
-        self.routes['boardings'] = self.avl_route_metrics_time_filtered.groupby(self.ROUTE_MULTIINDEX)['boardings'].quantile(percentile).round(sig_fig)
-        self.tpbp_segments['boardings'] = self.avl_tpbp_metrics_time_filtered.groupby(self.SEGMENT_MULTIINDEX)['boardings'].quantile(percentile).round(sig_fig)
-        self.tpbp_corridors['boardings'] = self.avl_tpbp_metrics_time_filtered.groupby(self.CORRIDOR_MULTIINDEX)['boardings'].quantile(percentile).round(sig_fig)
-
-        self.metrics_names['boardings'] = 'Boardings (pax)'
+        return [Metric('boardings', 'Boardings (pax)', ALL_LEVELS, 'avl', column='boardings', percentile=True, sig_fig=0)]
 
-    def on_time_performance(self):
+    def on_time_performance_metrics(self) -> List[Metric]:
         """Aggregated on-time performance in seconds or %.
 
             - stop level: arrival delay in seconds at the first stop of a stop pair averaged over all trips
             - routes level: percent of on-time arrivals among all stops along a trip averaged over all trips
         """
 
-        sig_fig = 0
+        return [Metric('on_time_performance', 'On Time Performance (sec)', ['segments', 'routes'], 'avl', column='on_time_performance', 
+                        reducer='mean', sig_fig=0)]
 
-        self.segments['on_time_performance'] = self.avl_stop_metrics_time_filtered.groupby(self.SEGMENT_MULTIINDEX)['on_time_performance'].mean().round(sig_fig)
-        self.routes['on_time_performance'] = self.avl_route_metrics_time_filtered.groupby(self.ROUTE_MULTIINDEX)['on_time_performance'].mean().round(sig_fig)
-
-        self.metrics_names['on_time_performance'] = 'On Time Performance (sec)'
-
-    def crowding(self):
+    def crowding_metrics(self) -> List[Metric]:
         """Aggregated crowding in %.
 
             - stop/stop-aggregated level: crowding level between a stop pair averaged over all trips
             - route level: peak crowding level of a trip averaged over all trips
-        """
 
-        sig_fig = 0
+        Stop-aggregated boardings are replaced by the average boardings of all trips.
+        """
 
-        self.segments['crowding'] = self.avl_stop_metrics_time_filtered.groupby(self.SEGMENT_MULTIINDEX)['crowding'].mean().round(sig_fig)
-        self.corridors['boardings'] = self.avl_stop_metrics_time_filtered.groupby(self.CORRIDOR_MULTIINDEX)['boardings'].mean().round(sig_fig)
-        self.routes['crowding'] = self.avl_route_metrics_time_filtered.groupby(self.ROUTE_MULTIINDEX)['crowding'].mean().round(sig_fig)
-        
-        self.metrics_names['crowding'] = 'Crowding (% of seated capacity)'
+        return [
+            Metric('crowding', 'Crowding (% of seated capacity)', ['segments'], 'avl', column='crowding', reducer='mean', sig_fig=0),
+            Metric('boardings', None, ['corridors'], 'avl', column='boardings', reducer='mean', sig_fig=0),
+            Metric('crowding', 'Crowding (% of seated capacity)', ['routes'], 'avl', column='crowding', reducer='mean', sig_fig=0)
+        ]
 
-    def passenger_load(self, percentile:int):
+    def passenger_load_metrics(self) -> List[Metric]:
         """Aggregated passenger load in pax.
 
             - stop level: passenger load between a stop pair averaged over all trips
-
-        :param percentile: the percentile that metrics are aggregated at
-        :type percentile: int
         """
 
-        sig_fig = 0
-        percentile = self.__get_percentile(percentile, 'passenger_load')
-
-        self.segments['passenger_load'] = self.avl_stop_metrics_time_filtered\
-                                                    .groupby(self.SEGMENT_MULTIINDEX)['passenger_load'].quantile(percentile).round(sig_fig)
+        return [Metric('passenger_load', 'Passenger Load (pax)', ['segments'], 'avl', column='passenger_load', percentile=True, sig_fig=0)]
 
-        self.metrics_names['passenger_load'] = 'Passenger Load (pax)'
-
-    def passenger_flow(self):
+    def passenger_flow_metrics(self) -> List[Metric]:
         """Aggregated passenger flow in pax/hr.
 
             - stop level: (sum of passenger load) / (revenue hour) between a stop pair
         """
 
-        sig_fig = 0
-
-        self.segments['passenger_flow'] = (self.avl_stop_metrics_time_filtered.groupby(self.SEGMENT_MULTIINDEX)['passenger_load'].sum() / \
-                                            (self.segments['revenue_hour'])).round(sig_fig)
-
-        self.corridors['passenger_flow'] = (self.avl_stop_metrics_time_filtered.groupby(self.CORRIDOR_MULTIINDEX)['passenger_load'].sum() / \
-                                            (self.corridors['revenue_hour'])).round(sig_fig)
-
-        self.metrics_names['passenger_flow'] = 'Passenger Flow (pax/hr)'
+        return [Metric('passenger_flow', 'Passenger Flow (pax/hr)', ['segments', 'corridors'], 'avl', column='passenger_load', reducer='sum', 
+                        derive=lambda table, passenger_load: passenger_load / table['revenue_hour'], sig_fig=0)]
 
-    def congestion_delay(self):
+    def congestion_delay_metrics(self) -> List[Metric]:
         """Aggregated vehicle- and passenger-weighted congestion delay in min/mile or pax-min/mile.
 
             - stop level: vehicle- and passenger-congestion delays between a stop pair averaged over all trips
         """
-        
-        sig_fig = 0
-
-        self.segments['vehicle_congestion_delay'] = self.avl_stop_metrics_time_filtered.groupby(self.SEGMENT_MULTIINDEX)['vehicle_congestion_delay'].mean().round(sig_fig)
-        self.segments['passenger_congestion_delay'] = self.avl_stop_metrics_time_filtered.groupby(self.SEGMENT_MULTIINDEX)['passenger_congestion_delay'].mean().round(sig_fig)
 
-        self.metrics_names['vehicle_congestion_delay'] = 'Vehicle Congestion Delay (min/mi)'
-        self.metrics_names['passenger_congestion_delay'] = 'Passenger Congestion Delay (pax-min/mi)'
+        return [
+            Metric('vehicle_congestion_delay', 'Vehicle Congestion Delay (min/mi)', ['segments'], 'avl', column='vehicle_congestion_delay', 
+                    reducer='mean', sig_fig=0),
+            Metric('passenger_congestion_delay', 'Passenger Congestion Delay (pax-min/mi)', ['segments'], 'avl', column='passenger_congestion_delay', 
+                    reducer='mean', sig_fig=0)
+        ]
 
-    def productivity(self):
+    def productivity_metrics(self) -> List[Metric]:
         """Productivity in pax/revenue hour. 
 
             - route level: (sum of passengers that board at all stops of a route) / (revenue hour of the route)
         """
 
-        sig_fig = 0
-
-        self.routes['productivity'] = (self.avl_route_metrics.groupby(self.ROUTE_MULTIINDEX)['boardings'].sum() \
-                                        / self.routes['revenue_hour']).round(sig_fig)
-
-        self.metrics_names['productivity'] = 'Productivity (pax/rev.hr)'
\ No newline at end of file
+        return [Metric('productivity', 'Productivity (pax/rev.hr)', ['routes'], 'avl', column='boardings', reducer='sum', time_filtered=False, 
+                        derive=lambda table, boardings: boardings / table['revenue_hour'], sig_fig=0)]
@@ -1,8 +1,12 @@
-from copy import deepcopy
 import logging
 import pandas as pd
 import numpy as np
+from typing import Dict, List
 from backend.data_class.rove_parameters import ROVE_params
+from backend.helper_functions import to_lean_dtypes
+from backend.metrics.execution_backend import Execution_Backend, get_execution_backend
+from backend.metrics.group_index import Group_Index, Group_Index_Cache
+from backend.metrics.stop_pair_codec import Stop_Pair_Codec
 
 logger = logging.getLogger("backendLogger")
 
@@ -20,7 +24,15 @@ class Metric_Calculation():
     and records for the same trip_id exist across multiple days, then calculate the trip metrics by averaging across all service dates. 
     In other words, the metric calculation module averages metrics for the same trip, so that metrics tables after calculation 
     only contains unique route_id, trip_id and stop_pair combinations. This is the upstream calculation of metric aggregation, which 
-    averages metrics of all trips on each aggregation level.
+    averages metrics of all trips on each aggregation level. Stop pairs are stored as int64 codes of the stop_pair_codec, see :py:class:`.Stop_Pair_Codec`.
+
+    Metrics tables are built once and extended in place: columns of other tables are attached by index alignment on their keys (see
+    :py:meth:`__add_lookup_columns`) rather than by merging whole tables, and intermediate values are kept in local series. Groupwise 
+    operations (shifts, headway diffs, per-trip sums and timepoint roll-ups) use a :py:class:`.Group_Index` of each table and key set, 
+    which is computed once and reused by all metrics of the table, see :py:meth:`__group_index`. The groupwise sums, maxima and quantiles 
+    are executed by the execution backend selected by params, see :py:class:`.Execution_Backend`. If lean_dtypes is set in params, the 
+    prepared records and the calculated metrics tables are stored in memory-lean dtypes, see :py:func:`.to_lean_dtypes`, while the 
+    metrics are calculated in float64.
 
     :param shapes: shapes table from Shape Generation
     :type shapes: pd.DataFrame
@@ -30,41 +42,55 @@ class Metric_Calculation():
     :type avl_records: pd.DataFrame
     :param data_option: user-specified data option
     :type data_option: str
+    :param stop_pair_codec: codec of the stop pairs, shared by metrics tables that are aggregated together. Defaults to None, 
+        a new codec of the stops of gtfs_records and avl_records.
+    :type stop_pair_codec: Stop_Pair_Codec, optional
     :raises ValueError: 'AVL' is in data_option but the avl_records table is None
     """
-    def __init__(self, shapes:pd.DataFrame, gtfs_records:pd.DataFrame, avl_records:pd.DataFrame, params:ROVE_params):
+    def __init__(self, shapes:pd.DataFrame, gtfs_records:pd.DataFrame, avl_records:pd.DataFrame, params:ROVE_params, 
+                    stop_pair_codec:Stop_Pair_Codec=None):
         
         logger.info(f'Calculating metrics...')
 
+        if stop_pair_codec is None:
+            stop_pair_codec = Stop_Pair_Codec(pd.concat([gtfs_records['stop_id'], avl_records['stop_id'] if avl_records is not None else None]))
+        #: Codec of the stop_pair columns of all metrics tables.
+        self.stop_pair_codec:Stop_Pair_Codec = stop_pair_codec
+        #: Engine of the groupwise reductions, selected by the execution_backend parameter of params.
+        self.execution_backend:Execution_Backend = get_execution_backend(params)
+        #: Whether the metrics tables are stored in memory-lean dtypes.
+        self.lean_dtypes:bool = params.lean_dtypes
+        self.__group_indexes = Group_Index_Cache()
+
         #: Initial stop-level metrics table generated from the GTFS records table.
         self.gtfs_stop_metrics:pd.DataFrame = self.__prepare_stop_event_records(gtfs_records, 'GTFS')
 
         #: Initial timepoint-level metrics table generated from the GTFS records table.
-        self.gtfs_tpbp_metrics = self.__prepare_stop_event_records(gtfs_records.loc[gtfs_records['tp_bp']==1, :], 'GTFS')
+        self.gtfs_tpbp_metrics = self.__prepare_stop_event_records(gtfs_records, 'GTFS', gtfs_records['tp_bp'].to_numpy()==1)
 
         self.GTFS_ROUTE_METRICS_KEY_COLUMNS = ['pattern', 'route_id', 'direction_id', 'trip_id']
         #: Initial route-level metrics table generated from the GTFS records table.
         self.gtfs_route_metrics = self.gtfs_stop_metrics[self.GTFS_ROUTE_METRICS_KEY_COLUMNS + ['trip_start_time', 'trip_end_time']].drop_duplicates()
         # add service_id column
-        self.gtfs_route_metrics = self.gtfs_route_metrics.merge(self.gtfs_stop_metrics[['trip_id', 'service_id']].drop_duplicates(), \
-                                        on=['trip_id'], how='left')    
+        self.gtfs_route_metrics = self.__add_lookup_columns(self.gtfs_route_metrics, self.gtfs_stop_metrics[['trip_id', 'service_id']], \
+                                        ['trip_id'], keep_index=False)
 
         data_option = params.data_option
         
         if 'AVL' in data_option:
             if avl_records is not None:
                 self.avl_stop_metrics = self.__prepare_stop_event_records(avl_records, 'AVL')
-                # add tp_bp column
-                self.avl_stop_metrics = self.avl_stop_metrics.merge(self.gtfs_stop_metrics[['route_id', 'stop_id', 'tp_bp', 'timepoint']].drop_duplicates(), \
-                                        on=['route_id', 'stop_id'], how='left')
+                # add tp_bp column, a stop is a timepoint (or branchpoint) of a route if it is one in any pattern of the route
+                route_stops = self.gtfs_stop_metrics.groupby(['route_id', 'stop_id'], observed=True)[['tp_bp', 'timepoint']].max().reset_index()
+                self.avl_stop_metrics = self.__add_lookup_columns(self.avl_stop_metrics, route_stops, ['route_id', 'stop_id'], keep_index=False)
 
-                self.avl_tpbp_metrics = self.__prepare_stop_event_records(self.avl_stop_metrics[self.avl_stop_metrics['tp_bp']==1], 'AVL')
+                self.avl_tpbp_metrics = self.__prepare_stop_event_records(self.avl_stop_metrics, 'AVL', self.avl_stop_metrics['tp_bp'].to_numpy()==1)
 
                 self.AVL_ROUTE_METRICS_KEY_COLUMNS = ['svc_date', 'trip_id', 'route_id']
                 self.avl_route_metrics = self.avl_stop_metrics[self.AVL_ROUTE_METRICS_KEY_COLUMNS + ['trip_start_time', 'trip_end_time']].drop_duplicates()
                 # add direction_id column
-                self.avl_route_metrics = self.avl_route_metrics.merge(self.gtfs_route_metrics[['route_id', 'trip_id', 'direction_id']].drop_duplicates(), \
-                                        on=['route_id', 'trip_id'], how='left')        
+                self.avl_route_metrics = self.__add_lookup_columns(self.avl_route_metrics, self.gtfs_route_metrics[['route_id', 'trip_id', 'direction_id']], \
+                                        ['route_id', 'trip_id'], keep_index=False)
             else:
                 raise ValueError(f'data_option is {data_option} but the AVL records table is None.')
 
@@ -72,29 +98,43 @@ class Metric_Calculation():
         self.stop_spacing(shapes)
         self.scheduled_headway()
         self.scheduled_running_time()
+        # timepoint pair sums of all additive metrics of a table are rolled up at once, before the timepoint speeds
+        self.__sum_by_tpbp_group(self.gtfs_stop_metrics, self.gtfs_tpbp_metrics, ['trip_id'], {'stop_spacing': 2, 'scheduled_running_time': 2})
         self.scheduled_speed_without_dwell()
 
         # ---- AVL metrics ----
         if 'AVL' in data_option:
             self.observed_headway()
             self.observed_running_time()
-            self.observed_speed_without_dwell()
             self.observed_running_time_with_dwell()
-            self.observed_speed_with_dwell()
             self.boardings()
+            self.__sum_by_tpbp_group(self.avl_stop_metrics, self.avl_tpbp_metrics, ['svc_date', 'trip_id'], 
+                                     {'observed_running_time': 2, 'observed_running_time_with_dwell': 2, 'boardings': 0})
+            self.observed_speed_without_dwell()
+            self.observed_speed_with_dwell()
             self.on_time_performance()
             self.passenger_load()
             self.crowding()
             self.congestion_delay()
+        self.__group_indexes.clear()
+
+        if self.lean_dtypes:
+            for table in [self.gtfs_stop_metrics, self.gtfs_tpbp_metrics, self.gtfs_route_metrics] + \
+                    ([self.avl_stop_metrics, self.avl_tpbp_metrics, self.avl_route_metrics] if 'AVL' in data_option else []):
+                to_lean_dtypes(table, floats=True)
         logger.info(f'Metrics calculation completed.')
 
-    def __prepare_stop_event_records(self, records:pd.DataFrame, type:str) -> pd.DataFrame:
-        """Add three columns to the records table: next_stop, next_stop_arrival_time, stop_pair while keeping original index.
+    def __prepare_stop_event_records(self, records:pd.DataFrame, type:str, subset:np.ndarray=None) -> pd.DataFrame:
+        """Add three columns to the records table: next_stop, next_stop_arrival_time, stop_pair (code of the stop pair, see 
+        :py:class:`.Stop_Pair_Codec`) while keeping original index.
 
         :param records: GTFS records
         :type records: pd.DataFrame
         :param type: depending on 'GTFS' or 'AVL', a different grouping is used to populate the next stop ID and its arrival time for each stop record
         :type type: str
+        :param subset: boolean mask of the records to prepare, e.g. the tp_bp stops, whose trip groups are taken from the trip groups of 
+            all records. Defaults to None, all records.
+        :type subset: np.ndarray, optional
         :raises ValueError: a type that is not 'GTFS' or 'AVL' is given
         :return: the records table with the three added columns
         :rtype: pd.DataFrame
@@ -109,13 +149,136 @@ class Metric_Calculation():
         else:
             raise ValueError(f"Invalid type {type}, must be one of: 'GTFS', 'AVL'.")
 
-        records = deepcopy(records).reset_index()
-        records.loc[:, 'next_stop'] = records.groupby(by=groups)['stop_id'].shift(-1)
-        records.loc[:, 'next_stop_arrival_time'] = records.groupby(by=groups)[arrival_time_col].shift(-1)
-        records.loc[:, 'stop_pair'] = pd.Series(list(zip(records.stop_id, records.next_stop)))
-        records = records.dropna(subset=['next_stop']).set_index('index')
+        if subset is None:
+            trips = Group_Index(records, groups)
+        else:
+            trips = self.__group_index(records, groups)
+            records = records[subset]
+            trips = trips.subset(records, subset)
+
+        next_stop = trips.shift(records['stop_id'], -1)
+        next_stop_arrival_time = trips.shift(records[arrival_time_col], -1)
+        has_next_stop = ~pd.isna(next_stop)
+
+        # the only copy of the records
+        records = records[has_next_stop].rename_axis('index')
+        records['next_stop'] = next_stop[has_next_stop]
+        records['next_stop_arrival_time'] = next_stop_arrival_time[has_next_stop]
+        records['stop_pair'] = self.stop_pair_codec.encode(records['stop_id'], records['next_stop'])
+        if self.lean_dtypes:
+            to_lean_dtypes(records)
+        self.__group_index(records, groups, group_index=trips.subset(records, has_next_stop))
+
+        return records
+
+    def __group_index(self, records:pd.DataFrame, keys:List[str], split_column:str=None, group_index:Group_Index=None) -> Group_Index:
+        """Group index of a metrics table by key columns, cached per table object and key set (see :py:class:`.Group_Index_Cache`) 
+        so that the groups of a table are only computed once for all of its metrics. The index is recomputed if the table is replaced, 
+        e.g. by a merge.
+
+        :param records: metrics table
+        :type records: pd.DataFrame
+        :param keys: key columns
+        :type keys: List[str]
+        :param split_column: column whose cumulative sum within each group splits the groups, e.g. tp_bp for the timepoint pairs 
+            of each trip, see :py:meth:`.Group_Index.split`, defaults to None
+        :type split_column: str, optional
+        :param group_index: index of records by the keys to cache, e.g. an index derived from the index of another table, 
+            defaults to None, the cached index
+        :type group_index: Group_Index, optional
+        :return: the index of records
+        :rtype: Group_Index
+        """
+
+        cache_key = (tuple(keys), split_column)
+        if group_index is None:
+            group_index = self.__group_indexes.get(records, cache_key)
+            if group_index is not None:
+                return group_index
+            if split_column is None:
+                group_index = Group_Index(records, keys)
+            else:
+                groups = self.__group_index(records, keys)
+                group_index = groups.split(groups.cumsum(records[split_column]))
+
+        self.__group_indexes.put(records, cache_key, group_index)
+        return group_index
+
+    def __add_lookup_columns(self, records:pd.DataFrame, lookup:pd.DataFrame, on:List[str], keep_index:bool=True) -> pd.DataFrame:
+        """Add the columns of a lookup table to records by the key columns "on", with the same result as a left merge of records with 
+        the unique rows of lookup. The columns are added to records in place by aligning the keys, without rebuilding records, or by a 
+        merge if records already have columns of the same name. Records are never repeated, so that their index stays unique: if several 
+        lookup rows have the same keys, e.g. stop pairs of a route with a different stop spacing in each pattern, the first of them is used 
+        and a warning is logged. Lookups that can be ambiguous are made unique by the callers with a rule of their own.
 
+        :param records: metrics table
+        :type records: pd.DataFrame
+        :param lookup: lookup table with the key columns
+        :type lookup: pd.DataFrame
+        :param on: key columns
+        :type on: List[str]
+        :param keep_index: whether the index of records is kept (and named 'index'), otherwise records get a range index as with a 
+            merge, defaults to True
+        :type keep_index: bool, optional
+        :return: records with the added columns
+        :rtype: pd.DataFrame
+        """
+
+        lookup = lookup.drop_duplicates()
+        columns = lookup.columns.drop(on)
+        lookup_keys = pd.MultiIndex.from_frame(lookup[on]) if len(on) > 1 else pd.Index(lookup[on[0]])
+
+        if not lookup_keys.is_unique:
+            is_first = ~lookup_keys.duplicated()
+            logger.warning(f'{(~is_first).sum()} rows of the lookup of {columns.tolist()} by {on} have the keys of an earlier row, '\
+                            f'the first row of each key is used')
+            lookup = lookup[is_first]
+            lookup_keys = lookup_keys[is_first]
+
+        if columns.isin(records.columns).any():
+            if keep_index:
+                return records.reset_index().merge(lookup, on=on, how='left').set_index('index')
+            return records.merge(lookup, on=on, how='left')
+
+        record_keys = pd.MultiIndex.from_frame(records[on]) if len(on) > 1 else pd.Index(records[on[0]])
+        positions = lookup_keys.get_indexer(record_keys)
+        for column in columns:
+            values = lookup[column].array if isinstance(lookup[column].dtype, pd.CategoricalDtype) else lookup[column].to_numpy()
+            records[column] = pd.api.extensions.take(values, positions, allow_fill=True)
+        records.index = records.index.rename('index') if keep_index else pd.RangeIndex(records.shape[0])
         return records
+
+    def __sum_by_tpbp_group(self, records:pd.DataFrame, tpbp_metrics:pd.DataFrame, trip_columns:List[str], decimals:Dict[str, int]):
+        """Sums of columns over the stops of each timepoint pair of each trip, i.e. from a tp_bp stop to the stop before the next one, 
+        added to the timepoint metrics table. The timepoint pairs are the groups of the cached index of the trips split at the tp_bp stops, 
+        and the sums of all columns are rolled up at once as the differences of one cumulative sum along the trips at the timepoint pair 
+        boundaries, in units of the decimals of each column, see :py:meth:`.Group_Index.exact_sums`.
+
+        :param records: stop metrics table
+        :type records: pd.DataFrame
+        :param tpbp_metrics: timepoint metrics table, i.e. the tp_bp records of the stop metrics table
+        :type tpbp_metrics: pd.DataFrame
+        :param trip_columns: key columns of the trips
+        :type trip_columns: List[str]
+        :param decimals: number of decimals that each summed column is rounded to, e.g. 0 for counts
+        :type decimals: Dict[str, int]
+        """
+
+        tpbp_groups = self.__group_index(records, trip_columns, split_column='tp_bp')
+        sums = tpbp_groups.exact_sums([records[column] for column in decimals], list(decimals.values()))
+        for column, column_sums in zip(decimals, sums):
+            tpbp_metrics[column] = pd.Series(tpbp_groups.broadcast(column_sums), index=records.index)
+
+    def __route_totals(self, records:pd.DataFrame, key_columns:List[str], column:str, reducer:str='sum', values:pd.Series=None) -> pd.DataFrame:
+        """Sum (or maximum) of a column, or of the values of each record named column, over the stop records of each trip, with the 
+        same result as records.groupby(key_columns)[column].sum().reset_index() up to the order of the rows.
+        """
+
+        values = records[column] if values is None else values
+        trips = self.__group_index(records, key_columns)
+        routes_data = records[key_columns].take(trips.first_rows()).reset_index(drop=True)
+        routes_data[column] = self.execution_backend.group_reduce(trips, values, reducer)
+        return routes_data
     
     def stop_spacing(self, shapes):
         """Stop spacing in ft. Distance is returned from Valhalla trace route requests in unit of kilometers.
@@ -123,33 +286,13 @@ class Metric_Calculation():
 
         logger.info(f'calculating stop spacing')
 
-        records = self.gtfs_stop_metrics.reset_index()\
-                    .merge(shapes[['pattern', 'stop_pair', 'distance']].drop_duplicates(), on=['pattern', 'stop_pair'], how='left')\
-                    .set_index('index')
-
-        self.gtfs_stop_metrics['stop_spacing'] = (records['distance'] * KILOMETER_TO_FT).round(2)
-
-        routes_data = self.gtfs_stop_metrics.groupby(self.GTFS_ROUTE_METRICS_KEY_COLUMNS)['stop_spacing'].sum().reset_index()
-        self.gtfs_route_metrics = self.gtfs_route_metrics.merge(routes_data, on=self.GTFS_ROUTE_METRICS_KEY_COLUMNS, how='left')
-
-        records = deepcopy(self.gtfs_stop_metrics)
-        ## calculate the distance between timepoints using the above records dataframe
-        ## step 1: label timepoint pairs as tpbp_stop_pair, each tpbp_stop_pair could correspond to multiple consecutive stop_pairs
-        ##           stops that don't belong to a tpbp_stop_pair but is a tp_bp (e.g. the last tp_bp of a route) are labeled -1
-        records['tpbp_stop_pair'] = self.gtfs_tpbp_metrics['stop_pair']
-        records.loc[(records['tp_bp']==1) & (records['tpbp_stop_pair'].isnull()), 'tpbp_stop_pair'] = -1
-        records['tpbp_stop_pair'] = records.groupby('trip_id')['tpbp_stop_pair'].fillna(method='ffill')
-        ## step 2: calculate the culmulative distance of each stop along the trip, and keep only the last record of each tpbp_stop_pair
-        ##           since the last culmulative distance encompasses the distances of all stop_pairs within the same tpbp_stop_pair
-        records['distance_cumsum'] = records.groupby('trip_id')['stop_spacing'].cumsum()
-        records = records[~records.duplicated(subset=['trip_id', 'tpbp_stop_pair'], keep='last')]
-        ## step 3: distance between timepoints = difference between kept tpbp_stop_pair culmulative distances
-        records['tpbp_distance'] = records.groupby('trip_id')['distance_cumsum'].diff().fillna(records['distance_cumsum'])
-
-        self.gtfs_tpbp_metrics = self.gtfs_tpbp_metrics\
-                                .merge(records[['pattern', 'tpbp_stop_pair', 'tpbp_distance']].drop_duplicates(), \
-                                    left_on=['pattern', 'stop_pair'], right_on=['pattern', 'tpbp_stop_pair'], how='left')\
-                                .drop(columns=['tpbp_stop_pair']).rename(columns={'tpbp_distance': 'stop_spacing'})
+        shapes = shapes[['pattern', 'stop_pair', 'distance']].assign(stop_pair=self.stop_pair_codec.encode_pairs(shapes['stop_pair'], add=False))
+        records = self.gtfs_stop_metrics
+        self.gtfs_stop_metrics = self.__add_lookup_columns(records, shapes, ['pattern', 'stop_pair'])
+        self.gtfs_stop_metrics['stop_spacing'] = (self.gtfs_stop_metrics.pop('distance') * KILOMETER_TO_FT).round(2)
+
+        routes_data = self.__route_totals(self.gtfs_stop_metrics, self.GTFS_ROUTE_METRICS_KEY_COLUMNS, 'stop_spacing')
+        self.gtfs_route_metrics = self.__add_lookup_columns(self.gtfs_route_metrics, routes_data, self.GTFS_ROUTE_METRICS_KEY_COLUMNS, keep_index=False)
     
     def scheduled_headway(self):
         """Scheduled headway in minutes. Defined as the difference between two consecutive scheduled arrivals of a route at the first stop of a stop pair.
@@ -157,14 +300,19 @@ class Metric_Calculation():
 
         logger.info(f'calculating scheduled headway')
         
-        self.gtfs_stop_metrics['scheduled_headway'] = (self.gtfs_stop_metrics.sort_values(['service_id', 'route_id', 'stop_pair', 'arrival_time'])\
-                                                    .groupby(['service_id', 'route_id', 'stop_pair'])['arrival_time'].diff())/60
-        self.gtfs_route_metrics['scheduled_headway'] = (self.gtfs_route_metrics.sort_values(['service_id', 'route_id', 'direction_id', 'trip_start_time'])\
-                                                    .groupby(['service_id', 'route_id', 'direction_id'])['trip_start_time'].diff())/60
-        self.gtfs_tpbp_metrics['scheduled_headway'] = (self.gtfs_tpbp_metrics.sort_values(['service_id', 'route_id', 'stop_pair', 'arrival_time'])\
-                                                    .groupby(['service_id', 'route_id', 'stop_pair'])['arrival_time'].diff())/60
+        self.gtfs_stop_metrics['scheduled_headway'] = self.__headway(self.gtfs_stop_metrics, ['service_id', 'route_id', 'stop_pair'], 'arrival_time')
+        self.gtfs_route_metrics['scheduled_headway'] = self.__headway(self.gtfs_route_metrics, ['service_id', 'route_id', 'direction_id'], 'trip_start_time')
+        self.gtfs_tpbp_metrics['scheduled_headway'] = self.__headway(self.gtfs_tpbp_metrics, ['service_id', 'route_id', 'stop_pair'], 'arrival_time')
         
     
+    def __headway(self, records:pd.DataFrame, keys:List[str], time_column:str) -> np.ndarray:
+        """Difference in minutes between the time of each record and the previous time of the same keys, i.e. of the records 
+        sorted by the keys and time.
+        """
+
+        # only used once, so not cached
+        return Group_Index(records, keys, sort_column=time_column).diff(records[time_column]) / 60
+
     def scheduled_running_time(self):
         """Running time in minutes. Defined as the difference between the departure time at a stop and arrival time at the next stop.
         """
@@ -173,14 +321,8 @@ class Metric_Calculation():
 
         self.gtfs_stop_metrics['scheduled_running_time'] = ((self.gtfs_stop_metrics['next_stop_arrival_time'] - self.gtfs_stop_metrics['departure_time']) / 60).round(2)
         
-        routes_data = self.gtfs_stop_metrics.groupby(self.GTFS_ROUTE_METRICS_KEY_COLUMNS)['scheduled_running_time'].sum().reset_index()
-        self.gtfs_route_metrics = self.gtfs_route_metrics.merge(routes_data, on=self.GTFS_ROUTE_METRICS_KEY_COLUMNS, how='left')
-
-        self.gtfs_stop_metrics['tpbp_group'] = self.gtfs_stop_metrics.groupby(['trip_id'])['tp_bp'].cumsum()
-        self.gtfs_stop_metrics['tpbp_scheduled_running_time'] = self.gtfs_stop_metrics.groupby(['trip_id', 'tpbp_group'])['scheduled_running_time'].transform('sum')
-        self.gtfs_tpbp_metrics['scheduled_running_time'] = self.gtfs_stop_metrics['tpbp_scheduled_running_time']
-        self.gtfs_stop_metrics.drop(columns=['tpbp_group', 'tpbp_scheduled_running_time'], inplace=True)
-
+        routes_data = self.__route_totals(self.gtfs_stop_metrics, self.GTFS_ROUTE_METRICS_KEY_COLUMNS, 'scheduled_running_time')
+        self.gtfs_route_metrics = self.__add_lookup_columns(self.gtfs_route_metrics, routes_data, self.GTFS_ROUTE_METRICS_KEY_COLUMNS, keep_index=False)
     
     def scheduled_speed_without_dwell(self):
         """Scheduled running speed in mph. Defined as stop spacing divided by running time.
@@ -201,12 +343,9 @@ class Metric_Calculation():
         
         logger.info(f'calculating observed headway')
 
-        self.avl_stop_metrics['observed_headway'] = (self.avl_stop_metrics.sort_values(['svc_date', 'route_id', 'stop_pair', 'stop_time'])\
-                                                    .groupby(['svc_date', 'route_id', 'stop_pair'])['stop_time'].diff())/60
-        self.avl_route_metrics['observed_headway'] = (self.avl_route_metrics.sort_values(['svc_date', 'route_id', 'direction_id', 'trip_start_time'])\
-                                                    .groupby(['svc_date', 'route_id', 'direction_id'])['trip_start_time'].diff())/60
-        self.avl_tpbp_metrics['observed_headway'] = (self.avl_tpbp_metrics.sort_values(['svc_date', 'route_id', 'stop_pair', 'stop_time'])\
-                                                    .groupby(['svc_date', 'route_id', 'stop_pair'])['stop_time'].diff())/60
+        self.avl_stop_metrics['observed_headway'] = self.__headway(self.avl_stop_metrics, ['svc_date', 'route_id', 'stop_pair'], 'stop_time')
+        self.avl_route_metrics['observed_headway'] = self.__headway(self.avl_route_metrics, ['svc_date', 'route_id', 'direction_id'], 'trip_start_time')
+        self.avl_tpbp_metrics['observed_headway'] = self.__headway(self.avl_tpbp_metrics, ['svc_date', 'route_id', 'stop_pair'], 'stop_time')
         
     
     def observed_running_time(self):
@@ -219,14 +358,8 @@ class Metric_Calculation():
         self.avl_stop_metrics['observed_running_time'] = ((self.avl_stop_metrics['next_stop_arrival_time'] - self.avl_stop_metrics['stop_time'] \
                                                     - self.avl_stop_metrics['dwell_time']).clip(lower=0) / 60).round(2)
         
-        routes_data = self.avl_stop_metrics.groupby(self.AVL_ROUTE_METRICS_KEY_COLUMNS)['observed_running_time'].sum().reset_index()
-        self.avl_route_metrics = self.avl_route_metrics.merge(routes_data, on=self.AVL_ROUTE_METRICS_KEY_COLUMNS, how='left')
-
-        self.avl_stop_metrics['tpbp_group'] = self.avl_stop_metrics.groupby(['svc_date', 'trip_id'])['tp_bp'].cumsum()
-        self.avl_stop_metrics['tpbp_observed_running_time'] = self.avl_stop_metrics.groupby(['svc_date', 'trip_id', 'tpbp_group'])['observed_running_time'].transform('sum')
-        self.avl_tpbp_metrics['observed_running_time'] = self.avl_stop_metrics['tpbp_observed_running_time']
-        self.avl_stop_metrics.drop(columns=['tpbp_group', 'tpbp_observed_running_time'], inplace=True)
-
+        routes_data = self.__route_totals(self.avl_stop_metrics, self.AVL_ROUTE_METRICS_KEY_COLUMNS, 'observed_running_time')
+        self.avl_route_metrics = self.__add_lookup_columns(self.avl_route_metrics, routes_data, self.AVL_ROUTE_METRICS_KEY_COLUMNS, keep_index=False)
     
     def observed_speed_without_dwell(self):
         """Observed running speed without dwell in mph. Defined as stop spacing divided by the observed running time without dwell.
@@ -234,15 +367,46 @@ class Metric_Calculation():
 
         logger.info(f'calculating observed speed without dwell')
 
-        self.avl_stop_metrics = self.avl_stop_metrics.merge(self.gtfs_stop_metrics[['route_id', 'stop_pair', 'stop_spacing']].drop_duplicates(), on=['route_id', 'stop_pair'], how='left')
+        # stop spacing of the pattern of the GTFS trip, stop pairs of a route may have a different stop spacing in each pattern
+        self.avl_stop_metrics = self.__add_stop_spacing(self.avl_stop_metrics, self.gtfs_stop_metrics, ['trip_id', 'stop_pair'], ['route_id', 'stop_pair'])
         self.avl_stop_metrics['observed_speed_without_dwell'] = ((self.avl_stop_metrics['stop_spacing'] / self.avl_stop_metrics['observed_running_time']) * FT_PER_MIN_TO_MPH).round(2)
         
-        self.avl_route_metrics = self.avl_route_metrics.merge(self.gtfs_route_metrics[['route_id', 'stop_spacing']].drop_duplicates(), on=['route_id'], how='left')
+        self.avl_route_metrics = self.__add_stop_spacing(self.avl_route_metrics, self.gtfs_route_metrics, ['route_id', 'trip_id'], ['route_id'], keep_index=False)
         self.avl_route_metrics['observed_speed_without_dwell'] = ((self.avl_route_metrics['stop_spacing'] / self.avl_route_metrics['observed_running_time']) * FT_PER_MIN_TO_MPH).round(2)
         
-        self.avl_tpbp_metrics = self.avl_tpbp_metrics.merge(self.gtfs_tpbp_metrics[['route_id', 'stop_pair', 'stop_spacing']].drop_duplicates(), on=['route_id', 'stop_pair'], how='left')
+        self.avl_tpbp_metrics = self.__add_stop_spacing(self.avl_tpbp_metrics, self.gtfs_tpbp_metrics, ['trip_id', 'stop_pair'], ['route_id', 'stop_pair'])
         self.avl_tpbp_metrics['observed_speed_without_dwell'] = ((self.avl_tpbp_metrics['stop_spacing'] / self.avl_tpbp_metrics['observed_running_time']) * FT_PER_MIN_TO_MPH).round(2)
     
+    def __add_stop_spacing(self, records:pd.DataFrame, gtfs_metrics:pd.DataFrame, on:List[str], fallback_on:List[str], 
+                           keep_index:bool=True) -> pd.DataFrame:
+        """Add the stop spacing of a GTFS metrics table to the AVL metrics table of the same level by the keys "on" of the GTFS trip, 
+        so that AVL trips get the spacing of the pattern of their GTFS trip. Records without a spacing by these keys, e.g. of AVL trips 
+        whose trip_id is not in GTFS or stop pairs that are not in the pattern of the trip, get the spacing by the fallback keys of 
+        the route instead, i.e. the spacing of the first pattern of the route that has it.
+
+        :param records: AVL metrics table
+        :type records: pd.DataFrame
+        :param gtfs_metrics: GTFS metrics table with the stop_spacing column
+        :type gtfs_metrics: pd.DataFrame
+        :param on: key columns of the GTFS trip, e.g. trip_id and stop_pair
+        :type on: List[str]
+        :param fallback_on: key columns of the route, e.g. route_id and stop_pair
+        :type fallback_on: List[str]
+        :param keep_index: whether the index of records is kept, see :py:meth:`__add_lookup_columns`, defaults to True
+        :type keep_index: bool, optional
+        :return: records with the stop_spacing column
+        :rtype: pd.DataFrame
+        """
+
+        records = self.__add_lookup_columns(records, gtfs_metrics[on + ['stop_spacing']], on, keep_index=keep_index)
+        is_missing = records['stop_spacing'].isna().to_numpy()
+        if is_missing.any():
+            fallback_lookup = gtfs_metrics[fallback_on + ['stop_spacing']].dropna(subset=['stop_spacing'])\
+                                .drop_duplicates(subset=fallback_on)
+            fallback = self.__add_lookup_columns(records.loc[is_missing, fallback_on].copy(), fallback_lookup, fallback_on)
+            records.loc[is_missing, 'stop_spacing'] = fallback['stop_spacing'].to_numpy()
+        return records
+
     def observed_running_time_with_dwell(self):
         """Observed running time with dwell in minutes. Defined as the time between arrival at a stop and arrival at the next stop averaged over all service dates 
         for each bus trip.
@@ -252,14 +416,8 @@ class Metric_Calculation():
 
         self.avl_stop_metrics['observed_running_time_with_dwell'] = ((self.avl_stop_metrics['next_stop_arrival_time'] - self.avl_stop_metrics['stop_time']).clip(lower=0) / 60).round(2)
         
-        routes_data = self.avl_stop_metrics.groupby(self.AVL_ROUTE_METRICS_KEY_COLUMNS)['observed_running_time_with_dwell'].sum().reset_index()
-        self.avl_route_metrics = self.avl_route_metrics.merge(routes_data, on=self.AVL_ROUTE_METRICS_KEY_COLUMNS, how='left')
-
-        self.avl_stop_metrics['tpbp_group'] = self.avl_stop_metrics.groupby(['svc_date', 'trip_id'])['tp_bp'].cumsum()
-        self.avl_stop_metrics['tpbp_observed_running_time_with_dwell'] = self.avl_stop_metrics.groupby(['svc_date', 'trip_id', 'tpbp_group'])['observed_running_time_with_dwell'].transform('sum')
-        self.avl_tpbp_metrics['observed_running_time_with_dwell'] = self.avl_stop_metrics['tpbp_observed_running_time_with_dwell']
-        self.avl_stop_metrics.drop(columns=['tpbp_group', 'tpbp_observed_running_time_with_dwell'], inplace=True)
-
+        routes_data = self.__route_totals(self.avl_stop_metrics, self.AVL_ROUTE_METRICS_KEY_COLUMNS, 'observed_running_time_with_dwell')
+        self.avl_route_metrics = self.__add_lookup_columns(self.avl_route_metrics, routes_data, self.AVL_ROUTE_METRICS_KEY_COLUMNS, keep_index=False)
     
     def observed_speed_with_dwell(self):
         """Observed running speed with dwell in mph. Defined as stop spacing divided by the observed running time with dwell.
@@ -281,14 +439,8 @@ class Metric_Calculation():
 
         self.avl_stop_metrics['boardings'] = self.avl_stop_metrics['passenger_on']
         
-        routes_data = self.avl_stop_metrics.groupby(self.AVL_ROUTE_METRICS_KEY_COLUMNS)['boardings'].sum().reset_index()
-        self.avl_route_metrics = self.avl_route_metrics.merge(routes_data, on=self.AVL_ROUTE_METRICS_KEY_COLUMNS, how='left')
-
-        self.avl_stop_metrics['tpbp_group'] = self.avl_stop_metrics.groupby(['svc_date', 'trip_id'])['tp_bp'].cumsum()
-        self.avl_stop_metrics['tpbp_boardings'] = self.avl_stop_metrics.groupby(['svc_date', 'trip_id', 'tpbp_group'])['boardings'].transform('sum')
-        self.avl_tpbp_metrics['boardings'] = self.avl_stop_metrics['tpbp_boardings']
-        self.avl_stop_metrics.drop(columns=['tpbp_group', 'tpbp_boardings'], inplace=True)
-
+        routes_data = self.__route_totals(self.avl_stop_metrics, self.AVL_ROUTE_METRICS_KEY_COLUMNS, 'boardings')
+        self.avl_route_metrics = self.__add_lookup_columns(self.avl_route_metrics, routes_data, self.AVL_ROUTE_METRICS_KEY_COLUMNS, keep_index=False)
     
     def on_time_performance(self, no_earlier_than=-1, no_later_than=5, route_metric_bases:str='timepoint'):
         """On time performance in seconds of delay (actual arrival - scheduled arrival) for stop segments, and percentage of stops on time per trip for routes, 
@@ -309,30 +461,34 @@ class Metric_Calculation():
         if no_earlier_than > 0 or no_later_than < 0:
             raise ValueError(f'no_earlier_than must be a negative value, no_later_than must be a positive value.')
         
-        self.avl_stop_metrics = self.avl_stop_metrics.merge(self.gtfs_stop_metrics[['route_id', 'trip_id', 'stop_pair', 'arrival_time']], on=['route_id', 'trip_id', 'stop_pair'], how='left')
+        self.avl_stop_metrics = self.__add_lookup_columns(self.avl_stop_metrics, self.gtfs_stop_metrics[['route_id', 'trip_id', 'stop_pair', 'arrival_time']], \
+                                    ['route_id', 'trip_id', 'stop_pair'])
         self.avl_stop_metrics['on_time_performance'] = self.avl_stop_metrics['stop_time'] - self.avl_stop_metrics['arrival_time']
 
         self.avl_stop_metrics['is_on_time'] = ((self.avl_stop_metrics['on_time_performance'] > no_earlier_than * 60) & \
                                                     (self.avl_stop_metrics['on_time_performance'] < no_later_than * 60)).astype(int)
         
-        self.avl_tpbp_metrics = self.avl_tpbp_metrics.merge(self.gtfs_tpbp_metrics[['route_id', 'trip_id', 'stop_pair', 'arrival_time']], on=['route_id', 'trip_id', 'stop_pair'], how='left')
+        self.avl_tpbp_metrics = self.__add_lookup_columns(self.avl_tpbp_metrics, self.gtfs_tpbp_metrics[['route_id', 'trip_id', 'stop_pair', 'arrival_time']], \
+                                    ['route_id', 'trip_id', 'stop_pair'])
         self.avl_tpbp_metrics['on_time_performance'] = self.avl_tpbp_metrics['stop_time'] - self.avl_tpbp_metrics['arrival_time']
 
         self.avl_tpbp_metrics['is_on_time'] = ((self.avl_tpbp_metrics['on_time_performance'] > no_earlier_than * 60) & \
                                                     (self.avl_tpbp_metrics['on_time_performance'] < no_later_than * 60)).astype(int)
 
         if route_metric_bases == 'timepoint':
-            timepoint_df = self.avl_stop_metrics[self.avl_stop_metrics['timepoint']==1]
-            routes_data = timepoint_df.groupby(self.AVL_ROUTE_METRICS_KEY_COLUMNS)['is_on_time'].sum().to_frame('on_time_count')
-            routes_data['total_stops'] = timepoint_df.groupby(self.AVL_ROUTE_METRICS_KEY_COLUMNS)['stop_pair'].count()
+            is_counted = (self.avl_stop_metrics['timepoint']==1).to_numpy()
         elif route_metric_bases == 'stop':
-            routes_data = self.avl_stop_metrics.groupby(self.AVL_ROUTE_METRICS_KEY_COLUMNS)['is_on_time'].sum().to_frame('on_time_count')
-            routes_data['total_stops'] = self.avl_stop_metrics.groupby(self.AVL_ROUTE_METRICS_KEY_COLUMNS)['stop_pair'].count()
+            is_counted = np.ones(self.avl_stop_metrics.shape[0], dtype=bool)
         else:
             raise ValueError(f"invalid route_metric_bases {route_metric_bases}, must be one of 'timepoint' or 'stop'.")
+        routes_data = self.__route_totals(self.avl_stop_metrics, self.AVL_ROUTE_METRICS_KEY_COLUMNS, 'on_time_count', 
+                                    values=self.avl_stop_metrics['is_on_time'].where(is_counted, 0))
+        routes_data['total_stops'] = self.__route_totals(self.avl_stop_metrics, self.AVL_ROUTE_METRICS_KEY_COLUMNS, 'total_stops', 
+                                    values=is_counted & self.avl_stop_metrics['stop_pair'].notna())['total_stops']
+        # trips without counted stops have no on time performance
         routes_data['on_time_performance'] = routes_data['on_time_count'] / routes_data['total_stops'] * 100
-        self.avl_route_metrics = self.avl_route_metrics.merge(routes_data.reset_index()\
-                                    .drop(columns=['on_time_count', 'total_stops']), on=self.AVL_ROUTE_METRICS_KEY_COLUMNS, how='left')
+        self.avl_route_metrics = self.__add_lookup_columns(self.avl_route_metrics, routes_data.drop(columns=['on_time_count', 'total_stops']), 
+                                    self.AVL_ROUTE_METRICS_KEY_COLUMNS, keep_index=False)
     
     def passenger_load(self):
         """Passenger load in pax. Defined as the number of passengers onboard the bus within each stop pair, averaged over all service dates for each bus trip.
@@ -340,8 +496,8 @@ class Metric_Calculation():
 
         logger.info(f'calculating passenger load')
         
-        routes_data = self.avl_stop_metrics.groupby(self.AVL_ROUTE_METRICS_KEY_COLUMNS)['passenger_load'].max().reset_index()
-        self.avl_route_metrics = self.avl_route_metrics.merge(routes_data, on=self.AVL_ROUTE_METRICS_KEY_COLUMNS, how='left')
+        routes_data = self.__route_totals(self.avl_stop_metrics, self.AVL_ROUTE_METRICS_KEY_COLUMNS, 'passenger_load', 'max')
+        self.avl_route_metrics = self.__add_lookup_columns(self.avl_route_metrics, routes_data, self.AVL_ROUTE_METRICS_KEY_COLUMNS, keep_index=False)
 
     
     def crowding(self):
@@ -353,22 +509,34 @@ class Metric_Calculation():
 
         self.avl_stop_metrics['crowding'] = self.avl_stop_metrics['passenger_load'] / self.avl_stop_metrics['seat_capacity'] * 100
         
-        routes_data = self.avl_stop_metrics.groupby(self.AVL_ROUTE_METRICS_KEY_COLUMNS)['crowding'].max().round(0).reset_index()
-        self.avl_route_metrics = self.avl_route_metrics.merge(routes_data, on=self.AVL_ROUTE_METRICS_KEY_COLUMNS, how='left')
+        routes_data = self.__route_totals(self.avl_stop_metrics, self.AVL_ROUTE_METRICS_KEY_COLUMNS, 'crowding', 'max').round({'crowding': 0})
+        self.avl_route_metrics = self.__add_lookup_columns(self.avl_route_metrics, routes_data, self.AVL_ROUTE_METRICS_KEY_COLUMNS, keep_index=False)
 
     
-    def congestion_delay(self):
-        """Vehicle congestion delay in min/mile and passenger congestion delay in pax-min/mile.
+    def congestion_delay(self, stop_pair_free_flow_speed:Dict=None):
+        """Vehicle congestion delay in min/mile and passenger congestion delay in pax-min/mile. The free flow speed of a stop pair is the 
+        90th percentile of its observed speeds without dwell.
+
+        :param stop_pair_free_flow_speed: free flow speeds (before capping) of stop pairs whose observed speeds are not all in avl_stop_metrics, 
+            e.g. stop pairs shared by routes of different partitions in :py:class:`.Partitioned_Metric_Execution`. These values are used in place 
+            of the free flow speeds calculated from avl_stop_metrics. Defaults to None.
+        :type stop_pair_free_flow_speed: Dict, optional
         """
         
         logger.info(f'calculating congestion delay')
 
-        self.avl_stop_metrics['free_flow_speed'] = self.avl_stop_metrics.groupby(['stop_pair'])['observed_speed_without_dwell'].transform(lambda x: x.quantile(0.9))\
-                                                    .clip(upper=MAX_SPEED_MPH).fillna(MEAN_SPEED_MPH)
+        stop_pairs = Group_Index(self.avl_stop_metrics, ['stop_pair'])
+        free_flow_speed = self.execution_backend.group_reduce(stop_pairs, self.avl_stop_metrics['observed_speed_without_dwell'], ('quantile', 0.9))
+        free_flow_speed = pd.Series(stop_pairs.broadcast(free_flow_speed), index=self.avl_stop_metrics.index)
+        if stop_pair_free_flow_speed:
+            is_overridden = self.avl_stop_metrics['stop_pair'].isin(list(stop_pair_free_flow_speed.keys()))
+            free_flow_speed = free_flow_speed.mask(is_overridden, self.avl_stop_metrics['stop_pair'].map(stop_pair_free_flow_speed))
+        self.avl_stop_metrics['free_flow_speed'] = free_flow_speed.clip(upper=MAX_SPEED_MPH).fillna(MEAN_SPEED_MPH)
         self.avl_stop_metrics['free_flow_travel_time'] = self.avl_stop_metrics['stop_spacing'] / (self.avl_stop_metrics['free_flow_speed'] / FT_PER_MIN_TO_MPH)
         self.avl_stop_metrics['observed_travel_time'] = self.avl_stop_metrics['stop_spacing'] / (self.avl_stop_metrics['observed_speed_without_dwell'] / FT_PER_MIN_TO_MPH)
 
-        self.avl_stop_metrics['vehicle_congestion_delay'] = (self.avl_stop_metrics['observed_travel_time'] - self.avl_stop_metrics['free_flow_travel_time']).apply(lambda x: max(0, x)) \
+        excess_travel_time = self.avl_stop_metrics['observed_travel_time'] - self.avl_stop_metrics['free_flow_travel_time']
+        self.avl_stop_metrics['vehicle_congestion_delay'] = excess_travel_time.where(excess_travel_time > 0, 0) \
                                                 / (self.avl_stop_metrics['stop_spacing'] * FEET_TO_MILES)
         
         self.avl_stop_metrics['passenger_congestion_delay'] = self.avl_stop_metrics['vehicle_congestion_delay'] * self.avl_stop_metrics['passenger_load']
\ No newline at end of file
@@ -0,0 +1,174 @@
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple, Union
+import numpy as np
+import pandas as pd
+
+#: Aggregation levels of the aggregated metrics tables, and the kind of metrics table (stop, route or tpbp) and the attribute name of
+#: the key columns that each level is aggregated from.
+LEVELS:Dict[str, Tuple[str, str]] = {
+    'segments': ('stop', 'SEGMENT_MULTIINDEX'),
+    'corridors': ('stop', 'CORRIDOR_MULTIINDEX'),
+    'routes': ('route', 'ROUTE_MULTIINDEX'),
+    'tpbp_segments': ('tpbp', 'SEGMENT_MULTIINDEX'),
+    'tpbp_corridors': ('tpbp', 'CORRIDOR_MULTIINDEX')
+}
+ALL_LEVELS = tuple(LEVELS.keys())
+
+
+class Metric():
+    """Declaration of an aggregated metric at one or more aggregation levels. The metric is aggregated from a column of the GTFS or AVL
+    metrics tables of each level (stop, route or tpbp) by a reducer, then optionally derived from other metrics of the same level, and
+    finally scaled, clipped, rounded, filled and cast, in this order:
+
+        value = derive(level table, reduced column) * scale, clipped to clip, rounded to sig_fig, filled with fill_value, cast to dtype
+
+    A metric with several entries in a registry (e.g. with a different column at the route level) has the union of their levels.
+
+    :param name: name of the metric, i.e. the column of the aggregated metrics tables
+    :type name: str
+    :param display_name: name of the metric in the frontend, or None if the entry does not set it
+    :type display_name: str
+    :param levels: aggregation levels of the entry, a subset of :py:data:`LEVELS`
+    :type levels: Iterable[str]
+    :param source: 'gtfs' for scheduled metrics, or 'avl' for observed metrics, which are only aggregated if AVL data is used, defaults to 'gtfs'
+    :type source: str, optional
+    :param column: column of the metrics tables that is aggregated, or None for a metric that is only derived from other metrics, defaults to None
+    :type column: str, optional
+    :param reducer: groupby aggregation of column, such as 'mean', 'sum', 'min', 'max', 'var' or 'nunique', a tuple of them, or a function
+        of the (time-filtered) metrics table, column and the key columns of the level that returns a series indexed by the keys. Defaults to None,
+        the aggregation percentile of the metric given by percentile.
+    :type reducer: Union[str, Tuple[str, ...], Callable], optional
+    :param percentile: whether the metric is the aggregation percentile of column, see :py:meth:`.Metric_Aggregation.aggregate_metrics`, defaults to False
+    :type percentile: bool, optional
+    :param time_filtered: whether the metric is aggregated from the metrics in the time window or from all metrics, defaults to True
+    :type time_filtered: bool, optional
+    :param derive: function of the aggregated metrics table of the level and the reduced column (a series, a dataframe with a column per
+        reducer if reducer is a tuple, or None if column is None) that returns the metric, defaults to None
+    :type derive: Callable, optional
+    :param scale: factor that the metric is multiplied by, defaults to 1
+    :type scale: float, optional
+    :param clip: lower and upper bounds of the metric, either one can be None, defaults to None
+    :type clip: Tuple, optional
+    :param sig_fig: number of decimals that the metric is rounded to, or None, defaults to None
+    :type sig_fig: int, optional
+    :param fill_value: value of missing metrics, defaults to None
+    :type fill_value: optional
+    :param dtype: dtype of the metric, defaults to None
+    :type dtype: optional
+    """
+
+    def __init__(self, name:str, display_name:str, levels:Iterable[str], source:str='gtfs', column:str=None,
+                    reducer:Union[str, Tuple[str, ...], Callable]=None, percentile:bool=False, time_filtered:bool=True, derive:Callable=None,
+                    scale:float=1, clip:Tuple=None, sig_fig:int=None, fill_value=None, dtype=None):
+
+        levels = tuple(levels)
+        invalid_levels = [level for level in levels if level not in LEVELS]
+        if invalid_levels:
+            raise ValueError(f'Invalid aggregation levels {invalid_levels} of metric {name}. Must be in {ALL_LEVELS}.')
+        if source not in ['gtfs', 'avl']:
+            raise ValueError(f"Invalid source {source} of metric {name}, must be one of: 'gtfs', 'avl'.")
+        if column is not None and (reducer is None) == (not percentile):
+            raise ValueError(f'Metric {name} must have either a reducer or percentile=True to aggregate column {column}.')
+        if column is None and derive is None:
+            raise ValueError(f'Metric {name} must have a column or a derive function.')
+
+        self.name = name
+        self.display_name = display_name
+        self.levels:Tuple[str, ...] = levels
+        self.source = source
+        self.column = column
+        self.reducer = reducer
+        self.percentile = percentile
+        self.time_filtered = time_filtered
+        self.derive = derive
+        self.scale = scale
+        self.clip = clip
+        self.sig_fig = sig_fig
+        self.fill_value = fill_value
+        self.dtype = dtype
+
+    def table_name(self, level:str) -> str:
+        """Name of the metrics table attribute of :py:class:`.Metric_Aggregation` that the metric is aggregated from at a level,
+        e.g. avl_stop_metrics_time_filtered.
+        """
+
+        table_name = f'{self.source}_{LEVELS[level][0]}_metrics'
+        return f'{table_name}_time_filtered' if self.time_filtered else table_name
+
+    def finalize(self, values:pd.Series) -> pd.Series:
+        """Scale, clip, round, fill and cast the derived metric values.
+        """
+
+        if self.scale != 1:
+            values = values * self.scale
+        if self.clip is not None:
+            # same as Series.clip, which is much slower for small series
+            values = pd.Series(np.clip(values.to_numpy(), self.clip[0], self.clip[1]), index=values.index)
+        if self.sig_fig is not None:
+            values = values.round(self.sig_fig)
+        if self.fill_value is not None:
+            values = values.fillna(self.fill_value)
+        if self.dtype is not None:
+            values = values.astype(self.dtype)
+        return values
+
+    def __repr__(self) -> str:
+
+        return f'Metric({self.name}, levels={self.levels})'
+
+
+class Metric_Registry():
+    """Ordered collection of the aggregated metrics of an agency. Metrics are aggregated, and their columns and display names are added,
+    in the order of their entries, so derived metrics must come after the metrics they are derived from.
+    """
+
+    def __init__(self):
+
+        #: Metric entries in the order of aggregation.
+        self.metrics:List[Metric] = []
+
+    def add(self, *metrics:Metric):
+        """Add metric entries after the existing ones.
+        """
+
+        self.metrics.extend(metrics)
+
+    def replace(self, name:str, *metrics:Metric):
+        """Replace all entries of a metric by new entries at the position of its first entry.
+
+        :raises KeyError: the metric is not registered
+        """
+
+        position = self.__position(name)
+        self.remove(name)
+        self.metrics[position:position] = metrics
+
+    def remove(self, *names:str):
+        """Remove all entries of the given metrics.
+
+        :raises KeyError: a metric is not registered
+        """
+
+        for name in names:
+            self.__position(name)
+        self.metrics = [metric for metric in self.metrics if metric.name not in names]
+
+    def names(self) -> List[str]:
+        """Names of the registered metrics in order of their first entries.
+        """
+
+        return list(dict.fromkeys(metric.name for metric in self.metrics))
+
+    def __position(self, name:str) -> int:
+
+        for position, metric in enumerate(self.metrics):
+            if metric.name == name:
+                return position
+        raise KeyError(f'Metric {name} is not registered.')
+
+    def __iter__(self) -> Iterator[Metric]:
+
+        return iter(self.metrics)
+
+    def __len__(self) -> int:
+
+        return len(self.metrics)
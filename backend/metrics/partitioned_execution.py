@@ -0,0 +1,489 @@
+import heapq
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+from typing import Dict, List, Tuple, Type, Union
+import numpy as np
+import pandas as pd
+from backend.data_class.avl import AVL
+from backend.data_class.rove_parameters import ROVE_params
+from backend.metrics.execution_backend import get_execution_backend
+from backend.metrics.metric_calculation import Metric_Calculation
+from backend.metrics.metric_aggregation import Metric_Aggregation
+from backend.metrics.stop_pair_codec import Stop_Pair_Codec
+from tqdm.auto import tqdm
+
+logger = logging.getLogger("backendLogger")
+
+#: Positions of the stop-aggregated and timepoint-aggregated tables in the tuples of five aggregated metrics tables.
+CORRIDOR_TABLE_INDEX = 1
+TPBP_CORRIDOR_TABLE_INDEX = 4
+#: Stop and timepoint metrics tables of GTFS and AVL data.
+GTFS_STOP_METRICS_TABLES = ['gtfs_stop_metrics', 'gtfs_tpbp_metrics']
+AVL_STOP_METRICS_TABLES = ['avl_stop_metrics', 'avl_tpbp_metrics']
+#: Columns that the concatenated aggregated metrics tables are sorted by, in the order of the five aggregated metrics tables.
+AGG_TABLE_SORT_COLUMNS = (['route', 'segment'], ['corridor'], ['route', 'direction'], ['route', 'segment'], ['corridor'])
+
+class Partitioned_Metric_Execution():
+    """Out-of-core metric calculation and aggregation. Routes are split into partitions of similar AVL (or GTFS, if no AVL data
+    is used) record counts, and the AVL records of each partition are written to disk. Metrics are then calculated and aggregated one
+    partition at a time, so that only the metrics tables of a single partition are held in memory. With more than one worker, the metrics
+    of the partitions are calculated in parallel by a pool of worker processes, see :py:func:`calculate_partition`, and as many partitions
+    as workers are held in memory at a time.
+
+    For the pre-defined time periods, stop, timepoint and route level aggregated metrics only depend on the records of their own route
+    and are concatenated across partitions. Stop pairs (and timepoint pairs) that are served by routes of more than one partition are 
+    aggregated once more from the stop events of all partitions to produce their stop-aggregated (and timepoint-aggregated) metrics. 
+    The 10-min intervals are aggregated once for all partitions, since the cost of aggregating an interval hardly depends on its number 
+    of records: the AVL stop and timepoint events of each partition are written to disk by interval, and the events of each interval 
+    are read from all partitions and aggregated together with the GTFS metrics and AVL route metrics of all partitions, which are small 
+    enough to be held in memory. The free flow speeds of shared stop pairs used for congestion delay are calculated from the observed 
+    speeds of all partitions. The results are therefore the same as aggregating all routes at once. All partitions share a single 
+    :py:class:`.Stop_Pair_Codec` of the stops of all records, so that their stop pair codes can be compared.
+
+    :param shapes: shapes table from Shape Generation
+    :type shapes: pd.DataFrame
+    :param gtfs_records: GTFS records table
+    :type gtfs_records: pd.DataFrame
+    :param avl: AVL data object, or None if AVL data is not used. Its records table is released once it has been written to the partitions.
+    :type avl: AVL
+    :param params: a rove_params object that stores information needed throughout the backend
+    :type params: ROVE_params
+    :param num_partitions: number of route partitions
+    :type num_partitions: int
+    :param calculation_class: metric calculation class of the agency, defaults to Metric_Calculation
+    :type calculation_class: Type[Metric_Calculation], optional
+    :param aggregation_class: metric aggregation class of the agency, defaults to Metric_Aggregation
+    :type aggregation_class: Type[Metric_Aggregation], optional
+    :param calculation_args: additional arguments passed to calculation_class after params, e.g. the stops table of WMATA_Metric_Calculation,
+        defaults to ()
+    :type calculation_args: Tuple, optional
+    :param workers: number of worker processes that calculate the metrics of partitions in parallel, defaults to 1, i.e. the partitions
+        are calculated one at a time in this process
+    :type workers: int, optional
+    :raises ValueError: num_partitions or workers is smaller than 1
+    """
+    def __init__(self, shapes:pd.DataFrame, gtfs_records:pd.DataFrame, avl:AVL, params:ROVE_params, num_partitions:int,
+                    calculation_class:Type[Metric_Calculation]=Metric_Calculation, aggregation_class:Type[Metric_Aggregation]=Metric_Aggregation,
+                    calculation_args:Tuple=(), workers:int=1):
+
+        if num_partitions < 1:
+            raise ValueError(f'num_partitions must be a positive integer, got {num_partitions}.')
+        if workers < 1:
+            raise ValueError(f'workers must be a positive integer, got {workers}.')
+
+        logger.info(f'Calculating and aggregating metrics in {num_partitions} route partitions...')
+
+        self.params = params
+        self.data_option = params.data_option
+        self.calculation_class = calculation_class
+        self.aggregation_class = aggregation_class
+        self.calculation_args = calculation_args
+        self.workers = workers
+
+        #: Directory that stores the partition files, retrieved from output_paths['partitions'].
+        self.partition_dir:str = params.output_paths['partitions']
+        os.makedirs(self.partition_dir, exist_ok=True)
+
+        avl_records = avl.records if avl is not None else None
+        #: Codec of the stop pairs of all partitions.
+        self.stop_pair_codec:Stop_Pair_Codec = Stop_Pair_Codec(pd.concat([gtfs_records['stop_id'], avl_records['stop_id'] if avl_records is not None else None]))
+        #: List of route partitions, each one is a list of route_ids.
+        self.partitions:List[List[str]] = self.partition_routes(gtfs_records, avl_records, num_partitions)
+
+        if avl_records is not None:
+            self.__write_avl_partitions(avl_records)
+            avl.records = None
+            del avl_records
+
+        self.__calculate_partitions(shapes, gtfs_records)
+        self.__aggregate_partitions()
+        self.__aggregate_shared_pairs()
+        self.__aggregate_10min_intervals()
+
+        Metric_Aggregation.write_time_period_metrics(self.agg_metrics, params.output_paths['metric_calculation_aggre'])
+        Metric_Aggregation.write_10min_interval_metrics(self.agg_metrics_10_min, params.output_paths['metric_calculation_aggre_10min'])
+
+        self.__remove_partition_files()
+        logger.info(f'Partitioned metrics calculation and aggregation completed.')
+
+    def partition_routes(self, gtfs_records:pd.DataFrame, avl_records:pd.DataFrame, num_partitions:int) -> List[List[str]]:
+        """Assign routes to partitions so that each partition has a similar number of records. Routes are assigned in
+        descending order of their record counts to the partition with the fewest records so far.
+
+        :param gtfs_records: GTFS records table
+        :type gtfs_records: pd.DataFrame
+        :param avl_records: AVL records table, or None if AVL data is not used
+        :type avl_records: pd.DataFrame
+        :param num_partitions: number of route partitions
+        :type num_partitions: int
+        :return: list of partitions, each one is a list of route_ids
+        :rtype: List[List[str]]
+        """
+        route_weights = self.__route_weights(gtfs_records)
+        if avl_records is not None:
+            # only routes with AVL records are worth a partition of their own, GTFS-only routes are cheap
+            avl_route_weights = self.__route_weights(avl_records)
+            num_partitions = min(num_partitions, avl_route_weights.shape[0])
+            route_weights = avl_route_weights.reindex(route_weights.index.union(avl_route_weights.index), fill_value=0)
+        num_partitions = max(1, min(num_partitions, route_weights.shape[0]))
+
+        partitions = [[] for _ in range(num_partitions)]
+        partition_heap = [(0, i) for i in range(num_partitions)]
+        for route_id, weight in route_weights.sort_values(ascending=False, kind='stable').items():
+            partition_weight, i = heapq.heappop(partition_heap)
+            partitions[i].append(route_id)
+            heapq.heappush(partition_heap, (partition_weight + weight, i))
+
+        logger.debug(f'{route_weights.shape[0]} routes assigned to {num_partitions} partitions')
+        return partitions
+
+    @staticmethod
+    def __route_weights(records:pd.DataFrame) -> pd.Series:
+        """Number of records of each route_id of the records, also if route_id is categorical (see :py:func:`.to_lean_dtypes`), 
+        whose value counts include unused categories.
+        """
+
+        route_weights = records['route_id'].value_counts()
+        if isinstance(route_weights.index, pd.CategoricalIndex):
+            route_weights = route_weights[route_weights > 0]
+            route_weights.index = route_weights.index.astype(route_weights.index.categories.dtype)
+        return route_weights
+
+    def __write_avl_partitions(self, avl_records:pd.DataFrame):
+
+        start_time = time.time()
+        route_partition = {route_id: i for i, routes in enumerate(self.partitions) for route_id in routes}
+        partition_of_records = avl_records['route_id'].map(route_partition)
+        for i in range(len(self.partitions)):
+            avl_records[partition_of_records==i].to_pickle(partition_path(self.partition_dir, 'avl', i))
+        logger.debug(f'AVL records written to {len(self.partitions)} partitions in {round((time.time() - start_time), 2)} seconds')
+
+    def __calculate_partitions(self, shapes:pd.DataFrame, gtfs_records:pd.DataFrame):
+        """Calculate the metrics of each partition and store them on disk, along with the observed speeds needed for the free flow speeds
+        of the stop pairs that are shared between partitions. With more than one worker, the GTFS records of each partition and the shapes
+        are written to disk as well, so that worker processes read their inputs from the partition files rather than receiving them 
+        through the pool.
+        """
+        start_time = time.time()
+        num_workers = min(self.workers, len(self.partitions))
+        if num_workers > 1:
+            shapes_path = os.path.join(self.partition_dir, 'shapes.p')
+            shapes.to_pickle(shapes_path)
+            for i, routes in enumerate(self.partitions):
+                gtfs_records[gtfs_records['route_id'].isin(routes)].to_pickle(partition_path(self.partition_dir, 'gtfs', i))
+            inputs = ((shapes_path, partition_path(self.partition_dir, 'gtfs', i)) for i in range(len(self.partitions)))
+        else:
+            inputs = ((shapes, gtfs_records[gtfs_records['route_id'].isin(routes)]) for routes in self.partitions)
+
+        arguments = ([*partition_inputs, partition_path(self.partition_dir, 'avl', i) if 'AVL' in self.data_option else None, partition_path(self.partition_dir, 'metrics', i),
+                        partition_path(self.partition_dir, 'speeds', i), self.params, self.calculation_class, self.calculation_args, self.stop_pair_codec]
+                        for i, partition_inputs in enumerate(inputs))
+        progress = {'desc': 'calculating metrics of route partitions', 'total': len(self.partitions)}
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                results = list(tqdm(executor.map(calculate_partition, *zip(*arguments)), **progress))
+            os.remove(shapes_path)
+        else:
+            results = [calculate_partition(*partition_arguments) for partition_arguments in tqdm(arguments, **progress)]
+        logger.debug(f'metrics of {len(self.partitions)} partitions calculated by {num_workers} worker(s) '\
+                        f'in {round((time.time() - start_time), 2)} seconds')
+
+        partition_stop_pairs, partition_tpbp_pairs, route_metrics_templates = zip(*results)
+        self.__route_metrics_templates = route_metrics_templates[0]
+
+        #: Codes of the stop pairs served by routes of more than one partition.
+        self.shared_stop_pairs:np.ndarray = self.__shared_pairs(partition_stop_pairs)
+        #: Codes of the timepoint pairs served by routes of more than one partition.
+        self.shared_tpbp_pairs:np.ndarray = self.__shared_pairs(partition_tpbp_pairs)
+        logger.debug(f'{len(self.shared_stop_pairs)} stop pairs and {len(self.shared_tpbp_pairs)} timepoint pairs are shared between partitions')
+
+        #: Free flow speeds of the shared stop pairs by stop pair code, calculated from the observed speeds of all partitions.
+        self.shared_free_flow_speed:Dict[int, float] = {}
+        if 'AVL' in self.data_option:
+            shared_speeds = []
+            for i in range(len(self.partitions)):
+                speeds = pd.read_pickle(partition_path(self.partition_dir, 'speeds', i))
+                shared_speeds.append(speeds[speeds['stop_pair'].isin(self.shared_stop_pairs)])
+                os.remove(partition_path(self.partition_dir, 'speeds', i))
+            if len(self.shared_stop_pairs):
+                free_flow_speed = get_execution_backend(self.params).reduce(pd.concat(shared_speeds), ['stop_pair'], 
+                                                                            {('quantile', 0.9): ['observed_speed_without_dwell']})
+                self.shared_free_flow_speed = free_flow_speed[(('quantile', 0.9), 'observed_speed_without_dwell')].to_dict()
+
+    def __aggregate_partitions(self):
+        """Aggregate the metrics of each partition by time periods, and collect the metrics tables of the aggregation by 10-min intervals,
+        see :py:func:`aggregate_partition`. With more than one worker, partitions are aggregated in parallel by a pool of worker processes.
+        """
+        start_time = time.time()
+        num_workers = min(self.workers, len(self.partitions))
+        arguments = ([self.partition_dir, i, self.params, self.aggregation_class, self.stop_pair_codec, self.shared_stop_pairs, 
+                        self.shared_tpbp_pairs, self.shared_free_flow_speed] for i in range(len(self.partitions)))
+        progress = {'desc': 'aggregating metrics of route partitions', 'total': len(self.partitions)}
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                results = list(tqdm(executor.map(aggregate_partition, *zip(*arguments)), **progress))
+        else:
+            results = [aggregate_partition(*partition_arguments) for partition_arguments in tqdm(arguments, **progress)]
+        logger.debug(f'metrics of {len(self.partitions)} partitions aggregated by {num_workers} worker(s) '\
+                        f'in {round((time.time() - start_time), 2)} seconds')
+
+        partition_time_period_tables, metrics_names, intervals, partition_interval_metrics = zip(*results)
+        #: Names of all aggregated metrics, to be written to the frontend config.
+        self.metrics_names:Dict[str, str] = metrics_names[-1]
+        #: 10-min intervals of the day, see :py:meth:`.Metric_Aggregation.get_10min_intervals`.
+        self.intervals:List[Tuple[Tuple[int, int], Tuple[int, int]]] = intervals[0]
+
+        self.__time_period_parts = {}
+        for time_period_tables in partition_time_period_tables:
+            for key, tables in time_period_tables.items():
+                self.__time_period_parts.setdefault(key, []).append(tables)
+        self.__interval_metrics = {table: pd.concat([metrics[table] for metrics in partition_interval_metrics]) 
+                                    for table in partition_interval_metrics[0]}
+
+    def __read_interval_records(self, interval:Tuple) -> Dict[str, pd.DataFrame]:
+        """Read the AVL stop and timepoint events of a 10-min interval from all partitions, and delete their files.
+        """
+        k = self.intervals.index(interval)
+        interval_records = {table: [self.__interval_metrics[table]] for table in AVL_STOP_METRICS_TABLES}
+        for i in range(len(self.partitions)):
+            path = partition_path(self.partition_dir, f'interval_{k}', i)
+            if os.path.isfile(path):
+                for table, records in pd.read_pickle(path).items():
+                    interval_records[table].append(records)
+                os.remove(path)
+        return {table: pd.concat(records) for table, records in interval_records.items()}
+
+    def __aggregate_10min_intervals(self):
+        """Aggregate the metrics of all partitions by 10-min intervals at once, from the GTFS metrics and AVL route metrics of all 
+        partitions, and the AVL stop and timepoint events of each interval read from disk.
+        """
+        metrics = SimpleNamespace(**self.__interval_metrics, stop_pair_codec=self.stop_pair_codec)
+        agg = self.aggregation_class(metrics, self.params, write_output=False)
+        #: 10-min interval aggregation output of all partitions, in the format returned by :py:meth:`.Metric_Aggregation.get_10min_interval_metrics`.
+        self.agg_metrics_10_min:Dict[Tuple, Dict[str, Tuple[pd.DataFrame, ...]]] = \
+            agg.get_10min_interval_metrics(self.__read_interval_records if 'AVL' in self.data_option else None)
+        del self.__interval_metrics
+
+    def __aggregate_shared_pairs(self):
+        """Aggregate the stop events of shared pairs from all partitions by time periods, and merge the resulting stop-aggregated and 
+        timepoint-aggregated metrics with the aggregated metrics of all partitions.
+        """
+        shared_records = {table: [] for table in stop_metrics_tables(self.data_option)}
+        for i in range(len(self.partitions)):
+            partition_shared_records = pd.read_pickle(partition_path(self.partition_dir, 'shared', i))
+            os.remove(partition_path(self.partition_dir, 'shared', i))
+            for table, records in partition_shared_records.items():
+                shared_records[table].append(records)
+
+        if len(self.shared_stop_pairs) or len(self.shared_tpbp_pairs):
+            logger.info(f'aggregating stop pairs shared between partitions')
+            shared_metrics = SimpleNamespace(**{table: pd.concat(records) for table, records in shared_records.items()},
+                                                **self.__route_metrics_templates, stop_pair_codec=self.stop_pair_codec)
+            agg = self.aggregation_class(shared_metrics, self.params, write_output=False)
+            for key, tables in agg.get_time_period_metrics().items():
+                self.__time_period_parts[key].append(self.__keep_corridors(tables))
+
+        #: Time period aggregation output of all partitions, in the format returned by :py:meth:`.Metric_Aggregation.get_time_period_metrics`.
+        self.agg_metrics:Dict[Tuple[str, str], Tuple[pd.DataFrame, ...]] = {
+            key: self.__concat_tables(parts) for key, parts in self.__time_period_parts.items()
+        }
+        del self.__time_period_parts
+
+    def __shared_pairs(self, partition_pairs:List[np.ndarray]) -> np.ndarray:
+
+        pairs, partition_counts = np.unique(np.concatenate(partition_pairs), return_counts=True)
+        return pairs[partition_counts > 1]
+
+    def __keep_corridors(self, tables:Tuple[pd.DataFrame, ...]) -> Tuple[pd.DataFrame, ...]:
+
+        return tuple(table if i in [CORRIDOR_TABLE_INDEX, TPBP_CORRIDOR_TABLE_INDEX] else table.head(0) for i, table in enumerate(tables))
+
+    def __concat_tables(self, parts:List[Tuple[pd.DataFrame, ...]]) -> Tuple[pd.DataFrame, ...]:
+
+        return tuple(pd.concat([part[i] for part in parts], ignore_index=True).sort_values(sort_columns, ignore_index=True)
+                        for i, sort_columns in enumerate(AGG_TABLE_SORT_COLUMNS))
+
+    def __remove_partition_files(self):
+
+        if not os.listdir(self.partition_dir):
+            os.rmdir(self.partition_dir)
+
+
+def calculate_partition(shapes:Union[pd.DataFrame, str], gtfs_records:Union[pd.DataFrame, str], avl_path:str, metrics_path:str, speeds_path:str,
+                        params:ROVE_params, calculation_class:Type[Metric_Calculation], calculation_args:Tuple,
+                        stop_pair_codec:Stop_Pair_Codec) -> Tuple[np.ndarray, np.ndarray, Dict[str, pd.DataFrame]]:
+    """Calculate the metrics of a route partition of :py:class:`.Partitioned_Metric_Execution`. Runs in this process or in a worker 
+    process, which reads its inputs from the partition files and deletes them. The metrics are stored at metrics_path, and the 
+    observed speeds of the stop events at speeds_path if AVL data is used.
+
+    :param shapes: shapes table, or path of the pickled shapes table
+    :type shapes: Union[pd.DataFrame, str]
+    :param gtfs_records: GTFS records of the partition, or path of the pickled records, which is deleted
+    :type gtfs_records: Union[pd.DataFrame, str]
+    :param avl_path: path of the pickled AVL records of the partition, which is deleted, or None if AVL data is not used
+    :type avl_path: str
+    :param metrics_path: path that the metric calculation object is pickled to
+    :type metrics_path: str
+    :param speeds_path: path that the stop pairs and observed speeds without dwell of the AVL stop metrics are pickled to
+    :type speeds_path: str
+    :param params: a rove_params object that stores information needed throughout the backend
+    :type params: ROVE_params
+    :param calculation_class: metric calculation class of the agency
+    :type calculation_class: Type[Metric_Calculation]
+    :param calculation_args: additional arguments passed to calculation_class after params
+    :type calculation_args: Tuple
+    :param stop_pair_codec: codec of the stop pairs of all partitions
+    :type stop_pair_codec: Stop_Pair_Codec
+    :return: codes of the stop pairs and timepoint pairs of the partition, and empty route metrics tables with the columns of the partition
+    :rtype: Tuple[np.ndarray, np.ndarray, Dict[str, pd.DataFrame]]
+    """
+
+    if isinstance(shapes, str):
+        shapes = pd.read_pickle(shapes)
+    if isinstance(gtfs_records, str):
+        gtfs_records_path, gtfs_records = gtfs_records, pd.read_pickle(gtfs_records)
+        os.remove(gtfs_records_path)
+    if avl_path is not None:
+        avl_records = pd.read_pickle(avl_path)
+        os.remove(avl_path)
+    else:
+        avl_records = None
+
+    metrics = calculation_class(shapes, gtfs_records, avl_records, params, *calculation_args, stop_pair_codec=stop_pair_codec)
+    del avl_records
+
+    stop_pairs = [metrics.gtfs_stop_metrics['stop_pair'].to_numpy()]
+    tpbp_pairs = [metrics.gtfs_tpbp_metrics['stop_pair'].to_numpy()]
+    route_metrics_tables = ['gtfs_route_metrics']
+    if avl_path is not None:
+        stop_pairs.append(metrics.avl_stop_metrics['stop_pair'].to_numpy())
+        tpbp_pairs.append(metrics.avl_tpbp_metrics['stop_pair'].to_numpy())
+        route_metrics_tables.append('avl_route_metrics')
+        metrics.avl_stop_metrics[['stop_pair', 'observed_speed_without_dwell']].to_pickle(speeds_path)
+    route_metrics_templates = {table: getattr(metrics, table).head(0) for table in route_metrics_tables}
+
+    pd.to_pickle(metrics, metrics_path)
+    return np.unique(np.concatenate(stop_pairs)), np.unique(np.concatenate(tpbp_pairs)), route_metrics_templates
+
+
+def aggregate_partition(partition_dir:str, partition:int, params:ROVE_params, aggregation_class:Type[Metric_Aggregation],
+                        stop_pair_codec:Stop_Pair_Codec, shared_stop_pairs:np.ndarray, shared_tpbp_pairs:np.ndarray, 
+                        shared_free_flow_speed:Dict[int, float]) -> Tuple[Dict, Dict[str, str], List, Dict[str, pd.DataFrame]]:
+    """Aggregate the metrics of a route partition of :py:class:`.Partitioned_Metric_Execution` by time periods. Runs in this process or 
+    in a worker process, which reads the metrics of the partition from disk and deletes them. The stop events of shared pairs are
+    stored on disk, to be aggregated with those of the other partitions, and so are the AVL stop and timepoint events of each 
+    10-min interval of the day, see :py:func:`write_interval_records`.
+
+    :param partition_dir: directory of the partition files
+    :type partition_dir: str
+    :param partition: index of the partition
+    :type partition: int
+    :param params: a rove_params object that stores information needed throughout the backend
+    :type params: ROVE_params
+    :param aggregation_class: metric aggregation class of the agency
+    :type aggregation_class: Type[Metric_Aggregation]
+    :param stop_pair_codec: codec of the stop pairs of all partitions
+    :type stop_pair_codec: Stop_Pair_Codec
+    :param shared_stop_pairs: codes of the stop pairs served by routes of more than one partition
+    :type shared_stop_pairs: np.ndarray
+    :param shared_tpbp_pairs: codes of the timepoint pairs served by routes of more than one partition
+    :type shared_tpbp_pairs: np.ndarray
+    :param shared_free_flow_speed: free flow speeds of the shared stop pairs by stop pair code
+    :type shared_free_flow_speed: Dict[int, float]
+    :return: time period aggregation output without the stop-aggregated and timepoint-aggregated metrics of shared pairs, names of the 
+        aggregated metrics, 10-min intervals of the day, and the metrics tables of the partition that the 10-min intervals are aggregated 
+        from: the GTFS metrics and AVL route metrics tables, and empty AVL stop and timepoint metrics tables
+    :rtype: Tuple[Dict, Dict[str, str], List, Dict[str, pd.DataFrame]]
+    """
+
+    metrics_path = partition_path(partition_dir, 'metrics', partition)
+    metrics = pd.read_pickle(metrics_path)
+    os.remove(metrics_path)
+    if shared_free_flow_speed:
+        metrics.congestion_delay(shared_free_flow_speed)
+
+    agg = aggregation_class(metrics, params, write_output=False)
+    time_period_tables = {key: drop_pairs(tables, stop_pair_codec, shared_stop_pairs, shared_tpbp_pairs) 
+                            for key, tables in agg.get_time_period_metrics().items()}
+    intervals = agg.get_10min_intervals()
+    metrics_names = agg.metrics_names
+    del agg
+
+    shared_records = {}
+    for table in stop_metrics_tables(params.data_option):
+        records = getattr(metrics, table)
+        shared_pairs = shared_tpbp_pairs if 'tpbp' in table else shared_stop_pairs
+        shared_records[table] = records[records['stop_pair'].isin(shared_pairs)]
+    pd.to_pickle(shared_records, partition_path(partition_dir, 'shared', partition))
+
+    interval_metrics = {table: getattr(metrics, table) for table in GTFS_STOP_METRICS_TABLES + ['gtfs_route_metrics']}
+    if 'AVL' in params.data_option:
+        interval_metrics['avl_route_metrics'] = metrics.avl_route_metrics
+        interval_metrics.update({table: getattr(metrics, table).head(0) for table in AVL_STOP_METRICS_TABLES})
+        write_interval_records(metrics, intervals, partition_dir, partition)
+
+    return time_period_tables, metrics_names, intervals, interval_metrics
+
+
+def write_interval_records(metrics:Metric_Calculation, intervals:List[Tuple[Tuple[int, int], Tuple[int, int]]], partition_dir:str, partition:int):
+    """Write to disk the AVL stop and timepoint events of a partition in each 10-min interval, i.e. the records that the interval is 
+    aggregated from, to interval_<interval index>_<partition>.p of partition_dir. Events outside of the full day are not aggregated 
+    and not written.
+
+    :param metrics: calculated metrics of the partition
+    :type metrics: Metric_Calculation
+    :param intervals: 10-min intervals of the day, see :py:meth:`.Metric_Aggregation.get_10min_intervals`
+    :type intervals: List[Tuple[Tuple[int, int], Tuple[int, int]]]
+    :param partition_dir: directory of the partition files
+    :type partition_dir: str
+    :param partition: index of the partition
+    :type partition: int
+    """
+
+    interval_starts = np.array([start[0] * 3600 + start[1] * 60 for start, _ in intervals])
+    day_end = intervals[-1][1][0] * 3600 + intervals[-1][1][1] * 60
+
+    interval_records = {}
+    for table in AVL_STOP_METRICS_TABLES:
+        records = getattr(metrics, table)
+        stop_time = records['stop_time'].to_numpy(dtype='float64')
+        interval = np.searchsorted(interval_starts, stop_time, side='right') - 1
+        interval[~((stop_time >= interval_starts[0]) & (stop_time < day_end))] = -1
+        # records of each interval are contiguous in the stable order of their interval, and keep their order within it
+        order = np.argsort(interval, kind='stable')
+        bounds = np.searchsorted(interval[order], np.arange(len(intervals) + 1))
+        for k in range(len(intervals)):
+            if bounds[k] < bounds[k + 1]:
+                interval_records.setdefault(k, {})[table] = records.iloc[order[bounds[k]:bounds[k + 1]]]
+    for k, tables in interval_records.items():
+        pd.to_pickle(tables, partition_path(partition_dir, f'interval_{k}', partition))
+
+
+def partition_path(partition_dir:str, name:str, partition:int) -> str:
+    """Path of a partition file of :py:class:`.Partitioned_Metric_Execution`.
+    """
+
+    return os.path.join(partition_dir, f'{name}_{partition}.p')
+
+
+def stop_metrics_tables(data_option:str) -> List[str]:
+    """Stop and timepoint metrics tables of the data option.
+    """
+
+    return GTFS_STOP_METRICS_TABLES + AVL_STOP_METRICS_TABLES if 'AVL' in data_option else GTFS_STOP_METRICS_TABLES
+
+
+def drop_pairs(tables:Tuple[pd.DataFrame, ...], stop_pair_codec:Stop_Pair_Codec, stop_pairs:np.ndarray, tpbp_pairs:np.ndarray) -> Tuple[pd.DataFrame, ...]:
+    """Drop the stop-aggregated metrics of stop pairs and the timepoint-aggregated metrics of timepoint pairs from aggregated metrics tables.
+    """
+
+    # corridors of the aggregated tables are tuples of stop IDs
+    tables = list(tables)
+    corridors = tables[CORRIDOR_TABLE_INDEX]
+    tables[CORRIDOR_TABLE_INDEX] = corridors[~corridors['corridor'].isin(stop_pair_codec.to_tuples(stop_pairs))]
+    tpbp_corridors = tables[TPBP_CORRIDOR_TABLE_INDEX]
+    tables[TPBP_CORRIDOR_TABLE_INDEX] = tpbp_corridors[~tpbp_corridors['corridor'].isin(stop_pair_codec.to_tuples(tpbp_pairs))]
+    return tuple(tables)
@@ -0,0 +1,101 @@
+from typing import Iterable, List, Tuple
+import numpy as np
+import pandas as pd
+
+#: Number of bits of the code of the second stop in a stop pair code.
+SECOND_STOP_BITS = 32
+SECOND_STOP_MASK = (1 << SECOND_STOP_BITS) - 1
+
+
+class Stop_Pair_Codec():
+    """Integer codes of stop pairs. Stop IDs are given codes in sorted order, and a stop pair (first stop, second stop) is represented
+    by the int64 code first stop code * 2^32 + second stop code, so that stop pairs can be used as groupby and merge keys without hashing
+    tuples of stop IDs, and sort in the same order as the tuples. Stop IDs that are added later are given codes after the existing ones,
+    so all known stops should be given to the constructor.
+
+    Stop pair codes are only comparable between tables encoded by the same codec, so a single codec is shared by all metrics tables
+    of a run, including the route partitions of :py:class:`.Partitioned_Metric_Execution`. Tuples of stop IDs are materialized with
+    :py:meth:`to_tuples` for output only.
+
+    :param stop_ids: stop IDs to give codes to, defaults to ()
+    :type stop_ids: Iterable, optional
+    """
+
+    def __init__(self, stop_ids:Iterable=()):
+
+        #: Stop IDs in the order of their codes.
+        self.stop_ids:pd.Index = pd.Index([], dtype=object)
+        self.add(stop_ids)
+
+    def add(self, stop_ids:Iterable):
+        """Give codes to the stop IDs that do not have one yet, after the existing codes, in sorted order unless stop IDs of different
+        types cannot be sorted.
+
+        :param stop_ids: stop IDs
+        :type stop_ids: Iterable
+        """
+
+        stop_ids = pd.unique(pd.Series(stop_ids, dtype=object).dropna())
+        new_stop_ids = stop_ids[self.stop_ids.get_indexer(stop_ids) < 0]
+        try:
+            new_stop_ids = np.sort(new_stop_ids)
+        except TypeError:
+            pass
+        if len(new_stop_ids):
+            self.stop_ids = self.stop_ids.append(pd.Index(new_stop_ids, dtype=object))
+
+    def encode(self, first_stops:Iterable, second_stops:Iterable, add:bool=True) -> np.ndarray:
+        """Codes of stop pairs given by their first and second stop IDs.
+
+        :param first_stops: first stop ID of each stop pair
+        :type first_stops: Iterable
+        :param second_stops: second stop ID of each stop pair
+        :type second_stops: Iterable
+        :param add: whether to give codes to stop IDs that do not have one, otherwise their stop pairs are coded -1, defaults to True
+        :type add: bool, optional
+        :return: int64 array of stop pair codes
+        :rtype: np.ndarray
+        """
+
+        if add:
+            self.add(first_stops)
+            self.add(second_stops)
+        first_codes = self.stop_ids.get_indexer(pd.Index(first_stops, dtype=object)).astype('int64')
+        second_codes = self.stop_ids.get_indexer(pd.Index(second_stops, dtype=object)).astype('int64')
+        codes = (first_codes << SECOND_STOP_BITS) | second_codes
+        codes[(first_codes < 0) | (second_codes < 0)] = -1
+        return codes
+
+    def encode_pairs(self, stop_pairs:Iterable[Tuple], add:bool=True) -> np.ndarray:
+        """Codes of stop pairs given as tuples (or lists) of two stop IDs, see :py:meth:`encode`.
+        """
+
+        stop_pairs = list(stop_pairs)
+        if not stop_pairs:
+            return np.empty(0, dtype='int64')
+        first_stops, second_stops = zip(*stop_pairs)
+        return self.encode(first_stops, second_stops, add)
+
+    def decode(self, codes:Iterable) -> Tuple[np.ndarray, np.ndarray]:
+        """First and second stop IDs of stop pair codes.
+
+        :param codes: stop pair codes
+        :type codes: Iterable
+        :return: arrays of the first and second stop IDs
+        :rtype: Tuple[np.ndarray, np.ndarray]
+        """
+
+        codes = np.asarray(codes, dtype='int64')
+        stop_ids = self.stop_ids.to_numpy()
+        return stop_ids[codes >> SECOND_STOP_BITS], stop_ids[codes & SECOND_STOP_MASK]
+
+    def to_tuples(self, codes:Iterable) -> List[Tuple]:
+        """Stop pair codes as tuples of (first stop ID, second stop ID), the representation of stop pairs in the outputs.
+
+        :param codes: stop pair codes
+        :type codes: Iterable
+        :return: list of tuples of stop IDs
+        :rtype: List[Tuple]
+        """
+
+        return list(zip(*self.decode(codes)))
@@ -2,67 +2,56 @@ from typing import List
 from backend.data_class.rove_parameters import ROVE_params
 from backend.metrics.metric_aggregation import Metric_Aggregation
 from backend.metrics.metric_calculation import Metric_Calculation
+from backend.metrics.metric_registry import Metric, Metric_Registry
 import pandas as pd
 
 class WMATA_Metric_Aggregation(Metric_Aggregation):
 
-    def __init__(self, metrics: Metric_Calculation, params: ROVE_params):
-        super().__init__(metrics, params)
+    def __init__(self, metrics: Metric_Calculation, params: ROVE_params, write_output: bool=True):
+        super().__init__(metrics, params, write_output)
 
-    def aggregate_metrics(self, percentile:int):
-        super().aggregate_metrics(percentile)
+    def register_metrics(self, registry:Metric_Registry):
+        super().register_metrics(registry)
 
-        self.in_efc()
+        registry.replace('on_time_performance', *self.percent_on_time_metrics())
+        registry.add(*self.in_efc_metrics())
+        registry.add(*self.schedule_sufficiency_index_metrics())
 
-        if 'AVL' in self.data_option:
-            self.schedule_sufficiency_index()
-
-    def on_time_performance(self):
-        """Aggregated on-time performance in seconds or %.
+    def percent_on_time_metrics(self) -> List[Metric]:
+        """Aggregated on-time performance in %, in place of the on-time performance in seconds.
 
             - stop level: arrival delay in seconds at the first stop of a stop pair averaged over all trips
             - routes level: percent of on-time arrivals among all stops along a trip averaged over all trips
         """
 
-        sig_fig = 0
-
-        # self.segments['on_time_performance_perc'] = self.avl_stop_metrics_time_filtered.groupby(self.SEGMENT_MULTIINDEX)['on_time_performance'].mean().round(sig_fig)
-        self.segments['on_time_performance_stop_tpbp'] = (self.avl_stop_metrics_time_filtered.groupby(self.SEGMENT_MULTIINDEX)['is_on_time'].mean() * 100).round(sig_fig)
-        self.tpbp_segments['on_time_performance_stop_tpbp'] = (self.avl_tpbp_metrics_time_filtered.groupby(self.SEGMENT_MULTIINDEX)['is_on_time'].mean() * 100).round(sig_fig)
-        self.routes['on_time_performance_perc'] = self.avl_route_metrics_time_filtered.groupby(self.ROUTE_MULTIINDEX)['on_time_performance'].mean().round(sig_fig)
+        return [
+            Metric('on_time_performance_stop_tpbp', 'On Time Performance (% of trips on time)', ['segments', 'tpbp_segments'], 'avl', 
+                    column='is_on_time', reducer='mean', scale=100, sig_fig=0),
+            Metric('on_time_performance_perc', 'On Time Performance (% of timepoints)', ['routes'], 'avl', 
+                    column='on_time_performance', reducer='mean', sig_fig=0)
+        ]
 
-        self.metrics_names['on_time_performance_stop_tpbp'] = 'On Time Performance (% of trips on time)'
-        self.metrics_names['on_time_performance_perc'] = 'On Time Performance (% of timepoints)'
+    def in_efc_metrics(self) -> List[Metric]:
 
-    def in_efc(self):
-        self.segments['in_efc'] = self.gtfs_stop_metrics.groupby(self.SEGMENT_MULTIINDEX)['in_efc'].max()
-        self.metrics_names['in_efc'] = 'Inside EFC (1: in, 0: out)'
+        return [Metric('in_efc', 'Inside EFC (1: in, 0: out)', ['segments'], column='in_efc', reducer='max', time_filtered=False)]
 
-    def schedule_sufficiency_index(self):
+    def schedule_sufficiency_index_metrics(self) -> List[Metric]:
         """Weighted coefficient of standard deviation of running time.
 
         - corridor level: coefficient of standard deviation of corridor-level running time, weighted by number of observations of each trip_id
         - route level: coefficient of standard deviation of route-level running time, weighted by number of observations of each trip_id
         """
-        sig_fig = 2
 
-        def __ssi_calculation(records:pd.DataFrame, by_trips_cols:List) -> pd.DataFrame:
-            data_by_trips = records.groupby(by_trips_cols)['observed_running_time_with_dwell'].agg('mean').to_frame(name = 'mean')
-            data_by_trips['std'] = records.groupby(by_trips_cols)['observed_running_time_with_dwell'].std()
+        def __ssi_calculation(records:pd.DataFrame, column:str, keys:List) -> pd.Series:
+            by_trips_cols = ['trip_id'] + keys
+            data_by_trips = records.groupby(by_trips_cols, observed=True)[column].agg('mean').to_frame(name = 'mean')
+            data_by_trips['std'] = records.groupby(by_trips_cols, observed=True)[column].std()
             data_by_trips['cov'] = data_by_trips['std'] / data_by_trips['mean']
-            data_by_trips['count'] = records.groupby(by_trips_cols)['observed_running_time_with_dwell'].count()
-            data_by_trips['total_trips'] = data_by_trips.groupby([item for item in by_trips_cols if item not in ['trip_id']])['count'].transform('sum')
+            data_by_trips['count'] = records.groupby(by_trips_cols, observed=True)[column].count()
+            data_by_trips['total_trips'] = data_by_trips.groupby(keys, observed=True)['count'].transform('sum')
             data_by_trips['weight'] = data_by_trips['count'] / data_by_trips['total_trips']
             data_by_trips['weighted_cov'] = data_by_trips['weight'] * data_by_trips['cov']
-            return data_by_trips
-
-        segment_by_trips =  __ssi_calculation(self.avl_stop_metrics_time_filtered, ['trip_id', 'route_id', 'stop_pair'])
-        self.segments['ssi'] = segment_by_trips.groupby(self.SEGMENT_MULTIINDEX)['weighted_cov'].sum().round(sig_fig)
-
-        corridor_by_trips = __ssi_calculation(self.avl_stop_metrics_time_filtered, ['trip_id', 'stop_pair'])
-        self.corridors['ssi'] = corridor_by_trips.groupby(self.CORRIDOR_MULTIINDEX)['weighted_cov'].sum().round(sig_fig)
-
-        route_by_trips = __ssi_calculation(self.avl_route_metrics_time_filtered, ['trip_id', 'route_id', 'direction_id'])         
-        self.routes['ssi'] = route_by_trips.groupby(self.ROUTE_MULTIINDEX)['weighted_cov'].sum().round(sig_fig)
+            return data_by_trips.groupby(keys, observed=True)['weighted_cov'].sum()
 
-        self.metrics_names['ssi'] = 'Run Time Variability'
\ No newline at end of file
+        return [Metric('ssi', 'Run Time Variability', ['segments', 'corridors', 'routes'], 'avl', column='observed_running_time_with_dwell', 
+                        reducer=__ssi_calculation, sig_fig=2)]
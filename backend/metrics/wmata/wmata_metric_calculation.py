@@ -1,4 +1,5 @@
 from backend.metrics.metric_calculation import Metric_Calculation
+from backend.metrics.stop_pair_codec import Stop_Pair_Codec
 from backend.data_class.rove_parameters import ROVE_params
 from backend.helper_functions import check_is_file
 import pandas as pd
@@ -10,8 +11,9 @@ logger = logging.getLogger("backendLogger")
 
 class WMATA_Metric_Calculation(Metric_Calculation):
 
-    def __init__(self, shapes: pd.DataFrame, gtfs_records: pd.DataFrame, avl_records: pd.DataFrame, params: ROVE_params, gtfs_stop_coords: pd.DataFrame):
-        super().__init__(shapes, gtfs_records, avl_records, params)
+    def __init__(self, shapes: pd.DataFrame, gtfs_records: pd.DataFrame, avl_records: pd.DataFrame, params: ROVE_params, gtfs_stop_coords: pd.DataFrame,
+                    stop_pair_codec: Stop_Pair_Codec=None):
+        super().__init__(shapes, gtfs_records, avl_records, params, stop_pair_codec)
         self.gtfs_stop_coords = gtfs_stop_coords
         self.rove_params:ROVE_params = params
         self.flag_if_in_EFC()
@@ -0,0 +1,158 @@
+from backend.shapes.base_shape import BaseShape
+from backend.shapes.mock_valhalla import Mock_Valhalla_Server
+from logger.backend_logger import getLogger
+from typing import Dict, List, Tuple
+import argparse
+import os
+import sys
+import tempfile
+import time
+import types
+import numpy as np
+import pandas as pd
+
+logger = getLogger('backendLogger')
+
+#: Center of the synthetic network of the benchmark, (lat, lon).
+CENTER = (38.9, -77.03)
+
+
+def synthetic_patterns(routes:int, patterns_per_route:int, stops:int, seed:int=0) -> Dict[str, Dict[Tuple[str, str], List[Tuple[float, float]]]]:
+    """Generate patterns in the format of :py:attr:`.GTFS.patterns_dict`. Each route is a random walk of stops about 400 m apart
+    with a few intermediate coordinates per segment. Patterns of the same route branch off the first pattern halfway, so that
+    the first half of their segments is shared, as with short-turns and branches of real routes.
+
+    :param routes: number of routes
+    :type routes: int
+    :param patterns_per_route: number of patterns of each route
+    :type patterns_per_route: int
+    :param stops: number of stops of each pattern
+    :type stops: int
+    :param seed: random seed, defaults to 0
+    :type seed: int, optional
+    :return: dict of the list of coordinates of each segment of each pattern
+    :rtype: Dict[str, Dict[Tuple[str, str], List[Tuple[float, float]]]]
+    """
+
+    rng = np.random.default_rng(seed)
+    step = 0.004 # about 400 m
+
+    def walk(start, count, heading):
+        headings = heading + np.cumsum(rng.normal(0, 0.3, count))
+        return start + np.cumsum(step * np.c_[np.sin(headings), np.cos(headings)], axis=0)
+
+    patterns = {}
+    for r in range(routes):
+        start = np.array(CENTER) + rng.normal(0, 0.05, 2)
+        trunk = walk(start, stops, rng.uniform(0, 2 * np.pi))
+        branch_at = stops // 2
+        for p in range(patterns_per_route):
+            coords = trunk if p == 0 else np.r_[trunk[:branch_at], walk(trunk[branch_at - 1], stops - branch_at, rng.uniform(0, 2 * np.pi))]
+            stop_ids = [f'{r}-{i}' if p == 0 or i < branch_at else f'{r}-{p}-{i}' for i in range(stops)]
+            segments = {}
+            for i in range(stops - 1):
+                intermediate = rng.integers(0, 4)
+                line = coords[i] + np.linspace(0, 1, intermediate + 2)[:, None] * (coords[i + 1] - coords[i])
+                segments[(stop_ids[i], stop_ids[i + 1])] = [tuple(coord) for coord in line.round(6).tolist()]
+            patterns[f'R{r}-0-{p}'] = segments
+    return patterns
+
+
+def run_shape_generation(patterns:Dict, workdir:str, backend_config:Dict) -> Dict:
+    """Generate the shapes of patterns with Valhalla and measure the throughput.
+
+    :param patterns: dict of patterns, see :py:func:`.synthetic_patterns`
+    :type patterns: Dict
+    :param workdir: directory that shapes, skipped shapes and the shape cache are written to
+    :type workdir: str
+    :param backend_config: backend config dict with the "valhalla" and "shape_cache" objects
+    :type backend_config: Dict
+    :return: dict of the number of segments, elapsed time, segments per second and request statistics, see :py:meth:`.Valhalla_Client.stats`
+    :rtype: Dict
+    """
+
+    params = types.SimpleNamespace(backend_config=backend_config,
+                                    output_paths={'shapes': os.path.join(workdir, 'shapes.json'),
+                                                    'shape_cache': os.path.join(workdir, 'shape_cache.sqlite')})
+    segment_count = sum(len(segments) for segments in patterns.values())
+    cwd = os.getcwd()
+    # skipped shapes are written to the working directory
+    os.chdir(workdir)
+    try:
+        start_time = time.perf_counter()
+        shape = BaseShape(patterns, params=params, check_signal=False, use_valhalla=True)
+        elapsed = time.perf_counter() - start_time
+    finally:
+        os.chdir(cwd)
+
+    return {'segments': segment_count, 'matched': len(shape.shapes), 'seconds': round(elapsed, 2),
+            'segments_per_sec': round(segment_count / elapsed, 1), **shape.valhalla_stats}
+
+
+def __main__(args):
+    """Benchmark shape generation with Valhalla against a local :py:class:`.Mock_Valhalla_Server`, or against the Valhalla service
+    at --url. Synthetic patterns are generated with :py:func:`.synthetic_patterns`, then shapes are generated once per value of
+    --concurrency. With --cache, each run is repeated with the shape cache of the previous run (see :py:class:`.Segment_Geometry_Cache`).
+    Segments per second, the numbers of requests, retries and skipped responses, and the 50th, 95th and 99th percentiles of the
+    request latency are printed, and written to --output if given. E.g.
+
+    .. code-block:: bash
+
+        python backend/shape_benchmark.py --routes 50 --concurrency 4 8 16 --latency 0.05 --error_rate 0.01 --no_match_rate 0.05
+
+    :param args: command line arguments
+    :type args: List[str]
+    """
+
+    parser = argparse.ArgumentParser(description="Benchmark shape generation with a mock Valhalla service.")
+    parser.add_argument("--routes", type=int, default=20, required=False)
+    parser.add_argument("--patterns_per_route", type=int, default=2, required=False)
+    parser.add_argument("--stops", type=int, default=30, required=False)
+    parser.add_argument("--seed", type=int, default=0, required=False)
+    parser.add_argument("--concurrency", type=int, nargs='+', default=[8], required=False)
+    parser.add_argument("--match_by_pattern", action='store_true', required=False)
+    parser.add_argument("--cache", action='store_true', required=False)
+    parser.add_argument("--retry_delay", type=float, default=1, required=False)
+    parser.add_argument("--url", type=str, default='', required=False)
+    parser.add_argument("--latency", type=float, default=0.02, required=False)
+    parser.add_argument("--latency_jitter", type=float, default=0, required=False)
+    parser.add_argument("--latency_per_point", type=float, default=0, required=False)
+    parser.add_argument("--error_rate", type=float, default=0, required=False)
+    parser.add_argument("--no_match_rate", type=float, default=0, required=False)
+    parser.add_argument("--workers", type=int, default=8, required=False)
+    parser.add_argument("--output", type=str, default='', required=False)
+    args = parser.parse_args(args)
+
+    patterns = synthetic_patterns(args.routes, args.patterns_per_route, args.stops, seed=args.seed)
+    server = None
+    if not args.url:
+        server = Mock_Valhalla_Server(latency=args.latency, latency_jitter=args.latency_jitter, latency_per_point=args.latency_per_point,
+                                        error_rate=args.error_rate, no_match_rate=args.no_match_rate, workers=args.workers,
+                                        seed=args.seed).start()
+    url = args.url or server.url
+
+    results = []
+    try:
+        for concurrency in args.concurrency:
+            backend_config = {
+                'valhalla': {'url': url, 'concurrency': concurrency, 'retry_delay': args.retry_delay,
+                                'match_by_pattern': args.match_by_pattern},
+                'shape_cache': {'enabled': args.cache}
+            }
+            with tempfile.TemporaryDirectory() as workdir:
+                for run in (['cold', 'warm'] if args.cache else ['cold']):
+                    logger.info(f'benchmarking shape generation with concurrency {concurrency} ({run} cache)')
+                    results.append({'concurrency': concurrency, 'match_by_pattern': args.match_by_pattern, 'run': run,
+                                    **run_shape_generation(patterns, workdir, backend_config)})
+    finally:
+        if server is not None:
+            server.stop()
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    if args.output:
+        results.to_csv(args.output, index=False)
+
+if __name__ == "__main__":
+
+    __main__(sys.argv[1:])
@@ -2,18 +2,21 @@ import logging
 import pandas as pd
 import numpy as np
 from typing import Tuple, Dict, Set, List
-from backend.helper_functions import check_parent_dir, check_is_file
+from backend.helper_functions import check_parent_dir
 from backend.data_class.rove_parameters import ROVE_params
+from backend.shapes.geometry_cache import Segment_Geometry_Cache
+from backend.shapes.geometry_utils import encode_polylines, segment_lengths, simplify_polylines
+from backend.shapes.osm_matcher import match_segments_with_osm
+from backend.shapes.overlay import Segment_Overlay, background_layer_paths
+from backend.shapes.shape_store import shape_store_path, write_shape_store
+from backend.shapes.valhalla_client import Valhalla_Client
 import math
+import os
 from tqdm.auto import tqdm
 import json
+import asyncio
 import requests
 from time import sleep
-import geopandas as gpd
-from shapely.geometry import LineString
-import polyline
-from geopy.distance import distance as geodist
-import stateplane
 
 logger = logging.getLogger("backendLogger")
 
@@ -47,6 +50,13 @@ class BaseShape():
         'radius_increase_step': 10 # Step size used to increase search area when Valhalla cannot find an initial match (meters)
         }
 
+    #: tolerances in meters of the simplified geometries of each resolution, from fine to coarse, for zoomed-out maps, see 
+    #: :py:meth:`.BaseShape.simplify_shapes`
+    RESOLUTIONS = {
+        'medium': 5, # about one pixel at zoom level 15
+        'low': 20 # about one pixel at zoom level 13, for network-wide views
+        }
+
     def __init__(self, patterns, params:ROVE_params, check_signal, mode='bus', use_valhalla=True):
 
         logger.info(f'Generating shapes...')
@@ -55,6 +65,10 @@ class BaseShape():
         self.patterns, self.sample_coord = self.__check_patterns(patterns)
         self.mode = mode
         self.use_valhalla = use_valhalla
+        #: whether segments are matched to a local OSM extract when Valhalla is not used, see :py:meth:`.BaseShape.match_segments_with_osm`
+        self.use_osm:bool = not use_valhalla and self.params.backend_config.get('osm_matching', {}).get('enabled', False)
+        #: summary of the requests sent to Valhalla, see :py:meth:`.Valhalla_Client.stats`, empty without Valhalla
+        self.valhalla_stats:Dict = {}
         self.shapes = self.generate_segment_shapes()
         # self.shapes = read_shapes(self.params.output_paths['shapes'])
         if check_signal:
@@ -63,11 +77,27 @@ class BaseShape():
         self.generate_shapes_json()
 
     def generate_shapes_json(self):
+        """Write the shapes to the shapes JSON file, and to the shape store alongside it with simplified geometries at each resolution, 
+        see :py:func:`.write_shape_store`.
+        """
 
         outpath = check_parent_dir(self.outpath)
         with open(outpath, 'w') as fp:
             shapes_json = json.loads(self.shapes.to_json(orient='records'))
             json.dump(shapes_json, fp)
+        write_shape_store(self.shapes, shape_store_path(outpath), resolutions=self.simplify_shapes())
+
+    def simplify_shapes(self) -> Dict[str, List[str]]:
+        """Simplify the geometries of all segments at each resolution, with the tolerances of :py:attr:`.RESOLUTIONS`, or of "resolutions" 
+        in the "shape_generation" object of backend_config if given, see :py:func:`.simplify_polylines`. The full resolution 
+        geometries are kept as they are.
+
+        :return: dict of the simplified encoded polylines of all segments, in the order of shapes, keyed by resolution
+        :rtype: Dict[str, List[str]]
+        """
+
+        resolutions = self.params.backend_config.get('shape_generation', {}).get('resolutions', self.RESOLUTIONS)
+        return {resolution: simplify_polylines(self.shapes['geometry'], tolerance, precision=6) for resolution, tolerance in resolutions.items()}
 
     def __check_patterns(self, patterns:Dict) -> Dict:
         
@@ -86,53 +116,48 @@ class BaseShape():
 
     def generate_segment_shapes(self) -> pd.DataFrame:
         """For each segment, find its encoded polyline and distance, then save the data in a json file as well
-        as a dataframe.
+        as a dataframe. With Valhalla, segments are map-matched concurrently, see :py:meth:`.BaseShape.match_segments`. Without 
+        Valhalla, segments are map-matched to a local OSM extract if "enabled" in the "osm_matching" object of backend_config is true, 
+        see :py:meth:`.BaseShape.match_segments_with_osm`, and drawn from their coordinates otherwise.
+        Segments found in the shape cache (see :py:class:`.Segment_Geometry_Cache`) are not generated again, and newly 
+        generated segments are added to the cache, except segments drawn from their coordinates because they could not be 
+        matched to the OSM extract, which are matched again by the next run.
 
         :return: a dataframe where each row contains all information of a segment
         :rtype: pd.DataFrame
         """
 
-        PARAMETERS = self.MAP_MATCHING_PARAMETERS
         all_matched = {}
         all_skipped = {}
-
-        # pbar = tqdm(total=len(self.patterns.keys()), desc='Generating pattern shapes', position=0)
-        # for p_name, segments in self.patterns.items():
-        for p_name, segments in tqdm(self.patterns.items(), desc='Generating pattern shapes', position=0):
+        # segments drawn from their coordinates in place of a map-matched geometry, keyed by stop pair and coordinates
+        fallback_segments = set()
+
+        cache = Segment_Geometry_Cache.from_params(self.params, self.__cache_context())
+        cached = {}
+        if cache is not None:
+            cached = cache.get_many({(p_name, s_name): coords for p_name, segments in self.patterns.items() \
+                                        for s_name, coords in segments.items()})
+
+        if self.use_valhalla:
+            uncached_patterns = {p_name: {s_name: coords for s_name, coords in segments.items() if (p_name, s_name) not in cached} \
+                                    for p_name, segments in self.patterns.items()}
+            segment_results = asyncio.run(self.match_segments({p_name: segments for p_name, segments in uncached_patterns.items() if segments}))
+        else:
+            uncached_segments = {(s_name, tuple(coords)): coords for p_name, segments in self.patterns.items() \
+                                    for s_name, coords in segments.items() if (p_name, s_name) not in cached and len(coords) > 1}
+            unique_segments = self.match_segments_with_osm(uncached_segments) if self.use_osm else {}
+            if self.use_osm:
+                fallback_segments = set(uncached_segments) - set(unique_segments)
+            unique_segments.update(self.compute_segments({key: coords for key, coords in uncached_segments.items() if key not in unique_segments}))
+
+        for p_name, segments in self.patterns.items():
             for s_name, coords in segments.items():
-                if self.use_valhalla:
-                    stop_distance = PARAMETERS['stop_distance_meter']
-                    found_geometry = False
-                    break_radius = PARAMETERS['stop_radius']
-                    via_radius = PARAMETERS['intermediate_radius']
-                    radius_increase = 0
-                    while radius_increase <= PARAMETERS['maximum_radius_increase'] and not found_geometry:
-
-                        seg_shape = []
-                        # Get subset of coordinates based on distance threshold.
-                        # Lower bounded at 1 to avoid division by zero.
-                        segment_length = self.__get_distance(coords[0], coords[-1])
-                        interval_count = max(math.floor(segment_length/stop_distance)+1,1) # min: 1
-                        step = math.ceil((len(coords)-1) / interval_count ) # max: len(coords)-1
-                        coords_to_use = [coords[i] for i in np.unique(np.append(np.arange(0, len(coords), step),[len(coords)-1]))]
-
-                        # build segment shape to be passed to Valhalla
-                        for i in range(len(coords_to_use)):
-                            if i==0 or i==len(coords_to_use)-1:
-                                type='break'
-                                radius = break_radius + radius_increase
-                            else:
-                                type='via'
-                                radius = via_radius + radius_increase
-                            
-                            coord = coords_to_use[i]
-                            seg_shape.append(Valhalla_Point(coord[0], coord[1], type, radius).point_parameters())
-
-                        radius_increase = radius_increase + PARAMETERS['radius_increase_step']
-                        matched, skipped = Valhalla_Request(s_name, seg_shape).get_trace_route_response()
-
-                        if not skipped:
-                            found_geometry = True
+                if (p_name, s_name) in cached:
+                    if p_name not in all_matched:
+                        all_matched[p_name] = {}
+                    all_matched[p_name][s_name] = cached[(p_name, s_name)]
+                elif self.use_valhalla:
+                    matched, skipped = segment_results[(p_name, s_name)]
                     
                     # assume the first leg of the matched result corresponds to the segment
                     if bool(matched):
@@ -149,19 +174,21 @@ class BaseShape():
                     if len(coords) > 1:
                         if p_name not in all_matched:
                             all_matched[p_name] = {}
-                        geometry = polyline.encode(coords, precision=6)
-                        distance = sum([geodist(coords[i], coords[i+1]).kilometers  for i in range(len(coords)-1)])
-                        all_matched[p_name][s_name] = {
-                            'geometry': geometry,
-                            'distance': round(distance, 2)
-                        }
+                        # the same stop pair with the same coordinates is computed once for all patterns it appears in
+                        all_matched[p_name][s_name] = unique_segments[(s_name, tuple(coords))]
                     else:
                         if p_name not in all_skipped:
                             all_skipped[p_name] = {}
                         all_skipped[p_name][s_name] = {
                             'coords': coords
                         }
-            # pbar.update()
+
+        if cache is not None:
+            # fallback geometries are not cached under the context of the map matching source
+            cache.put_many({(p_name, s_name): (self.patterns[p_name][s_name], s_info) for p_name, segments in all_matched.items() \
+                                for s_name, s_info in segments.items() if (p_name, s_name) not in cached \
+                                    and (s_name, tuple(self.patterns[p_name][s_name])) not in fallback_segments})
+            cache.close()
 
         matched_output = [
                             {
@@ -198,44 +225,255 @@ class BaseShape():
         return pd.json_normalize(matched_output)
         
 
-    def check_signal_intersection(self):
+    def compute_segments(self, segments:Dict[Tuple, List[Tuple[float, float]]]) -> Dict[Tuple, Dict]:
+        """Compute the encoded polylines and distances of segments from their coordinates without map matching, all segments at once. 
+        Distances are geodesic by default, or haversine if "distance_method" in the "shape_generation" object of backend_config is 
+        "haversine", see :py:func:`.segment_lengths`.
 
-        OSM_PLANE = 'EPSG:4326'
-        STATE_PLANE = f'EPSG:{stateplane.identify(self.sample_coord)}'
-        logger.info(f'checking intersecting signals')
-        signal_inpath = check_is_file(self.params.input_paths['signals'])
-        signal_df = gpd.read_file(signal_inpath)
-        signal_df['state_point'] = gpd.GeoSeries(signal_df['geometry']).set_crs(OSM_PLANE).to_crs(STATE_PLANE)
+        :param segments: dict of the list of coordinates of each segment
+        :type segments: Dict[Tuple, List[Tuple[float, float]]]
+        :return: dict of {'geometry': encoded polyline, 'distance': distance in km} of each segment
+        :rtype: Dict[Tuple, Dict]
+        """
 
-        # Add buffer around each traffic signal to catch any segments that pass through the intersection
-        buffer_radius = 10 # in ft
-        signal_df['buffer_state_point'] = signal_df['state_point'].buffer(buffer_radius)
+        distance_method = self.params.backend_config.get('shape_generation', {}).get('distance_method', 'geodesic')
+        coords_list = list(segments.values())
+        geometries = encode_polylines(coords_list, precision=6)
+        distances = segment_lengths(coords_list, method=distance_method)
+
+        return {key: {'geometry': geometry, 'distance': round(distance, 2)} \
+                    for key, geometry, distance in zip(segments.keys(), geometries, distances.tolist())}
+
+    def match_segments_with_osm(self, segments:Dict[Tuple, List[Tuple[float, float]]]) -> Dict[Tuple, Dict]:
+        """Map-match segments offline to the road graph of the local OSM extract at input_paths['osm'], without a Valhalla service, 
+        see :py:func:`.match_segments_with_osm`. The search radii are those of :py:attr:`.MAP_MATCHING_PARAMETERS`, and the other 
+        parameters are read from the "osm_matching" object of backend_config: "workers" (number of worker processes, defaults to 
+        the number of CPUs), "chunk_size", "sigma", "beta", "max_candidates", "min_spacing" and "highway_types". Distances are 
+        computed as in :py:meth:`.BaseShape.compute_segments`.
+
+        :param segments: dict of the list of coordinates of each segment
+        :type segments: Dict[Tuple, List[Tuple[float, float]]]
+        :return: dict of {'geometry': encoded polyline, 'distance': distance in km} of each matched segment, segments that cannot 
+            be matched are left out
+        :rtype: Dict[Tuple, Dict]
+        """
 
-        sig_gdf = gpd.GeoDataFrame(signal_df[['id', 'buffer_state_point']], geometry='buffer_state_point')
-        # signal_df_buffer = signal_df.buffer(buffer_radius)
-        # all_signals = signal_df_buffer.unary_union
-        
-        # Decode polylines and create geodataframe with same projection as signal df
-        shapes = self.shapes.copy()
-        shapes['linestring'] = shapes['geometry'].apply(lambda x: LineString(polyline.decode(x, geojson = True, precision = 6)))
-        shapes['state_linestring'] = gpd.GeoSeries(shapes['linestring']).set_crs(OSM_PLANE).to_crs(STATE_PLANE)
-        
-        bus_gdf = gpd.GeoDataFrame(shapes[['seg_index', 'state_linestring']], geometry='state_linestring')
+        if not segments:
+            return {}
+        osm_config = dict(self.params.backend_config.get('osm_matching', {}))
+        osm_config.pop('enabled', None)
+        workers = osm_config.pop('workers', os.cpu_count() or 1)
+        chunk_size = osm_config.pop('chunk_size', 200)
+        settings = {key: self.MAP_MATCHING_PARAMETERS[key] for key in \
+                        ['stop_radius', 'intermediate_radius', 'radius_increase_step', 'maximum_radius_increase']}
+        settings.update(osm_config)
+
+        matched = match_segments_with_osm(segments, self.params.input_paths['osm'], settings, workers=workers, chunk_size=chunk_size)
+        matched = {key: coords for key, coords in matched.items() if coords is not None and len(coords) > 1}
+        logger.info(f'{len(matched)} out of {len(segments)} segments matched to the OSM road graph, '\
+                        f'the rest are drawn from their coordinates')
+        return self.compute_segments(matched)
+
+    async def match_segments(self, patterns:Dict[str, Dict]=None) -> Dict[Tuple[str, Tuple], Tuple[Dict, Dict]]:
+        """Map-match the segments of the given patterns (by default, all patterns) with Valhalla concurrently, using a :py:class:`.Valhalla_Client` configured by the "valhalla" object
+        of backend_config. When Valhalla cannot match a segment, the segment is retried with search radii increased by 
+        "radius_increase_step", up to "maximum_radius_increase" (see :py:attr:`.MAP_MATCHING_PARAMETERS`). Each retry is scheduled 
+        as an independent task, so that other segments are matched in the meantime. Segments with the same stop pair and coordinates
+        in different patterns are matched only once, and the result is shared by all of them.
+
+        If "match_by_pattern" in the "valhalla" object of backend_config is true, each pattern is first matched with a single request
+        in which every stop is a break point, and the legs of the response are split back into segments. Segments of patterns that
+        cannot be matched, or whose legs are missing or empty, fall back to being matched one segment at a time.
+
+        :param patterns: dict of patterns whose segments are matched, defaults to all patterns
+        :type patterns: Dict[str, Dict], optional
+        :return: dict of the matched and skipped dicts of the last attempt of each segment, keyed by (pattern, stop pair), 
+            see :py:meth:`.Valhalla_Request.parse_response`
+        :rtype: Dict[Tuple[str, Tuple], Tuple[Dict, Dict]]
+        """
 
-        intersect = gpd.sjoin(sig_gdf, bus_gdf, how='left')
-        intersect['intersect'] = ~intersect['seg_index'].isnull()
-        ig = intersect.groupby('index_right')['intersect'].max().reset_index()
-        ig['index'] = ig['index_right'].astype('int')
-        ig = ig.set_index('index').drop(columns=['index_right'])
+        PARAMETERS = self.MAP_MATCHING_PARAMETERS
+        patterns = self.patterns if patterns is None else patterns
+        match_by_pattern = self.params.backend_config.get('valhalla', {}).get('match_by_pattern', False)
+        client = Valhalla_Client.from_config(self.params.backend_config)
+        segment_count = sum(len(segments) for segments in patterns.values())
+        pbar = tqdm(total=segment_count, desc='Generating segment shapes', position=0)
+        results = {}
+        tasks = set()
+        fallback_count = 0
+        # tasks that match each unique segment, keyed by stop pair and coordinates
+        segment_tasks = {}
+
+        async def match_segment(s_name, coords, radius_increase):
+            request = Valhalla_Request(s_name, self.__build_segment_shape(coords, radius_increase))
+            matched, skipped = await client.trace_route(request)
+
+            next_radius_increase = radius_increase + PARAMETERS['radius_increase_step']
+            if skipped and next_radius_increase <= PARAMETERS['maximum_radius_increase']:
+                return await asyncio.create_task(match_segment(s_name, coords, next_radius_increase))
+            return matched, skipped
+
+        async def match_unique_segment(p_name, s_name, coords):
+            # the same stop pair with the same coordinates is matched once for all patterns it appears in
+            key = (s_name, tuple(coords))
+            if key not in segment_tasks:
+                segment_tasks[key] = asyncio.create_task(match_segment(s_name, coords, 0))
+            results[(p_name, s_name)] = await segment_tasks[key]
+            pbar.update()
+
+        async def match_pattern(p_name, segments):
+            nonlocal fallback_count
+            pattern_shape, segment_legs = self.__build_pattern_shape(segments)
+            legs = {}
+            if segment_legs:
+                matched, skipped = await client.trace_route(Valhalla_Request(p_name, pattern_shape))
+                leg_count = sum(point['type'] == 'break' for point in pattern_shape) - 1
+                if not skipped and len(matched[p_name]) == leg_count:
+                    legs = matched[p_name]
 
-        shapes = shapes.merge(ig, left_index=True, right_index=True, how='left')
-        shapes['intersect'] = shapes['intersect'].fillna(False)
+            for s_name, coords in segments.items():
+                leg = legs.get(segment_legs.get(s_name))
+                if leg is not None and leg['geometry'] and leg['distance'] > 0:
+                    results[(p_name, s_name)] = ({s_name: {0: leg}}, {})
+                    pbar.update()
+                else:
+                    fallback_count += 1
+                    tasks.add(asyncio.create_task(match_unique_segment(p_name, s_name, coords)))
 
-        # bus_gdf = gpd.GeoSeries(shapes['linestring']).set_crs(OSM_PLANE).to_crs(STATE_PLANE)
-        shapes = shapes.drop(columns=['linestring', 'state_linestring'])
+        try:
+            for p_name, segments in patterns.items():
+                if match_by_pattern:
+                    tasks.add(asyncio.create_task(match_pattern(p_name, segments)))
+                else:
+                    for s_name, coords in segments.items():
+                        tasks.add(asyncio.create_task(match_unique_segment(p_name, s_name, coords)))
+            while tasks:
+                await tasks.pop()
+        finally:
+            for task in tasks | set(segment_tasks.values()):
+                task.cancel()
+            pbar.close()
+            client.close()
+            self.valhalla_stats = client.stats()
+
+        if match_by_pattern:
+            logger.debug(f'{segment_count - fallback_count} out of {segment_count} segments matched by pattern, '\
+                            f'{fallback_count} matched one segment at a time')
+        logger.debug(f'{len(segment_tasks)} unique segments matched one segment at a time')
+        logger.debug(f'Valhalla requests: {self.valhalla_stats}')
+
+        return results
+
+    def __cache_context(self) -> Dict:
+        """Everything other than the coordinates of a segment that its geometry depends on, used as part of the keys of the shape cache.
+
+        :return: dict of the source of geometries, mode and map matching parameters
+        :rtype: Dict
+        """
 
-        # For each segment, check if intersects with full signal dataframe
-        # shapes['intersect'] = bus_gdf.intersects(all_signals)
+        if self.use_valhalla:
+            valhalla_config = self.params.backend_config.get('valhalla', {})
+            return {'source': 'valhalla', 'mode': self.mode, 'parameters': self.MAP_MATCHING_PARAMETERS,
+                    'match_by_pattern': valhalla_config.get('match_by_pattern', False)}
+        if self.use_osm:
+            osm_path = self.params.input_paths['osm']
+            osm_config = {key: value for key, value in self.params.backend_config.get('osm_matching', {}).items() \
+                            if key not in ['enabled', 'workers', 'chunk_size']}
+            return {'source': 'osm', 'mode': self.mode, 'parameters': self.MAP_MATCHING_PARAMETERS, 'osm_matching': osm_config,
+                    'osm': [os.path.basename(osm_path), os.path.getsize(osm_path), os.path.getmtime(osm_path)]}
+        return {'source': 'coordinates', 'mode': self.mode}
+
+    def __build_pattern_shape(self, segments:Dict[Tuple, List]) -> Tuple[List[Dict], Dict[Tuple, int]]:
+        """Build the list of Valhalla points of a pattern by joining the points of its segments, see :py:meth:`.BaseShape.__build_segment_shape`.
+        Every stop is a break point, so that each segment corresponds to one leg of the matched trip. The end of a segment and the start 
+        of the next segment are a single break point if they have the same coordinates; otherwise, the leg between them is not used.
+        Segments whose start and end have the same coordinates are left out.
+
+        :param segments: dict of segments of the pattern, in the order of the stops
+        :type segments: Dict[Tuple, List]
+        :return: list of point parameters of the pattern, and dict of the leg index of each segment that is part of the pattern
+        :rtype: Tuple[List[Dict], Dict[Tuple, int]]
+        """
+
+        pattern_shape = []
+        segment_legs = {}
+        break_count = 0
+        for s_name, coords in segments.items():
+            seg_shape = self.__build_segment_shape(coords, 0)
+            start, end = seg_shape[0], seg_shape[-1]
+            if (start['lat'], start['lon']) == (end['lat'], end['lon']):
+                continue
+            if pattern_shape and (pattern_shape[-1]['lat'], pattern_shape[-1]['lon']) == (start['lat'], start['lon']):
+                seg_shape = seg_shape[1:]
+                segment_legs[s_name] = break_count - 1
+                break_count += 1
+            else:
+                segment_legs[s_name] = break_count
+                break_count += 2
+            pattern_shape.extend(seg_shape)
+
+        return pattern_shape, segment_legs
+
+    def __build_segment_shape(self, coords:List[Tuple[float, float]], radius_increase:int) -> List[Dict]:
+        """Build the list of Valhalla points of a segment. Intermediate coordinates are subsampled based on the stop-to-stop distance
+        threshold, and the search radii are increased by radius_increase.
+
+        :param coords: list of coordinates of the segment
+        :type coords: List[Tuple[float, float]]
+        :param radius_increase: increase of the search radii in meters
+        :type radius_increase: int
+        :return: list of point parameters, see :py:meth:`.Valhalla_Point.point_parameters`
+        :rtype: List[Dict]
+        """
+
+        PARAMETERS = self.MAP_MATCHING_PARAMETERS
+        stop_distance = PARAMETERS['stop_distance_meter']
+        break_radius = PARAMETERS['stop_radius']
+        via_radius = PARAMETERS['intermediate_radius']
+
+        seg_shape = []
+        # Get subset of coordinates based on distance threshold.
+        # Lower bounded at 1 to avoid division by zero.
+        segment_length = self.__get_distance(coords[0], coords[-1])
+        interval_count = max(math.floor(segment_length/stop_distance)+1,1) # min: 1
+        step = math.ceil((len(coords)-1) / interval_count ) # max: len(coords)-1
+        coords_to_use = [coords[i] for i in np.unique(np.append(np.arange(0, len(coords), step),[len(coords)-1]))]
+
+        # build segment shape to be passed to Valhalla
+        for i in range(len(coords_to_use)):
+            if i==0 or i==len(coords_to_use)-1:
+                type='break'
+                radius = break_radius + radius_increase
+            else:
+                type='via'
+                radius = via_radius + radius_increase
+            
+            coord = coords_to_use[i]
+            seg_shape.append(Valhalla_Point(coord[0], coord[1], type, radius).point_parameters())
+
+        return seg_shape
+
+    def check_signal_intersection(self) -> pd.DataFrame:
+        """Overlay traffic signals, and optionally every background layer of the frontend config, on the segments, see
+        :py:class:`.Segment_Overlay`. The segments are decoded, projected and indexed once for all layers. Adds the columns
+        "signals_count" and "signals_distance" (meters), and "intersect", whether a signal is within "buffer_meter" of the 
+        segment. If "background_layers" in the "overlay" object of backend_config is true, the count and distance columns of 
+        each layer in "backgroundLayerProp" are added too, named after the layer.
+
+        :return: shapes dataframe with the overlay columns
+        :rtype: pd.DataFrame
+        """
+
+        logger.info(f'checking intersecting signals')
+        overlay = Segment_Overlay.from_params(self.shapes, self.params, self.sample_coord)
+        signals_path = self.params.input_paths['signals']
+        layers = {'signals': Segment_Overlay.read_layer(signals_path)}
+        if self.params.backend_config.get('overlay', {}).get('background_layers', False):
+            for name, path in background_layer_paths(self.params.frontend_config, exclude=[signals_path]).items():
+                layers[name] = Segment_Overlay.read_layer(path)
+
+        shapes = pd.concat([self.shapes, overlay.overlay_layers(layers)], axis=1)
+        shapes['intersect'] = shapes['signals_count'] > 0
         
         return shapes
 
@@ -385,68 +623,71 @@ class Valhalla_Request():
                 'trace_options.turn_penalty_factor': self.trace_options_turn_penalty_factor 
                 }
 
-    def get_trace_route_response(self, timeout=100):
-        """Retrieve the request content for a segment, then send the request to Valhalla. If a good response is returned, 
-        then the geometry (encoded polyline) and distance are saved in the matched dict 
-        (e.g. {'seg1_id': {0: {geometry: xxx, distance: 0.5}}, 'seg2_id': {0: {geometry: xxx, distance: 0.5}}}). Otherwise if 
-        the response is invalid, then the segment information is stored in the skipped dict 
-        (e.g. {'seg1_id': {'shape_input': {request_parameters}, 'result': {400: 'No suitable edges near location'}}}).
+    def get_trace_route_response(self, timeout=100, url='http://localhost:8002/trace_route'):
+        """Retrieve the request content for a segment, then send the request to Valhalla and parse the response, see 
+        :py:meth:`.Valhalla_Request.parse_response`. To send many requests concurrently, use :py:meth:`.Valhalla_Client.trace_route` instead.
 
         :param timeout: request timeout threshold in seconds, defaults to 100
         :type timeout: int, optional
-        :raises requests.HTTPError: the response from Valhalla did not come back with a status code of 200
+        :param url: URL of the Valhalla trace_route service, defaults to 'http://localhost:8002/trace_route'
+        :type url: str, optional
         :raises ConnectionError: encounters Valhall connection error, will sleep for 1 second and retry
         :return: tuple of matched and skipped dicts
         :rtype: Tuple[Dict, Dict]
         """
 
-        matched = {}
-        skipped = {}
-
         request_data = self.request_parameters()
         retry_count = 0
         while retry_count < self.max_retry:
             try:
-                response = requests.post('http://localhost:8002/trace_route',
+                response = requests.post(url,
                                     data = json.dumps(request_data),
                                     timeout = timeout)
                 result = response.json()
-                        
-                if 'status_code' in result and result['status_code'] != 200:
-                    status_code = result['status_code']
-                    status = result['status']
-                    raise requests.HTTPError(f'Invalid response from Valhalla. '\
-                        f'Status code: {status_code}. Status: {status}.')
             except requests.exceptions.ConnectionError:
                 sleep(1)
             except ConnectionError:
                 logger.exception(f'Error connecting to Valhalla service. Retry count {retry_count}...')
                 retry_count += 1
-            except requests.HTTPError:
-                # logger.exception(f'Bad Valhalla request for {self.shape_name}.')
-                if self.shape_name not in skipped:
-                        skipped[self.shape_name] = {}
-
-                skipped[self.shape_name] = {
-                    'shape_input': self.shape,
-                    'result': result
-                }
-                break
             else:
-                for leg_index in range(len(result['trip']['legs'])):
-                    leg = result['trip']['legs'][0]
-                    geometry = leg['shape']
-                    length = leg['summary']['length']
-                    
-                    if self.shape_name not in matched:
-                        matched[self.shape_name] = {}
-
-                    matched[self.shape_name][leg_index] = {
-                        'geometry': geometry,
-                        'distance': length
-                    }
-                break
-        if retry_count == self.max_retry:
-            raise ConnectionError(f'Max retry reached. Unable to proceed.')
+                return self.parse_response(result)
+
+        raise ConnectionError(f'Max retry reached. Unable to proceed.')
+
+    def parse_response(self, result:Dict) -> Tuple[Dict, Dict]:
+        """Parse a response from Valhalla. If a good response is returned, then the geometry (encoded polyline) and distance are saved 
+        in the matched dict (e.g. {'seg1_id': {0: {geometry: xxx, distance: 0.5}}, 'seg2_id': {0: {geometry: xxx, distance: 0.5}}}). 
+        Otherwise if the response is invalid, i.e. its status code is not 200, then the segment information is stored in the skipped dict 
+        (e.g. {'seg1_id': {'shape_input': {request_parameters}, 'result': {400: 'No suitable edges near location'}}}).
+
+        :param result: JSON response from Valhalla
+        :type result: Dict
+        :return: tuple of matched and skipped dicts
+        :rtype: Tuple[Dict, Dict]
+        """
+
+        matched = {}
+        skipped = {}
+
+        if 'status_code' in result and result['status_code'] != 200:
+            # logger.debug(f'Bad Valhalla request for {self.shape_name}. Status code: {result['status_code']}. Status: {result['status']}.')
+            skipped[self.shape_name] = {
+                'shape_input': self.shape,
+                'result': result
+            }
+            return matched, skipped
+
+        for leg_index in range(len(result['trip']['legs'])):
+            leg = result['trip']['legs'][leg_index]
+            geometry = leg['shape']
+            length = leg['summary']['length']
+            
+            if self.shape_name not in matched:
+                matched[self.shape_name] = {}
+
+            matched[self.shape_name][leg_index] = {
+                'geometry': geometry,
+                'distance': length
+            }
 
         return matched, skipped
@@ -0,0 +1,145 @@
+from typing import Dict, Hashable, List, Tuple
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+
+from backend.helper_functions import check_parent_dir
+
+logger = logging.getLogger("backendLogger")
+
+
+class Segment_Geometry_Cache():
+    """On-disk cache of segment geometries (encoded polyline and distance) shared across runs, so that shapes of a new month only need
+    to be generated for segments that are new or whose coordinates moved. Segments are keyed by their list of coordinates rounded to
+    "precision" decimal places, together with a context of everything else that the geometry depends on, e.g. the map matching
+    parameters, the mode and the source of the geometry (Valhalla or stop coordinates).
+
+    The cache is a SQLite database in write-ahead logging mode, so that concurrent runs can read while another run writes, and
+    writers wait for each other instead of failing. When the stored geometries exceed max_size_mb, the least recently used
+    entries are evicted.
+
+    Parameters are read from the "shape_cache" object of backend_config, see :py:meth:`.Segment_Geometry_Cache.from_params`.
+
+    :param path: path to the SQLite database file
+    :type path: str
+    :param context: JSON-serializable description of how the geometries are generated, part of every key
+    :type context: Dict
+    :param precision: number of decimal places that coordinates are rounded to, defaults to 6 (about 0.1 meter)
+    :type precision: int, optional
+    :param max_size_mb: maximum size of the stored geometries in megabytes, defaults to 512
+    :type max_size_mb: float, optional
+    """
+
+    def __init__(self, path:str, context:Dict, precision:int=6, max_size_mb:float=512):
+
+        self.path:str = check_parent_dir(path)
+        self.context:str = json.dumps(context, sort_keys=True)
+        self.precision:int = precision
+        self.max_size:int = int(max_size_mb * 1024 * 1024)
+
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS segments (key TEXT PRIMARY KEY, geometry TEXT NOT NULL, '\
+                                    'distance REAL NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS segments_last_used ON segments (last_used)')
+
+    @classmethod
+    def from_params(cls, params, context:Dict) -> 'Segment_Geometry_Cache':
+        """Create the cache at the "shape_cache" output path with the parameters of the "shape_cache" object of backend_config:
+        "enabled" (default true), "precision" (default 6) and "max_size_mb" (default 512).
+
+        :param params: a rove_params object that stores information needed throughout the backend
+        :type params: ROVE_params
+        :param context: JSON-serializable description of how the geometries are generated
+        :type context: Dict
+        :return: the cache, or None if the cache is disabled or no "shape_cache" output path is given
+        :rtype: Segment_Geometry_Cache
+        """
+
+        cache_config = params.backend_config.get('shape_cache', {})
+        path = params.output_paths.get('shape_cache')
+        if not path or not cache_config.get('enabled', True):
+            return None
+        return cls(path, context, precision=cache_config.get('precision', 6), max_size_mb=cache_config.get('max_size_mb', 512))
+
+    def get_many(self, segments:Dict[Hashable, List[Tuple[float, float]]]) -> Dict[Hashable, Dict]:
+        """Look up the cached geometries of segments, and mark them as recently used.
+
+        :param segments: dict of the list of coordinates of each segment, keyed by any identifier of the segment
+        :type segments: Dict[Hashable, List[Tuple[float, float]]]
+        :return: dict of {'geometry': encoded polyline, 'distance': distance} of the segments found in the cache, keyed by the same identifiers
+        :rtype: Dict[Hashable, Dict]
+        """
+
+        keys = {segment: self.__key(coords) for segment, coords in segments.items()}
+        found = {}
+        unique_keys = list(set(keys.values()))
+        # stay below the limit of SQLite host parameters
+        for i in range(0, len(unique_keys), 500):
+            chunk = unique_keys[i:i+500]
+            rows = self.connection.execute(f"SELECT key, geometry, distance FROM segments WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            found.update({key: {'geometry': geometry, 'distance': distance} for key, geometry, distance in rows})
+
+        if found:
+            now = time.time()
+            with self.connection:
+                self.connection.executemany('UPDATE segments SET last_used = ? WHERE key = ?', [(now, key) for key in found])
+
+        logger.debug(f'found {sum(key in found for key in keys.values())} out of {len(keys)} segments in the shape cache')
+        return {segment: dict(found[key]) for segment, key in keys.items() if key in found}
+
+    def put_many(self, segments:Dict[Hashable, Tuple[List[Tuple[float, float]], Dict]]):
+        """Store the geometries of segments, then evict the least recently used entries if the cache exceeds its maximum size.
+
+        :param segments: dict of the list of coordinates and the {'geometry': encoded polyline, 'distance': distance} of each segment,
+            keyed by any identifier of the segment
+        :type segments: Dict[Hashable, Tuple[List[Tuple[float, float]], Dict]]
+        """
+
+        if not segments:
+            return
+
+        now = time.time()
+        rows = {}
+        for coords, info in segments.values():
+            key = self.__key(coords)
+            rows[key] = (key, info['geometry'], info['distance'], len(key) + len(info['geometry']) + 8, now)
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO segments (key, geometry, distance, size, last_used) VALUES (?, ?, ?, ?, ?)',
+                                        list(rows.values()))
+        logger.debug(f'stored {len(rows)} segments in the shape cache')
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used entries until the stored geometries fit in 90% of the maximum size.
+        """
+
+        with self.connection:
+            total_size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM segments').fetchone()[0]
+            if total_size <= self.max_size:
+                return
+
+            excess = total_size - int(self.max_size * 0.9)
+            evicted = []
+            for key, size in self.connection.execute('SELECT key, size FROM segments ORDER BY last_used'):
+                evicted.append((key,))
+                excess -= size
+                if excess <= 0:
+                    break
+            self.connection.executemany('DELETE FROM segments WHERE key = ?', evicted)
+        logger.debug(f'evicted {len(evicted)} least recently used segments from the shape cache')
+
+    def close(self):
+        """Close the connection to the database.
+        """
+
+        self.connection.close()
+
+    def __key(self, coords:List[Tuple[float, float]]) -> str:
+
+        rounded = [(round(lat, self.precision), round(lon, self.precision)) for lat, lon in coords]
+        return hashlib.sha1(json.dumps([self.context, rounded]).encode()).hexdigest()
@@ -0,0 +1,176 @@
+from typing import List, Sequence, Tuple
+import numpy as np
+from pyproj import Geod
+from shapely.geometry import LineString
+
+#: Methods of calculating segment lengths, see :py:func:`.segment_lengths`.
+DISTANCE_METHODS = ['geodesic', 'haversine']
+
+#: Mean earth radius in km, as used by geopy.
+EARTH_RADIUS_KM = 6371.0088
+
+WGS84 = Geod(ellps='WGS84')
+
+
+def flatten_coordinates(coords_list:Sequence[Sequence[Tuple[float, float]]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Concatenate the coordinates of many lines into one contiguous array.
+
+    :param coords_list: list of lines, each a list of (lat, lon) coordinates
+    :type coords_list: Sequence[Sequence[Tuple[float, float]]]
+    :return: array of shape (n, 2) of all coordinates, and array of the number of coordinates of each line
+    :rtype: Tuple[np.ndarray, np.ndarray]
+    """
+
+    counts = np.fromiter((len(coords) for coords in coords_list), dtype='int64', count=len(coords_list))
+    if counts.sum() == 0:
+        return np.empty((0, 2)), counts
+    points = np.array([coord for coords in coords_list for coord in coords], dtype='float64').reshape(-1, 2)
+    return points, counts
+
+
+def segment_lengths(coords_list:Sequence[Sequence[Tuple[float, float]]], method:str='geodesic') -> np.ndarray:
+    """Calculate the lengths of many lines at once, as the sum of the distances between consecutive coordinates of each line.
+
+    :param coords_list: list of lines, each a list of (lat, lon) coordinates
+    :type coords_list: Sequence[Sequence[Tuple[float, float]]]
+    :param method: 'geodesic' for distances on the WGS-84 ellipsoid (the same as geopy.distance.distance), or 'haversine'
+        for great-circle distances on a sphere, which are faster and within 0.5% of geodesic distances, defaults to 'geodesic'
+    :type method: str, optional
+    :raises ValueError: invalid method
+    :return: array of the length of each line in km
+    :rtype: np.ndarray
+    """
+
+    if method not in DISTANCE_METHODS:
+        raise ValueError(f'Invalid distance method: {method}, must be one of: {DISTANCE_METHODS}.')
+
+    points, counts = flatten_coordinates(coords_list)
+    if len(points) < 2:
+        return np.zeros(len(counts))
+
+    # distances between consecutive points, where pairs that span two lines are dropped
+    lat1, lon1, lat2, lon2 = points[:-1, 0], points[:-1, 1], points[1:, 0], points[1:, 1]
+    if method == 'geodesic':
+        _, _, pair_distances = WGS84.inv(lon1, lat1, lon2, lat2)
+        pair_distances = pair_distances / 1000
+    else:
+        phi1, phi2 = np.radians(lat1), np.radians(lat2)
+        a = np.sin((phi2 - phi1) / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(lon2 - lon1) / 2) ** 2
+        pair_distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+    line_index = np.repeat(np.arange(len(counts)), counts)
+    same_line = line_index[1:] == line_index[:-1]
+    return np.bincount(line_index[1:][same_line], weights=pair_distances[same_line], minlength=len(counts))
+
+
+def encode_polylines(coords_list:Sequence[Sequence[Tuple[float, float]]], precision:int=6) -> List[str]:
+    """Encode many lines into polyline strings at once, with the same output as polyline.encode.
+
+    :param coords_list: list of lines, each a list of (lat, lon) coordinates
+    :type coords_list: Sequence[Sequence[Tuple[float, float]]]
+    :param precision: number of decimal places of the encoded coordinates, defaults to 6
+    :type precision: int, optional
+    :return: list of encoded polylines
+    :rtype: List[str]
+    """
+
+    points, counts = flatten_coordinates(coords_list)
+    if len(points) == 0:
+        return ['' for _ in coords_list]
+
+    # round half away from zero, as polyline does
+    scaled = points * 10 ** precision
+    values = (np.sign(scaled) * np.floor(np.abs(scaled) + 0.5)).astype('int64')
+
+    # differences to the previous point of the same line, the first point of each line is encoded as is
+    heads = np.r_[0, np.cumsum(counts)[:-1]][counts > 0]
+    deltas = np.diff(values, axis=0, prepend=np.zeros((1, 2), dtype='int64'))
+    deltas[heads] = values[heads]
+    deltas = deltas.ravel()
+
+    # zigzag encoding, then split into 5-bit chunks of which all but the last have the continuation bit
+    zigzag = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+    chunk_counts = np.maximum(1, (np.floor(np.log2(np.maximum(zigzag, 1))).astype('int64') + 5) // 5)
+    max_chunks = chunk_counts.max()
+    chunks = (zigzag[:, None] >> (5 * np.arange(max_chunks))) & 0x1f
+    chunk_position = np.arange(max_chunks)[None, :]
+    chunks = np.where(chunk_position < chunk_counts[:, None] - 1, chunks | 0x20, chunks) + 63
+    characters = chunks[chunk_position < chunk_counts[:, None]].astype('uint8').tobytes().decode('ascii')
+
+    # split the characters back into lines
+    line_chars = np.add.reduceat(chunk_counts, np.arange(0, len(chunk_counts), 2)) if len(chunk_counts) else chunk_counts
+    point_line = np.repeat(np.arange(len(counts)), counts)
+    line_lengths = np.bincount(point_line, weights=line_chars, minlength=len(counts)).astype('int64')
+    ends = np.cumsum(line_lengths)
+    return [characters[end - length:end] for end, length in zip(ends, line_lengths)]
+
+
+def decode_polylines(polylines:Sequence[str], precision:int=6, geojson:bool=False) -> List[np.ndarray]:
+    """Decode many polyline strings at once, with the same output as polyline.decode.
+
+    :param polylines: list of encoded polylines
+    :type polylines: Sequence[str]
+    :param precision: number of decimal places of the encoded coordinates, defaults to 6
+    :type precision: int, optional
+    :param geojson: whether to return (lon, lat) instead of (lat, lon) coordinates, defaults to False
+    :type geojson: bool, optional
+    :return: list of arrays of shape (n, 2) of the coordinates of each polyline
+    :rtype: List[np.ndarray]
+    """
+
+    polylines = list(polylines)
+    characters = np.frombuffer(''.join(polylines).encode('ascii'), dtype='uint8').astype('int64') - 63
+    if len(characters) == 0:
+        return [np.empty((0, 2)) for _ in polylines]
+
+    # each value ends with a chunk without the continuation bit
+    is_last_chunk = (characters & 0x20) == 0
+    value_index = np.r_[0, np.cumsum(is_last_chunk)[:-1]]
+    value_starts = np.flatnonzero(np.r_[True, is_last_chunk[:-1]])
+    chunk_position = np.arange(len(characters)) - value_starts[value_index]
+    zigzag = np.zeros(is_last_chunk.sum(), dtype='int64')
+    np.add.at(zigzag, value_index, (characters & 0x1f) << (5 * chunk_position))
+    deltas = np.where(zigzag & 1, ~(zigzag >> 1), zigzag >> 1).reshape(-1, 2)
+
+    # cumulative sums of the differences restart at the first point of each polyline
+    line_values = np.bincount(np.repeat(np.arange(len(polylines)), [len(p) for p in polylines]), weights=is_last_chunk,
+                                minlength=len(polylines)).astype('int64')
+    counts = line_values // 2
+    cumulative = np.cumsum(deltas, axis=0)
+    heads = np.r_[0, np.cumsum(counts)[:-1]]
+    offsets = np.where((heads > 0)[:, None], cumulative[np.maximum(heads - 1, 0)], 0)
+    coordinates = (cumulative - np.repeat(offsets, counts, axis=0)) / 10 ** precision
+    if geojson:
+        coordinates = coordinates[:, ::-1]
+
+    return np.split(coordinates, np.cumsum(counts)[:-1])
+
+
+def simplify_polylines(polylines:Sequence[str], tolerance:float, precision:int=6) -> List[str]:
+    """Simplify many encoded polylines with the topology-preserving Douglas-Peucker algorithm of shapely. Each line is
+    projected to meters with an equirectangular projection centered on its mean latitude, so that the tolerance is in meters
+    everywhere. Simplified lines keep a subset of the original coordinates, including both ends.
+
+    :param polylines: list of encoded polylines
+    :type polylines: Sequence[str]
+    :param tolerance: maximum distance in meters between a simplified line and the original line
+    :type tolerance: float
+    :param precision: number of decimal places of the encoded coordinates, defaults to 6
+    :type precision: int, optional
+    :return: list of simplified encoded polylines
+    :rtype: List[str]
+    """
+
+    radius = EARTH_RADIUS_KM * 1000
+    simplified = []
+    for coords in decode_polylines(polylines, precision=precision):
+        if len(coords) <= 2:
+            simplified.append(coords)
+            continue
+        phi = np.radians(coords[:, 0])
+        xy = np.c_[np.radians(coords[:, 1]) * np.cos(phi.mean()) * radius, phi * radius]
+        line = LineString(xy).simplify(tolerance, preserve_topology=True)
+        # the simplified line is made of original vertices, map them back to the original coordinates
+        vertex_index = {vertex: i for i, vertex in enumerate(map(tuple, xy))}
+        simplified.append(coords[[vertex_index[vertex] for vertex in line.coords]])
+    return encode_polylines(simplified, precision=precision)
@@ -0,0 +1,241 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+import argparse
+import hashlib
+import json
+import logging
+import sys
+import threading
+import time
+
+from backend.shapes.geometry_utils import encode_polylines, segment_lengths
+
+logger = logging.getLogger("backendLogger")
+
+
+class Mock_Valhalla_Server():
+    """Local stand-in for the trace_route service of Valhalla, to measure and tune shape generation (see :py:class:`.BaseShape`)
+    without a Valhalla instance or map tiles. Each leg of a request, i.e. the points from one break point to the next, is "matched"
+    to the line through its input points, and its length is the haversine length of that line in km, so that the same request
+    always gets the same response.
+
+    Latency, transport errors and unmatched responses are simulated deterministically from a hash of the request: each request
+    waits latency + latency_jitter * u + latency_per_point * (number of points) seconds, where u is between 0 and 1; a share
+    error_rate of attempts is dropped without a response, which the client retries; and a share no_match_rate of requests is
+    answered with the "No suitable edges near location" error of Valhalla, which :py:class:`.BaseShape` retries with larger radii.
+    At most "workers" requests are processed at the same time, like the worker threads of Valhalla.
+
+    Run this module to serve until interrupted, e.g. ``python -m backend.shapes.mock_valhalla --port 8002 --latency 0.05``.
+
+    :param host: host to listen on, defaults to '127.0.0.1'
+    :type host: str, optional
+    :param port: port to listen on, 0 for any free port, defaults to 0
+    :type port: int, optional
+    :param latency: base latency of each request in seconds, defaults to 0.02
+    :type latency: float, optional
+    :param latency_jitter: maximum additional random latency in seconds, defaults to 0
+    :type latency_jitter: float, optional
+    :param latency_per_point: additional latency per point of the request in seconds, defaults to 0
+    :type latency_per_point: float, optional
+    :param error_rate: share of attempts that are dropped without a response, defaults to 0
+    :type error_rate: float, optional
+    :param no_match_rate: share of requests answered with "No suitable edges near location", defaults to 0
+    :type no_match_rate: float, optional
+    :param workers: maximum number of requests processed at the same time, defaults to 8
+    :type workers: int, optional
+    :param seed: seed of the simulated latencies, errors and unmatched responses, defaults to 0
+    :type seed: int, optional
+    """
+
+    #: response of Valhalla to a request that cannot be matched to the road network
+    NO_MATCH_RESPONSE = {'error_code': 171, 'error': 'No suitable edges near location', 'status_code': 400, 'status': 'Bad Request'}
+
+    def __init__(self, host:str='127.0.0.1', port:int=0, latency:float=0.02, latency_jitter:float=0, latency_per_point:float=0,
+                    error_rate:float=0, no_match_rate:float=0, workers:int=8, seed:int=0):
+
+        self.latency:float = latency
+        self.latency_jitter:float = latency_jitter
+        self.latency_per_point:float = latency_per_point
+        self.error_rate:float = error_rate
+        self.no_match_rate:float = no_match_rate
+        self.seed:int = seed
+
+        #: number of requests received, dropped and answered with "No suitable edges near location"
+        self.stats:Dict[str, int] = {'requests': 0, 'dropped': 0, 'no_match': 0}
+        self.workers = threading.BoundedSemaphore(workers)
+        self.lock = threading.Lock()
+        # number of attempts of each request body, so that retries of a dropped request get a different draw
+        self.attempts:Dict[str, int] = {}
+
+        self.httpd = ThreadingHTTPServer((host, port), _Trace_Route_Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        self.thread:threading.Thread = None
+
+    @property
+    def url(self) -> str:
+        """Base URL of the server, to be used as the "url" of the "valhalla" object of backend_config.
+        """
+
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self) -> 'Mock_Valhalla_Server':
+        """Serve requests in a background thread.
+
+        :return: the server
+        :rtype: Mock_Valhalla_Server
+        """
+
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='mock-valhalla', daemon=True)
+        self.thread.start()
+        logger.debug(f'mock Valhalla server listening at {self.url}')
+        return self
+
+    def stop(self):
+        """Stop serving requests and close the socket.
+        """
+
+        if self.thread is not None:
+            self.httpd.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.httpd.server_close()
+
+    def __enter__(self) -> 'Mock_Valhalla_Server':
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def draw(self, body:bytes, attempt:int=0) -> float:
+        """Deterministic number between 0 and 1 drawn from a request body.
+
+        :param body: request body
+        :type body: bytes
+        :param attempt: index of the attempt of the same request, defaults to 0
+        :type attempt: int, optional
+        :return: number in [0, 1)
+        :rtype: float
+        """
+
+        digest = hashlib.sha1(f'{self.seed}-{attempt}-'.encode() + body).digest()
+        return int.from_bytes(digest[:8], 'big') / 2 ** 64
+
+    def trace_route(self, body:bytes) -> Dict:
+        """Response to a trace_route request, see the class description.
+
+        :param body: JSON request body
+        :type body: bytes
+        :return: JSON response
+        :rtype: Dict
+        """
+
+        shape = json.loads(body)['shape']
+        time.sleep(self.latency + self.latency_jitter * self.draw(body, -1) + self.latency_per_point * len(shape))
+
+        if self.draw(body, -2) < self.no_match_rate:
+            with self.lock:
+                self.stats['no_match'] += 1
+            return dict(self.NO_MATCH_RESPONSE)
+
+        # a leg goes from each break point to the next, through the points in between
+        breaks = [i for i, point in enumerate(shape) if point.get('type', 'break') == 'break']
+        if len(breaks) < 2:
+            breaks = [0, len(shape) - 1]
+        legs_coords = [[(point['lat'], point['lon']) for point in shape[start:end + 1]] for start, end in zip(breaks[:-1], breaks[1:])]
+        geometries = encode_polylines(legs_coords, precision=6)
+        lengths = segment_lengths(legs_coords, method='haversine')
+        legs = [{'shape': geometry, 'summary': {'length': round(length, 3)}} for geometry, length in zip(geometries, lengths.tolist())]
+        return {'trip': {'legs': legs, 'summary': {'length': round(float(lengths.sum()), 3)}, 'status': 0}}
+
+    def drop(self, body:bytes) -> bool:
+        """Whether this attempt of a request is dropped without a response.
+
+        :param body: request body
+        :type body: bytes
+        :return: True if the attempt is dropped
+        :rtype: bool
+        """
+
+        if self.error_rate <= 0:
+            return False
+        key = hashlib.sha1(body).hexdigest()
+        with self.lock:
+            attempt = self.attempts.get(key, 0)
+            self.attempts[key] = attempt + 1
+        dropped = self.draw(body, attempt) < self.error_rate
+        if dropped:
+            with self.lock:
+                self.stats['dropped'] += 1
+        return dropped
+
+
+class _Trace_Route_Handler(BaseHTTPRequestHandler):
+
+    # keep connections open across requests, as Valhalla does
+    protocol_version = 'HTTP/1.1'
+    # send responses right away instead of waiting for the acknowledgement of the headers
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+
+        mock = self.server.mock
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.rstrip('/') != '/trace_route':
+            self.__respond(404, {'error': f'unknown path {self.path}', 'status_code': 404, 'status': 'Not Found'})
+            return
+
+        with mock.lock:
+            mock.stats['requests'] += 1
+        if mock.drop(body):
+            self.close_connection = True
+            return
+
+        with mock.workers:
+            try:
+                response = mock.trace_route(body)
+            except (ValueError, KeyError, TypeError) as err:
+                response = {'error': f'invalid request: {err!r}', 'status_code': 400, 'status': 'Bad Request'}
+        self.__respond(200 if 'trip' in response else response['status_code'], response)
+
+    def __respond(self, status:int, response:Dict):
+
+        data = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def __main__(args:List[str]):
+
+    parser = argparse.ArgumentParser(description="Serve a mock Valhalla trace_route service.")
+    parser.add_argument("--host", type=str, default='127.0.0.1', required=False)
+    parser.add_argument("--port", type=int, default=8002, required=False)
+    parser.add_argument("--latency", type=float, default=0.02, required=False)
+    parser.add_argument("--latency_jitter", type=float, default=0, required=False)
+    parser.add_argument("--latency_per_point", type=float, default=0, required=False)
+    parser.add_argument("--error_rate", type=float, default=0, required=False)
+    parser.add_argument("--no_match_rate", type=float, default=0, required=False)
+    parser.add_argument("--workers", type=int, default=8, required=False)
+    parser.add_argument("--seed", type=int, default=0, required=False)
+    args = parser.parse_args(args)
+
+    server = Mock_Valhalla_Server(**vars(args))
+    print(f'mock Valhalla server listening at {server.url}')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        print(f'served {server.stats}')
+
+if __name__ == "__main__":
+
+    __main__(sys.argv[1:])
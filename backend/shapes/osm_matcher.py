@@ -0,0 +1,428 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Dict, Hashable, List, Tuple
+import bz2
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+import xml.etree.ElementTree as ET
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+from backend.helper_functions import check_is_file
+from backend.shapes.geometry_utils import EARTH_RADIUS_KM
+
+logger = logging.getLogger("backendLogger")
+
+EARTH_RADIUS_M = EARTH_RADIUS_KM * 1000
+
+#: highway types of OSM ways that buses can drive on
+HIGHWAY_TYPES = ['motorway', 'motorway_link', 'trunk', 'trunk_link', 'primary', 'primary_link', 'secondary', 'secondary_link',
+                    'tertiary', 'tertiary_link', 'unclassified', 'residential', 'living_street', 'service', 'busway', 'bus_guideway', 'road']
+
+#: version of the rules that build the road graph from OSM ways, part of the settings key of saved graphs
+GRAPH_VERSION = 1
+
+
+class OSM_Road_Graph():
+    """Compact directed road graph built from a local OSM extract, with a spatial index of points along its edges. Nodes and edges
+    are stored in numpy arrays: the coordinates of each node, and the start node, end node and length in meters of each edge. Ways
+    are directed according to their "oneway" and "junction" tags, unless "oneway:bus" is "no".
+
+    The graph is built from an OSM XML file (.osm, optionally compressed as .osm.bz2 or .osm.gz) with a streaming parser, then saved
+    next to it as a compressed numpy archive (<path>.graph-<settings key>.npz), which is loaded instead as long as it is more recent 
+    than the extract. The settings key is a hash of the graph building settings, see :py:meth:`.OSM_Road_Graph.settings_key`, so 
+    that graphs built with other settings are never loaded.
+    OSM PBF files are not supported; convert them to OSM XML first, e.g. with ``osmium cat extract.osm.pbf -o extract.osm``.
+
+    :param node_coords: array of shape (n, 2) of the (lat, lon) coordinates of each node
+    :type node_coords: np.ndarray
+    :param edge_from: start node of each edge
+    :type edge_from: np.ndarray
+    :param edge_to: end node of each edge
+    :type edge_to: np.ndarray
+    :param edge_length: length of each edge in meters
+    :type edge_length: np.ndarray
+    :param sample_spacing: maximum spacing in meters of the points along each edge in the spatial index, defaults to 25
+    :type sample_spacing: float, optional
+    """
+
+    def __init__(self, node_coords:np.ndarray, edge_from:np.ndarray, edge_to:np.ndarray, edge_length:np.ndarray, sample_spacing:float=25):
+
+        self.node_coords:np.ndarray = node_coords
+        self.edge_from:np.ndarray = edge_from
+        self.edge_to:np.ndarray = edge_to
+        self.edge_length:np.ndarray = edge_length
+        self.sample_spacing:float = sample_spacing
+
+        #: latitude of the center of the equirectangular projection of the graph
+        self.ref_lat:float = float(node_coords[:, 0].mean()) if len(node_coords) else 0.0
+        #: projected (x, y) coordinates of each node in meters
+        self.node_xy:np.ndarray = self.project(node_coords)
+
+        # points along each edge every sample_spacing meters (at most), and the edge of each point
+        subdivisions = np.maximum(np.ceil(edge_length / sample_spacing).astype('int64'), 1) + 1
+        self.sample_edge:np.ndarray = np.repeat(np.arange(len(edge_from)), subdivisions)
+        fraction = (np.arange(subdivisions.sum()) - np.repeat(np.cumsum(subdivisions) - subdivisions, subdivisions)) \
+                        / (subdivisions[self.sample_edge] - 1)
+        start, end = self.node_xy[edge_from[self.sample_edge]], self.node_xy[edge_to[self.sample_edge]]
+        self.tree = cKDTree(start + (end - start) * fraction[:, None])
+
+    @classmethod
+    def from_file(cls, path:str, highway_types:List[str]=HIGHWAY_TYPES) -> 'OSM_Road_Graph':
+        """Load the graph of an OSM extract, from the graph saved with the same settings if it is more recent than the extract, 
+        otherwise by parsing the extract and saving its graph.
+
+        :param path: path to the OSM XML file, or to a saved graph (.npz), which is loaded as is
+        :type path: str
+        :param highway_types: highway types of the ways to include, defaults to HIGHWAY_TYPES
+        :type highway_types: List[str], optional
+        :raises ValueError: the file is an OSM PBF file
+        :return: the road graph
+        :rtype: OSM_Road_Graph
+        """
+
+        path = check_is_file(path)
+        graph_path = path if path.endswith('.npz') else f'{path}.graph-{cls.settings_key(highway_types)}.npz'
+        if os.path.isfile(graph_path) and os.path.getmtime(graph_path) >= os.path.getmtime(path):
+            with np.load(graph_path) as arrays:
+                return cls(arrays['node_coords'], arrays['edge_from'], arrays['edge_to'], arrays['edge_length'])
+        if path.endswith('.pbf'):
+            raise ValueError(f'OSM PBF files are not supported, convert {path} to OSM XML (.osm) first.')
+
+        graph = cls.from_osm_xml(path, highway_types)
+        np.savez_compressed(graph_path, node_coords=graph.node_coords, edge_from=graph.edge_from, edge_to=graph.edge_to,
+                                edge_length=graph.edge_length)
+        return graph
+
+    @staticmethod
+    def settings_key(highway_types:List[str]=HIGHWAY_TYPES) -> str:
+        """Short hash of the settings that the road graph is built with: the included highway types and the graph version.
+
+        :param highway_types: highway types of the ways to include, defaults to HIGHWAY_TYPES
+        :type highway_types: List[str], optional
+        :return: hexadecimal key of 12 characters
+        :rtype: str
+        """
+
+        settings = {'highway_types': sorted(set(highway_types)), 'version': GRAPH_VERSION}
+        return hashlib.sha1(json.dumps(settings).encode()).hexdigest()[:12]
+
+    @classmethod
+    def from_osm_xml(cls, path:str, highway_types:List[str]=HIGHWAY_TYPES) -> 'OSM_Road_Graph':
+        """Parse an OSM XML file into a road graph. Elements are cleared as soon as they are parsed, so that the file is never held
+        in memory. Only nodes of the included ways are kept, and parallel edges are reduced to the shortest one.
+
+        :param path: path to the OSM XML file
+        :type path: str
+        :param highway_types: highway types of the ways to include, defaults to HIGHWAY_TYPES
+        :type highway_types: List[str], optional
+        :return: the road graph
+        :rtype: OSM_Road_Graph
+        """
+
+        start_time = time.time()
+        highway_types = set(highway_types)
+        node_ids, node_lat, node_lon = [], [], []
+        from_ids, to_ids = [], []
+
+        opener = bz2.open if path.endswith('.bz2') else gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as osm_file:
+            elements = ET.iterparse(osm_file, events=('start', 'end'))
+            _, root = next(elements)
+            for event, element in elements:
+                if event != 'end' or element.tag not in ['node', 'way', 'relation']:
+                    continue
+                if element.tag == 'node':
+                    node_ids.append(int(element.get('id')))
+                    node_lat.append(float(element.get('lat')))
+                    node_lon.append(float(element.get('lon')))
+                elif element.tag == 'way':
+                    tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+                    if tags.get('highway') in highway_types and tags.get('area') != 'yes' and tags.get('access') not in ['no', 'private']:
+                        refs = [int(nd.get('ref')) for nd in element.iter('nd')]
+                        oneway = tags.get('oneway', 'yes' if tags.get('junction') in ['roundabout', 'circular'] else 'no')
+                        if tags.get('oneway:bus') == 'no':
+                            oneway = 'no'
+                        if oneway != '-1':
+                            from_ids += refs[:-1]
+                            to_ids += refs[1:]
+                        if oneway not in ['yes', 'true', '1']:
+                            from_ids += refs[1:]
+                            to_ids += refs[:-1]
+                root.clear()
+
+        node_ids = np.asarray(node_ids, dtype='int64')
+        order = np.argsort(node_ids)
+        node_ids, node_coords = node_ids[order], np.c_[node_lat, node_lon][order] if len(order) else np.empty((0, 2))
+        from_index, to_index = np.searchsorted(node_ids, from_ids), np.searchsorted(node_ids, to_ids)
+        # ways of an extract may refer to nodes outside of it
+        found = (from_index < len(node_ids)) & (to_index < len(node_ids))
+        found[found] = (node_ids[from_index[found]] == np.asarray(from_ids, dtype='int64')[found]) & \
+                        (node_ids[to_index[found]] == np.asarray(to_ids, dtype='int64')[found])
+        from_index, to_index = from_index[found], to_index[found]
+
+        used_nodes, edge_nodes = np.unique(np.r_[from_index, to_index], return_inverse=True)
+        node_coords = node_coords[used_nodes]
+        edge_from, edge_to = edge_nodes[:len(from_index)], edge_nodes[len(from_index):]
+        edge_length = haversine_m(node_coords[edge_from], node_coords[edge_to])
+
+        # keep the shortest of parallel edges, and drop loops
+        order = np.lexsort((edge_length, edge_to, edge_from))
+        edge_from, edge_to, edge_length = edge_from[order], edge_to[order], edge_length[order]
+        keep = np.r_[True, (edge_from[1:] != edge_from[:-1]) | (edge_to[1:] != edge_to[:-1])] & (edge_from != edge_to)
+
+        graph = cls(node_coords, edge_from[keep].astype('int32'), edge_to[keep].astype('int32'), edge_length[keep])
+        logger.debug(f'built road graph of {len(node_coords)} nodes and {keep.sum()} edges from {path} '\
+                        f'in {round((time.time() - start_time), 2)} seconds')
+        return graph
+
+    def project(self, coords:np.ndarray) -> np.ndarray:
+        """Project (lat, lon) coordinates to planar (x, y) coordinates in meters with an equirectangular projection centered at ref_lat.
+
+        :param coords: array of shape (n, 2) of (lat, lon) coordinates
+        :type coords: np.ndarray
+        :return: array of shape (n, 2)
+        :rtype: np.ndarray
+        """
+
+        coords = np.asarray(coords, dtype='float64').reshape(-1, 2)
+        return np.column_stack([EARTH_RADIUS_M * np.radians(coords[:, 1]) * np.cos(np.radians(self.ref_lat)), EARTH_RADIUS_M * np.radians(coords[:, 0])])
+
+    def edges_near(self, xy:np.ndarray, radius:float) -> np.ndarray:
+        """Edges that pass within radius meters of a point, plus possibly a few that pass within radius + sample_spacing / 2.
+
+        :param xy: projected point
+        :type xy: np.ndarray
+        :param radius: search radius in meters
+        :type radius: float
+        :return: array of edges
+        :rtype: np.ndarray
+        """
+
+        return np.unique(self.sample_edge[self.tree.query_ball_point(xy, radius + self.sample_spacing / 2)])
+
+
+class OSM_Matcher():
+    """Match the coordinates of segments to paths on an :py:class:`.OSM_Road_Graph` with a hidden Markov model, in the manner of
+    Newson and Krumm (2009). The candidates of each coordinate are the projections of the coordinate on the edges within the search
+    radius, with an emission probability that decreases with the distance to the coordinate (Gaussian with standard deviation sigma).
+    The transition probability between candidates of consecutive coordinates decreases with the difference between the route distance
+    and the straight distance between the coordinates (exponential with scale beta). Route distances between all candidates of a
+    segment are found with one run of Dijkstra's algorithm on the subgraph around the segment, and the most likely sequence of
+    candidates is found with the Viterbi algorithm, vectorized over candidates.
+
+    :param graph: the road graph
+    :type graph: OSM_Road_Graph
+    :param stop_radius: search radius of the first and last coordinates (the stops) in meters, defaults to 35
+    :type stop_radius: float, optional
+    :param intermediate_radius: search radius of intermediate coordinates in meters, defaults to 100
+    :type intermediate_radius: float, optional
+    :param sigma: standard deviation of the distance between coordinates and the road in meters, defaults to 10
+    :type sigma: float, optional
+    :param beta: scale of the difference between route and straight distances in meters, defaults to 50
+    :type beta: float, optional
+    :param max_candidates: maximum number of candidates of each coordinate, defaults to 8
+    :type max_candidates: int, optional
+    :param min_spacing: intermediate coordinates closer than this distance in meters to the previous coordinate are ignored, defaults to 20
+    :type min_spacing: float, optional
+    """
+
+    def __init__(self, graph:OSM_Road_Graph, stop_radius:float=35, intermediate_radius:float=100, sigma:float=10, beta:float=50,
+                    max_candidates:int=8, min_spacing:float=20):
+
+        self.graph:OSM_Road_Graph = graph
+        self.stop_radius:float = stop_radius
+        self.intermediate_radius:float = intermediate_radius
+        self.sigma:float = sigma
+        self.beta:float = beta
+        self.max_candidates:int = max_candidates
+        self.min_spacing:float = min_spacing
+
+    def match(self, coords:List[Tuple[float, float]], radius_increase:float=0) -> List[Tuple[float, float]]:
+        """Match the coordinates of a segment to a path on the road graph.
+
+        :param coords: list of (lat, lon) coordinates of the segment, from the first stop to the second stop
+        :type coords: List[Tuple[float, float]]
+        :param radius_increase: increase of the search radii in meters, defaults to 0
+        :type radius_increase: float, optional
+        :return: list of (lat, lon) coordinates of the matched path, or None if the segment cannot be matched
+        :rtype: List[Tuple[float, float]]
+        """
+
+        graph = self.graph
+        observations = self.__thin(graph.project(coords))
+        if len(observations) < 2:
+            return None
+
+        # candidates: edge, position along the edge (0 to 1), projected point and log emission probability
+        radii = np.full(len(observations), self.intermediate_radius + radius_increase)
+        radii[[0, -1]] = self.stop_radius + radius_increase
+        candidates = [self.__candidates(xy, radius) for xy, radius in zip(observations, radii)]
+        if any(len(edges) == 0 for edges, *_ in candidates):
+            return None
+
+        # route distances from the end node of every candidate edge, on the subgraph around the segment
+        subgraph_edges = graph.edges_near(observations.mean(axis=0), np.hypot(*np.ptp(observations, axis=0)) / 2 + self.intermediate_radius + 500)
+        subgraph_edges = np.union1d(subgraph_edges, np.concatenate([edges for edges, *_ in candidates]))
+        nodes, local = np.unique(np.r_[graph.edge_from[subgraph_edges], graph.edge_to[subgraph_edges]], return_inverse=True)
+        local_from, local_to = local[:len(subgraph_edges)], local[len(subgraph_edges):]
+        csgraph = csr_matrix((graph.edge_length[subgraph_edges], (local_from, local_to)), shape=(len(nodes), len(nodes)))
+        sources = np.unique(np.concatenate([np.searchsorted(nodes, graph.edge_to[edges]) for edges, *_ in candidates[:-1]]))
+        straight = np.hypot(*np.diff(observations, axis=0).T)
+        route_distances, predecessors = dijkstra(csgraph, indices=sources, return_predecessors=True,
+                                                    limit=straight.sum() * 3 + 2 * (self.intermediate_radius + radius_increase) + 1000)
+
+        # Viterbi
+        scores = candidates[0][3]
+        back_pointers = []
+        for i in range(1, len(candidates)):
+            from_edges, from_positions, _, _ = candidates[i - 1]
+            to_edges, to_positions, _, emissions = candidates[i]
+            from_lengths, to_lengths = graph.edge_length[from_edges], graph.edge_length[to_edges]
+            source_rows = np.searchsorted(sources, np.searchsorted(nodes, graph.edge_to[from_edges]))
+            target_columns = np.searchsorted(nodes, graph.edge_from[to_edges])
+            route = (1 - from_positions[:, None]) * from_lengths[:, None] + route_distances[source_rows][:, target_columns] \
+                        + to_positions[None, :] * to_lengths[None, :]
+            same_edge = (from_edges[:, None] == to_edges[None, :]) & (to_positions[None, :] >= from_positions[:, None])
+            route = np.where(same_edge, (to_positions[None, :] - from_positions[:, None]) * from_lengths[:, None], route)
+            transitions = -np.abs(route - straight[i - 1]) / self.beta
+            total = scores[:, None] + transitions
+            back_pointers.append(np.argmax(total, axis=0))
+            scores = total[back_pointers[-1], np.arange(len(to_edges))] + emissions
+            if not np.isfinite(scores).any():
+                return None
+
+        # most likely sequence of candidates, then the path through them
+        chosen = [int(np.argmax(scores))]
+        for pointers in reversed(back_pointers):
+            chosen.append(int(pointers[chosen[-1]]))
+        chosen.reverse()
+
+        path = [candidates[0][2][chosen[0]]]
+        for i in range(1, len(candidates)):
+            from_edge, from_position = candidates[i - 1][0][chosen[i - 1]], candidates[i - 1][1][chosen[i - 1]]
+            to_edge, to_position = candidates[i][0][chosen[i]], candidates[i][1][chosen[i]]
+            if not (from_edge == to_edge and to_position >= from_position):
+                source = np.searchsorted(nodes, graph.edge_to[from_edge])
+                target = np.searchsorted(nodes, graph.edge_from[to_edge])
+                node_path = [target]
+                while node_path[-1] != source:
+                    node_path.append(predecessors[np.searchsorted(sources, source), node_path[-1]])
+                path.extend(graph.node_coords[nodes[node_path[::-1]]])
+            path.append(candidates[i][2][chosen[i]])
+
+        path = np.asarray(path)
+        keep = np.r_[True, (np.diff(path, axis=0) != 0).any(axis=1)]
+        return [tuple(coord) for coord in path[keep].tolist()]
+
+    def __thin(self, xy:np.ndarray) -> np.ndarray:
+        """Drop intermediate coordinates closer than min_spacing to the previous kept coordinate, always keeping the last one.
+        """
+
+        keep = [0]
+        for i in range(1, len(xy) - 1):
+            if np.hypot(*(xy[i] - xy[keep[-1]])) >= self.min_spacing:
+                keep.append(i)
+        if len(xy) > 1 and np.hypot(*(xy[-1] - xy[keep[0]])) > 0:
+            keep.append(len(xy) - 1)
+        return xy[keep]
+
+    def __candidates(self, xy:np.ndarray, radius:float) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Candidates of a coordinate: edges within radius, the position of the projection along each edge (0 to 1), the (lat, lon)
+        coordinates of the projection and the log emission probability, of the max_candidates nearest edges.
+        """
+
+        graph = self.graph
+        edges = graph.edges_near(xy, radius)
+        start, end = graph.node_xy[graph.edge_from[edges]], graph.node_xy[graph.edge_to[edges]]
+        direction = end - start
+        squared_length = np.maximum((direction ** 2).sum(axis=1), 1e-12)
+        positions = np.clip(((xy - start) * direction).sum(axis=1) / squared_length, 0, 1)
+        distances = np.hypot(*(start + direction * positions[:, None] - xy).T)
+
+        nearest = np.argsort(distances, kind='stable')[:self.max_candidates]
+        nearest = nearest[distances[nearest] <= radius]
+        edges, positions, distances = edges[nearest], positions[nearest], distances[nearest]
+        start_coords, end_coords = graph.node_coords[graph.edge_from[edges]], graph.node_coords[graph.edge_to[edges]]
+        points = start_coords + (end_coords - start_coords) * positions[:, None]
+        return edges, positions, points, -0.5 * (distances / self.sigma) ** 2
+
+
+def haversine_m(start:np.ndarray, end:np.ndarray) -> np.ndarray:
+    """Great-circle distances in meters between arrays of (lat, lon) coordinates.
+    """
+
+    phi1, phi2 = np.radians(start[:, 0]), np.radians(end[:, 0])
+    a = np.sin((phi2 - phi1) / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(end[:, 1] - start[:, 1]) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def match_segments_with_osm(segments:Dict[Hashable, List[Tuple[float, float]]], osm_path:str, settings:Dict, workers:int=1,
+                            chunk_size:int=200) -> Dict[Hashable, List[Tuple[float, float]]]:
+    """Match many segments to the road graph of an OSM extract, see :py:class:`.OSM_Matcher`. Segments are split into chunks of
+    chunk_size in the given order, e.g. pattern by pattern, and chunks are matched in parallel by worker processes, each of which
+    loads the saved road graph once. Segments that cannot be matched are retried with the search radii increased by
+    "radius_increase_step", up to "maximum_radius_increase".
+
+    :param segments: dict of the list of (lat, lon) coordinates of each segment, keyed by any identifier of the segment
+    :type segments: Dict[Hashable, List[Tuple[float, float]]]
+    :param osm_path: path to the OSM XML file or saved graph
+    :type osm_path: str
+    :param settings: keyword arguments of :py:class:`.OSM_Matcher`, plus "radius_increase_step", "maximum_radius_increase"
+        and "highway_types"
+    :type settings: Dict
+    :param workers: number of worker processes, defaults to 1
+    :type workers: int, optional
+    :param chunk_size: number of segments matched by a worker at a time, defaults to 200
+    :type chunk_size: int, optional
+    :return: dict of the matched (lat, lon) coordinates of each segment, or None for segments that cannot be matched
+    :rtype: Dict[Hashable, List[Tuple[float, float]]]
+    """
+
+    start_time = time.time()
+    # parse the extract once in this process, so that workers only load the saved graph
+    OSM_Road_Graph.from_file(osm_path, settings.get('highway_types', HIGHWAY_TYPES))
+
+    keys = list(segments.keys())
+    chunks = [[segments[key] for key in keys[i:i+chunk_size]] for i in range(0, len(keys), chunk_size)]
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+            results = list(executor.map(match_chunk, chunks, repeat(osm_path), repeat(settings)))
+    else:
+        results = [match_chunk(chunk, osm_path, settings) for chunk in chunks]
+
+    matched = dict(zip(keys, [path for chunk_result in results for path in chunk_result]))
+    logger.debug(f'matched {sum(path is not None for path in matched.values())} out of {len(matched)} segments to the OSM road graph '\
+                    f'in {round((time.time() - start_time), 2)} seconds')
+    return matched
+
+
+_graphs:Dict[Tuple[str, str], OSM_Road_Graph] = {}
+
+def match_chunk(chunk:List[List[Tuple[float, float]]], osm_path:str, settings:Dict) -> List[List[Tuple[float, float]]]:
+    """Match a chunk of segments. Runs in a worker process, which keeps the road graph loaded across chunks.
+    """
+
+    highway_types = settings.get('highway_types', HIGHWAY_TYPES)
+    graph_key = (osm_path, OSM_Road_Graph.settings_key(highway_types))
+    if graph_key not in _graphs:
+        _graphs[graph_key] = OSM_Road_Graph.from_file(osm_path, highway_types)
+    matcher_settings = {key: value for key, value in settings.items() \
+                            if key not in ['radius_increase_step', 'maximum_radius_increase', 'highway_types']}
+    matcher = OSM_Matcher(_graphs[graph_key], **matcher_settings)
+
+    paths = []
+    for coords in chunk:
+        path = None
+        radius_increase = 0
+        while path is None and radius_increase <= settings.get('maximum_radius_increase', 0):
+            path = matcher.match(coords, radius_increase)
+            radius_increase += settings.get('radius_increase_step', 10)
+        paths.append(path)
+    return paths
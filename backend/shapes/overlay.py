@@ -0,0 +1,169 @@
+from typing import Dict, Sequence, Tuple
+import logging
+import re
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from pyproj import CRS
+from shapely.geometry import LineString, box
+import stateplane
+
+from backend.helper_functions import check_is_file
+from backend.shapes.geometry_utils import decode_polylines
+
+logger = logging.getLogger("backendLogger")
+
+
+class Segment_Overlay():
+    """Overlay layers of features, e.g. traffic signals, stop signs or bus bulbs, on the segments of a shapes dataframe. The encoded
+    polylines of the segments are decoded, projected to the state plane of the segments and indexed in an R-tree once, so that any
+    number of layers can be overlaid without repeating that work. Each layer is projected once and queried against the index in
+    bulk, and for each segment the number of features within buffer_meter and the distance to the nearest feature within
+    search_radius_meter are returned.
+
+    Parameters are read from the "overlay" object of backend_config, see :py:meth:`.Segment_Overlay.from_params`.
+
+    :param shapes: dataframe of segments with a column "geometry" of encoded polylines
+    :type shapes: pd.DataFrame
+    :param sample_coord: (lat, lon) coordinate used to find the state plane of the segments
+    :type sample_coord: Tuple[float, float]
+    :param buffer_meter: distance from a segment within which features are counted, defaults to 10
+    :type buffer_meter: float, optional
+    :param search_radius_meter: distance from a segment within which the nearest feature is searched, defaults to 100
+    :type search_radius_meter: float, optional
+    """
+
+    #: CRS of the coordinates of encoded polylines and input layers
+    OSM_PLANE = 'EPSG:4326'
+
+    def __init__(self, shapes:pd.DataFrame, sample_coord:Tuple[float, float], buffer_meter:float=10, search_radius_meter:float=100):
+
+        start_time = time.time()
+        self.index:pd.Index = shapes.index
+        self.buffer_meter:float = buffer_meter
+        self.search_radius_meter:float = max(search_radius_meter, buffer_meter)
+        self.crs:str = f'EPSG:{stateplane.identify(sample_coord[1], sample_coord[0])}'
+        #: meters per unit of the state plane CRS
+        self.unit:float = CRS(self.crs).axis_info[0].unit_conversion_factor
+
+        # segments with fewer than two coordinates have no line to overlay on
+        coords_list = decode_polylines(shapes['geometry'], precision=6, geojson=True)
+        self.valid:np.ndarray = np.array([len(coords) > 1 for coords in coords_list], dtype=bool)
+        linestrings = [LineString(coords) for coords, valid in zip(coords_list, self.valid) if valid]
+        #: projected linestrings of the valid segments, in the order of shapes
+        self.segments:gpd.GeoSeries = gpd.GeoSeries(linestrings, crs=self.OSM_PLANE).to_crs(self.crs)
+        self.segment_positions:np.ndarray = np.flatnonzero(self.valid)
+        # build the spatial index now so that every layer reuses it
+        self.segments.sindex
+        logger.debug(f'{len(self.segments)} segments indexed for overlay in {round((time.time() - start_time), 2)} seconds')
+
+    @classmethod
+    def from_params(cls, shapes:pd.DataFrame, params, sample_coord:Tuple[float, float]) -> 'Segment_Overlay':
+        """Create the overlay with the parameters of the "overlay" object of backend_config: "buffer_meter" (default 10) and
+        "search_radius_meter" (default 100).
+
+        :param shapes: dataframe of segments with a column "geometry" of encoded polylines
+        :type shapes: pd.DataFrame
+        :param params: a rove_params object that stores information needed throughout the backend
+        :type params: ROVE_params
+        :param sample_coord: (lat, lon) coordinate used to find the state plane of the segments
+        :type sample_coord: Tuple[float, float]
+        :return: the overlay
+        :rtype: Segment_Overlay
+        """
+
+        overlay_config = params.backend_config.get('overlay', {})
+        return cls(shapes, sample_coord, buffer_meter=overlay_config.get('buffer_meter', 10),
+                    search_radius_meter=overlay_config.get('search_radius_meter', 100))
+
+    @staticmethod
+    def read_layer(path:str) -> gpd.GeoSeries:
+        """Read the geometries of a layer file, e.g. a GeoJSON file of traffic signals. Geometries without a CRS are assumed
+        to be in EPSG:4326.
+
+        :param path: path to the layer file
+        :type path: str
+        :return: geometries of the layer
+        :rtype: gpd.GeoSeries
+        """
+
+        layer = gpd.read_file(check_is_file(path))
+        geometry = layer.geometry[layer.geometry.notna() & ~layer.geometry.is_empty]
+        if geometry.crs is None:
+            geometry = geometry.set_crs(Segment_Overlay.OSM_PLANE)
+        return geometry.reset_index(drop=True)
+
+    def overlay(self, features:gpd.GeoSeries, name:str) -> pd.DataFrame:
+        """Overlay a layer of features on the segments. Candidate pairs of features and segments are found in one bulk query of
+        the spatial index of the segments with the bounding boxes of the features expanded by search_radius_meter, then exact
+        distances are computed only for the candidate pairs.
+
+        :param features: geometries of the layer, in any CRS
+        :type features: gpd.GeoSeries
+        :param name: name of the layer, used as the prefix of the output columns
+        :type name: str
+        :return: dataframe with the index of shapes and columns "<name>_count", the number of features within buffer_meter of
+            each segment, and "<name>_distance", the distance in meters to the nearest feature within search_radius_meter
+            (NaN if there is none)
+        :rtype: pd.DataFrame
+        """
+
+        start_time = time.time()
+        counts = np.zeros(len(self.index), dtype='int64')
+        distances = np.full(len(self.index), np.inf)
+
+        if len(features) > 0 and len(self.segments) > 0:
+            features = features.to_crs(self.crs).reset_index(drop=True)
+            radius = self.search_radius_meter / self.unit
+            bounds = features.bounds.to_numpy()
+            search_boxes = [box(minx - radius, miny - radius, maxx + radius, maxy + radius) for minx, miny, maxx, maxy in bounds]
+            feature_idx, segment_idx = self.segments.sindex.query_bulk(search_boxes)
+
+            if len(feature_idx) > 0:
+                pair_distances = features.iloc[feature_idx].reset_index(drop=True).distance(
+                                    self.segments.iloc[segment_idx].reset_index(drop=True)).to_numpy() * self.unit
+                positions = self.segment_positions[segment_idx]
+                within_buffer = pair_distances <= self.buffer_meter
+                counts += np.bincount(positions[within_buffer], minlength=len(self.index))
+                np.minimum.at(distances, positions, pair_distances)
+
+        distances[distances > self.search_radius_meter] = np.nan
+        logger.debug(f'{len(features)} features of layer {name} overlaid in {round((time.time() - start_time), 2)} seconds')
+        return pd.DataFrame({f'{name}_count': counts, f'{name}_distance': distances.round(1)}, index=self.index)
+
+    def overlay_layers(self, layers:Dict[str, gpd.GeoSeries]) -> pd.DataFrame:
+        """Overlay several layers of features on the segments, see :py:meth:`.Segment_Overlay.overlay`.
+
+        :param layers: dict of the geometries of each layer, keyed by the name of the layer
+        :type layers: Dict[str, gpd.GeoSeries]
+        :return: dataframe with the index of shapes and the count and distance columns of each layer
+        :rtype: pd.DataFrame
+        """
+
+        return pd.concat([self.overlay(features, name) for name, features in layers.items()], axis=1) \
+                    if layers else pd.DataFrame(index=self.index)
+
+
+def background_layer_paths(frontend_config:Dict, exclude:Sequence[str]=()) -> Dict[str, str]:
+    """Find the files of the background layers listed in the "backgroundLayerProp" object of the frontend config, whose
+    "filename" entries are relative to ``frontend/static/inputs/``. Each layer is named after its "name" entry, in lower case
+    with every run of characters other than letters and digits replaced by an underscore.
+
+    :param frontend_config: frontend config dict
+    :type frontend_config: Dict
+    :param exclude: paths of layers to leave out, e.g. one that is already overlaid under another name, defaults to ()
+    :type exclude: Sequence[str], optional
+    :return: dict of the path of each layer, keyed by the name of the layer
+    :rtype: Dict[str, str]
+    """
+
+    excluded = {str(path).replace('\\', '/') for path in exclude}
+    layer_paths = {}
+    for layer_id, layer_info in frontend_config.get('backgroundLayerProp', {}).items():
+        path = f"frontend/static/inputs/{layer_info['filename']}"
+        if path in excluded:
+            continue
+        name = re.sub(r'[^0-9a-z]+', '_', str(layer_info.get('name', layer_id)).lower()).strip('_')
+        layer_paths[name or f'layer_{layer_id}'] = path
+    return layer_paths
@@ -0,0 +1,262 @@
+from typing import Dict, List, Sequence, Tuple
+import logging
+import os
+import sqlite3
+import time
+import numpy as np
+import pandas as pd
+
+from backend.helper_functions import check_parent_dir
+from backend.shapes.geometry_utils import decode_polylines
+
+logger = logging.getLogger("backendLogger")
+
+#: name of the feature table of shapes in the GeoPackage
+TABLE = 'shapes'
+
+#: name of the geometry column of the feature table
+GEOMETRY_COLUMN = 'geom'
+
+#: SRS of the geometries
+SRS_ID = 4326
+
+WGS84_DEFINITION = 'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],'\
+                    'AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],UNIT["degree",0.0174532925199433,'\
+                    'AUTHORITY["EPSG","9122"]],AUTHORITY["EPSG","4326"]]'
+
+
+def shape_store_path(shapes_path:str) -> str:
+    """Path of the shape store that is written alongside a shapes JSON file, i.e. the same path with the extension ".gpkg".
+
+    :param shapes_path: path to the shapes JSON file
+    :type shapes_path: str
+    :return: path to the shape store
+    :rtype: str
+    """
+
+    return f'{os.path.splitext(shapes_path)[0]}.gpkg'
+
+
+def write_shape_store(shapes:pd.DataFrame, path:str, resolutions:Dict[str, Sequence[str]]=None) -> str:
+    """Write shapes to a GeoPackage with the decoded geometry of each segment as a WGS 84 LineString, indexed in an R-tree, and
+    typed columns, i.e. "stop_pair" split into "first_stop_id" and "second_stop_id", with indexes on "route_id" and "pattern". The
+    encoded polyline is kept in the column "polyline" so that readers that only need polylines don't decode geometries, and the
+    simplified polylines of each resolution in the columns "polyline_<resolution>", see :py:meth:`.BaseShape.simplify_shapes`. The file
+    is written with sqlite3 only, to a temporary file that then replaces the store, so that readers never see a partial store.
+    It can be read with :py:func:`.read_shape_store`, or by GDAL-based tools like any other GeoPackage.
+
+    :param shapes: shapes dataframe, see :py:class:`.BaseShape`
+    :type shapes: pd.DataFrame
+    :param path: path to the GeoPackage
+    :type path: str
+    :param resolutions: dict of the simplified encoded polylines of all segments, in the order of shapes, keyed by resolution, 
+        defaults to None
+    :type resolutions: Dict[str, Sequence[str]], optional
+    :return: path to the GeoPackage
+    :rtype: str
+    """
+
+    start_time = time.time()
+    path = check_parent_dir(path)
+    tmp_path = f'{path}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    attributes = shapes.drop(columns=['geometry', 'stop_pair'])
+    attributes['first_stop_id'] = shapes['stop_pair'].str[0]
+    attributes['second_stop_id'] = shapes['stop_pair'].str[1]
+    attributes['polyline'] = shapes['geometry']
+    for resolution, polylines in (resolutions or {}).items():
+        attributes[f'polyline_{resolution}'] = list(polylines)
+    column_types = {column: _sql_type(attributes[column]) for column in attributes.columns}
+
+    geometries, envelopes = _encode_geometries(shapes['geometry'])
+
+    connection = sqlite3.connect(tmp_path)
+    try:
+        connection.execute(f'PRAGMA application_id = {0x47504B47}')
+        connection.execute('PRAGMA user_version = 10200')
+        _create_metadata_tables(connection)
+        columns = ', '.join(f'"{column}" {sql_type}' for column, sql_type in column_types.items())
+        connection.execute(f'CREATE TABLE {TABLE} (fid INTEGER PRIMARY KEY AUTOINCREMENT, {GEOMETRY_COLUMN} LINESTRING, {columns})')
+
+        values = attributes.astype(object).where(attributes.notna(), None)
+        for column, sql_type in column_types.items():
+            if sql_type == 'BOOLEAN':
+                values[column] = [None if value is None else int(value) for value in values[column]]
+        rows = ((fid, geometry, *row) for fid, (geometry, row) in enumerate(zip(geometries, values.itertuples(index=False, name=None)), start=1))
+        placeholders = ', '.join('?' * (len(column_types) + 2))
+        connection.executemany(f'INSERT INTO {TABLE} VALUES ({placeholders})', rows)
+
+        connection.execute(f'CREATE VIRTUAL TABLE rtree_{TABLE}_{GEOMETRY_COLUMN} USING rtree(id, minx, maxx, miny, maxy)')
+        has_geometry = ~np.isnan(envelopes[:, 0])
+        fids = np.flatnonzero(has_geometry) + 1
+        connection.executemany(f'INSERT INTO rtree_{TABLE}_{GEOMETRY_COLUMN} VALUES (?, ?, ?, ?, ?)',
+                                zip(fids.tolist(), *envelopes[has_geometry].T.tolist()))
+        for column in ['route_id', 'pattern']:
+            if column in column_types:
+                connection.execute(f'CREATE INDEX {TABLE}_{column} ON {TABLE} ("{column}")')
+
+        extent = [np.nanmin(envelopes[:, 0]), np.nanmin(envelopes[:, 2]), np.nanmax(envelopes[:, 1]), np.nanmax(envelopes[:, 3])] \
+                    if has_geometry.any() else [None] * 4
+        connection.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier, min_x, min_y, max_x, max_y, srs_id) "\
+                            "VALUES (?, 'features', ?, ?, ?, ?, ?, ?)", [TABLE, TABLE, *[None if v is None else float(v) for v in extent], SRS_ID])
+        connection.execute("INSERT INTO gpkg_geometry_columns VALUES (?, ?, 'LINESTRING', ?, 0, 0)", [TABLE, GEOMETRY_COLUMN, SRS_ID])
+        connection.execute("INSERT INTO gpkg_extensions VALUES (?, ?, 'gpkg_rtree_index', 'http://www.geopackage.org/spec120/#extension_rtree', "\
+                            "'write-only')", [TABLE, GEOMETRY_COLUMN])
+        connection.commit()
+    finally:
+        connection.close()
+
+    os.replace(tmp_path, path)
+    logger.debug(f'{len(shapes)} shapes written to the shape store in {round((time.time() - start_time), 2)} seconds')
+    return path
+
+
+def read_shape_store(path:str, bbox:Tuple[float, float, float, float]=None, route_ids:Sequence[str]=None,
+                        patterns:Sequence[str]=None, resolution:str=None, decode:bool=False) -> pd.DataFrame:
+    """Read shapes from a GeoPackage written by :py:func:`.write_shape_store`, in the same format as the shapes JSON file, i.e.
+    with the encoded polyline of the given resolution in the column "geometry" and "stop_pair" as tuples. Only segments that 
+    intersect the bounding box (found with the R-tree) and belong to the given routes and patterns (found with the indexes) are read.
+
+    :param path: path to the GeoPackage
+    :type path: str
+    :param bbox: (min lon, min lat, max lon, max lat) that segments must intersect, defaults to None, i.e. all segments
+    :type bbox: Tuple[float, float, float, float], optional
+    :param route_ids: route IDs of the segments to read, defaults to None, i.e. all routes
+    :type route_ids: Sequence[str], optional
+    :param patterns: patterns of the segments to read, defaults to None, i.e. all patterns
+    :type patterns: Sequence[str], optional
+    :param resolution: resolution of the geometries, e.g. "low", defaults to None, i.e. full resolution
+    :type resolution: str, optional
+    :param decode: whether to add the column "coordinates" of the decoded (lat, lon) coordinates of each segment, defaults to False
+    :type decode: bool, optional
+    :raises ValueError: the store has no geometries of the resolution
+    :return: shapes dataframe
+    :rtype: pd.DataFrame
+    """
+
+    start_time = time.time()
+    geometry_column = 'polyline' if resolution in [None, 'full'] else f'polyline_{resolution}'
+    conditions = []
+    parameters = []
+    if bbox is not None:
+        min_x, min_y, max_x, max_y = bbox
+        conditions.append(f'fid IN (SELECT id FROM rtree_{TABLE}_{GEOMETRY_COLUMN} WHERE maxx >= ? AND minx <= ? AND maxy >= ? AND miny <= ?)')
+        parameters += [min_x, max_x, min_y, max_y]
+    for column, values in [('route_id', route_ids), ('pattern', patterns)]:
+        if values is not None:
+            values = list(values)
+            conditions.append(f'"{column}" IN ({", ".join("?" * len(values))})' if values else '0')
+            parameters += values
+
+    connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        column_types = {name: sql_type for _, name, sql_type, *_ in connection.execute(f'PRAGMA table_info({TABLE})')}
+        if geometry_column not in column_types:
+            raise ValueError(f'No geometries of resolution {resolution} in the shape store {path}.')
+        columns = [column for column in column_types if column not in ['fid', GEOMETRY_COLUMN] and \
+                    (column == geometry_column or not column.startswith('polyline'))]
+        quoted_columns = ', '.join(f'"{column}"' for column in columns)
+        query = f'SELECT {quoted_columns} FROM {TABLE}'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        shapes = pd.DataFrame(connection.execute(query + ' ORDER BY fid', parameters).fetchall(), columns=columns)
+    finally:
+        connection.close()
+
+    for column in columns:
+        if column_types[column] == 'BOOLEAN':
+            shapes[column] = shapes[column].astype(bool)
+    shapes['stop_pair'] = list(zip(shapes.pop('first_stop_id'), shapes.pop('second_stop_id')))
+    shapes = shapes.rename(columns={geometry_column: 'geometry'})
+    if decode:
+        shapes['coordinates'] = decode_polylines(shapes['geometry'], precision=6)
+
+    logger.debug(f'{len(shapes)} shapes read from the shape store in {round((time.time() - start_time), 2)} seconds')
+    return shapes
+
+
+def intersects_bbox(polylines:Sequence[str], bbox:Tuple[float, float, float, float]) -> np.ndarray:
+    """Whether the envelope of each encoded polyline intersects a bounding box, the same test as the R-tree of the shape store.
+
+    :param polylines: encoded polylines
+    :type polylines: Sequence[str]
+    :param bbox: (min lon, min lat, max lon, max lat)
+    :type bbox: Tuple[float, float, float, float]
+    :return: boolean array, False for polylines with fewer than two coordinates
+    :rtype: np.ndarray
+    """
+
+    min_x, min_y, max_x, max_y = bbox
+    envelopes = _envelopes(decode_polylines(polylines, precision=6, geojson=True))
+    with np.errstate(invalid='ignore'):
+        return (envelopes[:, 1] >= min_x) & (envelopes[:, 0] <= max_x) & (envelopes[:, 3] >= min_y) & (envelopes[:, 2] <= max_y)
+
+
+def _sql_type(column:pd.Series) -> str:
+
+    if pd.api.types.is_bool_dtype(column):
+        return 'BOOLEAN'
+    if pd.api.types.is_integer_dtype(column):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(column):
+        return 'DOUBLE'
+    return 'TEXT'
+
+
+def _envelopes(coords_list:List[np.ndarray]) -> np.ndarray:
+    """(min x, max x, min y, max y) envelope of each line of (lon, lat) coordinates, NaN for lines with fewer than two coordinates.
+    """
+
+    envelopes = np.full((len(coords_list), 4), np.nan)
+    for i, coords in enumerate(coords_list):
+        if len(coords) > 1:
+            envelopes[i] = [coords[:, 0].min(), coords[:, 0].max(), coords[:, 1].min(), coords[:, 1].max()]
+    return envelopes
+
+
+def _encode_geometries(polylines:pd.Series) -> Tuple[List[bytes], np.ndarray]:
+    """Encode polylines as GeoPackage geometry blobs, i.e. a header with the envelope followed by the WKB of the LineString.
+
+    :param polylines: encoded polylines
+    :type polylines: pd.Series
+    :return: list of geometry blobs (None for segments with fewer than two coordinates), and array of the (min x, max x, min y, max y)
+        envelope of each segment (NaN for segments without a geometry)
+    :rtype: Tuple[List[bytes], np.ndarray]
+    """
+
+    coords_list = decode_polylines(polylines, precision=6, geojson=True)
+    envelopes = _envelopes(coords_list)
+    # little endian, envelope [minx, maxx, miny, maxy]
+    header = b'GP\x00\x03' + np.array(SRS_ID, dtype='<i4').tobytes()
+    geometries = []
+    for coords, envelope in zip(coords_list, envelopes):
+        if len(coords) < 2:
+            geometries.append(None)
+            continue
+        wkb = b'\x01' + np.array([2, len(coords)], dtype='<u4').tobytes() + np.ascontiguousarray(coords, dtype='<f8').tobytes()
+        geometries.append(header + envelope.astype('<f8').tobytes() + wkb)
+    return geometries, envelopes
+
+
+def _create_metadata_tables(connection:sqlite3.Connection):
+
+    connection.execute('CREATE TABLE gpkg_spatial_ref_sys (srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY, organization TEXT NOT NULL, '\
+                        'organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT)')
+    connection.executemany('INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)', [
+        ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', 'undefined cartesian coordinate reference system'),
+        ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', 'undefined geographic coordinate reference system'),
+        ('WGS 84 geodetic', SRS_ID, 'EPSG', SRS_ID, WGS84_DEFINITION, 'longitude/latitude coordinates in decimal degrees on the WGS 84 spheroid')
+    ])
+    connection.execute("CREATE TABLE gpkg_contents (table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE, "\
+                        "description TEXT DEFAULT '', last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')), "\
+                        "min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER, "\
+                        "CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id))")
+    connection.execute('CREATE TABLE gpkg_geometry_columns (table_name TEXT NOT NULL, column_name TEXT NOT NULL, '\
+                        'geometry_type_name TEXT NOT NULL, srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL, '\
+                        'CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name), '\
+                        'CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name), '\
+                        'CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys (srs_id))')
+    connection.execute('CREATE TABLE gpkg_extensions (table_name TEXT, column_name TEXT, extension_name TEXT NOT NULL, '\
+                        'definition TEXT NOT NULL, scope TEXT NOT NULL, CONSTRAINT ge_tce UNIQUE (table_name, column_name, extension_name))')
@@ -0,0 +1,133 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+import asyncio
+import json
+import logging
+import time
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("backendLogger")
+
+
+class Valhalla_Client():
+    """Send trace_route requests to a Valhalla service concurrently from an asyncio event loop. Requests are posted through one
+    requests.Session, whose connection pool keeps up to "concurrency" connections to Valhalla open and reuses them across requests,
+    from a pool of worker threads. At most "concurrency" requests are in flight at any time, so that a local Valhalla with that many
+    worker threads is kept busy without being flooded. The number of requests, retries and skipped (unmatched) responses, and the 
+    latency of each request are recorded, see :py:meth:`.Valhalla_Client.stats`.
+
+    Parameters are read from the "valhalla" object of backend_config, see :py:meth:`.Valhalla_Client.from_config`.
+
+    :param url: base URL of the Valhalla service, defaults to 'http://localhost:8002'
+    :type url: str, optional
+    :param concurrency: maximum number of requests in flight, defaults to 8
+    :type concurrency: int, optional
+    :param timeout: timeout of each request in seconds, defaults to 100
+    :type timeout: float, optional
+    :param max_retry: maximum number of attempts of a request when the connection fails or times out, defaults to 10
+    :type max_retry: int, optional
+    :param retry_delay: time in seconds to wait before retrying a request, defaults to 1
+    :type retry_delay: float, optional
+    """
+
+    def __init__(self, url:str='http://localhost:8002', concurrency:int=8, timeout:float=100, max_retry:int=10, retry_delay:float=1):
+
+        self.trace_route_url:str = f"{url.rstrip('/')}/trace_route"
+        self.concurrency:int = concurrency
+        self.timeout:float = timeout
+        self.max_retry:int = max_retry
+        self.retry_delay:float = retry_delay
+
+        #: number of requests that received a response
+        self.request_count:int = 0
+        #: number of attempts that failed to connect or timed out and were retried
+        self.retry_count:int = 0
+        #: number of responses that Valhalla could not match, e.g. "No suitable edges near location"
+        self.skipped_count:int = 0
+        #: time in seconds from sending each request to receiving its response
+        self.latencies:List[float] = []
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='valhalla')
+        # created in the running event loop on first use
+        self.semaphore:asyncio.Semaphore = None
+
+    @classmethod
+    def from_config(cls, backend_config:Dict) -> 'Valhalla_Client':
+        """Create a client with the parameters of the "valhalla" object of backend_config: "url" (default 'http://localhost:8002'),
+        "concurrency" (default 8), "timeout" in seconds (default 100), "max_retry" (default 10) and "retry_delay" in seconds (default 1).
+
+        :param backend_config: backend config dict
+        :type backend_config: Dict
+        :return: a Valhalla client
+        :rtype: Valhalla_Client
+        """
+
+        valhalla_config = backend_config.get('valhalla', {})
+        return cls(url=valhalla_config.get('url', 'http://localhost:8002'), concurrency=valhalla_config.get('concurrency', 8),
+                    timeout=valhalla_config.get('timeout', 100), max_retry=valhalla_config.get('max_retry', 10),
+                    retry_delay=valhalla_config.get('retry_delay', 1))
+
+    async def trace_route(self, request) -> Tuple[Dict, Dict]:
+        """Send a trace_route request and return its matched and skipped dicts, see :py:meth:`.Valhalla_Request.parse_response`.
+        Requests whose connection fails or times out are retried after retry_delay seconds, up to max_retry attempts.
+
+        :param request: the request of a segment or pattern
+        :type request: Valhalla_Request
+        :raises ConnectionError: no response after max_retry attempts
+        :return: tuple of matched and skipped dicts
+        :rtype: Tuple[Dict, Dict]
+        """
+
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+
+        data = json.dumps(request.request_parameters())
+        loop = asyncio.get_running_loop()
+        for retry_count in range(self.max_retry):
+            try:
+                async with self.semaphore:
+                    start_time = time.perf_counter()
+                    result = await loop.run_in_executor(self.executor, self.__post, data)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+                logger.warning(f'Error connecting to Valhalla service for {request.shape_name}: {err!r}. Retry count {retry_count}...')
+                self.retry_count += 1
+                await asyncio.sleep(self.retry_delay)
+                continue
+            self.latencies.append(time.perf_counter() - start_time)
+            self.request_count += 1
+            matched, skipped = request.parse_response(result)
+            self.skipped_count += bool(skipped)
+            return matched, skipped
+
+        raise ConnectionError(f'Max retry reached. Unable to proceed.')
+
+    def stats(self) -> Dict[str, float]:
+        """Summarize the requests sent so far.
+
+        :return: dict of the number of requests, retries and skipped responses, and the 50th, 95th and 99th percentiles of the 
+            request latency in milliseconds
+        :rtype: Dict[str, float]
+        """
+
+        latencies = np.array(self.latencies) * 1000
+        percentiles = np.percentile(latencies, [50, 95, 99]).round(1).tolist() if len(latencies) else [np.nan] * 3
+        return {'requests': self.request_count, 'retries': self.retry_count, 'skipped': self.skipped_count,
+                'p50_ms': percentiles[0], 'p95_ms': percentiles[1], 'p99_ms': percentiles[2]}
+
+    def close(self):
+        """Close the connection pool and the worker threads.
+        """
+
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+    def __post(self, data:str) -> Dict:
+
+        response = self.session.post(self.trace_route_url, data=data, timeout=self.timeout)
+        return response.json()
@@ -0,0 +1,193 @@
+from data_class import GTFS, MBTA_GTFS, WMATA_GTFS
+from backend.shapes.base_shape import BaseShape
+from backend.streaming import File_Tail_Source, Socket_Source, Stop_Event_Stream, Realtime_Metric_Calculation, Realtime_Metric_Aggregation
+from logger.backend_logger import getLogger
+from data_class.rove_parameters import ROVE_params
+from helper_functions import read_shapes, write_to_frontend_config, string_is_date, string_is_month
+import argparse
+import datetime
+import sys
+import time
+
+# -----------------------------------PARAMETERS--------------------------------------
+AGENCY = "WMATA" # CTA, MBTA, WMATA
+MONTH = "05" # MM in string format, month of the GTFS feed
+YEAR = "2023" # YYYY in string format, year of the GTFS feed
+SERVICE_DATE = '' # YYYY-MM-DD, service date of the stream, defaults to today
+STREAM_FILE = 'data/WMATA/realtime/stream.jsonl' # newline-delimited JSON file that is followed for messages
+STREAM_SOCKET = '' # host:port of a TCP stream of messages, used instead of STREAM_FILE if given
+
+# --------------------------------END PARAMETERS--------------------------------------
+
+logger = getLogger('backendLogger')
+
+#: Day types of the days of the week, as returned by datetime.date.weekday().
+WEEKDAY_DATE_TYPES = ['Workday'] * 5 + ['Saturday', 'Sunday']
+
+
+def __main__(args):
+    """Main method of the ROVE real-time stream - run this file to keep the metrics of a service date up to date with a stream of GTFS-realtime
+    stand-in messages (trip updates or vehicle positions, see :py:class:`.Stop_Event_Stream`) read from a local file or socket. Aggregated metrics are
+    written to the same formats as the monthly backend outputs, under a "<agency> LIVE <year>" entry in the frontend config, and are updated
+    every flush_interval seconds while the stream is running. Shapes of the GTFS month must have been generated by the backend beforehand.
+    The stream runs until it is interrupted, or until the end of a file that is not followed; run it once per service date.
+
+    Parameters are read from the "streaming" object of backend_config:
+
+        - flush_interval: time in seconds between updates of the 10-min interval output, defaults to 60
+        - period_flush_interval: time in seconds between updates of the time period output, defaults to 900
+        - poll_interval: time in seconds to wait for new messages before checking for updates, defaults to 1
+
+    :param args: command line arguments needed for the stream.
+    "-a" or "--agency": REQUIRED, name of the agency to be analyzed, must be a string with no space. E.g. "WMATA", "MBTA", "MTA_Manhattan".
+    "-m" or "--month": REQUIRED, 2-character string of the month of the GTFS feed (and shapes) to use, e.g. "05".
+    "-y" or "--year": REQUIRED, 4-character string of the year of the GTFS feed (and shapes) to use, e.g. "2023".
+    "-d" or "--date": the service date ("YYYY-MM-DD") of the stream. Defaults to today.
+    "-f" or "--file": path to a newline-delimited JSON file of messages, which is followed for new lines. One of "--file" and "--socket" is required.
+    "-s" or "--socket": "host:port" of a TCP server that sends newline-delimited JSON messages.
+    "-no-follow" or "--no_follow": stop at the end of the file instead of waiting for new lines, e.g. to replay a recorded stream.
+    :type args: _type_
+    """
+    if len(args) > 0:
+        parser = argparse.ArgumentParser(description="Do something.")
+        parser.add_argument("-a", "--agency", type=str, required=True)
+        parser.add_argument("-m", "--month", type=str, required=True)
+        parser.add_argument("-y", "--year", type=str, required=True)
+        parser.add_argument("-d", "--date", type=str, default=datetime.date.today().isoformat(), required=False)
+        source_group = parser.add_mutually_exclusive_group(required=True)
+        source_group.add_argument("-f", "--file", type=str)
+        source_group.add_argument("-s", "--socket", type=str)
+        parser.add_argument("-no-follow", "--no_follow", dest='follow', action='store_false', required=False)
+        parser.set_defaults(follow=True)
+        args = parser.parse_args(args)
+
+        agency = args.agency
+        month = args.month
+        year = args.year
+        service_date = args.date
+        stream_file = args.file
+        stream_socket = args.socket
+        follow = args.follow
+
+        if not string_is_month(month):
+            parser.error(f'-m (--month) must be a valid numeric string between 1 and 12 (received {month}).')
+        if not string_is_date(service_date):
+            parser.error(f'-d (--date) must be a valid string date (YYYY-MM-DD) (received {service_date}).')
+
+    else:
+        agency = AGENCY
+        month = MONTH
+        year = YEAR
+        service_date = SERVICE_DATE or datetime.date.today().isoformat()
+        stream_file = None if STREAM_SOCKET else STREAM_FILE
+        stream_socket = STREAM_SOCKET or None
+        follow = True
+
+    date = datetime.datetime.strptime(service_date, '%Y-%m-%d').date()
+    date_type = WEEKDAY_DATE_TYPES[date.weekday()]
+
+    logger.info(f'Starting ROVE real-time stream for {agency}, service date {service_date} ({date_type}), GTFS of {month}-{year}.')
+
+    suffix:str = f'_{agency}_{month}_{year}'
+    live_suffix:str = f'_{agency}_{service_date}'
+
+    input_paths = {
+            'gtfs': f'data/{agency}/gtfs/GTFS{suffix}.zip',
+            'backend_config': f'data/{agency}/config.json',
+            'frontend_config': f'frontend/static/inputs/{agency}/config.json',
+            'shapes': f'frontend/static/inputs/{agency}/shapes/bus-shapes{suffix}.json',
+            'signals': f'frontend/static/inputs/{agency}/backgroundlayers/{agency.lower()}_traffic_signals.geojson',
+            'timepoint': f'data/{agency}/agency-specific/timepoints{suffix}.csv'
+        }
+
+    output_paths = {
+            'shapes': f'frontend/static/inputs/{agency}/shapes/bus-shapes{suffix}.json',
+            'timepoints': f'frontend/static/inputs/{agency}/timepoints/timepoints{live_suffix}.json',
+            'stop_name_lookup': f'frontend/static/inputs/{agency}/lookup/lookup{live_suffix}.json',
+            'metric_calculation_aggre': f'data/{agency}/metrics/METRICS_LIVE{live_suffix}.p',
+            'metric_calculation_aggre_10min': f'data/{agency}/metrics/METRICS_10MIN_LIVE{live_suffix}.p'
+        }
+
+    # -----store parameters-----
+    params = ROVE_params(agency, 'LIVE', str(date.year), date_type, 'GTFS-AVL', input_paths, output_paths, service_date, service_date)
+    stream_config = params.backend_config.get('streaming', {})
+    flush_interval = stream_config.get('flush_interval', 60)
+    period_flush_interval = stream_config.get('period_flush_interval', 900)
+    poll_interval = stream_config.get('poll_interval', 1)
+
+    # ------GTFS data of the service date------
+    if agency == 'MBTA':
+        bus_gtfs = MBTA_GTFS(params, mode='bus', shape_gen=True, lean=True)
+    elif agency == 'WMATA':
+        bus_gtfs = WMATA_GTFS(params, mode='bus', shape_gen=True, lean=True)
+    else:
+        bus_gtfs = GTFS(params, mode='bus', shape_gen=True, lean=True)
+    gtfs_records = bus_gtfs.records
+
+    shapes = read_shapes(params.output_paths['shapes'])
+    if shapes.empty:
+        shapes = BaseShape(bus_gtfs.patterns_dict, params=params, check_signal=False, use_valhalla=False).shapes
+
+    # ------real-time metric calculation and aggregation------
+    stream = Stop_Event_Stream(params, bus_gtfs, date)
+    calculation = Realtime_Metric_Calculation(gtfs_records, params)
+    aggregation = Realtime_Metric_Aggregation(shapes, gtfs_records, calculation, params)
+    aggregation.update_time_periods()
+    write_to_frontend_config(aggregation.metrics_names, params.frontend_config, input_paths['frontend_config'])
+
+    if stream_socket:
+        host, port = stream_socket.rsplit(':', 1)
+        source = Socket_Source(host, int(port), poll_interval=poll_interval)
+    else:
+        source = File_Tail_Source(stream_file, poll_interval=poll_interval, follow=follow)
+
+    consume_stream(source, stream, calculation, aggregation, flush_interval, period_flush_interval)
+
+    logger.info(f'ROVE real-time stream completed')
+
+
+def consume_stream(source, stream:Stop_Event_Stream, calculation:Realtime_Metric_Calculation, aggregation:Realtime_Metric_Aggregation,
+                    flush_interval:float, period_flush_interval:float):
+    """Convert the messages of the source into stop events and add them to the calculation, updating the aggregated outputs every flush_interval
+    seconds (10-min intervals) and every period_flush_interval seconds (time periods). All outputs are updated once more when the source ends
+    or the stream is interrupted.
+
+    :param source: source of messages, e.g. :py:class:`.File_Tail_Source` or :py:class:`.Socket_Source`
+    :type source: Union[File_Tail_Source, Socket_Source]
+    """
+
+    message_count = 0
+    stop_event_count = 0
+    last_flush = last_period_flush = time.time()
+    try:
+        for message in source.messages():
+            if message is not None:
+                message_count += 1
+                for stop_event in stream.process(message):
+                    calculation.add_stop_event(*stop_event)
+                    stop_event_count += 1
+
+            now = time.time()
+            if now - last_flush >= flush_interval:
+                for stop_event in stream.expire():
+                    calculation.add_stop_event(*stop_event)
+                    stop_event_count += 1
+                aggregation.update()
+                last_flush = now
+                logger.info(f'processed {message_count} stream messages, {stop_event_count} stop events')
+            if now - last_period_flush >= period_flush_interval:
+                aggregation.update_time_periods()
+                last_period_flush = now
+    except KeyboardInterrupt:
+        logger.info(f'stream interrupted')
+
+    for stop_event in stream.expire(force=True):
+        calculation.add_stop_event(*stop_event)
+        stop_event_count += 1
+    aggregation.update()
+    aggregation.update_time_periods()
+    logger.info(f'processed {message_count} stream messages, {stop_event_count} stop events')
+
+if __name__ == "__main__":
+
+    __main__(sys.argv[1:])
@@ -0,0 +1,8 @@
+from .sources import File_Tail_Source, Socket_Source
+from .stop_events import Stop_Event_Stream
+from .realtime_calculation import Realtime_Metric_Calculation
+from .realtime_aggregation import Realtime_Metric_Aggregation
+
+__all__ = [
+    "File_Tail_Source", "Socket_Source", "Stop_Event_Stream", "Realtime_Metric_Calculation", "Realtime_Metric_Aggregation"
+]
@@ -0,0 +1,123 @@
+from copy import copy
+from typing import Callable, Dict, Iterable
+import logging
+import os
+import time
+import pandas as pd
+
+from backend.data_class.rove_parameters import ROVE_params
+from backend.metrics.metric_aggregation import Metric_Aggregation
+from backend.metrics.metric_calculation import Metric_Calculation
+from backend.metrics.metric_registry import Metric_Registry
+from backend.streaming.realtime_calculation import Realtime_Metric_Calculation
+
+logger = logging.getLogger("backendLogger")
+
+#: Observed metrics that can be derived from stop event times.
+REALTIME_METRICS = ('observed_headway', 'observed_frequency', 'observed_running_time', 'on_time_performance', 'observed_wait_time', 'excess_wait_time')
+
+
+class Realtime_Metric_Aggregation(Metric_Aggregation):
+    """Aggregated metrics of a service date that are kept up to date with the observed metrics of a :py:class:`.Realtime_Metric_Calculation`.
+    Scheduled metrics are calculated from GTFS once, and the aggregated metrics of every 10-min interval are calculated at startup. Afterwards,
+    :py:meth:`update` re-aggregates only the 10-min intervals whose observed records changed, using only the records of those intervals, and
+    writes the results in the same formats as the batch outputs of :py:class:`.Metric_Aggregation`, so that the frontend can read them while
+    the stream is running. Each output is written to a temporary file first and then moved into place, so the frontend never reads a partial file.
+
+    Observed metrics are limited to the ones that can be derived from stop event times: headway, frequency, wait time, running time
+    and on-time performance.
+
+    :param shapes: shapes table from Shape Generation
+    :type shapes: pd.DataFrame
+    :param gtfs_records: GTFS records table of the service date
+    :type gtfs_records: pd.DataFrame
+    :param calculation: the incrementally calculated observed metrics
+    :type calculation: Realtime_Metric_Calculation
+    :param params: a rove_params object that stores information needed throughout the backend, with the 'GTFS-AVL' data option
+    :type params: ROVE_params
+    """
+
+    def __init__(self, shapes:pd.DataFrame, gtfs_records:pd.DataFrame, calculation:Realtime_Metric_Calculation, params:ROVE_params):
+
+        # scheduled metrics only, observed metrics come from the stream
+        gtfs_params = copy(params)
+        gtfs_params.data_option = 'GTFS'
+        metrics = Metric_Calculation(shapes, gtfs_records, None, gtfs_params)
+        metrics.avl_stop_metrics = metrics.avl_route_metrics = metrics.avl_tpbp_metrics = None
+
+        super().__init__(metrics, params, write_output=False)
+
+        self.calculation:Realtime_Metric_Calculation = calculation
+        self.__set_observed_metrics([])
+        self.output_paths:Dict[str, str] = params.output_paths
+
+        #: The 10-min intervals of the full day, whose indices are the interval indices of the calculation.
+        self.intervals = self.get_10min_intervals()
+        #: Aggregated metrics of every 10-min interval, see :py:meth:`.Metric_Aggregation.get_10min_interval_metrics`.
+        self.agg_metrics_10_min = self.get_10min_interval_metrics()
+        self.__write_atomically(self.write_10min_interval_metrics, self.agg_metrics_10_min, self.output_paths['metric_calculation_aggre_10min'])
+
+    def register_metrics(self, registry:Metric_Registry):
+        """Register the metrics that are available in real time, i.e. all scheduled metrics and the observed metrics in :py:data:`REALTIME_METRICS`.
+
+        :param registry: the metric registry of the aggregation
+        :type registry: Metric_Registry
+        """
+
+        super().register_metrics(registry)
+        registry.remove(*[name for name in registry.names() 
+                            if name not in REALTIME_METRICS and any(metric.source == 'avl' for metric in registry if metric.name == name)])
+
+    def update(self):
+        """Re-aggregate the 10-min intervals whose observed records changed since the last update, and write the 10-min interval output.
+        """
+
+        updated_intervals = sorted(self.calculation.pop_updated_intervals())
+        if not updated_intervals:
+            return
+
+        start_time = time.time()
+        for interval_index in updated_intervals:
+            self.__set_observed_metrics([interval_index])
+
+            interval_start, interval_end = self.intervals[interval_index]
+            for agg_method, percentile in self.percentiles.items():
+                self.aggregate_by_start_end_time(list(interval_start), list(interval_end), percentile)
+                self.agg_metrics_10_min[self.intervals[interval_index]][agg_method] = (
+                    self.segments_agg_metrics,
+                    self.corridors_agg_metrics,
+                    self.routes_agg_metrics,
+                    self.tpbp_segments_agg_metrics,
+                    self.tpbp_corridors_agg_metrics
+                )
+
+        self.__write_atomically(self.write_10min_interval_metrics, self.agg_metrics_10_min, self.output_paths['metric_calculation_aggre_10min'])
+        logger.debug(f'updated {len(updated_intervals)} 10-min intervals in {round((time.time() - start_time), 2)} seconds')
+
+    def update_time_periods(self):
+        """Re-aggregate all pre-defined time periods with the observed records of the full day so far, and write the time period output.
+        This takes as long as the batch aggregation of a day, so it is meant to run less often than :py:meth:`update`.
+        """
+
+        start_time = time.time()
+        self.__set_observed_metrics()
+
+        self.__write_atomically(self.write_time_period_metrics, self.get_time_period_metrics(), self.output_paths['metric_calculation_aggre'])
+        logger.debug(f'updated time periods in {round((time.time() - start_time), 2)} seconds')
+
+    def __set_observed_metrics(self, intervals:Iterable[int]=None):
+        """Set the observed metrics tables to the records of the given 10-min intervals of the calculation, or of the full day if no
+        intervals are given, with stop pairs encoded by the codec of the scheduled metrics.
+        """
+
+        self.avl_stop_metrics = self.calculation.get_stop_metrics(intervals)
+        self.avl_route_metrics = self.calculation.get_route_metrics(intervals)
+        self.avl_tpbp_metrics = self.calculation.get_tpbp_metrics(intervals)
+        for metrics in [self.avl_stop_metrics, self.avl_tpbp_metrics]:
+            metrics['stop_pair'] = self.stop_pair_codec.encode_pairs(metrics['stop_pair'])
+
+    def __write_atomically(self, writer:Callable, agg_metrics:Dict, output_path:str):
+
+        temp_path = f'{output_path}.tmp'
+        writer(agg_metrics, temp_path)
+        os.replace(temp_path, output_path)
@@ -0,0 +1,258 @@
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, Set, Tuple
+import logging
+import numpy as np
+import pandas as pd
+
+from backend.data_class.rove_parameters import ROVE_params
+
+logger = logging.getLogger("backendLogger")
+
+SECONDS_IN_MINUTE = 60
+SECONDS_IN_HOUR = 3600
+SECONDS_IN_TEN_MINUTES = SECONDS_IN_MINUTE * 10
+
+
+class Realtime_Metric_Calculation():
+    """Incrementally calculate observed stop, timepoint and route level metrics of a service date from a stream of stop events. It is the
+    streaming counterpart of the AVL metrics of :py:class:`.Metric_Calculation`, with the same definitions of observed headway,
+    observed running time (without dwell) and on-time performance, but each stop event only updates the few records it affects:
+
+        - a stop event completes the stop pair between the previous stop event of its trip and itself, whose running time and
+          on-time performance are calculated once;
+        - the headway of the stop pair is the time since the previous arrival of its route at the first stop of the pair, and a late
+          stop event also updates the headway of the next arrival;
+        - timepoint pairs and trips are updated in the same way as each of their stop pairs is completed.
+
+    Records are stored by the 10-min interval of the full day (defined in the frontend config file under 'PeriodRanges' -> 'full') that their
+    stop_time, or trip_start_time for trips, falls in. Intervals whose records changed are tracked so that only their aggregated metrics
+    need to be updated, see :py:meth:`pop_updated_intervals`.
+
+    :param gtfs_records: GTFS records table of the service date
+    :type gtfs_records: pd.DataFrame
+    :param params: a rove_params object that stores information needed throughout the backend
+    :type params: ROVE_params
+    :param no_earlier_than: minutes that a bus can arrive early for to be on time, defaults to -1
+    :type no_earlier_than: int, optional
+    :param no_later_than: minutes that a bus can arrive late for to be on time, defaults to 5
+    :type no_later_than: int, optional
+    """
+
+    STOP_METRICS_COLUMNS = ['route_id', 'trip_id', 'stop_pair', 'stop_time', 'observed_headway', 'observed_running_time', 'on_time_performance']
+    TPBP_METRICS_COLUMNS = ['route_id', 'trip_id', 'stop_pair', 'stop_time', 'observed_headway', 'observed_running_time']
+    ROUTE_METRICS_COLUMNS = ['route_id', 'direction_id', 'trip_id', 'trip_start_time', 'observed_headway', 'observed_running_time', 'on_time_performance']
+
+    def __init__(self, gtfs_records:pd.DataFrame, params:ROVE_params, no_earlier_than:int=-1, no_later_than:int=5):
+
+        if no_earlier_than > 0 or no_later_than < 0:
+            raise ValueError(f'no_earlier_than must be a negative value, no_later_than must be a positive value.')
+        self.no_earlier_than:int = no_earlier_than
+        self.no_later_than:int = no_later_than
+
+        day_start, day_end = params.frontend_config['periodRanges']['full']
+        interval_to_second = lambda x: x[0] * SECONDS_IN_HOUR + x[1] * SECONDS_IN_MINUTE if isinstance(x, List) else x * SECONDS_IN_HOUR
+        #: Start and end of the full day in seconds since midnight of the service date.
+        self.day_start:int = interval_to_second(day_start)
+        self.day_end:int = interval_to_second(day_end)
+
+        trips = gtfs_records.drop_duplicates(subset=['trip_id']).set_index('trip_id')
+        #: Lookup of the route_id and direction_id of each GTFS trip.
+        self.trip_routes:Dict[str, Tuple[str, int]] = dict(zip(trips.index, zip(trips['route_id'], trips['direction_id'])))
+        #: Lookup of the scheduled arrival time of each stop of each GTFS trip.
+        self.scheduled_arrivals:Dict[Tuple[str, str], int] = gtfs_records.drop_duplicates(subset=['trip_id', 'stop_id'])\
+                                                                .set_index(['trip_id', 'stop_id'])['arrival_time'].to_dict()
+        route_stops = gtfs_records.groupby(['route_id', 'stop_id'], observed=True)[['tp_bp', 'timepoint']].max()
+        #: Lookup of whether each stop of each route is a timepoint or branchpoint.
+        self.tp_bp:Dict[Tuple[str, str], int] = route_stops['tp_bp'].to_dict()
+        #: Lookup of whether each stop of each route is a timepoint.
+        self.timepoint:Dict[Tuple[str, str], int] = route_stops['timepoint'].to_dict()
+
+        #: Records of each level, keyed by 10-min interval index then by record key.
+        self.stop_records:Dict[int, Dict[Tuple, Dict]] = {}
+        self.tpbp_records:Dict[int, Dict[Tuple, Dict]] = {}
+        self.route_records:Dict[int, Dict[Tuple, Dict]] = {}
+
+        # sorted arrival times at each (route_id, stop_pair) and trip start times of each (route_id, direction_id), for headways
+        self.__stop_arrivals:Dict[Tuple, List] = {}
+        self.__tpbp_arrivals:Dict[Tuple, List] = {}
+        self.__trip_starts:Dict[Tuple, List] = {}
+
+        #: State of each trip: its last stop event, last timepoint, and running totals of the trip record.
+        self.trips:Dict[str, Dict] = {}
+        self.__updated_intervals:Set[int] = set()
+
+    def add_stop_event(self, trip_id:str, stop_id:str, stop_sequence:int, arrival_time:float, departure_time:float):
+        """Update metrics with a stop event. Stop events of a trip are expected in the order of stop_sequence; a stop event with a stop_sequence
+        that is not after the last stop event of its trip is a duplicate or arrives too late to be used, and is ignored.
+
+        :param trip_id: GTFS trip_id
+        :type trip_id: str
+        :param stop_id: GTFS stop_id
+        :type stop_id: str
+        :param stop_sequence: sequence of the stop in the trip
+        :type stop_sequence: int
+        :param arrival_time: arrival time at the stop in seconds since midnight of the service date
+        :type arrival_time: float
+        :param departure_time: departure time from the stop in seconds since midnight of the service date
+        :type departure_time: float
+        """
+
+        if trip_id not in self.trip_routes:
+            return
+        route_id, direction_id = self.trip_routes[trip_id]
+        stop_event = {'stop_id': stop_id, 'stop_sequence': stop_sequence, 'arrival_time': arrival_time, 'dwell_time': departure_time - arrival_time}
+
+        trip = self.trips.get(trip_id)
+        if trip is None:
+            self.trips[trip_id] = {
+                'last_stop_event': stop_event,
+                'last_tpbp_event': stop_event if self.tp_bp.get((route_id, stop_id)) == 1 else None,
+                'tpbp_running_time': 0,
+                'record': None
+            }
+            return
+
+        last_stop_event = trip['last_stop_event']
+        if stop_sequence <= last_stop_event['stop_sequence']:
+            return
+        trip['last_stop_event'] = stop_event
+
+        # stop pair completed by this stop event
+        stop_pair = (last_stop_event['stop_id'], stop_id)
+        stop_time = last_stop_event['arrival_time']
+        running_time = round(max(arrival_time - stop_time - last_stop_event['dwell_time'], 0) / 60, 2)
+        scheduled_arrival = self.scheduled_arrivals.get((trip_id, last_stop_event['stop_id']), np.nan)
+        on_time_performance = stop_time - scheduled_arrival
+        record = {
+            'route_id': route_id,
+            'trip_id': trip_id,
+            'stop_pair': stop_pair,
+            'stop_time': stop_time,
+            'observed_headway': np.nan,
+            'observed_running_time': running_time,
+            'on_time_performance': on_time_performance
+        }
+        self.__add_record(self.stop_records, self.__stop_arrivals, (route_id, stop_pair), (trip_id, last_stop_event['stop_sequence']), record, 'stop_time')
+
+        # timepoint pair completed by this stop event
+        if trip['last_tpbp_event'] is not None:
+            trip['tpbp_running_time'] = round(trip['tpbp_running_time'] + running_time, 2)
+        if self.tp_bp.get((route_id, stop_id)) == 1:
+            last_tpbp_event = trip['last_tpbp_event']
+            if last_tpbp_event is not None:
+                tpbp_pair = (last_tpbp_event['stop_id'], stop_id)
+                tpbp_record = {
+                    'route_id': route_id,
+                    'trip_id': trip_id,
+                    'stop_pair': tpbp_pair,
+                    'stop_time': last_tpbp_event['arrival_time'],
+                    'observed_headway': np.nan,
+                    'observed_running_time': trip['tpbp_running_time']
+                }
+                self.__add_record(self.tpbp_records, self.__tpbp_arrivals, (route_id, tpbp_pair), (trip_id, last_tpbp_event['stop_sequence']), \
+                                    tpbp_record, 'stop_time')
+            trip['last_tpbp_event'] = stop_event
+            trip['tpbp_running_time'] = 0
+
+        # trip record: total running time and percent of on-time arrivals at timepoints
+        is_timepoint = self.timepoint.get((route_id, last_stop_event['stop_id'])) == 1
+        is_on_time = (on_time_performance > self.no_earlier_than * 60) and (on_time_performance < self.no_later_than * 60)
+        trip_record = trip['record']
+        if trip_record is None:
+            trip_record = {
+                'route_id': route_id,
+                'direction_id': direction_id,
+                'trip_id': trip_id,
+                'trip_start_time': stop_time,
+                'observed_headway': np.nan,
+                'observed_running_time': 0,
+                'on_time_performance': np.nan,
+                'on_time_count': 0,
+                'timepoint_count': 0
+            }
+            trip['record'] = trip_record
+            self.__add_record(self.route_records, self.__trip_starts, (route_id, direction_id), (trip_id,), trip_record, 'trip_start_time')
+        elif self.get_interval_index(trip_record['trip_start_time']) != -1:
+            self.__updated_intervals.add(self.get_interval_index(trip_record['trip_start_time']))
+        trip_record['observed_running_time'] = round(trip_record['observed_running_time'] + running_time, 2)
+        if is_timepoint:
+            trip_record['timepoint_count'] += 1
+            trip_record['on_time_count'] += int(is_on_time)
+            trip_record['on_time_performance'] = trip_record['on_time_count'] / trip_record['timepoint_count'] * 100
+
+    def get_interval_index(self, time:float) -> int:
+        """Index of the 10-min interval of the full day that the given time falls in.
+
+        :param time: time in seconds since midnight of the service date
+        :type time: float
+        :return: interval index, -1 if the time is outside of the full day
+        :rtype: int
+        """
+
+        if time < self.day_start or time >= self.day_end:
+            return -1
+        return int((time - self.day_start) // SECONDS_IN_TEN_MINUTES)
+
+    def pop_updated_intervals(self) -> Set[int]:
+        """Return the indices of 10-min intervals whose records changed since the last call, and reset them.
+
+        :return: set of interval indices
+        :rtype: Set[int]
+        """
+
+        updated_intervals = self.__updated_intervals
+        self.__updated_intervals = set()
+        return updated_intervals
+
+    def get_stop_metrics(self, intervals:Iterable[int]=None) -> pd.DataFrame:
+        """Stop-level metrics table of the given 10-min intervals, or of the full day if no intervals are given.
+        """
+
+        return self.__get_metrics(self.stop_records, intervals, self.STOP_METRICS_COLUMNS)
+
+    def get_tpbp_metrics(self, intervals:Iterable[int]=None) -> pd.DataFrame:
+        """Timepoint-level metrics table of the given 10-min intervals, or of the full day if no intervals are given.
+        """
+
+        return self.__get_metrics(self.tpbp_records, intervals, self.TPBP_METRICS_COLUMNS)
+
+    def get_route_metrics(self, intervals:Iterable[int]=None) -> pd.DataFrame:
+        """Route-level metrics table of trips that start in the given 10-min intervals, or of the full day if no intervals are given.
+        """
+
+        return self.__get_metrics(self.route_records, intervals, self.ROUTE_METRICS_COLUMNS)
+
+    def __get_metrics(self, records:Dict[int, Dict[Tuple, Dict]], intervals:Iterable[int], columns:List[str]) -> pd.DataFrame:
+
+        if intervals is None:
+            intervals = records.keys()
+        interval_records = [record for interval in intervals for record in records.get(interval, {}).values()]
+
+        metrics = pd.DataFrame(interval_records, columns=columns)
+        # time and metric columns, which follow the id columns, stay numeric even if there is no record
+        metrics[columns[3:]] = metrics[columns[3:]].astype('float64')
+
+        return metrics
+
+    def __add_record(self, records:Dict[int, Dict[Tuple, Dict]], arrivals:Dict[Tuple, List], group:Tuple, record_key:Tuple, record:Dict, time_col:str):
+        """Store a record by its 10-min interval, and set its headway and the headway of the next arrival of the same group from the sorted
+        arrival times of the group.
+        """
+
+        time = record[time_col]
+        interval = self.get_interval_index(time)
+        if interval == -1:
+            return
+        records.setdefault(interval, {})[record_key] = record
+        self.__updated_intervals.add(interval)
+
+        group_arrivals = arrivals.setdefault(group, [])
+        arrival = (time, interval, record_key)
+        insort(group_arrivals, arrival)
+        position = bisect_left(group_arrivals, arrival)
+        if position > 0:
+            record['observed_headway'] = (time - group_arrivals[position - 1][0]) / 60
+        if position < len(group_arrivals) - 1:
+            next_time, next_interval, next_key = group_arrivals[position + 1]
+            records[next_interval][next_key]['observed_headway'] = (next_time - time) / 60
+            self.__updated_intervals.add(next_interval)
@@ -0,0 +1,170 @@
+from typing import Dict, Iterator, Optional
+import json
+import logging
+import os
+import socket
+import time
+
+logger = logging.getLogger("backendLogger")
+
+
+def parse_message(line:str) -> Optional[Dict]:
+    """Parse one line of a stream into a message dict. Blank lines are skipped, and malformed lines are logged and skipped.
+
+    :param line: a line of JSON text
+    :type line: str
+    :return: the message, or None if the line is blank or malformed
+    :rtype: Optional[Dict]
+    """
+
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        message = json.loads(line)
+    except json.JSONDecodeError:
+        logger.warning(f'skipped malformed stream message: {line[:200]}')
+        return None
+    if not isinstance(message, dict):
+        logger.warning(f'skipped stream message that is not a JSON object: {line[:200]}')
+        return None
+    return message
+
+
+class File_Tail_Source():
+    """Stream of messages read from a file of newline-delimited JSON, e.g. a GTFS-realtime feed dumped to a local file by another process.
+    The file is followed like "tail -f": lines appended to the file are read as they are written. If the file is truncated or replaced,
+    it is read again from the start.
+
+    :param path: path to the file of newline-delimited JSON messages
+    :type path: str
+    :param poll_interval: time in seconds to wait for new lines when the end of the file is reached, defaults to 1
+    :type poll_interval: float, optional
+    :param follow: whether to keep waiting for new lines at the end of the file, defaults to True. Set to False to replay a file and stop at its end.
+    :type follow: bool, optional
+    """
+
+    def __init__(self, path:str, poll_interval:float=1, follow:bool=True):
+
+        self.path:str = path
+        self.poll_interval:float = poll_interval
+        self.follow:bool = follow
+
+    def messages(self) -> Iterator[Optional[Dict]]:
+        """Yield messages from the file. None is yielded every poll_interval while no new line is available, so that the consumer can
+        do periodic work while the stream is idle.
+
+        :return: iterator of messages
+        :rtype: Iterator[Optional[Dict]]
+        """
+
+        while not os.path.isfile(self.path):
+            if not self.follow:
+                raise FileNotFoundError(f'Stream file not found: {self.path}.')
+            logger.warning(f'waiting for stream file {self.path}')
+            yield None
+            time.sleep(self.poll_interval)
+
+        stream_file = open(self.path, 'r')
+        inode = os.fstat(stream_file.fileno()).st_ino
+        partial_line = ''
+        try:
+            while True:
+                line = stream_file.readline()
+                if line.endswith('\n'):
+                    message = parse_message(partial_line + line)
+                    partial_line = ''
+                    if message is not None:
+                        yield message
+                    continue
+
+                partial_line += line
+                if not self.follow:
+                    message = parse_message(partial_line)
+                    if message is not None:
+                        yield message
+                    return
+
+                yield None
+                time.sleep(self.poll_interval)
+
+                # reopen the file if it has been truncated or replaced, e.g. by log rotation
+                try:
+                    file_stat = os.stat(self.path)
+                except FileNotFoundError:
+                    continue
+                if file_stat.st_ino != inode or file_stat.st_size < stream_file.tell():
+                    logger.info(f'stream file {self.path} was truncated or replaced, reading from the start')
+                    stream_file.close()
+                    stream_file = open(self.path, 'r')
+                    inode = os.fstat(stream_file.fileno()).st_ino
+                    partial_line = ''
+        finally:
+            stream_file.close()
+
+
+class Socket_Source():
+    """Stream of newline-delimited JSON messages read from a TCP socket, e.g. a local relay of a GTFS-realtime feed. The connection is
+    re-established if it is closed or fails.
+
+    :param host: host name or address of the server
+    :type host: str
+    :param port: port of the server
+    :type port: int
+    :param poll_interval: time in seconds to wait for new data before yielding None, defaults to 1
+    :type poll_interval: float, optional
+    :param reconnect_interval: time in seconds to wait before reconnecting after the connection is closed or fails, defaults to 5
+    :type reconnect_interval: float, optional
+    """
+
+    def __init__(self, host:str, port:int, poll_interval:float=1, reconnect_interval:float=5):
+
+        self.host:str = host
+        self.port:int = port
+        self.poll_interval:float = poll_interval
+        self.reconnect_interval:float = reconnect_interval
+
+    def messages(self) -> Iterator[Optional[Dict]]:
+        """Yield messages from the socket. None is yielded every poll_interval while no data is received, so that the consumer can
+        do periodic work while the stream is idle.
+
+        :return: iterator of messages
+        :rtype: Iterator[Optional[Dict]]
+        """
+
+        while True:
+            try:
+                connection = socket.create_connection((self.host, self.port), timeout=self.reconnect_interval)
+            except OSError as err:
+                logger.warning(f'failed to connect to stream at {self.host}:{self.port}: {err}')
+                yield None
+                time.sleep(self.reconnect_interval)
+                continue
+
+            logger.info(f'connected to stream at {self.host}:{self.port}')
+            connection.settimeout(self.poll_interval)
+            buffer = b''
+            try:
+                while True:
+                    try:
+                        data = connection.recv(65536)
+                    except socket.timeout:
+                        yield None
+                        continue
+                    if not data:
+                        logger.warning(f'stream at {self.host}:{self.port} closed the connection')
+                        break
+
+                    lines = (buffer + data).split(b'\n')
+                    buffer = lines.pop()
+                    for line in lines:
+                        message = parse_message(line.decode('utf-8', errors='replace'))
+                        if message is not None:
+                            yield message
+            except OSError as err:
+                logger.warning(f'lost connection to stream at {self.host}:{self.port}: {err}')
+            finally:
+                connection.close()
+
+            yield None
+            time.sleep(self.reconnect_interval)
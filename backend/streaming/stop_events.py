@@ -0,0 +1,233 @@
+from typing import Dict, List, Tuple
+import datetime
+import logging
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from backend.data_class.gps_pings import pattern_geometry, project_coordinates
+from backend.data_class.gtfs import GTFS
+from backend.data_class.rove_parameters import ROVE_params
+
+logger = logging.getLogger("backendLogger")
+
+#: A stop event in the form of (trip_id, stop_id, stop_sequence, arrival_time, departure_time), where times are in seconds since
+#: midnight of the service date.
+Stop_Event = Tuple[str, str, int, float, float]
+
+
+class Stop_Event_Stream():
+    """Convert messages of a GTFS-realtime stand-in stream into stop events of the trips of a service date. Two message types are supported,
+    both given as JSON objects:
+
+        - trip updates, whose stop time updates with a departure (or arrival, if departure is not given) no later than the timestamp of the
+          message are taken as observed stop events. Later stop time updates are predictions and are ignored.
+          E.g. {"type": "trip_update", "trip_id": "1001", "timestamp": 1683030000, "stop_time_updates":
+          [{"stop_id": "A", "stop_sequence": 1, "arrival": 1683029900, "departure": 1683029930}]}
+        - vehicle positions, which are snapped to the GTFS pattern of their trip as they arrive to detect arrivals at and departures from stops,
+          following the same rules as :py:func:`.infer_chunk_stop_events`.
+          E.g. {"type": "vehicle_position", "trip_id": "1001", "timestamp": 1683029900, "lat": 38.89, "lon": -77.03}
+
+    Timestamps are either date-time strings in local time or numeric epoch seconds. Messages of trips not found in the GTFS data of the
+    service date are dropped.
+
+    Parameters are read from the "streaming" object of backend_config:
+
+        - timezone: time zone that numeric epoch seconds are converted to local time in, e.g. "America/New_York", defaults to none,
+          i.e. epoch seconds are already in local time
+        - trip_timeout: time in seconds without vehicle positions after which a trip is considered complete, defaults to 900
+
+    and the arrival_radius, max_offset and densify_spacing parameters of vehicle positions are read from the "gps_pings" object of backend_config,
+    see :py:class:`.GPS_Ping_Inference`.
+
+    :param rove_params: a rove_params object that stores information needed throughout the backend
+    :type rove_params: ROVE_params
+    :param bus_gtfs: GTFS data object of the service date
+    :type bus_gtfs: GTFS
+    :param service_date: the service date that stop event times are relative to
+    :type service_date: datetime.date
+    """
+
+    def __init__(self, rove_params:ROVE_params, bus_gtfs:GTFS, service_date:datetime.date):
+
+        stream_config = rove_params.backend_config.get('streaming', {})
+        self.timezone:str = stream_config.get('timezone')
+        self.trip_timeout:int = stream_config.get('trip_timeout', 900)
+
+        ping_config = rove_params.backend_config.get('gps_pings', {})
+        self.arrival_radius:float = ping_config.get('arrival_radius', 30)
+        self.max_offset:float = ping_config.get('max_offset', 50)
+        self.densify_spacing:float = ping_config.get('densify_spacing', 5)
+
+        self.patterns_dict:Dict[str, Dict] = bus_gtfs.patterns_dict
+        self.service_midnight:pd.Timestamp = pd.Timestamp(service_date)
+
+        records = bus_gtfs.records
+        #: Lookup of the pattern of each GTFS trip.
+        self.trip_patterns:Dict[str, str] = records.drop_duplicates(subset=['trip_id']).set_index('trip_id')['pattern'].to_dict()
+        #: Lookup of the stop_sequence of each stop of each GTFS trip, for stop time updates that have no stop_sequence.
+        self.stop_sequences:Dict[Tuple[str, str], int] = records.drop_duplicates(subset=['trip_id', 'stop_id'])\
+                                                            .set_index(['trip_id', 'stop_id'])['stop_sequence'].to_dict()
+
+        #: Pattern geometries and their KD-trees, built the first time a vehicle position of the pattern is received.
+        self.geometries:Dict[str, Tuple[Dict, cKDTree]] = {}
+        #: State of trips with vehicle positions, keyed by trip_id.
+        self.trips:Dict[str, Dict] = {}
+        #: The latest timestamp received, in seconds since midnight of the service date.
+        self.clock:float = float('-inf')
+
+    def process(self, message:Dict) -> List[Stop_Event]:
+        """Convert a message into the stop events it completes.
+
+        :param message: a trip update or vehicle position message
+        :type message: Dict
+        :return: list of stop events
+        :rtype: List[Stop_Event]
+        """
+
+        message_type = message.get('type')
+        trip_id = message.get('trip_id')
+        if trip_id is None:
+            logger.debug(f'skipped stream message without trip_id')
+            return []
+        trip_id = str(trip_id)
+        if trip_id not in self.trip_patterns:
+            logger.debug(f'skipped stream message of trip {trip_id} not found in GTFS')
+            return []
+
+        try:
+            if message_type == 'trip_update':
+                return self.__process_trip_update(trip_id, message)
+            elif message_type == 'vehicle_position':
+                return self.__process_vehicle_position(trip_id, message)
+        except (KeyError, TypeError, ValueError) as err:
+            logger.warning(f'skipped invalid {message_type} message of trip {trip_id}: {err!r}')
+            return []
+
+        logger.warning(f"skipped stream message of unknown type {message_type}, must be one of: 'trip_update', 'vehicle_position'.")
+        return []
+
+    def expire(self, force:bool=False) -> List[Stop_Event]:
+        """Complete trips that have received no vehicle position for trip_timeout seconds, emitting the stop that the vehicle is still at, if any.
+
+        :param force: whether to complete all trips regardless of time, e.g. when the stream ends, defaults to False
+        :type force: bool, optional
+        :return: list of stop events
+        :rtype: List[Stop_Event]
+        """
+
+        stop_events = []
+        expired_trips = [trip_id for trip_id, state in self.trips.items() if force or state['last_time'] < self.clock - self.trip_timeout]
+        for trip_id in expired_trips:
+            state = self.trips.pop(trip_id)
+            if state['first_in_radius'] is not None:
+                stop_events.append(self.__observed_stop_event(trip_id, state))
+
+        return stop_events
+
+    def convert_timestamp(self, value) -> float:
+        """Convert a message timestamp to seconds since midnight of the service date. Numeric timestamps are taken as epoch seconds
+        and converted to local time with the "timezone" of the "streaming" object in backend_config, if given.
+
+        :param value: numeric epoch seconds or date-time string in local time
+        :type value: Union[int, float, str]
+        :return: seconds since midnight of the service date
+        :rtype: float
+        """
+
+        if isinstance(value, str) and not value.replace('.', '', 1).isdigit():
+            timestamp = pd.Timestamp(value)
+        elif self.timezone is None:
+            timestamp = pd.Timestamp(float(value), unit='s')
+        else:
+            timestamp = pd.Timestamp(float(value), unit='s', tz='UTC').tz_convert(self.timezone).tz_localize(None)
+
+        return (timestamp - self.service_midnight).total_seconds()
+
+    def __process_trip_update(self, trip_id:str, message:Dict) -> List[Stop_Event]:
+
+        message_time = self.convert_timestamp(message['timestamp']) if message.get('timestamp') is not None else None
+        if message_time is not None:
+            self.clock = max(self.clock, message_time)
+
+        stop_events = []
+        for update in message.get('stop_time_updates', []):
+            arrival = update.get('arrival', update.get('departure'))
+            departure = update.get('departure', update.get('arrival'))
+            if arrival is None:
+                continue
+            arrival_time = self.convert_timestamp(arrival)
+            departure_time = max(self.convert_timestamp(departure), arrival_time)
+            if message_time is not None and departure_time > message_time:
+                continue
+
+            stop_id = str(update['stop_id'])
+            stop_sequence = update.get('stop_sequence', self.stop_sequences.get((trip_id, stop_id)))
+            if stop_sequence is None:
+                continue
+            stop_events.append((trip_id, stop_id, int(stop_sequence), arrival_time, departure_time))
+
+        return stop_events
+
+    def __process_vehicle_position(self, trip_id:str, message:Dict) -> List[Stop_Event]:
+
+        timestamp = self.convert_timestamp(message['timestamp'])
+        self.clock = max(self.clock, timestamp)
+
+        pattern = self.trip_patterns[trip_id]
+        if pattern not in self.geometries:
+            geometry = pattern_geometry(self.patterns_dict[pattern], self.densify_spacing)
+            self.geometries[pattern] = (geometry, cKDTree(geometry['points']))
+        geometry, tree = self.geometries[pattern]
+
+        offset, nearest = tree.query(project_coordinates(np.array([float(message['lat'])]), np.array([float(message['lon'])]), geometry['ref_lat'])[0])
+        if offset > self.max_offset:
+            return []
+
+        state = self.trips.get(trip_id)
+        if state is None:
+            state = {'geometry': geometry, 'next_stop': 0, 'last_position': None, 'last_time': None, 'first_in_radius': None, 'last_in_radius': None}
+            self.trips[trip_id] = state
+        elif timestamp <= state['last_time']:
+            return []
+
+        # the distance along the pattern is non-decreasing to absorb GPS noise
+        position = geometry['positions'][nearest]
+        if state['last_position'] is not None:
+            position = max(position, state['last_position'])
+
+        stop_events = []
+        stop_positions = geometry['stop_positions']
+        while state['next_stop'] < len(stop_positions):
+            stop_position = stop_positions[state['next_stop']]
+            if position < stop_position - self.arrival_radius:
+                break
+            if position <= stop_position + self.arrival_radius:
+                # at the stop: the first and last positions within arrival_radius give the arrival and departure times
+                if state['first_in_radius'] is None:
+                    state['first_in_radius'] = timestamp
+                state['last_in_radius'] = timestamp
+                break
+
+            # passed the stop
+            if state['first_in_radius'] is not None:
+                stop_events.append(self.__observed_stop_event(trip_id, state))
+            elif state['last_position'] is not None:
+                # interpolate between the last position before the stop and this position, with zero dwell time
+                position_gap = position - state['last_position']
+                fraction = (stop_position - state['last_position']) / position_gap if position_gap > 0 else 0
+                passing_time = state['last_time'] + fraction * (timestamp - state['last_time'])
+                stop_events.append((trip_id, geometry['stop_ids'][state['next_stop']], state['next_stop'] + 1, passing_time, passing_time))
+            state['next_stop'] += 1
+            state['first_in_radius'] = None
+            state['last_in_radius'] = None
+
+        state['last_position'] = position
+        state['last_time'] = timestamp
+
+        return stop_events
+
+    def __observed_stop_event(self, trip_id:str, state:Dict) -> Stop_Event:
+
+        stop_index = state['next_stop']
+        return (trip_id, state['geometry']['stop_ids'][stop_index], stop_index + 1, state['first_in_radius'], state['last_in_radius'])
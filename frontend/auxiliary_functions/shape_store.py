@@ -0,0 +1,72 @@
+"""
+This script reads shapes from the shape store (GeoPackage) that the backend writes
+alongside each shapes JSON file, only for the segments in a bounding box and/or of
+a list of routes, using the R-tree and route index of the store.
+"""
+
+import os
+import sqlite3
+
+
+def shape_store_path(shapes_path):
+    """
+    Path of the shape store written alongside a shapes JSON file
+    :param shapes_path: path to the shapes JSON file
+    :return: path to the shape store, or None if there is no store as recent as the JSON file
+    """
+
+    store_path = os.path.splitext(shapes_path)[0] + '.gpkg'
+    if os.path.isfile(store_path) and os.path.getmtime(store_path) >= os.path.getmtime(shapes_path):
+        return store_path
+    return None
+
+
+def read_shape_records(store_path, bbox=None, route_ids=None, resolution=None):
+    """
+    Read shapes in the format of the shapes JSON file, i.e. a list of segment dicts with
+    the encoded polyline in "geometry" and "stop_pair" as a list of two stop IDs
+    :param store_path: path to the shape store
+    :param bbox: [min lon, min lat, max lon, max lat] that segments must intersect, None for all segments
+    :param route_ids: list of route IDs of the segments, None for all routes
+    :param resolution: resolution of the geometries, e.g. "low" for network-wide zoom levels,
+        None or unknown resolutions for full resolution
+    :return: list of segment dicts
+    """
+
+    conditions = []
+    parameters = []
+    if bbox is not None:
+        min_x, min_y, max_x, max_y = bbox
+        conditions.append('fid IN (SELECT id FROM rtree_shapes_geom WHERE maxx >= ? AND minx <= ? AND maxy >= ? AND miny <= ?)')
+        parameters += [min_x, max_x, min_y, max_y]
+    if route_ids is not None:
+        route_ids = [str(route_id) for route_id in route_ids]
+        conditions.append('route_id IN ({})'.format(', '.join('?' * len(route_ids))) if route_ids else '0')
+        parameters += route_ids
+
+    connection = sqlite3.connect('file:{}?mode=ro'.format(store_path), uri=True)
+    try:
+        column_types = {row[1]: row[2] for row in connection.execute('PRAGMA table_info(shapes)')}
+        geometry_column = 'polyline_{}'.format(resolution)
+        if geometry_column not in column_types:
+            geometry_column = 'polyline'
+        columns = [column for column in column_types if column not in ['fid', 'geom'] and
+                   (column == geometry_column or not column.startswith('polyline'))]
+        query = 'SELECT {} FROM shapes'.format(', '.join('"{}"'.format(column) for column in columns))
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        rows = connection.execute(query + ' ORDER BY fid', parameters).fetchall()
+    finally:
+        connection.close()
+
+    boolean_columns = [column for column in columns if column_types[column] == 'BOOLEAN']
+    records = []
+    for row in rows:
+        record = dict(zip(columns, row))
+        for column in boolean_columns:
+            if record[column] is not None:
+                record[column] = bool(record[column])
+        record['stop_pair'] = [record.pop('first_stop_id'), record.pop('second_stop_id')]
+        record['geometry'] = record.pop(geometry_column)
+        records.append(record)
+    return records
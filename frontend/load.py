@@ -1,6 +1,7 @@
 from flask import (Blueprint, redirect, request, url_for, jsonify, session, Response)
 from frontend.auxiliary_functions.dynamic_filter import dynamic_filter_process
 from frontend.auxiliary_functions.calculate_difference import paxflow_difference
+from frontend.auxiliary_functions.shape_store import shape_store_path, read_shape_records
 import json
 import pandas as pd
 
@@ -137,14 +138,32 @@ def load_shapes():
 
     if request.method == 'PUT':
 
-        layer_num = request.json
+        # either the file number, or a dict of the file number, optional "bbox" and "route_ids" filters and "resolution"
+        if isinstance(request.json, dict):
+            layer_num = request.json['file']
+            bbox = request.json.get('bbox')
+            route_ids = request.json.get('route_ids')
+            resolution = request.json.get('resolution')
+        else:
+            layer_num = request.json
+            bbox = None
+            route_ids = None
+            resolution = None
 
         file_info = session['transit_files']
         filename = file_info[layer_num]['shapes_file']
         path = 'frontend/static/inputs/' + str(filename)
 
-        with open(path) as f:
-            layer = json.load(f)
+        store_path = shape_store_path(path)
+        if store_path is not None:
+            layer = read_shape_records(store_path, bbox=bbox, route_ids=route_ids, resolution=resolution)
+        else:
+            # without the shape store, only the route filter is applied, at full resolution
+            with open(path) as f:
+                layer = json.load(f)
+            if route_ids is not None:
+                route_ids = {str(route_id) for route_id in route_ids}
+                layer = [segment for segment in layer if str(segment['route_id']) in route_ids]
 
         return jsonify(layer)
 
@@ -0,0 +1,183 @@
+"""Shared fixtures of the backend tests.
+
+The backend modules import each other both as ``backend.<module>`` and as ``<module>`` (e.g. ``metrics.wmata``),
+so both the repository root and the backend directory are put on the path, as running ``backend_main.py`` does.
+"""
+import os
+import sys
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+for path in [ROOT, os.path.join(ROOT, 'backend')]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+SERVICE_DATES = ['2023-05-01', '2023-05-02']
+
+
+def make_records(routes, trips_per_pattern=6, service_dates=SERVICE_DATES, skip_rate=0.03, seed=1):
+    """Build synthetic GTFS records, AVL records and stop pair distances of shapes.
+
+    :param routes: dict of route_id to a list of patterns, each pattern a list of stop_ids
+    :type routes: dict
+    :param trips_per_pattern: number of scheduled trips of each pattern, defaults to 6
+    :type trips_per_pattern: int, optional
+    :param service_dates: service dates of the AVL records, defaults to SERVICE_DATES
+    :type service_dates: list, optional
+    :param skip_rate: share of stops without an AVL record, defaults to 0.03
+    :type skip_rate: float, optional
+    :param seed: random seed, defaults to 1
+    :type seed: int, optional
+    :return: GTFS records, AVL records and shapes (pattern, stop_pair, distance in km)
+    :rtype: tuple of pd.DataFrame
+    """
+    rng = np.random.default_rng(seed)
+    gtfs_rows = []
+    avl_rows = []
+    shape_rows = []
+    for route_id, patterns in routes.items():
+        for p, stops in enumerate(patterns):
+            pattern = f'{route_id}-0-{p}'
+            for s1, s2 in zip(stops[:-1], stops[1:]):
+                shape_rows.append({'pattern': pattern, 'stop_pair': (s1, s2), 'distance': float(rng.uniform(0.2, 0.6))})
+            for k in range(trips_per_pattern):
+                trip_id = f'{pattern}_{k}'
+                t0 = 5*3600 + k*1500 + p*300 + int(rng.integers(0, 300))
+                for i, stop_id in enumerate(stops):
+                    arrival = t0 + i*150
+                    gtfs_rows.append({'route_id': route_id, 'trip_id': trip_id, 'service_id': 'wk', 'direction_id': 0,
+                                      'pattern': pattern, 'stop_id': stop_id, 'stop_sequence': i + 1,
+                                      'arrival_time': arrival, 'departure_time': arrival + 10,
+                                      'tp_bp': int(i % 3 == 0 or i == len(stops) - 1), 'timepoint': int(i % 3 == 0),
+                                      'trip_start_time': t0, 'trip_end_time': t0 + (len(stops) - 1)*150})
+                for svc_date in service_dates:
+                    load = 0
+                    stop_time = t0 + int(rng.integers(-60, 300))
+                    for i, stop_id in enumerate(stops):
+                        if rng.random() < skip_rate:
+                            continue
+                        on = int(rng.integers(0, 5))
+                        off = int(min(load, rng.integers(0, 5)))
+                        load += on - off
+                        dwell = int(rng.integers(0, 40))
+                        avl_rows.append({'svc_date': svc_date, 'route_id': route_id, 'trip_id': trip_id, 'stop_id': stop_id,
+                                         'stop_sequence': i + 1, 'stop_time': stop_time, 'dwell_time': dwell,
+                                         'passenger_on': on, 'passenger_off': off, 'passenger_load': load, 'seat_capacity': 40})
+                        stop_time += dwell + int(rng.integers(100, 250))
+
+    gtfs_records = pd.DataFrame(gtfs_rows)
+    avl_records = pd.DataFrame(avl_rows)
+    trip_times = avl_records.groupby(['svc_date', 'trip_id'])['stop_time']
+    avl_records['trip_start_time'] = trip_times.transform('min')
+    avl_records['trip_end_time'] = trip_times.transform('max')
+    avl_records = avl_records.sort_values(['svc_date', 'route_id', 'trip_id', 'stop_sequence']).reset_index(drop=True)
+
+    return gtfs_records, avl_records, pd.DataFrame(shape_rows)
+
+
+def random_routes(num_routes=6, seed=1):
+    """Single-pattern routes of 5 to 14 stops drawn from a pool of 60 stops. Every other route starts with the first four stops
+    of the route before it, so that some stop pairs are served by several routes.
+    """
+    rng = np.random.default_rng(seed)
+    routes = {}
+    for r in range(num_routes):
+        stops = [str(s) for s in rng.choice(60, int(rng.integers(5, 15)), replace=False)]
+        if r % 2 == 1:
+            trunk = routes[f'R{r - 1}'][0][:4]
+            stops = trunk + [stop for stop in stops if stop not in trunk]
+        routes[f'R{r}'] = [stops]
+    return routes
+
+
+#: Latitude of the pattern of make_pings(), the longitude step between its stops and its stops
+PING_LAT = 42.0
+PING_STOP_SPACING = 0.005
+PING_STOP_IDS = ['A', 'B', 'C', 'D']
+
+
+def make_pings(trip_id='t1', start=1683000000):
+    """GPS pings of one run of a trip along a straight east-bound pattern of four stops (see PING_STOP_IDS) about 413 m apart, and the
+    GTFS stand-in with its records and patterns_dict. The vehicle passes A at 0 s, dwells at B from 40 s to 60 s, passes C without a ping
+    near it at 85 s (interpolated) and arrives at D at 120 s. A ping 110 m off the pattern at B at 35 s is to be discarded.
+
+    :param trip_id: trip_id of the pings, defaults to 't1'
+    :type trip_id: str, optional
+    :param start: epoch seconds of the first ping, defaults to 1683000000
+    :type start: int, optional
+    :return: pings (route, trip_id, timestamp, lat, lon) and the GTFS stand-in
+    :rtype: tuple of pd.DataFrame and types.SimpleNamespace
+    """
+    meters_per_degree = 6371008.8 * np.radians(1) * np.cos(np.radians(PING_LAT))
+    stop_spacing = PING_STOP_SPACING * meters_per_degree
+    positions = [(0, 0), (10, 100), (20, 200), (30, 300), (40, stop_spacing), (50, stop_spacing), (60, stop_spacing),
+                 (70, stop_spacing + 150), (80, 2*stop_spacing - 100), (90, 2*stop_spacing + 100), (100, 3*stop_spacing - 200),
+                 (120, 3*stop_spacing)]
+    pings = pd.DataFrame({'route': 'R0', 'trip_id': trip_id, 'timestamp': [start + t for t, _ in positions], 'lat': PING_LAT,
+                          'lon': [position / meters_per_degree for _, position in positions]})
+    off_pattern = pd.DataFrame({'route': ['R0'], 'trip_id': [trip_id], 'timestamp': [start + 35], 'lat': [PING_LAT + 0.001],
+                                'lon': [PING_STOP_SPACING]})
+    pings = pd.concat([pings, off_pattern], ignore_index=True).sort_values('timestamp', ignore_index=True)
+
+    stop_lons = [i * PING_STOP_SPACING for i in range(len(PING_STOP_IDS))]
+    segments = {(s1, s2): [(PING_LAT, lon1), (PING_LAT, lon2)]
+                for s1, s2, lon1, lon2 in zip(PING_STOP_IDS[:-1], PING_STOP_IDS[1:], stop_lons[:-1], stop_lons[1:])}
+    records = pd.DataFrame({'route_id': 'R0', 'trip_id': trip_id, 'pattern': 'R0-0-0', 'stop_id': PING_STOP_IDS,
+                            'stop_sequence': range(1, len(PING_STOP_IDS) + 1)})
+    return pings, types.SimpleNamespace(records=records, patterns_dict={'R0-0-0': segments})
+
+
+def make_params(out_dir, **options):
+    """Stand-in for ROVE_params with the attributes read by metric calculation and aggregation.
+
+    :param out_dir: directory of the output files
+    :type out_dir: str or pathlib.Path
+    :return: parameters, keyword arguments override the defaults
+    :rtype: types.SimpleNamespace
+    """
+    out_dir = str(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    params = {
+        'lean_dtypes': False,
+        'execution_backend': 'pandas',
+        'verify_execution_backend': False,
+        'data_option': 'GTFS-AVL',
+        'redValues': {'observed_headway': 'High'},
+        'backend_config': {'speed_range': {'min': 0, 'max': 65}},
+        'frontend_config': {'periodRanges': {'full': [4, 10], 'am': [6, 9]}, 'units': {}},
+        'output_paths': {'metric_calculation_aggre': os.path.join(out_dir, 'metrics.p'),
+                         'metric_calculation_aggre_10min': os.path.join(out_dir, 'metrics_10min.p'),
+                         'partitions': os.path.join(out_dir, 'partitions')},
+    }
+    params.update(options)
+    return types.SimpleNamespace(**params)
+
+
+@pytest.fixture(scope='session')
+def records():
+    """GTFS records, AVL records and shapes of six single-pattern routes.
+    """
+    return make_records(random_routes())
+
+
+def assert_same_outputs(params, other_params, check_dtype=True):
+    """Assert that the aggregation outputs written to the output paths of two parameters are the same.
+    """
+    time_periods = pd.read_pickle(params.output_paths['metric_calculation_aggre'])
+    other_time_periods = pd.read_pickle(other_params.output_paths['metric_calculation_aggre'])
+    assert time_periods.keys() == other_time_periods.keys()
+    for key, table in time_periods.items():
+        assert table == other_time_periods[key], key
+
+    intervals = pd.read_pickle(params.output_paths['metric_calculation_aggre_10min'])
+    other_intervals = pd.read_pickle(other_params.output_paths['metric_calculation_aggre_10min'])
+    assert intervals.keys() == other_intervals.keys()
+    for interval, interval_tables in intervals.items():
+        assert interval_tables.keys() == other_intervals[interval].keys()
+        for agg_method, tables in interval_tables.items():
+            for table, other_table in zip(tables, other_intervals[interval][agg_method]):
+                pd.testing.assert_frame_equal(table, other_table, check_dtype=check_dtype)
@@ -0,0 +1,231 @@
+import datetime
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from backend.data_class import AVL
+
+from conftest import make_records, random_routes
+
+
+def avl_params(**backend_config):
+    return types.SimpleNamespace(backend_config=backend_config, output_paths={}, lean_dtypes=False)
+
+
+def checked_avl(validated_data, **backend_config):
+    avl = AVL.__new__(AVL)
+    avl.rove_params = avl_params(**backend_config)
+    avl.validated_data = validated_data
+    avl.check_data_quality()
+    return avl
+
+
+@pytest.fixture
+def avl_records():
+    _, avl_records, _ = make_records(random_routes(3), trips_per_pattern=3, skip_rate=0)
+    return avl_records.drop(columns=['trip_start_time', 'trip_end_time'])
+
+
+def test_clean_records_are_kept(avl_records):
+    avl = checked_avl(avl_records.copy())
+    assert len(avl.validated_data) == len(avl_records)
+    assert avl.quarantine.empty
+    assert avl.quality_report.empty
+
+
+def test_duplicates_are_quarantined(avl_records):
+    data = pd.concat([avl_records, avl_records.iloc[[3, 10]]], ignore_index=True)
+    avl = checked_avl(data)
+    assert len(avl.validated_data) == len(avl_records)
+    assert avl.quarantine['quality_issues'].tolist() == ['duplicate', 'duplicate']
+
+
+@pytest.mark.parametrize('column', ['trip_id', 'route_id', 'svc_date'])
+def test_missing_trip_keys_are_quarantined(avl_records, column):
+    data = avl_records.copy()
+    data.loc[[0, 5, 6], column] = np.nan
+    avl = checked_avl(data)
+
+    assert len(avl.validated_data) == len(avl_records) - 3
+    assert avl.validated_data[['svc_date', 'route_id', 'trip_id']].notna().all().all()
+    assert avl.quarantine['quality_issues'].tolist() == ['missing_trip_key'] * 3
+    assert avl.quality_report['missing_trip_key'].sum() == 3
+    assert avl.quality_report['records'].sum() == 3
+
+
+def test_missing_trip_key_does_not_join_neighboring_trips(avl_records):
+    data = avl_records.copy()
+    trip = data['trip_id'] == data.loc[0, 'trip_id']
+    data.loc[trip.idxmax() + 1, 'trip_id'] = np.nan
+    avl = checked_avl(data)
+    # the rest of the trip is not flagged, e.g. as a repeated stop or out of order around the removed record
+    assert avl.quality_report['records'].sum() == 1
+    assert len(avl.validated_data) == len(avl_records) - 1
+
+
+def test_quarantine_rules_are_validated(avl_records):
+    with pytest.raises(ValueError):
+        checked_avl(avl_records.copy(), avl_quality={'quarantine': ['no_such_rule']})
+
+
+def test_flagged_rules_are_quarantined_when_configured(avl_records):
+    data = avl_records.copy()
+    data.loc[4, 'dwell_time'] = -5
+    flagged = checked_avl(data.copy())
+    assert len(flagged.validated_data) == len(avl_records)
+    assert flagged.quality_report['negative_dwell_time'].sum() == 1
+
+    quarantined = checked_avl(data.copy(), avl_quality={'quarantine': ['negative_dwell_time']})
+    assert len(quarantined.validated_data) == len(avl_records) - 1
+    assert quarantined.quarantine['quality_issues'].tolist() == ['negative_dwell_time']
+
+
+@pytest.mark.parametrize('lean', [False, True])
+def test_raw_data_is_released_only_when_lean(avl_records, tmp_path, monkeypatch, lean):
+    path = tmp_path / 'avl.csv'
+    path.write_text('')
+    monkeypatch.setattr(AVL, 'load_data', lambda self, path: avl_records.copy())
+    monkeypatch.setattr(AVL, 'validate_data', lambda self: self.raw_data.copy())
+    monkeypatch.setattr(AVL, 'check_avl_gtfs_ids_match', lambda self: None)
+    params = avl_params()
+    params.date_list = [datetime.date(2023, 5, 1)]
+    params.month_name = 'May'
+    params.input_paths = {'avl': str(path)}
+
+    avl = AVL(params, None, lean=lean)
+    assert (avl.raw_data is None) == lean
+    assert (avl.validated_data is None) == lean
+    assert len(avl.records) == len(avl_records)
+
+
+@pytest.mark.parametrize('lean', [False, True])
+def test_raw_data_is_converted_in_place_only_when_lean(avl_records, lean):
+    raw_data = avl_records.rename(columns={'route_id': 'route'}).drop(columns=['svc_date'])
+    raw_data['stop_time'] = (pd.Timestamp('2023-05-01') + pd.to_timedelta(avl_records['stop_time'], unit='s')).astype(str)
+    original = raw_data.copy()
+    avl = AVL.__new__(AVL)
+    avl.rove_params = avl_params()
+    avl.rove_params.date_list = [datetime.date(2023, 5, 1)]
+    avl.rove_params.frontend_config = {'periodRanges': {'full': [4, 27]}}
+    avl.lean = lean
+    avl.raw_data = raw_data
+
+    avl.validated_data = avl.validate_data()
+    assert (avl.validated_data is raw_data) == lean
+    assert avl.validated_data['stop_time'].tolist() == avl_records['stop_time'].tolist()
+    if not lean:
+        pd.testing.assert_frame_equal(avl.raw_data, original)
+    avl.records = avl.get_avl_records()
+    assert (avl.records is avl.validated_data) == lean
+    assert ('trip_start_time' in avl.validated_data.columns) == lean
+
+
+def corrected_avl(records, **backend_config):
+    avl = AVL.__new__(AVL)
+    avl.rove_params = avl_params(**backend_config)
+    avl.records = records
+    avl.correct_passenger_load()
+    return avl
+
+
+def trip_records(passenger_on, passenger_off, trip_id='t1'):
+    return pd.DataFrame({'svc_date': '2023-05-01', 'route_id': 'R0', 'trip_id': trip_id, 'stop_sequence': range(1, len(passenger_on) + 1),
+                         'passenger_on': passenger_on, 'passenger_off': passenger_off, 
+                         'passenger_load': np.cumsum(passenger_on) - np.cumsum(passenger_off)})
+
+
+@pytest.mark.parametrize('strategy', ['alightings', 'boardings', 'proportional'])
+def test_corrected_passenger_load_adds_up(avl_records, strategy):
+    records = avl_records.copy()
+    rng = np.random.default_rng(2)
+    records['passenger_off'] = rng.integers(0, 6, len(records))
+    avl = corrected_avl(records, passenger_load_correction={'strategy': strategy})
+
+    records = avl.records
+    trips = records.groupby(['svc_date', 'route_id', 'trip_id'])
+    load = trips['passenger_on'].cumsum() - trips['passenger_off'].cumsum()
+    assert (records['passenger_load'] == load).all()
+    assert (records['passenger_load'] >= 0).all()
+    assert (trips['passenger_off'].head(1) == 0).all()
+    assert (trips['passenger_on'].tail(1) == 0).all()
+    assert (trips['passenger_load'].tail(1) == 0).all()
+    assert len(avl.load_correction_report) == trips.ngroups
+    assert avl.load_correction_report['stops'].sum() == len(records)
+
+
+@pytest.mark.parametrize('strategy, passenger_on, passenger_off', [('alightings', [2, 0, 0], [0, 2, 0]),
+                                                                    ('boardings', [2, 1, 0], [0, 3, 0]),
+                                                                    ('proportional', [2, 0, 0], [0, 2, 0])])
+def test_negative_load_is_balanced_by_strategy(strategy, passenger_on, passenger_off):
+    records = pd.concat([trip_records([2, 0, 0], [0, 3, 0]), trip_records([1, 1, 0], [0, 1, 1], trip_id='t2')], ignore_index=True)
+    avl = corrected_avl(records, passenger_load_correction={'strategy': strategy})
+
+    assert avl.records['passenger_on'].tolist() == passenger_on + [1, 1, 0]
+    assert avl.records['passenger_off'].tolist() == passenger_off + [0, 1, 1]
+    assert avl.load_correction_report['stops_corrected'].tolist() == [1, 0]
+    assert avl.load_correction_report['raw_negative_load_stops'].tolist() == [2, 0]
+
+
+def test_invalid_load_correction_strategy():
+    with pytest.raises(ValueError):
+        corrected_avl(trip_records([2, 0, 0], [0, 2, 0]), passenger_load_correction={'strategy': 'nearest'})
+
+
+MATCHING_DATE = datetime.date(2023, 5, 1)
+# two patterns of R0 with the same stops in the opposite order, so that only the stop order tells them apart
+MATCHING_PATTERNS = {'R0-0-0': ['A', 'B', 'C', 'D', 'E'], 'R0-1-0': ['E', 'D', 'C', 'B', 'A']}
+# scheduled start of the GTFS trips of each pattern, in seconds
+MATCHING_STARTS = {'R0-0-0': [21600, 23400, 32400], 'R0-1-0': [21600]}
+
+
+def matching_gtfs():
+    rows = [{'route_id': 'R0', 'pattern': pattern, 'trip_id': f'{pattern}_{start}', 'service_id': 'wk', 'stop_id': stop_id,
+             'stop_sequence': i + 1, 'arrival_time': start + i*120}
+            for pattern, stops in MATCHING_PATTERNS.items() for start in MATCHING_STARTS[pattern] for i, stop_id in enumerate(stops)]
+    return types.SimpleNamespace(records=pd.DataFrame(rows), service_ids_by_date={MATCHING_DATE: ['wk']})
+
+
+def avl_trip(trip_id, start, stops=MATCHING_PATTERNS['R0-0-0']):
+    return pd.DataFrame({'svc_date': MATCHING_DATE, 'route_id': 'R0', 'trip_id': pd.array([trip_id] * len(stops), dtype='string'),
+                         'stop_id': stops, 'stop_sequence': range(1, len(stops) + 1), 'stop_time': [start + i*130 for i in range(len(stops))]})
+
+
+def matched_trips(*trips, **trip_matching):
+    avl = AVL.__new__(AVL)
+    avl.rove_params = avl_params(trip_matching=trip_matching)
+    avl.gtfs = matching_gtfs()
+    avl.validated_data = pd.concat(trips, ignore_index=True)
+    data = avl.match_trips_to_gtfs()
+    assert set(data['trip_id']) == set(avl.trip_matches['gtfs_trip_id'])
+    return avl.trip_matches.set_index('trip_id')
+
+
+def test_shifted_trips_are_matched_within_max_start_time_diff():
+    matches = matched_trips(avl_trip('early', 21600 - 300), avl_trip('late', 23400 + 600), avl_trip('off', 32400 - 1000), 
+                            max_start_time_diff=900)
+    assert matches['gtfs_trip_id'].to_dict() == {'early': 'R0-0-0_21600', 'late': 'R0-0-0_23400'}
+    assert matches['start_time_diff'].to_dict() == {'early': 300, 'late': 600}
+
+
+def test_max_start_time_diff_from_json_may_be_a_float():
+    matches = matched_trips(avl_trip('late', 23400 + 600), max_start_time_diff=900.0)
+    assert matches['gtfs_trip_id'].to_dict() == {'late': 'R0-0-0_23400'}
+    with pytest.raises(ValueError):
+        matched_trips(avl_trip('late', 23400 + 600), max_start_time_diff=-1)
+
+
+def test_matching_ties():
+    # halfway between two GTFS trips, the earlier one is matched
+    assert matched_trips(avl_trip('halfway', 22500))['gtfs_trip_id'].to_dict() == {'halfway': 'R0-0-0_21600'}
+    # two AVL trips at the same time difference from a GTFS trip, the first by trip_id keeps it
+    matches = matched_trips(avl_trip('b_late', 21600 + 60), avl_trip('a_early', 21600 - 60), max_start_time_diff=300)
+    assert matches['gtfs_trip_id'].to_dict() == {'a_early': 'R0-0-0_21600'}
+
+
+def test_trips_are_matched_to_the_pattern_of_their_stop_order():
+    matches = matched_trips(avl_trip('outbound', 21600), avl_trip('inbound', 21600, MATCHING_PATTERNS['R0-1-0']))
+    assert matches['pattern'].to_dict() == {'inbound': 'R0-1-0', 'outbound': 'R0-0-0'}
+    assert matches['gtfs_trip_id'].to_dict() == {'inbound': 'R0-1-0_21600', 'outbound': 'R0-0-0_21600'}
+    assert (matches['similarity'] == 1).all()
@@ -0,0 +1,137 @@
+import types
+
+import pytest
+
+from backend.shape_benchmark import synthetic_patterns
+from backend.shapes.base_shape import BaseShape
+from backend.shapes.mock_valhalla import Mock_Valhalla_Server
+
+
+class Segment_Only_Server(Mock_Valhalla_Server):
+    """Mock Valhalla server that cannot match requests of more than one segment, i.e. with more than two break points."""
+
+    def trace_route(self, body):
+        response = super().trace_route(body)
+        if 'trip' in response and len(response['trip']['legs']) > 1:
+            return dict(self.NO_MATCH_RESPONSE)
+        return response
+
+
+@pytest.fixture
+def patterns():
+    # two routes of two patterns each, which share the first half of their segments
+    return synthetic_patterns(routes=2, patterns_per_route=2, stops=6, seed=1)
+
+
+def generate_shapes(tmp_path, monkeypatch, patterns, server, shape_cache=None, **valhalla):
+    # skipped shapes are written to the working directory
+    tmp_path.mkdir(exist_ok=True)
+    monkeypatch.chdir(tmp_path)
+    params = types.SimpleNamespace(backend_config={'valhalla': {'url': server.url, 'retry_delay': 0, **valhalla},
+                                                   'shape_cache': shape_cache or {'enabled': False}},
+                                   output_paths={'shapes': str(tmp_path / 'shapes.json'), 'shape_cache': str(tmp_path / 'cache.sqlite')})
+    return BaseShape(patterns, params=params, check_signal=False, use_valhalla=True)
+
+
+def segment_geometries(shape):
+    return shape.shapes.set_index(['pattern', 'stop_pair'])[['geometry', 'distance']].sort_index()
+
+
+def test_patterns_are_matched_with_one_request_each(tmp_path, monkeypatch, patterns):
+    with Mock_Valhalla_Server(latency=0) as server:
+        by_segment = generate_shapes(tmp_path / 'segments', monkeypatch, patterns, server)
+        segment_requests = server.stats['requests']
+    with Mock_Valhalla_Server(latency=0) as server:
+        by_pattern = generate_shapes(tmp_path / 'patterns', monkeypatch, patterns, server, match_by_pattern=True)
+        pattern_requests = server.stats['requests']
+
+    assert pattern_requests == len(patterns) == by_pattern.valhalla_stats['requests']
+    assert segment_requests == by_segment.valhalla_stats['requests'] > pattern_requests
+    # every stop is a break point, so the legs of a pattern are the geometries of its segments
+    assert len(by_pattern.shapes) == sum(len(segments) for segments in patterns.values())
+    assert segment_geometries(by_pattern).equals(segment_geometries(by_segment))
+
+
+def unique_segments(patterns):
+    return {(s_name, tuple(coords)) for segments in patterns.values() for s_name, coords in segments.items()}
+
+
+def test_segments_shared_by_patterns_are_requested_once(tmp_path, monkeypatch, patterns):
+    p_name, segments = next(iter(patterns.items()))
+    s_name, coords = next(iter(segments.items()))
+    # the same stop pair with other coordinates, e.g. a stop that moved, is a different segment
+    moved = {'R9-0-0': {s_name: [(lat + 0.001, lon) for lat, lon in coords]}}
+    with Mock_Valhalla_Server(latency=0) as server:
+        shape = generate_shapes(tmp_path, monkeypatch, {**patterns, **moved}, server)
+        requests = server.stats['requests']
+
+    total_segments = sum(len(segments) for segments in patterns.values()) + 1
+    assert requests == len(unique_segments({**patterns, **moved})) == len(unique_segments(patterns)) + 1 < total_segments
+    assert len(shape.shapes) == total_segments
+    geometries = shape.shapes.set_index(['pattern', 'stop_pair'])['geometry']
+    assert geometries[('R9-0-0', s_name)] != geometries[(p_name, s_name)]
+    # every pattern that shares a segment gets the geometry of the same request
+    shared = {}
+    for p, segments in patterns.items():
+        for s, c in segments.items():
+            shared.setdefault((s, tuple(c)), set()).add(geometries[(p, s)])
+    assert max(len(found) for found in shared.values()) == 1
+
+
+def test_segments_of_unmatched_patterns_fall_back_to_segment_requests(tmp_path, monkeypatch, patterns):
+    with Segment_Only_Server(latency=0) as server:
+        shape = generate_shapes(tmp_path, monkeypatch, patterns, server, match_by_pattern=True)
+    assert shape.valhalla_stats['skipped'] == len(patterns)
+    assert shape.valhalla_stats['requests'] == len(patterns) + len(unique_segments(patterns))
+    assert len(shape.shapes) == sum(len(segments) for segments in patterns.values())
+    assert (shape.shapes['distance'] > 0).all()
+
+
+def test_segments_left_out_of_the_pattern_request_fall_back(tmp_path, monkeypatch, patterns):
+    p_name, segments = next(iter(patterns.items()))
+    (s_name, coords), *rest = segments.items()
+    # a segment that starts and ends at the same coordinates, and one that doesn't start at the end of the previous segment
+    loop = ('loop', 'loop')
+    detached = ('detached', 'detached')
+    pattern = {loop: [coords[0], coords[-1], coords[0]], s_name: coords, detached: [(lat + 0.01, lon) for lat, lon in coords], **dict(rest)}
+    with Mock_Valhalla_Server(latency=0) as server:
+        shape = generate_shapes(tmp_path, monkeypatch, {p_name: pattern}, server, match_by_pattern=True)
+    # the loop is matched on its own, the detached segment is a leg of the pattern request
+    assert shape.valhalla_stats['requests'] == 2
+    assert set(shape.shapes['stop_pair'].map(tuple)) == set(pattern)
+
+
+def test_cached_segments_are_not_requested_again(tmp_path, monkeypatch, patterns):
+    with Mock_Valhalla_Server(latency=0) as server:
+        first = generate_shapes(tmp_path, monkeypatch, patterns, server, shape_cache={'enabled': True})
+        first_requests = server.stats['requests']
+        second = generate_shapes(tmp_path, monkeypatch, patterns, server, shape_cache={'enabled': True})
+        assert server.stats['requests'] == first_requests > 0
+    assert segment_geometries(second).equals(segment_geometries(first))
+
+
+def test_segments_not_matched_to_osm_are_matched_again(tmp_path, monkeypatch, patterns):
+    requested = []
+
+    def is_matched(key):
+        # segments from stops with an even last number are matched, the others fall back to their coordinates
+        return int(key[0][0].split('-')[-1]) % 2 == 0
+
+    def match_some_segments(self, segments):
+        requested.append(set(segments))
+        return self.compute_segments({key: coords for key, coords in segments.items() if is_matched(key)})
+
+    monkeypatch.setattr(BaseShape, 'match_segments_with_osm', match_some_segments)
+    monkeypatch.chdir(tmp_path)
+    osm_path = tmp_path / 'extract.osm'
+    osm_path.write_text('<osm version="0.6"></osm>')
+    params = types.SimpleNamespace(backend_config={'osm_matching': {'enabled': True}}, input_paths={'osm': str(osm_path)},
+                                   output_paths={'shapes': str(tmp_path / 'shapes.json'), 'shape_cache': str(tmp_path / 'cache.sqlite')})
+    first = BaseShape(patterns, params=params, check_signal=False, use_valhalla=False)
+    second = BaseShape(patterns, params=params, check_signal=False, use_valhalla=False)
+
+    fallbacks = {key for key in unique_segments(patterns) if not is_matched(key)}
+    assert requested[0] == unique_segments(patterns) and 0 < len(fallbacks) < len(requested[0])
+    # only the fallback geometries are not served from the cache
+    assert requested[1] == fallbacks
+    assert segment_geometries(second).equals(segment_geometries(first))
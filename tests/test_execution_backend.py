@@ -0,0 +1,94 @@
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from backend.helper_functions import to_lean_dtypes, to_standard_dtypes
+from backend.metrics import execution_backend
+from backend.metrics.execution_backend import Execution_Backend, Polars_Execution_Backend, get_execution_backend
+from backend.metrics.group_index import Group_Index
+
+REDUCTIONS = {'mean': ['value'], 'sum': ['count', 'value'], 'max': ['count'], ('quantile', 0.9): ['value'], 'nunique': ['trip_id']}
+
+
+@pytest.fixture
+def table():
+    rng = np.random.default_rng(5)
+    n = 400
+    table = pd.DataFrame({'route_id': rng.choice(['R0', 'R1', 'R2'], n), 'stop_pair': rng.integers(0, 4, n),
+                          'trip_id': rng.choice([f't{i}' for i in range(20)], n), 'count': rng.integers(0, 40, n),
+                          'value': np.round(rng.gamma(2, 3, n), 2)})
+    table.loc[rng.random(n) < 0.1, 'value'] = np.nan
+    # a route that is not served at every stop pair
+    return table[(table['route_id'] != 'R2') | (table['stop_pair'] < 2)].reset_index(drop=True)
+
+
+def backends():
+    yield Execution_Backend()
+    if execution_backend.pl is not None:
+        yield Polars_Execution_Backend(verify=True)
+
+
+def assert_reduced(reduced, expected):
+    assert reduced.keys() == expected.keys()
+    for reduction, values in expected.items():
+        result = reduced[reduction]
+        # keys of lean tables are categorical or small integers
+        result.index = pd.MultiIndex.from_frame(to_standard_dtypes(result.index.to_frame(index=False)))
+        pd.testing.assert_series_equal(result.sort_index(), values, check_names=False, check_dtype=False)
+
+
+def expected_reductions(table, keys):
+    groups = table.groupby(keys)
+    expected = {}
+    for reducer, columns in REDUCTIONS.items():
+        for column in columns:
+            expected[(reducer, column)] = groups[column].quantile(reducer[1]) if isinstance(reducer, tuple) else groups[column].agg(reducer)
+    return expected
+
+
+@pytest.mark.parametrize('backend', list(backends()), ids=lambda backend: backend.name)
+def test_reduce_matches_pandas_groupby(table, backend):
+    assert_reduced(backend.reduce(table, ['route_id', 'stop_pair'], REDUCTIONS), expected_reductions(table, ['route_id', 'stop_pair']))
+
+
+@pytest.mark.parametrize('backend', list(backends()), ids=lambda backend: backend.name)
+def test_reduce_lean_dtypes(table, backend):
+    lean_table = to_lean_dtypes(table.copy(), floats=True)
+    assert lean_table['route_id'].dtype == 'category' and lean_table['value'].dtype == 'float32'
+    # unobserved combinations of categorical keys are no groups, also for unique counts
+    assert_reduced(backend.reduce(lean_table, ['route_id', 'stop_pair'], REDUCTIONS), expected_reductions(table, ['route_id', 'stop_pair']))
+
+
+@pytest.mark.parametrize('backend', list(backends()), ids=lambda backend: backend.name)
+def test_group_reduce_matches_pandas_groupby(table, backend):
+    group_index = Group_Index(table, ['route_id', 'stop_pair'])
+    groups = table.groupby(['route_id', 'stop_pair'])
+    keys = pd.MultiIndex.from_frame(table[['route_id', 'stop_pair']].take(group_index.first_rows()))
+    for reducer, expected in [('sum', groups['value'].sum()), ('sum', groups['count'].sum()), ('max', groups['count'].max()),
+                              (('quantile', 0.5), groups['value'].quantile(0.5))]:
+        column = expected.name
+        np.testing.assert_array_equal(backend.group_reduce(group_index, table[column], reducer), expected.reindex(keys))
+
+
+def test_float32_values_are_reduced_as_stored():
+    table = pd.DataFrame({'trip_id': ['a', 'a'], 'value': np.array([3.55, 3.55], dtype='float32')})
+    backend = Execution_Backend()
+    assert backend.group_reduce(Group_Index(table, ['trip_id']), table['value'], ('quantile', 0.5)).tolist() == [3.55]
+    assert backend.reduce(table, ['trip_id'], {('quantile', 0.5): ['value']})[(('quantile', 0.5), 'value')].round(1).tolist() == [3.6]
+
+
+def test_invalid_reducer(table):
+    with pytest.raises(ValueError):
+        Execution_Backend().group_reduce(Group_Index(table, ['route_id']), table['value'], 'median')
+
+
+def test_get_execution_backend(monkeypatch):
+    params = types.SimpleNamespace(execution_backend='pandas', verify_execution_backend=False)
+    assert type(get_execution_backend(params)) is Execution_Backend
+    with pytest.raises(ValueError):
+        get_execution_backend(types.SimpleNamespace(execution_backend='spark', verify_execution_backend=False))
+    monkeypatch.setattr(execution_backend, 'pl', None)
+    with pytest.raises(ImportError):
+        get_execution_backend(types.SimpleNamespace(execution_backend='polars', verify_execution_backend=False))
@@ -0,0 +1,106 @@
+import itertools
+import types
+
+import pytest
+
+from backend.shapes import geometry_cache
+from backend.shapes.geometry_cache import Segment_Geometry_Cache
+
+CONTEXT = {'source': 'valhalla', 'mode': 'bus'}
+
+
+def segment(i):
+    return [(42.0, -71.0 + 0.001*i), (42.0, -71.0 + 0.001*(i + 1))]
+
+
+def geometry(i, length=10):
+    return {'geometry': str(i) * length, 'distance': 0.1 * i}
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = Segment_Geometry_Cache(str(tmp_path / 'cache.sqlite'), CONTEXT)
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # last_used times that increase with every call, however fast the calls are
+    ticks = itertools.count(1)
+    monkeypatch.setattr(geometry_cache.time, 'time', lambda: next(ticks))
+
+
+def test_hits_and_misses(cache):
+    assert cache.get_many({'a': segment(0)}) == {}
+    cache.put_many({'a': (segment(0), geometry(0)), 'b': (segment(1), geometry(1))})
+    # hits are keyed by the identifiers of the lookup, and segments with the same coordinates share their geometry
+    found = cache.get_many({'x': segment(1), 'y': segment(1), 'z': segment(2)})
+    assert found == {'x': geometry(1), 'y': geometry(1)}
+
+
+def test_geometries_persist_across_connections(tmp_path, cache):
+    cache.put_many({'a': (segment(0), geometry(0))})
+    reopened = Segment_Geometry_Cache(str(tmp_path / 'cache.sqlite'), CONTEXT)
+    assert reopened.get_many({'a': segment(0)}) == {'a': geometry(0)}
+    reopened.close()
+
+
+def test_keys_depend_on_the_context(tmp_path, cache):
+    cache.put_many({'a': (segment(0), geometry(0))})
+    other = Segment_Geometry_Cache(str(tmp_path / 'cache.sqlite'), {**CONTEXT, 'source': 'coordinates'})
+    assert other.get_many({'a': segment(0)}) == {}
+    # the order of the context keys doesn't matter
+    same = Segment_Geometry_Cache(str(tmp_path / 'cache.sqlite'), {'mode': 'bus', 'source': 'valhalla'})
+    assert same.get_many({'a': segment(0)}) == {'a': geometry(0)}
+    other.close()
+    same.close()
+
+
+def test_coordinates_are_rounded_to_the_precision(tmp_path):
+    cache = Segment_Geometry_Cache(str(tmp_path / 'cache.sqlite'), CONTEXT, precision=4)
+    cache.put_many({'a': (segment(0), geometry(0))})
+    moved = [(lat + 0.00001, lon - 0.00002) for lat, lon in segment(0)]
+    assert cache.get_many({'a': moved}) == {'a': geometry(0)}
+    assert cache.get_many({'a': [(lat + 0.001, lon) for lat, lon in segment(0)]}) == {}
+    cache.close()
+
+    precise = Segment_Geometry_Cache(str(tmp_path / 'precise.sqlite'), CONTEXT)
+    precise.put_many({'a': (segment(0), geometry(0))})
+    assert precise.get_many({'a': moved}) == {}
+    precise.close()
+
+
+def test_least_recently_used_segments_are_evicted(tmp_path, clock):
+    # every entry takes 1000 bytes: a 40 character key, the geometry and 8 bytes for the distance
+    cache = Segment_Geometry_Cache(str(tmp_path / 'cache.sqlite'), CONTEXT, max_size_mb=3500 / (1024 * 1024))
+    for i in range(3):
+        cache.put_many({i: (segment(i), geometry(i, 952))})
+    # segment 0 is used again, so segment 1 is the least recently used
+    cache.get_many({0: segment(0)})
+    cache.put_many({3: (segment(3), geometry(3, 952))})
+
+    # 4000 bytes are more than the maximum, the oldest entries are evicted until at most 3150 bytes are left
+    assert set(cache.get_many({i: segment(i) for i in range(4)})) == {0, 2, 3}
+    cache.close()
+
+
+def test_cache_within_max_size_is_not_evicted(cache):
+    cache.put_many({i: (segment(i), geometry(i)) for i in range(100)})
+    cache.evict()
+    assert len(cache.get_many({i: segment(i) for i in range(100)})) == 100
+
+
+@pytest.mark.parametrize('shape_cache, output_paths', [({'enabled': False}, {'shape_cache': 'cache.sqlite'}), ({}, {})])
+def test_from_params_without_cache(shape_cache, output_paths):
+    params = types.SimpleNamespace(backend_config={'shape_cache': shape_cache}, output_paths=output_paths)
+    assert Segment_Geometry_Cache.from_params(params, CONTEXT) is None
+
+
+def test_from_params(tmp_path):
+    params = types.SimpleNamespace(backend_config={'shape_cache': {'precision': 5, 'max_size_mb': 1}},
+                                   output_paths={'shape_cache': str(tmp_path / 'cache' / 'cache.sqlite')})
+    cache = Segment_Geometry_Cache.from_params(params, CONTEXT)
+    assert (cache.precision, cache.max_size) == (5, 1024 * 1024)
+    assert (tmp_path / 'cache' / 'cache.sqlite').exists()
+    cache.close()
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from backend.shapes.geometry_utils import decode_polylines, encode_polylines, segment_lengths, simplify_polylines
+
+# the example of the encoded polyline algorithm format
+EXAMPLE_COORDS = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+EXAMPLE_POLYLINE = '_p~iF~ps|U_ulLnnqC_mqNvxq`@'
+
+
+def test_encode_example():
+    assert encode_polylines([EXAMPLE_COORDS], precision=5) == [EXAMPLE_POLYLINE]
+    np.testing.assert_allclose(decode_polylines([EXAMPLE_POLYLINE], precision=5)[0], EXAMPLE_COORDS)
+
+
+def test_round_trip_of_many_lines():
+    rng = np.random.default_rng(4)
+    coords_list = [np.round(rng.uniform([-90, -180], [90, 180], (n, 2)), 6) for n in [3, 0, 1, 2, 0, 50]]
+    polylines = encode_polylines(coords_list)
+    assert polylines[1] == polylines[4] == ''
+    assert polylines == [encode_polylines([coords])[0] for coords in coords_list]
+
+    decoded = decode_polylines(polylines)
+    assert [coords.shape for coords in decoded] == [coords.shape for coords in coords_list]
+    for coords, expected in zip(decoded, coords_list):
+        np.testing.assert_allclose(coords, expected, atol=1e-9)
+    np.testing.assert_allclose(decode_polylines(polylines, geojson=True)[0], coords_list[0][:, ::-1], atol=1e-9)
+
+
+def test_empty_polylines():
+    assert encode_polylines([]) == []
+    assert encode_polylines([[], []]) == ['', '']
+    assert [coords.shape for coords in decode_polylines(['', ''])] == [(0, 2), (0, 2)]
+
+
+def test_segment_lengths():
+    coords_list = [[(42.0, -71.0), (42.0, -70.99), (42.01, -70.99)], [(42.0, -71.0)], []]
+    geodesic = segment_lengths(coords_list)
+    haversine = segment_lengths(coords_list, method='haversine')
+    # the pair of points that spans the first and second line is not counted
+    assert geodesic[1:].tolist() == [0, 0]
+    np.testing.assert_allclose(geodesic[0], 0.8285 + 1.1106, atol=1e-3)
+    np.testing.assert_allclose(haversine, geodesic, rtol=5e-3)
+    with pytest.raises(ValueError):
+        segment_lengths(coords_list, method='euclidean')
+
+
+def test_simplify_polylines():
+    coords = [(42.0, -71.0), (42.000001, -70.995), (42.0, -70.99), (42.01, -70.99)]
+    simplified = simplify_polylines(encode_polylines([coords, coords[:2]]), tolerance=1)
+    assert decode_polylines(simplified)[0].tolist() == [list(coords[i]) for i in [0, 2, 3]]
+    assert simplified[1] == encode_polylines([coords[:2]])[0]
+
+
+def test_same_as_polyline():
+    polyline = pytest.importorskip('polyline')
+    rng = np.random.default_rng(5)
+    coords_list = [[tuple(coord) for coord in rng.uniform([-90, -180], [90, 180], (n, 2))] for n in [1, 2, 30]]
+    assert encode_polylines(coords_list) == [polyline.encode(coords, 6) for coords in coords_list]
+    for coords, polyline_string in zip(decode_polylines(encode_polylines(coords_list)), encode_polylines(coords_list)):
+        np.testing.assert_allclose(coords, polyline.decode(polyline_string, 6), atol=1e-9)
@@ -0,0 +1,70 @@
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from backend.data_class.gps_pings import GPS_Ping_Inference, pattern_geometry
+
+from conftest import PING_STOP_IDS, make_pings
+
+
+def ping_inference(bus_gtfs, **ping_config):
+    ping_config.setdefault('workers', 1)
+    return GPS_Ping_Inference(types.SimpleNamespace(backend_config={'gps_pings': ping_config}), bus_gtfs)
+
+
+def test_pattern_geometry():
+    _, bus_gtfs = make_pings()
+    geometry = pattern_geometry(bus_gtfs.patterns_dict['R0-0-0'], 5)
+    assert geometry['stop_ids'].tolist() == PING_STOP_IDS
+    np.testing.assert_allclose(np.diff(geometry['stop_positions']), 413.2, atol=0.1)
+    assert (np.diff(geometry['positions']) <= 5 + 1e-9).all()
+    assert geometry['positions'][-1] == geometry['stop_positions'][-1]
+
+
+def test_stop_events_are_inferred():
+    pings, bus_gtfs = make_pings(start=1683000000)
+    stop_events = ping_inference(bus_gtfs).infer_stop_events(pings)
+
+    assert stop_events['stop_id'].tolist() == PING_STOP_IDS
+    assert stop_events['stop_sequence'].tolist() == [1, 2, 3, 4]
+    # arrivals at A, B (not at the off-pattern ping) and D are observed, the pass of C is interpolated
+    expected_times = pd.to_datetime(1683000000 + pd.Series([0, 40, 85, 120]), unit='s')
+    assert (stop_events['stop_time'] == expected_times).all()
+    np.testing.assert_allclose(stop_events['dwell_time'], [0, 20, 0, 0], atol=1e-9)
+    assert (stop_events[['passenger_on', 'passenger_off', 'passenger_load', 'seat_capacity']] == 0).all().all()
+
+
+def test_runs_of_a_trip_are_split_by_time_gaps():
+    pings, bus_gtfs = make_pings()
+    next_day = pings.assign(timestamp=pings['timestamp'] + 86400)
+    stop_events = ping_inference(bus_gtfs).infer_stop_events(pd.concat([next_day, pings], ignore_index=True))
+    assert stop_events['stop_sequence'].tolist() == [1, 2, 3, 4] * 2
+    assert stop_events['stop_time'].is_monotonic_increasing
+
+
+def test_chunks_give_the_same_stop_events():
+    pings, bus_gtfs = make_pings()
+    runs = pd.concat([pings.assign(timestamp=pings['timestamp'] + day * 86400) for day in range(5)], ignore_index=True)
+    stop_events = ping_inference(bus_gtfs).infer_stop_events(runs)
+    pd.testing.assert_frame_equal(ping_inference(bus_gtfs, chunk_size=20).infer_stop_events(runs), stop_events)
+
+
+def test_pings_of_unknown_trips():
+    pings, bus_gtfs = make_pings()
+    unknown = pings.assign(trip_id='t9')
+    stop_events = ping_inference(bus_gtfs).infer_stop_events(pd.concat([pings, unknown], ignore_index=True))
+    assert stop_events['trip_id'].unique().tolist() == ['t1']
+    with pytest.raises(ValueError):
+        ping_inference(bus_gtfs).infer_stop_events(unknown)
+
+
+def test_convert_timestamp():
+    _, bus_gtfs = make_pings()
+    inference = ping_inference(bus_gtfs)
+    assert inference.convert_timestamp(pd.Series(['2023-05-01 06:00:00'])).tolist() == [1682920800]
+    assert inference.convert_timestamp(pd.Series(['1682920800'])).tolist() == [1682920800]
+    # epoch seconds in UTC to local time
+    local_inference = ping_inference(bus_gtfs, timezone='America/New_York')
+    assert local_inference.convert_timestamp(pd.Series([1682935200])).tolist() == [1682920800]
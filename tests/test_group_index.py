@@ -0,0 +1,142 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from backend.metrics.group_index import Group_Index, Group_Index_Cache
+
+
+@pytest.fixture
+def table():
+    rng = np.random.default_rng(3)
+    n = 500
+    table = pd.DataFrame({'trip_id': rng.choice(['t1', 't2', 't3', 't4', None], n), 'svc_date': rng.choice(['d1', 'd2'], n),
+                          'stop_time': rng.permutation(n), 'value': np.round(rng.gamma(2, 3, n), 2), 'count': rng.integers(0, 5, n),
+                          'tp_bp': rng.integers(0, 2, n)})
+    table.loc[rng.random(n) < 0.1, 'value'] = np.nan
+    return table
+
+
+def grouped(table, keys=['svc_date', 'trip_id']):
+    return table.groupby(keys)
+
+
+def by_group(group_index, table, values, keys=['svc_date', 'trip_id']):
+    """Values of a pandas groupby reduction in the order of the groups of the index."""
+    return values.reindex(pd.MultiIndex.from_frame(table[keys].take(group_index.first_rows())))
+
+
+def test_row_operations_match_pandas(table):
+    group_index = Group_Index(table, ['svc_date', 'trip_id'])
+    groups = grouped(table)
+    # rows with missing keys are compared in test_rows_with_missing_keys_belong_to_no_group, pandas drops them from some results and 
+    # leaves them uninitialized in integer cumulative sums
+    has_group = table['trip_id'].notna().to_numpy()
+    for result, expected in [(group_index.shift(table['value']), groups['value'].shift(1)),
+                             (group_index.shift(table['value'], -2), groups['value'].shift(-2)),
+                             (group_index.diff(table['value']), groups['value'].diff()),
+                             (group_index.ffill(table['value']), groups['value'].ffill()),
+                             (group_index.cumsum(table['value']), groups['value'].cumsum()),
+                             (group_index.cumsum(table['count']), groups['count'].cumsum())]:
+        np.testing.assert_array_equal(result[has_group], expected.reindex(table.index)[has_group])
+
+
+def test_rows_with_missing_keys_belong_to_no_group(table):
+    group_index = Group_Index(table, ['svc_date', 'trip_id'])
+    is_missing = table['trip_id'].isna().to_numpy()
+    assert is_missing.any()
+    assert np.isnan(group_index.cumsum(table['count'])[is_missing]).all()
+    assert np.isnan(group_index.broadcast(group_index.sum(table['count']))[is_missing]).all()
+    assert group_index.order.shape[0] == (~is_missing).sum()
+
+
+def test_reductions_match_pandas(table):
+    group_index = Group_Index(table, ['svc_date', 'trip_id'])
+    groups = grouped(table)
+    np.testing.assert_array_equal(group_index.sum(table['value']), by_group(group_index, table, groups['value'].sum()))
+    np.testing.assert_array_equal(group_index.sum(table['count']), by_group(group_index, table, groups['count'].sum()))
+    np.testing.assert_array_equal(group_index.max(table['value']), by_group(group_index, table, groups['value'].max()))
+    for q in [0, 0.5, 0.9, 1]:
+        np.testing.assert_array_equal(group_index.quantile(table['value'], q), by_group(group_index, table, groups['value'].quantile(q)))
+    keys = table[['svc_date', 'trip_id']]
+    pd.testing.assert_frame_equal(keys.take(group_index.last_rows()).reset_index(drop=True), 
+                                  keys.take(group_index.first_rows()).reset_index(drop=True))
+    assert group_index.starts.shape[0] == groups.ngroups
+
+
+def test_sum_of_lean_dtypes():
+    table = pd.DataFrame({'trip_id': ['a'] * 3, 'count': np.array([100, 100, 100], dtype='int8'),
+                          'value': np.array([0.1, 0.2, 0.3], dtype='float32')})
+    group_index = Group_Index(table, ['trip_id'])
+    # int8 counts don't overflow and float32 values are summed in float64
+    assert group_index.sum(table['count']).tolist() == [300]
+    assert group_index.sum(table['value']).dtype == np.float64
+
+
+def test_exact_sums(table):
+    trips = Group_Index(table, ['svc_date', 'trip_id'])
+    tpbp_groups = trips.split(trips.cumsum(table['tp_bp']))
+    value_sums, count_sums = tpbp_groups.exact_sums([table['value'], table['count']], [2, 0])
+    tpbp_group = grouped(table)['tp_bp'].cumsum()
+    groups = table.groupby([table['svc_date'], table['trip_id'], tpbp_group])
+    hundredths = (table['value'].fillna(0) * 100).round().astype('int64').groupby([table['svc_date'], table['trip_id'], tpbp_group])
+    np.testing.assert_array_equal(tpbp_groups.broadcast(value_sums), (hundredths.transform('sum') / 100).reindex(table.index))
+    np.testing.assert_array_equal(tpbp_groups.broadcast(value_sums), groups['value'].transform('sum').round(2).reindex(table.index))
+    assert count_sums.dtype == np.int64
+    np.testing.assert_array_equal(tpbp_groups.broadcast(count_sums), groups['count'].transform('sum').reindex(table.index))
+    # the sums don't depend on the summation order
+    reversed_table = table.iloc[::-1]
+    reversed_trips = Group_Index(reversed_table, ['trip_id'])
+    trip_sums = (table['value'].fillna(0) * 100).round().astype('int64').groupby(table['trip_id']).sum() / 100
+    trip_ids = reversed_table['trip_id'].take(reversed_trips.first_rows())
+    np.testing.assert_array_equal(reversed_trips.exact_sums([reversed_table['value']], [2])[0], trip_sums[trip_ids])
+
+
+def test_sort_column(table):
+    group_index = Group_Index(table, ['trip_id'], sort_column='stop_time')
+    sorted_table = table.sort_values(['trip_id', 'stop_time'])
+    expected = sorted_table.groupby('trip_id')['stop_time'].diff().reindex(table.index)
+    np.testing.assert_array_equal(group_index.diff(table['stop_time']), expected)
+
+
+def test_split(table):
+    trips = Group_Index(table, ['svc_date', 'trip_id'])
+    tpbp_groups = trips.split(trips.cumsum(table['tp_bp']))
+    tpbp_group = grouped(table)['tp_bp'].cumsum()
+    expected = table.groupby([table['svc_date'], table['trip_id'], tpbp_group])['value'].transform('sum')
+    np.testing.assert_array_equal(tpbp_groups.broadcast(tpbp_groups.sum(table['value'])), expected.reindex(table.index))
+
+
+def test_subset(table):
+    trips = Group_Index(table, ['svc_date', 'trip_id'])
+    mask = (table['count'] > 1).to_numpy()
+    subset = table[mask]
+    subset_index = trips.subset(subset, mask)
+    np.testing.assert_array_equal(subset_index.cumsum(subset['value']), grouped(subset)['value'].cumsum().reindex(subset.index))
+
+
+def test_empty_table():
+    table = pd.DataFrame({'trip_id': pd.Series([], dtype=object), 'value': pd.Series([], dtype=float)})
+    group_index = Group_Index(table, ['trip_id'])
+    assert group_index.sum(table['value']).shape == (0,)
+    assert group_index.max(table['value']).shape == (0,)
+    assert group_index.quantile(table['value'], 0.5).shape == (0,)
+    assert group_index.cumsum(table['value']).shape == (0,)
+
+
+def test_all_missing_values():
+    table = pd.DataFrame({'trip_id': ['a', 'a', 'b'], 'value': [np.nan, np.nan, 1.0]})
+    group_index = Group_Index(table, ['trip_id'])
+    assert group_index.sum(table['value']).tolist() == [0.0, 1.0]
+    np.testing.assert_array_equal(group_index.quantile(table['value'], 0.5), [np.nan, 1.0])
+
+
+def test_cache(table):
+    cache = Group_Index_Cache()
+    group_index = Group_Index(table, ['trip_id'])
+    cache.put(table, 'trip_id', group_index)
+    assert cache.get(table, 'trip_id') is group_index
+    assert cache.get(table.copy(), 'trip_id') is None
+    # indexes are not pickled, e.g. to worker processes
+    assert pickle.loads(pickle.dumps(cache)).get(table, 'trip_id') is None
@@ -0,0 +1,88 @@
+import datetime
+import types
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from backend.data_class import GTFS
+from backend.metrics import Metric_Aggregation, Metric_Calculation
+
+from conftest import assert_same_outputs, make_params
+
+# a shorter day keeps the number of 10-min intervals small
+PERIOD_RANGES = {'full': [5, 7], 'am': [6, 7]}
+
+
+def seconds_to_gtfs_time(seconds):
+    return f'{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+
+@pytest.fixture(scope='module')
+def feed_path(records, tmp_path_factory):
+    """GTFS feed of the conftest GTFS records, in a zip file."""
+    gtfs_records, _, _ = records
+    rng = np.random.default_rng(7)
+    stop_ids = gtfs_records['stop_id'].unique()
+    tables = {
+        'agency': pd.DataFrame({'agency_id': ['A'], 'agency_name': ['Agency'], 'agency_url': ['https://example.com'],
+                                'agency_timezone': ['America/New_York']}),
+        'calendar': pd.DataFrame({'service_id': ['wk'], **{day: [1] for day in ['monday', 'tuesday', 'wednesday', 'thursday', 'friday']},
+                                  'saturday': [0], 'sunday': [0], 'start_date': ['20230501'], 'end_date': ['20230531']}),
+        'stops': pd.DataFrame({'stop_id': stop_ids, 'stop_code': stop_ids, 'stop_name': [f'Stop {stop_id}' for stop_id in stop_ids],
+                               'stop_lat': 42.3 + rng.uniform(0, 0.1, len(stop_ids)), 'stop_lon': -71.1 + rng.uniform(0, 0.1, len(stop_ids)),
+                               'wheelchair_boarding': 1}),
+        'routes': pd.DataFrame({'route_id': gtfs_records['route_id'].unique(), 'agency_id': 'A', 'route_type': 3}),
+        'trips': gtfs_records[['route_id', 'service_id', 'trip_id', 'direction_id']].drop_duplicates(),
+        'stop_times': gtfs_records[['trip_id', 'stop_id', 'stop_sequence', 'timepoint']].assign(
+                            arrival_time=gtfs_records['arrival_time'].map(seconds_to_gtfs_time),
+                            departure_time=gtfs_records['departure_time'].map(seconds_to_gtfs_time))
+    }
+    path = tmp_path_factory.mktemp('gtfs') / 'gtfs.zip'
+    with zipfile.ZipFile(path, 'w') as feed:
+        for name, table in tables.items():
+            feed.writestr(f'{name}.txt', table.to_csv(index=False))
+    return str(path)
+
+
+def gtfs_params(feed_path, out_dir):
+    return types.SimpleNamespace(backend_config={'route_type': {'bus': ['3']}}, input_paths={'gtfs': feed_path}, lean_dtypes=False,
+                                 date_list=[datetime.date(2023, 5, 1), datetime.date(2023, 5, 2)],
+                                 output_paths={'timepoints': str(out_dir / 'timepoints.json'), 'stop_name_lookup': str(out_dir / 'lookup.json')})
+
+
+@pytest.fixture(scope='module')
+def gtfs(feed_path, tmp_path_factory):
+    return {lean: GTFS(gtfs_params(feed_path, tmp_path_factory.mktemp('lean' if lean else 'standard')), shape_gen=False, lean=lean)
+            for lean in [False, True]}
+
+
+def test_lean_releases_raw_and_validated_data(gtfs):
+    standard, lean = gtfs[False], gtfs[True]
+    assert lean.raw_data is None and lean.validated_data is None
+    assert standard.raw_data is not None and set(standard.validated_data) == {'stops', 'routes', 'trips', 'stop_times'}
+    # the stop coordinates are kept without the other columns of the stops table
+    assert list(lean.stop_coords.columns) == ['stop_id', 'stop_code', 'stop_lat', 'stop_lon']
+    pd.testing.assert_frame_equal(lean.stop_coords, standard.stop_coords[lean.stop_coords.columns])
+    pd.testing.assert_frame_equal(lean.stops, standard.stops)
+    assert (lean.stop_ids, lean.trip_ids) == (standard.stop_ids, standard.trip_ids)
+    # the raw tables of the standard run are not modified by validation
+    assert standard.validated_data['stops'] is not standard.raw_data['stops']
+
+
+def test_lean_gives_the_same_records_and_metrics(gtfs, records, tmp_path):
+    standard, lean = gtfs[False], gtfs[True]
+    pd.testing.assert_frame_equal(lean.records, standard.records)
+    assert lean.patterns_dict == standard.patterns_dict
+
+    _, avl_records, _ = records
+    shapes = pd.DataFrame([{'pattern': pattern, 'stop_pair': stop_pair, 'distance': 0.3}
+                           for pattern, segments in standard.patterns_dict.items() for stop_pair in segments])
+    outputs = []
+    for name, run in [('standard', standard), ('lean', lean)]:
+        params = make_params(tmp_path / name, frontend_config={'periodRanges': PERIOD_RANGES, 'units': {}})
+        Metric_Aggregation(Metric_Calculation(shapes, run.records.copy(), avl_records.copy(), params), params)
+        outputs.append(params)
+    assert_same_outputs(*outputs)
+
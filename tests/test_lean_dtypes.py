@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from backend.helper_functions import is_restored_from_float32, restore_float32, to_lean_dtypes, to_standard_dtypes
+from backend.metrics import Metric_Aggregation, Metric_Calculation
+
+from conftest import assert_same_outputs, make_params, make_records, random_routes
+
+
+def test_restore_float32():
+    values = pd.Series([3.55, 4760.5, 0.07, np.nan, np.inf], index=[5, 6, 7, 8, 9], name='observed_running_time')
+    restored = restore_float32(values.astype('float32'))
+    pd.testing.assert_series_equal(restored, values)
+    np.testing.assert_array_equal(restore_float32(values.to_numpy(dtype='float32')), values.to_numpy())
+    assert restore_float32(values) is values
+
+
+def test_is_restored_from_float32():
+    assert is_restored_from_float32(pd.Series([3.55, 12.1, np.nan]))
+    # float errors of sums, more than two decimals, or too large for float32 to hold two decimals
+    assert not is_restored_from_float32(pd.Series([0.1 + 0.2]))
+    assert not is_restored_from_float32(pd.Series([1/3]))
+    assert not is_restored_from_float32(pd.Series([300000.01]))
+
+
+def test_lean_and_standard_dtypes():
+    table = pd.DataFrame({'route_id': ['R0', 'R1', 'R0'], 'stop_time': [18000, 18150, 18300], 'passenger_load': [3, 0, 40000],
+                          'arrival_time': [18000.0, np.nan, 18300.0], 'observed_running_time': [3.55, 2.5, 1.01],
+                          'observed_headway': [0.1 + 0.2, 1.0, 2.0], 'stop_pair': np.array([1, 2, 3], dtype='int64')})
+    standard = table.copy()
+    to_lean_dtypes(table, floats=True)
+    assert table.dtypes.astype(str).to_dict() == {'route_id': 'category', 'stop_time': 'int32', 'passenger_load': 'int64', 
+                                                  'arrival_time': 'float32', 'observed_running_time': 'float32', 
+                                                  'observed_headway': 'float64', 'stop_pair': 'int64'}
+    pd.testing.assert_frame_equal(to_standard_dtypes(table), standard)
+
+
+@pytest.fixture(scope='module')
+def lean_records():
+    return make_records(random_routes(12), trips_per_pattern=12)
+
+
+@pytest.mark.parametrize('execution_backend', ['pandas', 'polars'])
+def test_lean_outputs_are_standard_outputs(lean_records, tmp_path, execution_backend):
+    if execution_backend == 'polars':
+        pytest.importorskip('polars')
+    gtfs_records, avl_records, shapes_data = lean_records
+    standard = make_params(tmp_path / 'standard', execution_backend=execution_backend)
+    Metric_Aggregation(Metric_Calculation(shapes_data, gtfs_records.copy(), avl_records.copy(), standard), standard)
+
+    lean = make_params(tmp_path / 'lean', execution_backend=execution_backend, lean_dtypes=True)
+    lean_gtfs_records = to_lean_dtypes(gtfs_records.copy(), exclude=['trip_id', 'stop_id'])
+    lean_avl_records = to_lean_dtypes(avl_records.copy(), exclude=['trip_id', 'stop_id'])
+    metrics = Metric_Calculation(shapes_data, lean_gtfs_records, lean_avl_records, lean)
+    assert (metrics.avl_stop_metrics.dtypes == 'float32').any()
+    Metric_Aggregation(metrics, lean)
+
+    assert_same_outputs(lean, standard)
@@ -0,0 +1,243 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from backend.metrics import Metric_Aggregation, Metric_Calculation
+from backend.metrics.wmata.wmata_metric_aggregation import WMATA_Metric_Aggregation
+
+from conftest import assert_same_outputs, make_params
+
+# a shorter day keeps the number of 10-min intervals small
+PERIOD_RANGES = {'full': [5, 7], 'am': [6, 7]}
+
+
+class Legacy_Metric_Aggregation(Metric_Aggregation):
+    """Aggregation with one groupby per metric and level, as before the metric registry. The metric methods are those of the
+    previous Metric_Aggregation, written with a loop over the aggregation levels.
+    """
+
+    def aggregate_metrics(self, percentile:int):
+
+        self.sample_size()
+        self.stop_spacing()
+        self.service_start_end()
+        self.revenue_hour()
+
+        self.headway(percentile, 'scheduled')
+        self.frequency('scheduled')
+        self.wait_time('scheduled')
+        self.running_time(percentile, 'scheduled')
+        self.speed(percentile, 'scheduled_speed_without_dwell')
+
+        if 'AVL' in self.data_option:
+            self.headway(percentile, 'observed')
+            self.frequency('observed')
+            self.running_time(percentile, 'observed')
+            self.speed(percentile, 'observed_speed_without_dwell')
+            self.speed(percentile, 'observed_speed_with_dwell')
+            self.boardings(percentile)
+            self.on_time_performance()
+            self.crowding()
+            self.passenger_load(percentile)
+            self.wait_time('observed')
+            self.excess_wait_time()
+            self.passenger_flow()
+            self.congestion_delay()
+            self.productivity()
+
+    def levels(self, source:str, time_filtered:bool=True):
+        """Aggregated metrics table, metrics table and key columns of each aggregation level."""
+
+        suffix = '_time_filtered' if time_filtered else ''
+        stop, route, tpbp = [getattr(self, f'{source}_{kind}_metrics{suffix}') for kind in ['stop', 'route', 'tpbp']]
+        return [(self.segments, stop, self.SEGMENT_MULTIINDEX), (self.corridors, stop, self.CORRIDOR_MULTIINDEX),
+                (self.routes, route, self.ROUTE_MULTIINDEX), (self.tpbp_segments, tpbp, self.SEGMENT_MULTIINDEX),
+                (self.tpbp_corridors, tpbp, self.CORRIDOR_MULTIINDEX)]
+
+    def percentile(self, p:int, metric_name:str) -> float:
+
+        red_value_at_10th_perc = (metric_name not in self.redValues) or (self.redValues[metric_name] == 'Low')
+        return ((100 - p) if red_value_at_10th_perc else p) / 100
+
+    def sample_size(self):
+
+        for table, records, keys in self.levels('gtfs'):
+            table['sample_size'] = records.groupby(keys)['trip_id'].nunique().round(0)
+
+    def stop_spacing(self):
+
+        for table, records, keys in self.levels('gtfs', time_filtered=False):
+            table['stop_spacing'] = records.groupby(keys)['stop_spacing'].mean().round(0).fillna(0).astype(int)
+        self.metrics_names['stop_spacing'] = 'Stop Spacing (ft)'
+
+    def service_start_end(self):
+
+        for table, records, keys in self.levels('gtfs', time_filtered=False):
+            start, end = ('trip_start_time', 'trip_end_time') if keys == self.ROUTE_MULTIINDEX else ('arrival_time', 'arrival_time')
+            table['service_start'] = (records.groupby(keys)[start].agg('min')/3600).round(2)
+            table['service_end'] = (records.groupby(keys)[end].agg('max')/3600).round(2)
+        self.metrics_names['service_start'] = 'Service Start (hr)'
+        self.metrics_names['service_end'] = 'Service End (hr)'
+
+    def revenue_hour(self):
+
+        for table, _, _ in self.levels('gtfs'):
+            table['revenue_hour'] = (table['service_end'] - table['service_start']).round(2)
+        self.metrics_names['revenue_hour'] = 'Revenue Hour (hr)'
+
+    def quantile_metric(self, percentile:int, metric_name:str, sig_fig:int, clip:bool=False):
+
+        source = 'gtfs' if metric_name.startswith('scheduled') else 'avl'
+        q = self.percentile(percentile, metric_name)
+        for table, records, keys in self.levels(source):
+            values = records.groupby(keys)[metric_name].quantile(q)
+            if clip:
+                values = values.clip(lower=self.speed_range['min'], upper=self.speed_range['max'])
+            table[metric_name] = values.round(sig_fig)
+
+    def headway(self, percentile:int, data_type:str):
+
+        self.quantile_metric(percentile, f'{data_type}_headway', 0)
+        self.metrics_names[f'{data_type}_headway'] = f'{data_type.capitalize()} Headway (min)'
+
+    def frequency(self, data_type:str):
+
+        for table, _, _ in self.levels('gtfs'):
+            table[f'{data_type}_frequency'] = (60 / table[f'{data_type}_headway']).round(1)
+        self.metrics_names[f'{data_type}_frequency'] = f'{data_type.capitalize()} Freq. (/hr)'
+
+    def running_time(self, percentile:int, data_type:str):
+
+        self.quantile_metric(percentile, f'{data_type}_running_time', 1)
+        self.metrics_names[f'{data_type}_running_time'] = f'{data_type.capitalize()} Running Time (min)'
+
+    def speed(self, percentile:int, metric_name:str):
+
+        self.quantile_metric(percentile, metric_name, 0, clip=True)
+        data_type, dwell = metric_name.split('_speed_')
+        self.metrics_names[metric_name] = f'{data_type.capitalize()} Speed {dwell.title()} (mph)'
+
+    def wait_time(self, data_type:str):
+
+        stop_metrics = getattr(self, f"{'gtfs' if data_type == 'scheduled' else 'avl'}_stop_metrics_time_filtered")
+        headway = stop_metrics.groupby(self.SEGMENT_MULTIINDEX)[f'{data_type}_headway']
+        mean = headway.agg('mean').fillna(0)
+        self.segments[f'{data_type}_wait_time'] = ((mean / 2) + (headway.agg('var') / (2 * mean))).clip(upper=300).round(0)
+        self.metrics_names[f'{data_type}_wait_time'] = f'{data_type.capitalize()} Wait (min)'
+
+    def excess_wait_time(self):
+
+        self.segments['excess_wait_time'] = (self.segments['observed_wait_time'] - self.segments['scheduled_wait_time']).clip(lower=0)
+        self.metrics_names['excess_wait_time'] = 'Excess Wait (min)'
+
+    def boardings(self, percentile:int):
+
+        self.quantile_metric(percentile, 'boardings', 0)
+        self.metrics_names['boardings'] = 'Boardings (pax)'
+
+    def on_time_performance(self):
+
+        self.segments['on_time_performance'] = self.avl_stop_metrics_time_filtered.groupby(self.SEGMENT_MULTIINDEX)['on_time_performance'].mean().round(0)
+        self.routes['on_time_performance'] = self.avl_route_metrics_time_filtered.groupby(self.ROUTE_MULTIINDEX)['on_time_performance'].mean().round(0)
+        self.metrics_names['on_time_performance'] = 'On Time Performance (sec)'
+
+    def crowding(self):
+
+        self.segments['crowding'] = self.avl_stop_metrics_time_filtered.groupby(self.SEGMENT_MULTIINDEX)['crowding'].mean().round(0)
+        # stop-aggregated boardings are replaced by their mean
+        self.corridors['boardings'] = self.avl_stop_metrics_time_filtered.groupby(self.CORRIDOR_MULTIINDEX)['boardings'].mean().round(0)
+        self.routes['crowding'] = self.avl_route_metrics_time_filtered.groupby(self.ROUTE_MULTIINDEX)['crowding'].mean().round(0)
+        self.metrics_names['crowding'] = 'Crowding (% of seated capacity)'
+
+    def passenger_load(self, percentile:int):
+
+        self.segments['passenger_load'] = self.avl_stop_metrics_time_filtered.groupby(self.SEGMENT_MULTIINDEX)['passenger_load']\
+                                            .quantile(self.percentile(percentile, 'passenger_load')).round(0)
+        self.metrics_names['passenger_load'] = 'Passenger Load (pax)'
+
+    def passenger_flow(self):
+
+        for table, keys in [(self.segments, self.SEGMENT_MULTIINDEX), (self.corridors, self.CORRIDOR_MULTIINDEX)]:
+            table['passenger_flow'] = (self.avl_stop_metrics_time_filtered.groupby(keys)['passenger_load'].sum() / table['revenue_hour']).round(0)
+        self.metrics_names['passenger_flow'] = 'Passenger Flow (pax/hr)'
+
+    def congestion_delay(self):
+
+        for metric_name in ['vehicle_congestion_delay', 'passenger_congestion_delay']:
+            self.segments[metric_name] = self.avl_stop_metrics_time_filtered.groupby(self.SEGMENT_MULTIINDEX)[metric_name].mean().round(0)
+        self.metrics_names['vehicle_congestion_delay'] = 'Vehicle Congestion Delay (min/mi)'
+        self.metrics_names['passenger_congestion_delay'] = 'Passenger Congestion Delay (pax-min/mi)'
+
+    def productivity(self):
+
+        self.routes['productivity'] = (self.avl_route_metrics.groupby(self.ROUTE_MULTIINDEX)['boardings'].sum() / self.routes['revenue_hour']).round(0)
+        self.metrics_names['productivity'] = 'Productivity (pax/rev.hr)'
+
+
+class Legacy_WMATA_Metric_Aggregation(Legacy_Metric_Aggregation):
+    """WMATA aggregation as before the metric registry."""
+
+    def aggregate_metrics(self, percentile:int):
+
+        super().aggregate_metrics(percentile)
+        self.segments['in_efc'] = self.gtfs_stop_metrics.groupby(self.SEGMENT_MULTIINDEX)['in_efc'].max()
+        self.metrics_names['in_efc'] = 'Inside EFC (1: in, 0: out)'
+        if 'AVL' in self.data_option:
+            self.schedule_sufficiency_index()
+
+    def on_time_performance(self):
+
+        for table, records in [(self.segments, self.avl_stop_metrics_time_filtered), (self.tpbp_segments, self.avl_tpbp_metrics_time_filtered)]:
+            table['on_time_performance_stop_tpbp'] = (records.groupby(self.SEGMENT_MULTIINDEX)['is_on_time'].mean() * 100).round(0)
+        self.routes['on_time_performance_perc'] = self.avl_route_metrics_time_filtered.groupby(self.ROUTE_MULTIINDEX)['on_time_performance'].mean().round(0)
+        self.metrics_names['on_time_performance_stop_tpbp'] = 'On Time Performance (% of trips on time)'
+        self.metrics_names['on_time_performance_perc'] = 'On Time Performance (% of timepoints)'
+
+    def schedule_sufficiency_index(self):
+
+        def ssi_calculation(records:pd.DataFrame, by_trips_cols:list) -> pd.DataFrame:
+            data_by_trips = records.groupby(by_trips_cols)['observed_running_time_with_dwell'].agg('mean').to_frame(name = 'mean')
+            data_by_trips['std'] = records.groupby(by_trips_cols)['observed_running_time_with_dwell'].std()
+            data_by_trips['cov'] = data_by_trips['std'] / data_by_trips['mean']
+            data_by_trips['count'] = records.groupby(by_trips_cols)['observed_running_time_with_dwell'].count()
+            data_by_trips['total_trips'] = data_by_trips.groupby([item for item in by_trips_cols if item not in ['trip_id']])['count'].transform('sum')
+            data_by_trips['weight'] = data_by_trips['count'] / data_by_trips['total_trips']
+            data_by_trips['weighted_cov'] = data_by_trips['weight'] * data_by_trips['cov']
+            return data_by_trips
+
+        for table, records, keys in self.levels('avl')[:3]:
+            table['ssi'] = ssi_calculation(records, ['trip_id'] + keys).groupby(keys)['weighted_cov'].sum().round(2)
+        self.metrics_names['ssi'] = 'Run Time Variability'
+
+
+@pytest.fixture(scope='module')
+def metrics(records, tmp_path_factory):
+    """Calculated metrics for each data option, with the in_efc flag of WMATA_Metric_Calculation."""
+    gtfs_records, avl_records, shapes_data = records
+    calculated = {}
+    for data_option, avl in [('GTFS-AVL', avl_records.copy()), ('GTFS', None)]:
+        params = make_params(tmp_path_factory.mktemp('calculation'), data_option=data_option)
+        calculation = Metric_Calculation(shapes_data, gtfs_records, avl, params)
+        calculation.gtfs_stop_metrics['in_efc'] = np.random.default_rng(4).integers(0, 2, len(calculation.gtfs_stop_metrics))
+        calculated[data_option] = calculation
+    return calculated
+
+
+@pytest.mark.parametrize('aggregation, legacy_aggregation', [(Metric_Aggregation, Legacy_Metric_Aggregation),
+                                                              (WMATA_Metric_Aggregation, Legacy_WMATA_Metric_Aggregation)])
+@pytest.mark.parametrize('data_option', ['GTFS-AVL', 'GTFS'])
+def test_registry_matches_per_metric_aggregation(metrics, tmp_path, aggregation, legacy_aggregation, data_option):
+    outputs = {}
+    for name, aggregation_class in [('registry', aggregation), ('legacy', legacy_aggregation)]:
+        params = make_params(tmp_path / name, data_option=data_option, frontend_config={'periodRanges': PERIOD_RANGES, 'units': {}})
+        outputs[name] = (params, aggregation_class(metrics[data_option], params))
+
+    (params, registry), (legacy_params, legacy) = outputs['registry'], outputs['legacy']
+    assert_same_outputs(params, legacy_params)
+    assert list(registry.metrics_names.items()) == list(legacy.metrics_names.items())
+    # the outputs are not empty, e.g. the observed and WMATA metrics are aggregated
+    columns = registry.segments.columns
+    assert ('observed_wait_time' in columns) == (data_option == 'GTFS-AVL')
+    if aggregation is WMATA_Metric_Aggregation:
+        assert 'in_efc' in columns and 'on_time_performance' not in columns
+        assert ('ssi' in registry.routes.columns) == (data_option == 'GTFS-AVL')
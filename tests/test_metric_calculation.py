@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from backend.metrics import Metric_Calculation
+
+from conftest import make_params, make_records
+
+# two patterns of R0 share the stop pairs (A, B) and (B, C), with a different shape distance in each pattern
+MULTI_PATTERN_ROUTES = {
+    'R0': [['A', 'B', 'C', 'D', 'E', 'F'], ['A', 'B', 'C', 'G', 'H']],
+    'R1': [['J', 'K', 'L', 'M', 'N']],
+}
+
+
+@pytest.fixture(scope='module')
+def multi_pattern_metrics(tmp_path_factory):
+    gtfs_records, avl_records, shapes_data = make_records(MULTI_PATTERN_ROUTES)
+    params = make_params(tmp_path_factory.mktemp('multi_pattern'))
+    return Metric_Calculation(shapes_data, gtfs_records, avl_records, params)
+
+
+def test_shared_stop_pairs_have_different_spacing(multi_pattern_metrics):
+    metrics = multi_pattern_metrics
+    spacing = metrics.gtfs_stop_metrics.groupby(['route_id', 'stop_pair'], observed=True)['stop_spacing'].nunique()
+    assert (spacing == 2).sum() == 2
+
+
+@pytest.mark.parametrize('table', ['avl_stop_metrics', 'avl_tpbp_metrics', 'avl_route_metrics'])
+def test_avl_metrics_index_is_unique(multi_pattern_metrics, table):
+    metrics = multi_pattern_metrics
+    assert getattr(metrics, table).index.is_unique
+    assert getattr(metrics, table)['observed_running_time_with_dwell'].notna().any()
+
+
+def test_avl_stop_records_are_not_repeated(multi_pattern_metrics):
+    metrics = multi_pattern_metrics
+    keys = metrics.avl_stop_metrics[['svc_date', 'trip_id', 'stop_sequence']]
+    assert not keys.duplicated().any()
+
+
+@pytest.mark.parametrize('avl_table, gtfs_table', [('avl_stop_metrics', 'gtfs_stop_metrics'),
+                                                   ('avl_tpbp_metrics', 'gtfs_tpbp_metrics'),
+                                                   ('avl_route_metrics', 'gtfs_route_metrics')])
+def test_avl_stop_spacing_is_of_trip_pattern(multi_pattern_metrics, avl_table, gtfs_table):
+    metrics = multi_pattern_metrics
+    avl = getattr(metrics, avl_table)
+    gtfs = getattr(metrics, gtfs_table)
+    on = ['trip_id', 'stop_pair'] if 'stop_pair' in gtfs.columns else ['trip_id']
+    expected = avl[on].astype(object).merge(gtfs[on + ['stop_spacing']].astype({c: object for c in on}), on=on, how='left')['stop_spacing']
+    np.testing.assert_array_equal(avl['stop_spacing'].to_numpy(dtype=float), expected.to_numpy(dtype=float))
+
+
+def test_stop_is_timepoint_if_timepoint_of_any_pattern(multi_pattern_metrics):
+    metrics = multi_pattern_metrics
+    expected = metrics.gtfs_stop_metrics.groupby(['route_id', 'stop_id'], observed=True)['tp_bp'].max()
+    avl = metrics.avl_stop_metrics
+    keys = pd.MultiIndex.from_arrays([avl['route_id'].astype(object), avl['stop_id'].astype(object)])
+    expected.index = pd.MultiIndex.from_arrays([expected.index.get_level_values(i).astype(object) for i in range(2)])
+    np.testing.assert_array_equal(avl['tp_bp'].to_numpy(), expected.reindex(keys).to_numpy())
+
+
+@pytest.mark.parametrize('stop_table, tpbp_table, trip_columns, column', [
+    ('gtfs_stop_metrics', 'gtfs_tpbp_metrics', ['trip_id'], 'stop_spacing'),
+    ('gtfs_stop_metrics', 'gtfs_tpbp_metrics', ['trip_id'], 'scheduled_running_time'),
+    ('avl_stop_metrics', 'avl_tpbp_metrics', ['svc_date', 'trip_id'], 'observed_running_time'),
+    ('avl_stop_metrics', 'avl_tpbp_metrics', ['svc_date', 'trip_id'], 'observed_running_time_with_dwell'),
+    ('avl_stop_metrics', 'avl_tpbp_metrics', ['svc_date', 'trip_id'], 'boardings')])
+def test_tpbp_sums_are_exact_decimal_sums(multi_pattern_metrics, stop_table, tpbp_table, trip_columns, column):
+    # the sums of values rounded to hundredths are exact, i.e. the pandas group sums rounded to hundredths
+    stops = getattr(multi_pattern_metrics, stop_table)
+    tpbp = getattr(multi_pattern_metrics, tpbp_table)
+    trips = [stops[key].astype(object) for key in trip_columns]
+    tpbp_group = stops.groupby(trips)['tp_bp'].cumsum()
+    expected = stops.groupby(trips + [tpbp_group])[column].transform('sum').round(2)
+    np.testing.assert_array_equal(tpbp[column].to_numpy(dtype=float), expected[tpbp.index].to_numpy(dtype=float))
+    hundredths = (stops[column].astype(float).fillna(0) * 100).round().astype('int64')
+    exact = hundredths.groupby(trips + [tpbp_group]).transform('sum') / 100
+    np.testing.assert_array_equal(tpbp[column].to_numpy(dtype=float), exact[tpbp.index].to_numpy(dtype=float))
+
+
+def test_avl_trip_missing_from_gtfs_gets_route_stop_spacing(tmp_path):
+    gtfs_records, avl_records, shapes_data = make_records(MULTI_PATTERN_ROUTES)
+    avl_records['trip_id'] = avl_records['trip_id'].replace({'R1-0-0_0': 'R1-unscheduled'})
+    metrics = Metric_Calculation(shapes_data, gtfs_records, avl_records, make_params(tmp_path))
+
+    for avl_table, gtfs_table, on in [('avl_stop_metrics', 'gtfs_stop_metrics', ['route_id', 'stop_pair']),
+                                      ('avl_tpbp_metrics', 'gtfs_tpbp_metrics', ['route_id', 'stop_pair']),
+                                      ('avl_route_metrics', 'gtfs_route_metrics', ['route_id'])]:
+        avl = getattr(metrics, avl_table)
+        unscheduled = avl[avl['trip_id'] == 'R1-unscheduled']
+        assert len(unscheduled) > 0
+        # R1 has a single pattern, so all of its trips have the same spacing of each stop pair
+        gtfs = getattr(metrics, gtfs_table)
+        spacing = gtfs.loc[gtfs['route_id'] == 'R1', on + ['stop_spacing']].drop_duplicates()
+        expected = unscheduled[on].merge(spacing, on=on, how='left')['stop_spacing']
+        assert expected.notna().any()
+        np.testing.assert_array_equal(unscheduled['stop_spacing'].to_numpy(dtype=float), expected.to_numpy(dtype=float))
+        assert unscheduled.loc[unscheduled['stop_spacing'].notna(), 'observed_speed_without_dwell'].notna().all()
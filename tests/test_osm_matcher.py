@@ -0,0 +1,76 @@
+import glob
+
+import numpy as np
+import pytest
+
+from backend.shapes.osm_matcher import HIGHWAY_TYPES, OSM_Matcher, OSM_Road_Graph, match_segments_with_osm
+
+LAT = 42.0
+LONS = [-71.0 + 0.001*i for i in range(6)]
+
+
+@pytest.fixture
+def osm_path(tmp_path):
+    """A primary road of five nodes from west to east, continued by a footway, and a one-way residential street back.
+    """
+    nodes = ''.join(f'<node id="{i + 1}" lat="{LAT}" lon="{lon}"/>' for i, lon in enumerate(LONS))
+    nodes += f'<node id="7" lat="{LAT + 0.001}" lon="{LONS[0]}"/><node id="8" lat="{LAT + 0.001}" lon="{LONS[4]}"/>'
+    ways = '<way id="1"><nd ref="1"/><nd ref="2"/><nd ref="3"/><nd ref="4"/><nd ref="5"/><tag k="highway" v="primary"/></way>' \
+           '<way id="2"><nd ref="5"/><nd ref="6"/><tag k="highway" v="footway"/></way>' \
+           '<way id="3"><nd ref="8"/><nd ref="7"/><tag k="highway" v="residential"/><tag k="oneway" v="yes"/></way>' \
+           '<way id="4"><nd ref="1"/><nd ref="9"/><tag k="highway" v="primary"/></way>'
+    path = tmp_path / 'extract.osm'
+    path.write_text(f'<?xml version="1.0"?><osm version="0.6">{nodes}{ways}</osm>')
+    return str(path)
+
+
+def test_graph_edges(osm_path):
+    graph = OSM_Road_Graph.from_osm_xml(osm_path)
+    # four two-way edges of the primary road and one edge of the one-way street, the footway and the way to a missing node are dropped
+    assert len(graph.edge_from) == 9
+    assert len(graph.node_coords) == 7
+    np.testing.assert_allclose(np.sort(graph.edge_length)[:8], 82.7, atol=0.5)
+
+
+def test_saved_graph_is_keyed_by_settings(osm_path, monkeypatch):
+    default_graph = OSM_Road_Graph.from_file(osm_path)
+    with_footways = OSM_Road_Graph.from_file(osm_path, HIGHWAY_TYPES + ['footway'])
+    assert len(with_footways.edge_from) == len(default_graph.edge_from) + 2
+    assert sorted(glob.glob(f'{osm_path}.graph-*.npz')) == sorted([f'{osm_path}.graph-{OSM_Road_Graph.settings_key()}.npz',
+                                f'{osm_path}.graph-{OSM_Road_Graph.settings_key(HIGHWAY_TYPES + ["footway"])}.npz'])
+
+    # both graphs are loaded from their saved files from now on
+    def parse(*args, **kwargs):
+        raise AssertionError('the OSM extract was parsed again')
+    monkeypatch.setattr(OSM_Road_Graph, 'from_osm_xml', parse)
+    assert len(OSM_Road_Graph.from_file(osm_path).edge_from) == len(default_graph.edge_from)
+    assert len(OSM_Road_Graph.from_file(osm_path, list(reversed(HIGHWAY_TYPES)) + ['footway']).edge_from) == len(with_footways.edge_from)
+
+
+def test_settings_key():
+    assert OSM_Road_Graph.settings_key(['primary', 'secondary']) == OSM_Road_Graph.settings_key(['secondary', 'primary', 'primary'])
+    assert OSM_Road_Graph.settings_key(['primary']) != OSM_Road_Graph.settings_key(['primary', 'secondary'])
+
+
+def test_pbf_is_not_supported(tmp_path):
+    path = tmp_path / 'extract.osm.pbf'
+    path.write_bytes(b'')
+    with pytest.raises(ValueError):
+        OSM_Road_Graph.from_file(str(path))
+
+
+def test_match_follows_road(osm_path):
+    matcher = OSM_Matcher(OSM_Road_Graph.from_file(osm_path))
+    coords = [(LAT + 0.0001, LONS[0] + 0.0002), (LAT - 0.0001, LONS[2]), (LAT + 0.0001, LONS[3] + 0.0005)]
+    path = np.asarray(matcher.match(coords))
+    np.testing.assert_allclose(path[:, 0], LAT, atol=1e-9)
+    assert path[0, 1] == pytest.approx(LONS[0] + 0.0002, abs=1e-5)
+    assert path[-1, 1] == pytest.approx(LONS[3] + 0.0005, abs=1e-5)
+    assert np.all(np.diff(path[:, 1]) >= 0)
+
+
+def test_match_segments(osm_path):
+    segments = {'east': [(LAT, LONS[0] + 0.0002), (LAT, LONS[4] - 0.0002)], 'far': [(LAT + 1, LONS[0]), (LAT + 1, LONS[1])]}
+    matched = match_segments_with_osm(segments, osm_path, {}, workers=1)
+    assert matched['far'] is None
+    assert len(matched['east']) >= 2
@@ -0,0 +1,101 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import LineString, Point
+
+from backend.shapes.geometry_utils import encode_polylines
+from backend.shapes.overlay import Segment_Overlay
+
+SAMPLE_COORD = (42.36, -71.06)
+
+
+@pytest.fixture
+def segments():
+    # short random walks of (lat, lon) coordinates around downtown Boston
+    rng = np.random.default_rng(5)
+    coords_list = []
+    for _ in range(12):
+        start = np.array(SAMPLE_COORD) + rng.uniform(-0.01, 0.01, 2)
+        steps = rng.normal(0, 0.0008, (int(rng.integers(2, 6)), 2))
+        coords_list.append([tuple(coord) for coord in np.vstack([start, start + np.cumsum(steps, axis=0)])])
+    return coords_list
+
+
+def make_shapes(coords_list):
+    return pd.DataFrame({'seg_index': [f'R0-{i}-{i + 1}' for i in range(len(coords_list))], 'geometry': encode_polylines(coords_list)},
+                        index=pd.RangeIndex(100, 100 + len(coords_list)))
+
+
+def make_signals(coords_list, overlay, n=150):
+    rng = np.random.default_rng(6)
+    lats, lons = np.concatenate(coords_list).T
+    points = gpd.GeoSeries([Point(lon, lat) for lat, lon in coords_list[0]], crs=Segment_Overlay.OSM_PLANE)
+    random_points = gpd.GeoSeries(gpd.points_from_xy(rng.uniform(lons.min() - 0.001, lons.max() + 0.001, n),
+                                                     rng.uniform(lats.min() - 0.001, lats.max() + 0.001, n)), crs=Segment_Overlay.OSM_PLANE)
+    signals = pd.concat([points, random_points], ignore_index=True)
+    # leave out signals at about buffer_meter from a segment, where the polygon approximation of the buffer of the previous
+    # implementation differs from the exact distance
+    distances = np.array([overlay.segments.distance(signal).to_numpy() * overlay.unit for signal in signals.to_crs(overlay.crs)])
+    return signals[~((np.abs(distances - overlay.buffer_meter) < 0.1).any(axis=1))].reset_index(drop=True)
+
+
+def brute_force_intersect(shapes, signals, crs, buffer_radius=10):
+    """Previous implementation of BaseShape.check_signal_intersection: spatial join of every buffered signal with every segment."""
+
+    signal_df = gpd.GeoDataFrame({'id': range(len(signals)), 'geometry': signals.to_crs(crs).buffer(buffer_radius)}, crs=crs)
+    shapes = shapes.copy()
+    shapes['state_linestring'] = gpd.GeoSeries([LineString(np.array(coords)[:, ::-1]) for coords in shapes['coords']],
+                                               crs=Segment_Overlay.OSM_PLANE, index=shapes.index).to_crs(crs)
+    bus_gdf = gpd.GeoDataFrame(shapes[['seg_index', 'state_linestring']], geometry='state_linestring')
+    intersect = gpd.sjoin(signal_df, bus_gdf, how='left')
+    intersect['intersect'] = ~intersect['seg_index'].isnull()
+    ig = intersect.groupby('index_right')['intersect'].max()
+    ig.index = ig.index.astype('int')
+    return shapes.merge(ig, left_index=True, right_index=True, how='left')['intersect'].fillna(False).astype(bool)
+
+
+def brute_force_overlay(overlay, signals):
+    """Count and nearest distance of the signals of every segment from the distances of all pairs."""
+
+    distances = np.array([overlay.segments.distance(signal).to_numpy() * overlay.unit for signal in signals.to_crs(overlay.crs)])
+    counts = (distances <= overlay.buffer_meter).sum(axis=0)
+    nearest = distances.min(axis=0)
+    nearest[nearest > overlay.search_radius_meter] = np.nan
+    return counts, nearest.round(1)
+
+
+def test_overlay_matches_brute_force(segments):
+    shapes = make_shapes(segments)
+    overlay = Segment_Overlay(shapes, SAMPLE_COORD)
+    signals = make_signals(segments, overlay)
+    result = overlay.overlay(signals, 'signals')
+
+    counts, nearest = brute_force_overlay(overlay, signals)
+    np.testing.assert_array_equal(result['signals_count'], counts)
+    np.testing.assert_array_equal(result['signals_distance'], nearest)
+    # the fixture has segments with and without signals around them
+    assert (counts == 0).any() and (counts > 1).any() and np.isnan(nearest).any()
+
+    expected = brute_force_intersect(shapes.assign(coords=segments), signals, overlay.crs)
+    pd.testing.assert_series_equal(result['signals_count'] > 0, expected, check_names=False)
+    assert expected.any() and not expected.all()
+
+
+def test_overlay_of_layers_in_other_crs(segments):
+    shapes = make_shapes(segments)
+    overlay = Segment_Overlay(shapes, SAMPLE_COORD, buffer_meter=30, search_radius_meter=200)
+    signals = make_signals(segments, overlay)
+    expected = overlay.overlay(signals, 'signals')
+    projected = overlay.overlay_layers({'signals': signals.to_crs('EPSG:3857'), 'stops': signals.iloc[:0]})
+    pd.testing.assert_frame_equal(projected[['signals_count', 'signals_distance']], expected, atol=0.1)
+    assert (projected['stops_count'] == 0).all() and projected['stops_distance'].isna().all()
+
+
+def test_segments_without_a_line_are_not_overlaid(segments):
+    coords_list = [segments[0], segments[0][:1], segments[1]]
+    overlay = Segment_Overlay(make_shapes(coords_list), SAMPLE_COORD)
+    result = overlay.overlay(gpd.GeoSeries([Point(lon, lat) for lat, lon in coords_list[1]], crs=Segment_Overlay.OSM_PLANE), 'signals')
+    assert result['signals_count'].tolist() == [1, 0, 0]
+    assert result.index.tolist() == [100, 101, 102]
+    assert np.isnan(result['signals_distance'].iloc[1])
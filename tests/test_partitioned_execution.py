@@ -0,0 +1,76 @@
+import os
+import types
+
+import pytest
+
+from backend.metrics import Metric_Aggregation, Metric_Calculation, Partitioned_Metric_Execution
+
+from conftest import assert_same_outputs, make_params
+
+# a shorter day keeps the number of 10-min intervals small
+PERIOD_RANGES = {'full': [5, 7], 'am': [6, 7]}
+
+
+@pytest.fixture(scope='module')
+def single_params(records, tmp_path_factory):
+    gtfs_records, avl_records, shapes_data = records
+    params = make_params(tmp_path_factory.mktemp('single'), frontend_config={'periodRanges': PERIOD_RANGES, 'units': {}})
+    Metric_Aggregation(Metric_Calculation(shapes_data, gtfs_records, avl_records.copy(), params), params)
+    return params
+
+
+@pytest.mark.parametrize('num_partitions, workers', [(1, 1), (3, 1), (3, 2)])
+def test_same_outputs_as_single_execution(records, single_params, tmp_path, num_partitions, workers):
+    gtfs_records, avl_records, shapes_data = records
+    params = make_params(tmp_path, frontend_config={'periodRanges': PERIOD_RANGES, 'units': {}})
+    avl = types.SimpleNamespace(records=avl_records.copy())
+    execution = Partitioned_Metric_Execution(shapes_data, gtfs_records, avl, params, num_partitions, workers=workers)
+
+    assert avl.records is None
+    assert not os.path.exists(params.output_paths['partitions'])
+    assert len(execution.partitions) == num_partitions
+    assert (len(execution.shared_stop_pairs) > 0) == (num_partitions > 1)
+    assert_same_outputs(params, single_params)
+
+
+def test_gtfs_only_outputs(records, tmp_path):
+    gtfs_records, _, shapes_data = records
+    periods = {'frontend_config': {'periodRanges': PERIOD_RANGES, 'units': {}}, 'data_option': 'GTFS'}
+    single = make_params(tmp_path / 'single', **periods)
+    Metric_Aggregation(Metric_Calculation(shapes_data, gtfs_records, None, single), single)
+    partitioned = make_params(tmp_path / 'partitioned', **periods)
+    Partitioned_Metric_Execution(shapes_data, gtfs_records, None, partitioned, 3)
+    assert_same_outputs(partitioned, single)
+
+
+def test_routes_are_balanced(records, tmp_path):
+    gtfs_records, avl_records, shapes_data = records
+    params = make_params(tmp_path)
+    execution = Partitioned_Metric_Execution.__new__(Partitioned_Metric_Execution)
+    partitions = execution.partition_routes(gtfs_records, avl_records, 2)
+    assert sorted(route for partition in partitions for route in partition) == sorted(gtfs_records['route_id'].unique())
+    weights = [avl_records['route_id'].isin(partition).sum() for partition in partitions]
+    assert max(weights) - min(weights) <= avl_records['route_id'].value_counts().max()
+
+
+@pytest.mark.parametrize('num_partitions, workers', [(0, 1), (2, 0)])
+def test_invalid_arguments(records, tmp_path, num_partitions, workers):
+    gtfs_records, _, shapes_data = records
+    with pytest.raises(ValueError):
+        Partitioned_Metric_Execution(shapes_data, gtfs_records, None, make_params(tmp_path, data_option='GTFS'), num_partitions, workers=workers)
+
+
+def test_10min_intervals_are_aggregated_once(records, tmp_path, monkeypatch):
+    gtfs_records, avl_records, shapes_data = records
+    calls = []
+    get_10min_interval_metrics = Metric_Aggregation.get_10min_interval_metrics
+    def counted(self, *args, **kwargs):
+        calls.append(len(self.avl_stop_metrics))
+        return get_10min_interval_metrics(self, *args, **kwargs)
+    monkeypatch.setattr(Metric_Aggregation, 'get_10min_interval_metrics', counted)
+
+    params = make_params(tmp_path, frontend_config={'periodRanges': PERIOD_RANGES, 'units': {}})
+    Partitioned_Metric_Execution(shapes_data, gtfs_records, types.SimpleNamespace(records=avl_records.copy()), params, 3)
+    # the AVL stop events of each interval are read from disk, the aggregation starts without any
+    assert calls == [0]
+    assert not os.path.exists(params.output_paths['partitions'])
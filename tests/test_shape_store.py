@@ -0,0 +1,101 @@
+import json
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from backend.helper_functions import read_shapes
+from backend.shapes.geometry_utils import decode_polylines, encode_polylines
+from backend.shapes.shape_store import intersects_bbox, read_shape_store, shape_store_path, write_shape_store
+
+
+@pytest.fixture
+def shapes():
+    """Segments of two routes, the second one further north, and a segment without a geometry.
+    """
+    coords = [[(42.0, -71.0), (42.0, -70.99), (42.001, -70.98)], [(42.001, -70.98), (42.002, -70.97)],
+              [(42.1, -71.0), (42.1, -70.99)], [(42.1, -70.99)]]
+    return pd.DataFrame({'pattern': ['R0-0-0', 'R0-0-0', 'R1-0-0', 'R1-0-0'], 'route_id': ['R0', 'R0', 'R1', 'R1'],
+                         'stop_pair': [('a', 'b'), ('b', 'c'), ('x', 'y'), ('y', 'y')], 'distance': [1.6, 0.8, np.nan, 0.0],
+                         'direction': [0, 0, 1, 1], 'is_matched': [True, False, True, True],
+                         'geometry': encode_polylines(coords)})
+
+
+def test_round_trip(shapes, tmp_path):
+    path = write_shape_store(shapes, str(tmp_path / 'shapes.gpkg'))
+    store_shapes = read_shape_store(path)
+    pd.testing.assert_frame_equal(store_shapes, shapes[store_shapes.columns])
+    assert sorted(store_shapes.columns) == sorted(shapes.columns)
+    assert not (tmp_path / 'shapes.gpkg.tmp').exists()
+
+    decoded = read_shape_store(path, decode=True)['coordinates']
+    for coords, expected in zip(decoded, decode_polylines(shapes['geometry'])):
+        np.testing.assert_array_equal(coords, expected)
+
+
+def test_filters(shapes, tmp_path):
+    path = write_shape_store(shapes, str(tmp_path / 'shapes.gpkg'))
+    assert read_shape_store(path, route_ids=['R1'])['stop_pair'].tolist() == [('x', 'y'), ('y', 'y')]
+    assert read_shape_store(path, patterns=['R0-0-0'], route_ids=['R0', 'R1'])['stop_pair'].tolist() == [('a', 'b'), ('b', 'c')]
+    assert read_shape_store(path, route_ids=[]).empty
+
+    # the R-tree finds the same segments as intersects_bbox, segments without a geometry are in no bounding box
+    for bbox in [(-71.1, 41.9, -70.9, 42.2), (-70.975, 41.9, -70.9, 42.05), (-71.0, 42.05, -70.995, 42.1), (-70, 40, -69, 41)]:
+        expected = shapes['stop_pair'][intersects_bbox(shapes['geometry'], bbox)].tolist()
+        assert read_shape_store(path, bbox=bbox)['stop_pair'].tolist() == expected, bbox
+    assert read_shape_store(path, bbox=(-71.1, 41.9, -70.9, 42.2), route_ids=['R0'])['stop_pair'].tolist() == [('a', 'b'), ('b', 'c')]
+
+
+def test_resolutions(shapes, tmp_path):
+    low = encode_polylines([coords[[0, -1]] for coords in decode_polylines(shapes['geometry'])])
+    path = write_shape_store(shapes, str(tmp_path / 'shapes.gpkg'), resolutions={'low': low})
+    assert read_shape_store(path, resolution='low')['geometry'].tolist() == low
+    assert read_shape_store(path, resolution='full')['geometry'].tolist() == shapes['geometry'].tolist()
+    assert 'polyline_low' not in read_shape_store(path).columns
+    with pytest.raises(ValueError):
+        read_shape_store(path, resolution='medium')
+
+
+def test_geopackage_metadata(shapes, tmp_path):
+    path = write_shape_store(shapes, str(tmp_path / 'shapes.gpkg'))
+    connection = sqlite3.connect(path)
+    try:
+        assert connection.execute('PRAGMA application_id').fetchone()[0] == 0x47504B47
+        extent = connection.execute("SELECT min_x, min_y, max_x, max_y FROM gpkg_contents WHERE table_name = 'shapes'").fetchone()
+        np.testing.assert_allclose(extent, [-71.0, 42.0, -70.97, 42.1])
+        geometries = [row[0] for row in connection.execute('SELECT geom FROM shapes ORDER BY fid')]
+    finally:
+        connection.close()
+
+    assert geometries[-1] is None
+    # header of 8 bytes and an envelope of 4 doubles, followed by the WKB of a LineString
+    blob = geometries[0]
+    assert blob[:2] == b'GP'
+    assert np.frombuffer(blob[8:40], dtype='<f8').tolist() == [-71.0, -70.98, 42.0, 42.001]
+    assert np.frombuffer(blob[41:49], dtype='<u4').tolist() == [2, 3]
+    np.testing.assert_array_equal(np.frombuffer(blob[49:], dtype='<f8').reshape(-1, 2), decode_polylines(shapes['geometry'][:1], geojson=True)[0])
+
+
+def test_geopackage_is_read_by_gdal(shapes, tmp_path):
+    fiona = pytest.importorskip('fiona')
+    path = write_shape_store(shapes, str(tmp_path / 'shapes.gpkg'))
+    with fiona.open(path) as features:
+        assert '4326' in features.crs_wkt
+        features = list(features)
+    assert [feature['properties']['first_stop_id'] for feature in features] == ['a', 'b', 'x', 'y']
+    np.testing.assert_allclose(features[1]['geometry']['coordinates'], [(-70.98, 42.001), (-70.97, 42.002)])
+
+
+def test_read_shapes_uses_the_store(shapes, tmp_path, monkeypatch):
+    json_path = tmp_path / 'shapes.json'
+    json_shapes = shapes.assign(stop_pair=shapes['stop_pair'].apply(list))
+    json_path.write_text(json.dumps(json_shapes.to_dict(orient='records')))
+    from_json = read_shapes(str(json_path), route_ids=['R0'])
+
+    write_shape_store(shapes, shape_store_path(str(json_path)))
+    def load(*args, **kwargs):
+        raise AssertionError('the shapes JSON file was read')
+    monkeypatch.setattr(json, 'load', load)
+    from_store = read_shapes(str(json_path), route_ids=['R0'])
+    pd.testing.assert_frame_equal(from_store, from_json[from_store.columns])
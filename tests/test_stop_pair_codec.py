@@ -0,0 +1,65 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from backend.metrics.stop_pair_codec import SECOND_STOP_BITS, Stop_Pair_Codec
+
+
+def test_round_trip():
+    codec = Stop_Pair_Codec(['b', 'a', 'c'])
+    codes = codec.encode(['a', 'c', 'b'], ['b', 'a', 'c'])
+    assert codes.dtype == np.int64
+    first_stops, second_stops = codec.decode(codes)
+    assert first_stops.tolist() == ['a', 'c', 'b']
+    assert second_stops.tolist() == ['b', 'a', 'c']
+    assert codec.to_tuples(codes) == [('a', 'b'), ('c', 'a'), ('b', 'c')]
+
+
+def test_codes_sort_as_tuples():
+    codec = Stop_Pair_Codec(['10', '2', '1'])
+    pairs = [('2', '1'), ('1', '10'), ('10', '2'), ('1', '2'), ('2', '10')]
+    codes = codec.encode_pairs(pairs)
+    assert [pairs[i] for i in np.argsort(codes)] == sorted(pairs)
+
+
+def test_new_stops_are_added_after_existing_ones():
+    codec = Stop_Pair_Codec(['b', 'c'])
+    codes = codec.encode(['b'], ['c'])
+    codec.encode(['a'], ['b'])
+    assert codec.stop_ids.tolist() == ['b', 'c', 'a']
+    # codes of known stop pairs don't change
+    np.testing.assert_array_equal(codec.encode(['b'], ['c']), codes)
+
+
+def test_unknown_stops_are_not_added():
+    codec = Stop_Pair_Codec(['a', 'b'])
+    codes = codec.encode(['a', 'x', 'a'], ['b', 'a', None], add=False)
+    assert codes.tolist() == [1, -1, -1]
+    assert codec.stop_ids.tolist() == ['a', 'b']
+
+
+def test_large_codes():
+    stop_ids = [f'S{i:06d}' for i in range(70000)]
+    codec = Stop_Pair_Codec(stop_ids)
+    codes = codec.encode([stop_ids[-1]], [stop_ids[-2]])
+    assert codes[0] == (69999 << SECOND_STOP_BITS) + 69998
+    assert codec.to_tuples(codes) == [(stop_ids[-1], stop_ids[-2])]
+
+
+def test_mixed_stop_id_types():
+    # IDs that can't be sorted together keep their order of appearance
+    codec = Stop_Pair_Codec([3, 'a', 1])
+    assert codec.to_tuples(codec.encode([3, 'a'], ['a', 1])) == [(3, 'a'), ('a', 1)]
+
+
+def test_empty_pairs():
+    codec = Stop_Pair_Codec()
+    assert codec.encode_pairs([]).shape == (0,)
+    assert codec.to_tuples([]) == []
+
+
+def test_pickled_codec_decodes_the_same():
+    codec = Stop_Pair_Codec(['a', 'b', 'c'])
+    codes = codec.encode(['c', 'a'], ['a', 'b'])
+    assert pickle.loads(pickle.dumps(codec)).to_tuples(codes) == codec.to_tuples(codes)
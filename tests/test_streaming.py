@@ -0,0 +1,131 @@
+import datetime
+import json
+import types
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from backend.data_class.gps_pings import GPS_Ping_Inference
+from backend.metrics import Metric_Calculation
+from backend.streaming import File_Tail_Source, Realtime_Metric_Aggregation, Realtime_Metric_Calculation, Stop_Event_Stream
+
+from conftest import assert_same_outputs, make_params, make_pings, make_records, random_routes
+
+SERVICE_DATE = '2023-05-01'
+
+
+@pytest.fixture(scope='module')
+def day_records():
+    """GTFS records, AVL records of a single service date without skipped stops, and shapes.
+    """
+    return make_records(random_routes(), service_dates=[SERVICE_DATE], skip_rate=0)
+
+
+def stream_params(**backend_config):
+    return types.SimpleNamespace(backend_config=backend_config)
+
+
+def feed(calculation, avl_records):
+    for record in avl_records.itertuples():
+        calculation.add_stop_event(record.trip_id, record.stop_id, record.stop_sequence, record.stop_time, record.stop_time + record.dwell_time)
+
+
+def test_file_tail_source_replays_messages(tmp_path):
+    path = tmp_path / 'stream.jsonl'
+    path.write_text('{"trip_id": "1"}\n\n{"trip_id": \n[1, 2]\n{"trip_id": "2"}')
+    messages = list(File_Tail_Source(str(path), follow=False).messages())
+    # blank, malformed and non-object lines are skipped, and the last line is read without a newline
+    assert messages == [{'trip_id': '1'}, {'trip_id': '2'}]
+    with pytest.raises(FileNotFoundError):
+        list(File_Tail_Source(str(tmp_path / 'missing.jsonl'), follow=False).messages())
+
+
+def test_trip_updates(day_records):
+    gtfs_records, _, _ = day_records
+    trip_id = gtfs_records.loc[0, 'trip_id']
+    first_stop, second_stop = gtfs_records.loc[0, 'stop_id'], gtfs_records.loc[1, 'stop_id']
+    stream = Stop_Event_Stream(stream_params(), types.SimpleNamespace(records=gtfs_records, patterns_dict={}), datetime.date(2023, 5, 1))
+    midnight = pd.Timestamp(SERVICE_DATE).timestamp()
+
+    message = {'type': 'trip_update', 'trip_id': trip_id, 'timestamp': midnight + 18100, 'stop_time_updates': [
+        {'stop_id': first_stop, 'arrival': midnight + 18000, 'departure': midnight + 18030},
+        # a prediction
+        {'stop_id': second_stop, 'stop_sequence': 2, 'arrival': midnight + 18200}]}
+    assert stream.process(message) == [(trip_id, first_stop, 1, 18000, 18030)]
+    assert stream.process(dict(message, trip_id='no_such_trip')) == []
+    assert stream.process(dict(message, type='alert')) == []
+
+    # date-time strings are in local time, epoch seconds are converted to it with the timezone
+    assert stream.convert_timestamp('2023-05-01 05:00:00') == 18000
+    local_stream = Stop_Event_Stream(stream_params(streaming={'timezone': 'America/New_York'}),
+                                     types.SimpleNamespace(records=gtfs_records, patterns_dict={}), datetime.date(2023, 5, 1))
+    assert local_stream.convert_timestamp(midnight + 18000 + 4 * 3600) == 18000
+
+
+def test_vehicle_positions_match_gps_ping_inference():
+    pings, bus_gtfs = make_pings()
+    service_date = pd.Timestamp(pings['timestamp'].iloc[0], unit='s').normalize()
+    stream = Stop_Event_Stream(stream_params(), bus_gtfs, service_date.date())
+    stop_events = []
+    for ping in pings.itertuples():
+        stop_events += stream.process({'type': 'vehicle_position', 'trip_id': ping.trip_id, 'timestamp': ping.timestamp,
+                                       'lat': ping.lat, 'lon': ping.lon})
+    stop_events += stream.expire(force=True)
+
+    inferred = GPS_Ping_Inference(types.SimpleNamespace(backend_config={'gps_pings': {'workers': 1}}), bus_gtfs).infer_stop_events(pings)
+    arrival_times = (inferred['stop_time'] - service_date).dt.total_seconds()
+    assert [stop_event[:3] for stop_event in stop_events] == list(zip(inferred['trip_id'], inferred['stop_id'], inferred['stop_sequence']))
+    np.testing.assert_allclose([stop_event[3] for stop_event in stop_events], arrival_times, atol=0.5)
+    np.testing.assert_allclose([stop_event[4] - stop_event[3] for stop_event in stop_events], inferred['dwell_time'], atol=1e-9)
+
+
+def test_realtime_metrics_match_batch_metrics(day_records, tmp_path):
+    gtfs_records, avl_records, shapes = day_records
+    params = make_params(tmp_path)
+    metrics = Metric_Calculation(shapes, gtfs_records, avl_records.copy(), params)
+    calculation = Realtime_Metric_Calculation(gtfs_records, params)
+    # trip by trip, so that most stop events arrive after later arrivals of other trips, and with duplicates that are ignored
+    feed(calculation, pd.concat([avl_records, avl_records.iloc[::7]]).sort_index(kind='stable'))
+
+    day_start, day_end = params.frontend_config['periodRanges']['full']
+    for level, batch_metrics, keys in [('stop', metrics.avl_stop_metrics, ['trip_id', 'stop_pair']),
+                                       ('tpbp', metrics.avl_tpbp_metrics, ['trip_id', 'stop_pair']),
+                                       ('route', metrics.avl_route_metrics, ['trip_id'])]:
+        realtime_metrics = getattr(calculation, f'get_{level}_metrics')()
+        time_column = realtime_metrics.columns[3]
+        if 'stop_pair' in keys:
+            batch_metrics = batch_metrics.assign(stop_pair=metrics.stop_pair_codec.to_tuples(batch_metrics['stop_pair']))
+        batch_metrics = batch_metrics[(batch_metrics[time_column] >= day_start * 3600) & (batch_metrics[time_column] < day_end * 3600)]
+        # the last timepoint pair of each trip is not a batch timepoint-level record
+        merged = batch_metrics.merge(realtime_metrics, on=keys, how='left' if level == 'tpbp' else 'outer', validate='one_to_one')
+        assert len(merged) == len(batch_metrics), level
+        for column in realtime_metrics.columns[3:]:
+            if column in batch_metrics:
+                # running times are summed in a different order
+                np.testing.assert_allclose(merged[f'{column}_y'], merged[f'{column}_x'].astype(float), rtol=1e-12, err_msg=f'{level} {column}')
+
+
+def test_realtime_aggregation_updates_match_one_update(tmp_path):
+    gtfs_records, avl_records, shapes = make_records(random_routes(2), trips_per_pattern=4, service_dates=[SERVICE_DATE])
+    avl_records = avl_records.sort_values('stop_time', kind='stable')
+    # a short day of few 10-min intervals to aggregate
+    frontend_config = {'periodRanges': {'full': [5, 8], 'am': [6, 7]}, 'units': {}}
+
+    params = make_params(tmp_path / 'incremental', frontend_config=frontend_config)
+    calculation = Realtime_Metric_Calculation(gtfs_records, params)
+    aggregation = Realtime_Metric_Aggregation(shapes, gtfs_records, calculation, params)
+    for start in range(0, len(avl_records), 20):
+        feed(calculation, avl_records.iloc[start:start + 20])
+        aggregation.update()
+    assert calculation.pop_updated_intervals() == set()
+    aggregation.update_time_periods()
+
+    other_params = make_params(tmp_path / 'once', frontend_config=frontend_config)
+    other_calculation = Realtime_Metric_Calculation(gtfs_records, other_params)
+    other_aggregation = Realtime_Metric_Aggregation(shapes, gtfs_records, other_calculation, other_params)
+    feed(other_calculation, avl_records)
+    other_aggregation.update()
+    other_aggregation.update_time_periods()
+
+    assert_same_outputs(params, other_params)
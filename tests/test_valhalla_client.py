@@ -0,0 +1,106 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from backend.shapes.base_shape import Valhalla_Request
+from backend.shapes.mock_valhalla import Mock_Valhalla_Server
+from backend.shapes.valhalla_client import Valhalla_Client
+
+
+class Counting_Server(Mock_Valhalla_Server):
+    """Mock Valhalla server that records the largest number of requests processed at the same time."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def trace_route(self, body):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return super().trace_route(body)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def segment_request(i):
+    shape = [{'lat': 42.0, 'lon': -71.0 + 0.001*i, 'type': 'break'}, {'lat': 42.0, 'lon': -71.0 + 0.001*(i + 1), 'type': 'break'}]
+    return Valhalla_Request(f'segment-{i}', shape)
+
+
+def trace_routes(client, requests):
+    async def run():
+        return await asyncio.gather(*[client.trace_route(request) for request in requests])
+    try:
+        return asyncio.run(run())
+    finally:
+        client.close()
+
+
+def test_requests_in_flight_are_limited_by_concurrency():
+    with Counting_Server(latency=0.05, workers=16) as server:
+        client = Valhalla_Client(server.url, concurrency=3, retry_delay=0)
+        results = trace_routes(client, [segment_request(i) for i in range(12)])
+    assert server.max_in_flight == 3
+    assert all(f'segment-{i}' in matched and not skipped for i, (matched, skipped) in enumerate(results))
+    np.testing.assert_allclose([matched[f'segment-{i}'][0]['distance'] for i, (matched, _) in enumerate(results)], 0.083, atol=0.001)
+
+
+def test_dropped_requests_are_retried():
+    with Mock_Valhalla_Server(latency=0, error_rate=0.5, seed=3) as server:
+        client = Valhalla_Client(server.url, concurrency=4, retry_delay=0)
+        results = trace_routes(client, [segment_request(i) for i in range(20)])
+    assert server.stats['dropped'] > 0
+    assert client.retry_count == server.stats['dropped']
+    assert all(not skipped for _, skipped in results)
+    stats = client.stats()
+    assert stats['requests'] == 20 and stats['retries'] == server.stats['dropped'] and stats['skipped'] == 0
+    assert len(client.latencies) == 20
+
+
+def test_timed_out_requests_are_retried_up_to_max_retry():
+    with Mock_Valhalla_Server(latency=0.5) as server:
+        client = Valhalla_Client(server.url, timeout=0.05, max_retry=2, retry_delay=0)
+        with pytest.raises(ConnectionError):
+            trace_routes(client, [segment_request(0)])
+    assert client.stats()['retries'] == 2
+    assert client.stats()['requests'] == 0
+
+
+def test_unreachable_service_raises_connection_error():
+    # a closed port of the local host refuses connections right away
+    server = Mock_Valhalla_Server()
+    url = server.url
+    server.stop()
+    client = Valhalla_Client(url, max_retry=3, retry_delay=0)
+    with pytest.raises(ConnectionError):
+        trace_routes(client, [segment_request(0)])
+    assert client.retry_count == 3
+
+
+def test_stats_count_skipped_responses():
+    with Mock_Valhalla_Server(latency=0, no_match_rate=1) as server:
+        client = Valhalla_Client(server.url, retry_delay=0)
+        results = trace_routes(client, [segment_request(i) for i in range(5)])
+    assert all(not matched and skipped[f'segment-{i}']['result']['error_code'] == 171 for i, (matched, skipped) in enumerate(results))
+    stats = client.stats()
+    assert stats['requests'] == 5 and stats['retries'] == 0 and stats['skipped'] == 5
+    assert 0 <= stats['p50_ms'] <= stats['p95_ms'] <= stats['p99_ms']
+
+
+def test_stats_without_requests():
+    client = Valhalla_Client()
+    stats = client.stats()
+    client.close()
+    assert stats['requests'] == 0 and np.isnan(stats['p50_ms'])
+
+
+def test_from_config():
+    client = Valhalla_Client.from_config({'valhalla': {'url': 'http://valhalla:8002/', 'concurrency': 2, 'max_retry': 4}})
+    client.close()
+    assert client.trace_route_url == 'http://valhalla:8002/trace_route'
+    assert (client.concurrency, client.max_retry, client.timeout) == (2, 4, 100)